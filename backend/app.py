@@ -1,13 +1,38 @@
 
 import logging
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+import hmac
+from typing import Optional
+
+from fastapi import FastAPI, Depends, Header, HTTPException, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
 
 # --- Basic Setup ---
 logger = logging.getLogger("uvicorn")
-logger.setLevel(logging.DEBUG)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # After the server set up its loggers, in each worker: writes go through a queue from here on
+    logs.start()
+    # Every API process runs a few job workers (MEALPLANNER_JOB_WORKERS, 0 disables them) per shard
+    job_workers = [JobWorkerPool(shard_sessionmaker(shard)) for shard in range(shard_count())]
+    for pool in job_workers:
+        pool.start()
+    # One LISTEN connection per process and shard feeds the /events streams
+    event_hub.start(*(shard_engine(shard) for shard in range(shard_count())))
+    yield
+    event_hub.stop()
+    for pool in job_workers:
+        pool.stop()
+    logs.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -15,15 +40,39 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Read-your-writes token (database.ReadYourWritesMiddleware), profile ids (profiling.py)
+    expose_headers=["X-MealPlanner-LSN", "X-MealPlanner-Profile-Id"],
 )
 
+import metrics
+from metrics import MetricsMiddleware, render_metrics
+app.add_middleware(MetricsMiddleware)
+
+from database import ReadYourWritesMiddleware
+app.add_middleware(ReadYourWritesMiddleware)
 
-from schemas import HealthCheckSchema
+from profiling import ProfilingMiddleware
+app.add_middleware(ProfilingMiddleware)
+
+
+from schemas import HealthCheckSchema, ReadinessSchema
+from database import get_db, POOL_MAX_OVERFLOW, shard_count, shard_engine, shard_sessionmaker
+from events import hub as event_hub
+from jobs import JobWorkerPool
+import logs
+# Registers the global catalog replication with the job workers' maintenance
+import shards
 from routers.recipe_router import rec_router
 from routers.ingredient_router import ing_router
 from routers.plan_router import pl_router
 from routers.utilities_router import util_router
 from routers.auth_router import auth_router
+from routers.jobs_router import jobs_router
+from routers.events_router import ev_router
+from routers.analytics_router import analytics_router
+from routers.sync_router import sync_router
+from routers.notifications_router import notifications_router
+from routers.admin_router import admin_router
 
 
 
@@ -32,11 +81,54 @@ app.include_router(ing_router)
 app.include_router(pl_router)
 app.include_router(util_router)
 app.include_router(auth_router)
+app.include_router(jobs_router)
+app.include_router(ev_router)
+app.include_router(analytics_router)
+app.include_router(sync_router)
+app.include_router(notifications_router)
+app.include_router(admin_router)
 
 
 # --- API Endpoints ---
 
+# Liveness: the process is up and serving. Deliberately touches nothing else,
+# so a database outage does not get healthy workers restarted.
 @app.get("/health", tags=["healthcheck"], response_model=HealthCheckSchema)
+@app.get("/health/live", tags=["healthcheck"], response_model=HealthCheckSchema)
 def get_health() -> HealthCheckSchema:
     return HealthCheckSchema(status="OK")
 
+
+# Readiness: this worker can reach Postgres and still has pool capacity.
+# Load balancers and the compose healthcheck should route on this one.
+@app.get("/health/ready", tags=["healthcheck"], response_model=ReadinessSchema,
+         responses={503: {"model": ReadinessSchema}})
+def get_readiness(response: Response, db: Session = Depends(get_db)) -> ReadinessSchema:
+    readiness = ReadinessSchema()
+    pool = db.get_bind().pool
+    if hasattr(pool, "checkedout"):
+        readiness.pool = {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "overflow": max(pool.overflow(), 0),
+        }
+        # An exhausted pool would make the probe itself wait for pool_timeout
+        if pool.checkedout() >= pool.size() + POOL_MAX_OVERFLOW:
+            readiness.status = readiness.database = "POOL_EXHAUSTED"
+            response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+            return readiness
+    try:
+        db.execute(text("SELECT 1"))
+    except SQLAlchemyError as e:
+        logger.warning("Readiness check failed: %s", e)
+        readiness.status = readiness.database = "UNAVAILABLE"
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return readiness
+
+
+@app.get("/metrics", tags=["healthcheck"], response_class=PlainTextResponse)
+def get_metrics(authorization: Optional[str] = Header(None)) -> PlainTextResponse:
+    """Per-route request, latency and SQL metrics in the Prometheus text format."""
+    if metrics.METRICS_TOKEN and not hmac.compare_digest(authorization or "", f"Bearer {metrics.METRICS_TOKEN}"):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Metrics need the scrape token")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
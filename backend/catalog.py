@@ -0,0 +1,128 @@
+# catalog.py
+"""
+Process-wide cache of the global catalog: the recipes and ingredients that
+belong to no user (`user_id` NULL).
+
+They are the same for every user, so each worker process reads them once and
+merges them with the requesting user's own rows, which are still read from
+the database. Queries that need both read them as two index-friendly branches
+(`owned_or_global`) instead of `user_id = :me OR user_id IS NULL`.
+
+The cache is invalidated by version. A load remembers the oldest transaction
+still running (the snapshot xmin) and the row counts. At most every
+MEALPLANNER_CATALOG_CHECK_SECONDS the next request checks, with one small
+indexed query, whether a global row has been written by a transaction at or
+after that xmin (see the row versions in models.py) or whether the counts
+changed (a delete or truncate). The catalog is reloaded only if so. Global
+rows are written by setup_db, generate_data and by hand, never by the API,
+so the check is what notices them, in every worker process.
+
+With several shards (shards.py) each holds a copy of the catalog, versioned by
+its own transactions, so each gets its own cache entry.
+
+Cached entries are read-only schemas shared between threads: copy one before
+changing it.
+"""
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Query, Session
+
+from metrics import registry
+from models import Ingredient, Recipe
+from schemas import IngredientSchema, RecipeSchema
+
+# 0 checks on every request
+CATALOG_CHECK_SECONDS = float(os.environ.get("MEALPLANNER_CATALOG_CHECK_SECONDS", "5"))
+
+CATALOG_LOADS = registry.counter(
+    "mealplanner_catalog_loads_total", "Loads of the global catalog cache by reason (empty, changed).", ["reason"])
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    # Snapshot xmin when loaded: later writes have a row_version at or above it
+    version: int
+    recipes: Tuple[RecipeSchema, ...]
+    ingredients: Tuple[IngredientSchema, ...]
+    recipes_by_id: Dict[int, RecipeSchema]
+
+
+class GlobalCatalog:
+    def __init__(self, check_seconds: float = CATALOG_CHECK_SECONDS) -> None:
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        # Per database (engine) the catalog is read from
+        self._snapshots: Dict[Any, CatalogSnapshot] = {}
+        self._checked_at: Dict[Any, float] = {}
+
+    def _fresh(self, bind) -> Optional[CatalogSnapshot]:
+        snapshot = self._snapshots.get(bind)
+        if snapshot is not None and time.monotonic() - self._checked_at.get(bind, 0.0) < self.check_seconds:
+            return snapshot
+        return None
+
+    def get(self, db: Session) -> CatalogSnapshot:
+        """The global catalog, reloaded through `db` first if it has changed since it was loaded."""
+        bind = db.get_bind()
+        snapshot = self._fresh(bind)
+        if snapshot is not None:
+            return snapshot
+        # One request checks (and reloads); the others wait for it rather than querying too
+        with self._lock:
+            snapshot = self._fresh(bind)
+            if snapshot is not None:
+                return snapshot
+            snapshot = self._snapshots.get(bind)
+            if snapshot is None:
+                reason = "empty"
+            elif self._changed(db, snapshot):
+                reason = "changed"
+            else:
+                reason = None
+            if reason:
+                snapshot = self._snapshots[bind] = self._load(db)
+                registry.inc(CATALOG_LOADS, [reason])
+            self._checked_at[bind] = time.monotonic()
+            return snapshot
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._snapshots.clear()
+
+    @staticmethod
+    def _changed(db: Session, snapshot: CatalogSnapshot) -> bool:
+        row = db.execute(text("""
+            SELECT (SELECT count(*) FROM recipes WHERE user_id IS NULL) AS recipes,
+                   (SELECT count(*) FROM ingredients WHERE user_id IS NULL) AS ingredients,
+                   EXISTS (SELECT 1 FROM recipes WHERE user_id IS NULL AND row_version >= :version)
+                   OR EXISTS (SELECT 1 FROM ingredients WHERE user_id IS NULL AND row_version >= :version) AS written
+        """), {"version": snapshot.version}).one()
+        return row.written or (row.recipes, row.ingredients) != (len(snapshot.recipes), len(snapshot.ingredients))
+
+    @staticmethod
+    def _load(db: Session) -> CatalogSnapshot:
+        # Taken before reading: a write committing during the load has a version at or above it
+        version = db.execute(text("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")).scalar()
+        recipes = tuple(
+            RecipeSchema.model_validate(r)
+            for r in db.query(Recipe).filter(Recipe.user_id == None).order_by(Recipe.name)
+        )
+        ingredients = tuple(
+            IngredientSchema.model_validate(i)
+            for i in db.query(Ingredient).filter(Ingredient.user_id == None).order_by(Ingredient.name)
+        )
+        return CatalogSnapshot(version=version, recipes=recipes, ingredients=ingredients,
+                               recipes_by_id={r.id: r for r in recipes})
+
+
+global_catalog = GlobalCatalog()
+
+
+def owned_or_global(query: Query, user_column, user_id: int) -> Query:
+    """`query` restricted to the user's rows and the global ones, as a UNION ALL of two indexed branches."""
+    return query.filter(user_column == user_id).union_all(query.filter(user_column == None))
@@ -0,0 +1,154 @@
+# coalesce.py
+"""
+Single-flight coalescing for expensive idempotent GETs.
+
+Concurrent identical requests (same user, route, parameters, data version
+and database read from) share one in-flight computation: the first caller (the leader) runs it, the
+others wait for its result or its exception. Nothing is cached once the
+computation finishes, so a request that arrives afterwards computes afresh.
+
+Each user has an in-process data version that write endpoints bump when they
+commit. A request that starts after a write therefore never joins a
+computation that started before it. Versions are per process; writes served
+by other workers reach them through the change events (see events.py).
+
+Requests reading from a replica and from the primary never share: a read
+pinned to the primary after the client's own write (database.read_session)
+must not get the result of a replica that has not replayed it.
+
+Results are shared between requests and threads, so computations must return
+plain data (schemas, dicts, bytes), never ORM objects bound to a session.
+"""
+import os
+import threading
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from metrics import registry
+
+COALESCE_TIMEOUT_SECONDS = float(os.environ.get("MEALPLANNER_COALESCE_TIMEOUT_SECONDS", "30"))
+
+COALESCE_REQUESTS = registry.counter(
+    "mealplanner_coalesced_requests_total",
+    "Requests to coalesced routes by outcome (leader, shared, error, timeout).",
+    ["route", "outcome"])
+
+
+class CoalesceTimeout(Exception):
+    """Raised to a follower whose leader did not finish within the timeout."""
+    pass
+
+
+# --- Per-user data versions ---
+
+_versions: Dict[int, int] = defaultdict(int)
+_versions_lock = threading.Lock()
+
+
+def data_version(user_id: int) -> int:
+    with _versions_lock:
+        return _versions[user_id]
+
+
+def bump_version(user_id: int) -> None:
+    with _versions_lock:
+        _versions[user_id] += 1
+
+
+def bump_on_commit(session: Session, user_id: int) -> None:
+    """Bumps the user's data version once `session` commits (not if it rolls back)."""
+    session.info.setdefault("coalesce_bump", set()).add(user_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_after_commit(session: Session) -> None:
+    for user_id in session.info.pop("coalesce_bump", ()):
+        bump_version(user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(session: Session) -> None:
+    session.info.pop("coalesce_bump", None)
+
+
+# --- Single flight ---
+
+@dataclass
+class _Call:
+    done: threading.Event = field(default_factory=threading.Event)
+    result: Any = None
+    error: Optional[BaseException] = None
+    waiters: int = 0
+
+
+class SingleFlight:
+    def __init__(self, timeout: float = COALESCE_TIMEOUT_SECONDS) -> None:
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+    def waiting(self, key: Hashable) -> int:
+        """Callers currently waiting on the in-flight call for `key`."""
+        with self._lock:
+            call = self._calls.get(key)
+            return call.waiters if call is not None else 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any], label: str = "") -> Tuple[Any, bool]:
+        """Runs `fn` or joins the identical call in flight; returns (result, shared)."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            if not call.done.wait(self.timeout):
+                registry.inc(COALESCE_REQUESTS, [label, "timeout"])
+                raise CoalesceTimeout(f"Identical request still running after {self.timeout:.0f}s")
+            registry.inc(COALESCE_REQUESTS, [label, "shared"])
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            registry.inc(COALESCE_REQUESTS, [label, "error"])
+            raise
+        else:
+            registry.inc(COALESCE_REQUESTS, [label, "leader"])
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+flights = SingleFlight()
+
+
+def coalesced(db: Session, route: str, user_id: int, params: Tuple, fn: Callable[[], Any]) -> Any:
+    """
+    Result of `fn` for this (user, route, params), shared with identical
+    requests in flight that read from the same database as `db`.
+    """
+    key = (route, user_id, params, data_version(user_id), db.info.get("read_target", "primary"))
+    try:
+        result, _ = flights.do(key, fn, label=route)
+    except CoalesceTimeout as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "5"}
+        ) from e
+    return result
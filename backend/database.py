@@ -1,23 +1,89 @@
 # database.py
+import itertools
+import logging
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import re
+import threading
+import zlib
+from typing import Dict, List, Optional
+
+import anyio
+import jwt
+from fastapi import Request
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from starlette.datastructures import MutableHeaders
+
+from metrics import registry
+
+logger = logging.getLogger("uvicorn")
 
 # Fetch database credentials from environment variables
 try:
     DB_USER = os.environ["POSTGRES_USER"]
     DB_PASSWORD = os.environ["POSTGRES_PASSWORD"]
     DB_NAME = os.environ["POSTGRES_DB"]
-    DB_HOST = "db"  # As in your original script
+    DB_HOST = os.environ.get("POSTGRES_HOST", "db")
 except KeyError as e:
     raise SystemExit(f"Error: Environment variable not set: {e}") from e
 
 # Database connection URL
 DATABASE_URL = f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
 
+# Connection pool sizing is per worker process; with several workers the
+# total is workers * (pool_size + max_overflow).
+POOL_SIZE = int(os.environ.get("MEALPLANNER_DB_POOL_SIZE", "5"))
+POOL_MAX_OVERFLOW = int(os.environ.get("MEALPLANNER_DB_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = int(os.environ.get("MEALPLANNER_DB_POOL_TIMEOUT", "30"))
+
+# User-sharded deployments (see shards.py): comma-separated SQLAlchemy URLs of
+# shards 1, 2, ...; shard 0 is the database above. Append shards, never reorder
+# them: a shard's number is part of the ids it generates.
+SHARD_URLS: List[str] = [u.strip() for u in os.environ.get("MEALPLANNER_SHARDS", "").split(",") if u.strip()]
+# Upper bound on the number of shards; ids created on shard k are k modulo this
+MAX_SHARDS = 16
+
+
+def _parse_replicas(value: str) -> Dict[int, List[str]]:
+    replicas: Dict[int, List[str]] = {}
+    for entry in (e.strip() for e in value.split(",")):
+        if entry:
+            shard, url = re.match(r"^(?:(\d+)=)?(.+)$", entry).groups()
+            replicas.setdefault(int(shard or 0), []).append(url)
+    return replicas
+
+
+# Streaming replicas that serve GET requests: comma-separated SQLAlchemy URLs of
+# shard 0's replicas; prefix a URL with "<shard>=" for another shard's.
+REPLICA_URLS: Dict[int, List[str]] = _parse_replicas(os.environ.get("MEALPLANNER_REPLICAS", ""))
+# How long after a write the client's reads wait for the replica to replay it (see get_db)
+READ_PIN_SECONDS = int(os.environ.get("MEALPLANNER_READ_PIN_SECONDS", "30"))
+READ_LSN_COOKIE = "mealplanner_lsn"
+READ_LSN_HEADER = "X-MealPlanner-LSN"
+READ_METHODS = ("GET", "HEAD")
+
+DB_READS = registry.counter(
+    "mealplanner_db_reads_total",
+    "Read requests by shard and the database serving them (replica, primary_pinned, primary_fallback).",
+    ["shard", "target"])
+
+
+def _create_engine(url: str) -> Engine:
+    return create_engine(
+        url,
+        pool_size=POOL_SIZE,
+        max_overflow=POOL_MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        # Replace connections that died (e.g. after a Postgres restart) instead of failing requests
+        pool_pre_ping=True,
+    )
+
+
 # The engine is the core interface to the database
-engine = create_engine(DATABASE_URL)
+engine = _create_engine(DATABASE_URL)
 
 # A sessionmaker provides a factory for Session objects
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -26,10 +92,184 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
+# --- Shards ---
+
+# shard -> session factory of shards 1, 2, ..., created on first use
+_shards: Dict[int, sessionmaker] = {}
+_shards_lock = threading.Lock()
+
+
+def shard_count() -> int:
+    return 1 + len(SHARD_URLS)
+
+
+def shard_sessionmaker(shard: int) -> sessionmaker:
+    if shard == 0:
+        return SessionLocal
+    with _shards_lock:
+        if shard not in _shards:
+            if not 0 < shard < shard_count():
+                raise ValueError(f"No shard {shard}: MEALPLANNER_SHARDS configures {shard_count()}")
+            _shards[shard] = sessionmaker(autocommit=False, autoflush=False,
+                                          bind=_create_engine(SHARD_URLS[shard - 1]))
+        return _shards[shard]
+
+
+def shard_engine(shard: int) -> Engine:
+    return shard_sessionmaker(shard).kw["bind"]
+
+
+def shard_of_session(db: Session) -> int:
+    """The shard `db` is connected to; 0 for any other database."""
+    bind = db.get_bind()
+    for shard in range(1, shard_count()):
+        if shard_engine(shard) is bind:
+            return shard
+    return 0
+
+
+def shard_for_user(user_id: int) -> int:
+    """The shard a new user is placed on: a stable hash of the id, the same in every process."""
+    return zlib.crc32(str(user_id).encode()) % shard_count()
+
+
+def request_shard(request: Request) -> int:
+    """
+    The shard of the user making the request, from the `shard` claim of its
+    access token; 0 (which also holds every user's login) without one. The
+    claim only routes: the token is verified on that shard, where
+    get_current_user also rejects it if the user has since moved.
+    """
+    if shard_count() == 1:
+        return 0
+    # The events stream authenticates with a ticket in the query string (EventSource cannot send headers)
+    token: Optional[str] = request.query_params.get("ticket")
+    for header in ("authorization", "x-forwarded-authorization"):
+        value = request.headers.get(header, "")
+        if value.lower().startswith("bearer "):
+            token = value.split(" ", 1)[1]
+            break
+    if not token:
+        return 0
+    try:
+        shard = int(jwt.decode(token, options={"verify_signature": False}).get("shard", 0))
+    except (jwt.InvalidTokenError, TypeError, ValueError):
+        return 0
+    return shard if 0 <= shard < shard_count() else 0
+
+
+# --- Read replicas ---
+
+# shard -> session factories of its replicas, created on first use
+_replicas: Dict[int, List[sessionmaker]] = {}
+_replica_turn = itertools.count()
+_LSN = re.compile(r"^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$")
+
+
+def replica_sessionmakers(shard: int) -> List[sessionmaker]:
+    with _shards_lock:
+        if shard not in _replicas:
+            _replicas[shard] = [sessionmaker(autocommit=False, autoflush=False, bind=_create_engine(url))
+                                for url in REPLICA_URLS.get(shard, [])]
+        return _replicas[shard]
+
+
+def primary_lsn(shard: int) -> str:
+    """The primary's current WAL position: replicas that replayed it see every write committed so far."""
+    with shard_engine(shard).connect() as conn:
+        return conn.execute(text("SELECT pg_current_wal_lsn()::text")).scalar()
+
+
+def request_lsn(request: Request) -> Optional[str]:
+    """The WAL position of the client's last write, from the header or cookie set by ReadYourWritesMiddleware."""
+    lsn = request.headers.get(READ_LSN_HEADER) or request.cookies.get(READ_LSN_COOKIE)
+    return lsn if lsn and _LSN.match(lsn) else None
+
+
+def read_session(shard: int, min_lsn: Optional[str] = None) -> Session:
+    """
+    A session for reads: on one of the shard's replicas in turn, or on the
+    primary when it has none, when the replica has not replayed `min_lsn` yet,
+    or when the replica cannot be reached. Its `info["read_target"]` says
+    which ("replica" or "primary").
+    """
+    replicas = replica_sessionmakers(shard)
+    if not replicas:
+        return _primary_read(shard)
+    db = replicas[next(_replica_turn) % len(replicas)]()
+    try:
+        caught_up = not min_lsn or db.execute(text("""
+            SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END
+                   >= CAST(:lsn AS pg_lsn)
+        """), {"lsn": min_lsn}).scalar()
+        # Checks the connection out, so an unreachable replica fails here rather than in the route
+        db.connection()
+    except DBAPIError as e:
+        logger.warning("Replica of shard %d unavailable, reading from the primary: %s", shard, e)
+        db.close()
+        registry.inc(DB_READS, [shard, "primary_fallback"])
+        return _primary_read(shard)
+    if not caught_up:
+        db.close()
+        registry.inc(DB_READS, [shard, "primary_pinned"])
+        return _primary_read(shard)
+    registry.inc(DB_READS, [shard, "replica"])
+    db.info["read_target"] = "replica"
+    return db
+
+
+def _primary_read(shard: int) -> Session:
+    db = shard_sessionmaker(shard)()
+    db.info["read_target"] = "primary"
+    return db
+
+
+class ReadYourWritesMiddleware:
+    """
+    Hands the client of every successful write the primary's WAL position
+    afterwards, as a header and a cookie that lasts MEALPLANNER_READ_PIN_SECONDS.
+    Reads presenting it stay on the primary until a replica has replayed it,
+    so a client always sees its own writes. Pure ASGI, like MetricsMiddleware.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in READ_METHODS or not REPLICA_URLS:
+            await self.app(scope, receive, send)
+            return
+        shard = request_shard(Request(scope))
+        if shard not in REPLICA_URLS:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            # The route has committed by the time its response starts
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                try:
+                    lsn = await anyio.to_thread.run_sync(primary_lsn, shard)
+                except DBAPIError as e:
+                    logger.warning("Could not read the WAL position of shard %d: %s", shard, e)
+                else:
+                    headers = MutableHeaders(scope=message)
+                    headers.append(READ_LSN_HEADER, lsn)
+                    headers.append("set-cookie", f"{READ_LSN_COOKIE}={lsn}; Max-Age={READ_PIN_SECONDS}; "
+                                                 "Path=/; SameSite=Lax; HttpOnly")
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
 # --- Database Dependency ---
-def get_db():
-    db = SessionLocal()
+def get_db(request: Request):
+    # Reads go to a replica when the shard has one; the rest, and reads right after a write, to the primary
+    shard = request_shard(request)
+    if request.method in READ_METHODS:
+        db = read_session(shard, request_lsn(request))
+    else:
+        db = shard_sessionmaker(shard)()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
@@ -0,0 +1,12 @@
+#!/bin/sh
+# Boots the database, then serves the API.
+# MEALPLANNER_ENV=development runs a single auto-reloading uvicorn instead of gunicorn.
+set -e
+
+python setup_db.py
+
+if [ "${MEALPLANNER_ENV:-production}" = "development" ]; then
+    exec uvicorn app:app --host 0.0.0.0 --port 5000 --reload
+fi
+
+exec gunicorn -c gunicorn.conf.py app:app
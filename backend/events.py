@@ -0,0 +1,237 @@
+# events.py
+"""
+Change events pushed to browsers over Server-Sent Events.
+
+Writes call `publish()` before they commit. The events are sent with
+Postgres NOTIFY in the same transaction, so they are delivered only if it
+commits. Every worker process keeps one LISTEN connection per database
+shard (the `EventHub`; see shards.py) and fans the events out to the SSE streams of the user they belong to.
+Receiving an event also bumps that user's coalescing data version, so
+requests to any worker see writes served by another.
+
+An event is compact JSON naming what changed, e.g.
+    {"entity": "recipe", "action": "updated", "ids": [12]}
+    {"entity": "plan", "action": "updated", "ids": [], "data": {"day": "Monday", ...}}
+An event without ids means the whole collection changed. Clients receive a
+`resync` event when events may have been missed (the hub reconnected, or
+the client fell behind) and should reload from the API.
+"""
+import asyncio
+import json
+import logging
+import os
+import select
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+import coalesce
+from metrics import registry
+
+logger = logging.getLogger("uvicorn")
+
+CHANNEL = "mealplanner_changes"
+# NOTIFY payloads are limited to 8000 bytes
+MAX_PAYLOAD_BYTES = 7900
+SUBSCRIBER_QUEUE_SIZE = int(os.environ.get("MEALPLANNER_EVENTS_QUEUE_SIZE", "100"))
+HEARTBEAT_SECONDS = float(os.environ.get("MEALPLANNER_EVENTS_HEARTBEAT_SECONDS", "15"))
+RECONNECT_SECONDS = 2.0
+
+EVENTS_DELIVERED = registry.counter(
+    "mealplanner_change_events_total", "Change events received from NOTIFY by entity.", ["entity"])
+
+
+# --- Publishing ---
+
+def publish(session: Session, user_id: int, entity: str, action: str,
+            ids: Iterable[int] = (), data: Optional[Dict[str, Any]] = None) -> None:
+    """Sends a change event to `user_id`'s streams once `session` commits (not if it rolls back)."""
+    coalesce.bump_on_commit(session, user_id)
+    change = {"user_id": user_id, "entity": entity, "action": action, "ids": list(ids)}
+    if data is not None:
+        change["data"] = data
+    payload = json.dumps(change, separators=(",", ":"), default=str)
+    if len(payload.encode()) > MAX_PAYLOAD_BYTES:
+        # Too big to describe: the client reloads the collection
+        payload = json.dumps({"user_id": user_id, "entity": entity, "action": action, "ids": []})
+    session.info.setdefault("change_events", []).append(payload)
+
+
+@event.listens_for(Session, "before_commit")
+def _notify_before_commit(session: Session) -> None:
+    payloads = session.info.pop("change_events", None)
+    if payloads:
+        # NOTIFY is transactional: listeners get these only when the commit succeeds
+        calls = ", ".join(f"pg_notify(:channel, :p{i})" for i in range(len(payloads)))
+        params = {f"p{i}": payload for i, payload in enumerate(payloads)}
+        session.execute(text(f"SELECT {calls}"), {"channel": CHANNEL, **params})
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(session: Session) -> None:
+    session.info.pop("change_events", None)
+
+
+# --- Fan-out ---
+
+RESYNC = {"entity": "all", "action": "resync", "ids": []}
+
+
+class Subscription:
+    """One SSE stream; events are handed to its event loop from the hub thread."""
+
+    def __init__(self, user_id: int, loop: asyncio.AbstractEventLoop) -> None:
+        self.user_id = user_id
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put(self, change: Dict[str, Any]) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self._put, change)
+        except RuntimeError:
+            # Its event loop has shut down; the stream is going away
+            pass
+
+    def _put(self, change: Dict[str, Any]) -> None:
+        try:
+            self.queue.put_nowait(change)
+        except asyncio.QueueFull:
+            # The client is not keeping up: drop what it has not read and make it reload
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+
+class EventHub:
+    """A LISTEN connection per database and process, fanning events out to subscribers by user."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._subscribers: Dict[int, Set[Subscription]] = {}
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._listening: Set[int] = set()
+        # Set while every listener is connected
+        self.connected = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return any(thread.is_alive() for thread in self._threads)
+
+    def start(self, *engines) -> None:
+        """Listens on each of `engines` (the shards) from a thread of its own."""
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._run, args=(engine, len(engines)),
+                             name=f"event-hub-{i}" if i else "event-hub", daemon=True)
+            for i, engine in enumerate(engines)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._listening.clear()
+        self.connected.clear()
+
+    def subscribe(self, user_id: int) -> Subscription:
+        subscription = Subscription(user_id, asyncio.get_running_loop())
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self._subscribers.pop(subscription.user_id, None)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def dispatch(self, payload: str) -> None:
+        try:
+            change = json.loads(payload)
+            user_id = change.pop("user_id")
+        except (ValueError, KeyError):
+            logger.warning("Ignoring malformed change event: %s", payload[:200])
+            return
+        coalesce.bump_version(user_id)
+        registry.inc(EVENTS_DELIVERED, [change.get("entity", "")])
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for subscription in subscribers:
+            subscription.put(change)
+
+    def _broadcast(self, change: Dict[str, Any]) -> None:
+        with self._lock:
+            subscribers = [s for group in self._subscribers.values() for s in group]
+        for subscription in subscribers:
+            subscription.put(change)
+
+    def _set_listening(self, engine, listening: bool, listeners: int) -> None:
+        with self._lock:
+            if listening:
+                self._listening.add(id(engine))
+            else:
+                self._listening.discard(id(engine))
+            if len(self._listening) == listeners:
+                self.connected.set()
+            else:
+                self.connected.clear()
+
+    def _run(self, engine, listeners: int) -> None:
+        reconnecting = False
+        while not self._stop.is_set():
+            dbapi_connection = None
+            try:
+                # A dedicated connection, taken out of the pool for good
+                connection = engine.raw_connection()
+                dbapi_connection = connection.driver_connection
+                connection.detach()
+                dbapi_connection.autocommit = True
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANNEL}")
+                self._set_listening(engine, True, listeners)
+                if reconnecting:
+                    # Events sent while we were away are lost
+                    self._broadcast(RESYNC)
+                while not self._stop.is_set():
+                    if select.select([dbapi_connection], [], [], 1.0)[0]:
+                        dbapi_connection.poll()
+                        while dbapi_connection.notifies:
+                            self.dispatch(dbapi_connection.notifies.pop(0).payload)
+            except Exception as e:
+                logger.warning("Change event listener lost its connection: %s", e)
+                reconnecting = True
+                self._set_listening(engine, False, listeners)
+                self._stop.wait(RECONNECT_SECONDS)
+            finally:
+                if dbapi_connection is not None:
+                    try:
+                        dbapi_connection.close()
+                    except Exception:
+                        pass
+
+
+hub = EventHub()
+
+
+async def event_stream(subscription: Subscription, heartbeat: float = HEARTBEAT_SECONDS):
+    """SSE frames for one subscriber, with comment heartbeats to keep proxies from timing out."""
+    yield f"retry: {int(RECONNECT_SECONDS * 1000)}\n\n"
+    while True:
+        try:
+            change = await asyncio.wait_for(subscription.queue.get(), heartbeat)
+        except asyncio.TimeoutError:
+            yield ": keepalive\n\n"
+            continue
+        name = "resync" if change.get("action") == "resync" else "change"
+        yield f"event: {name}\ndata: {json.dumps(change, separators=(',', ':'))}\n\n"
@@ -0,0 +1,435 @@
+# generate_data.py
+"""
+Synthetic tenant data at production scale.
+
+The seed CSVs in data/ are used as a statistical template: every tenant starts
+from the catalog ingredients (as a signup clones the demo user's), recipes are
+variations of the template recipes with the same meal type mix, ingredient
+counts and per-ingredient quantities, and the plans of the current week (and
+optionally of past weeks) are filled with the template's slot occupancy. Nutrients (and the ingredient ids of recipe items) are computed here exactly as the recipe
+trigger would (nutrients.py), so the trigger can be switched off during bulk loads.
+
+Rows are streamed per user into COPY-ready CSV files, so memory stays flat at
+millions of recipes:
+
+    python generate_data.py --users 10000 --recipes-per-user 200 --out /tmp/synthetic
+    python generate_data.py --users 10000 --recipes-per-user 200 --weeks 52 --load
+"""
+import argparse
+import csv
+import datetime
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from passlib.context import CryptContext
+
+from nutrients import NUTRIENTS, IngredientIndex, recipe_nutrients
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+WEIGHT_UNITS = ("g", "ml")
+
+# Spread of recipes per user around the requested mean (log-normal: most tenants
+# are small, a few have very large collections)
+RECIPES_PER_USER_SIGMA = 0.75
+
+# Tables in load order, with the columns written to each file
+TABLE_COLUMNS: Dict[str, List[str]] = {
+    "users": ["id", "email", "password_hash"],
+    "ingredients": ["id", "user_id", "name", "shelf_life", "available", "last_available",
+                    "serving_unit", "serving_size", "density_g_per_ml", "grams_per_piece"] + NUTRIENTS,
+    "recipes": ["id", "user_id", "name", "serves", "ingredients", "instructions", "meal_type",
+                "is_vegetarian"] + NUTRIENTS,
+    "plan_entries": ["user_id", "plan_date", "meal_type", "recipe_ids"],
+}
+# Tables with a serial id, assigned by the generator
+ID_TABLES = [table for table, columns in TABLE_COLUMNS.items() if "id" in columns]
+# Tables whose triggers recompute what the generator already wrote
+TRIGGER_TABLES = ["recipes", "plan_entries"]
+
+
+# --- Template ---
+
+@dataclass
+class Template:
+    ingredients: List[dict]
+    recipes: List[dict]
+    # Observed number of ingredients per recipe
+    ingredient_counts: List[int]
+    # Number of template recipes using each ingredient (+1, so every ingredient can be picked)
+    popularity: Dict[str, int]
+    # Observed (quantity, unit) pairs per ingredient name
+    quantities: Dict[str, List[Tuple[float, str]]]
+    availability_rate: float
+    # P(slot has at least one recipe) per plan meal type
+    slot_fill: Dict[str, float]
+    # Observed number of recipes in a non-empty slot
+    slot_sizes: List[int]
+
+
+def _read_csv(path: str) -> List[dict]:
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+def load_template(data_dir: str = DATA_DIR) -> Template:
+    ingredients = []
+    for row in _read_csv(os.path.join(data_dir, "ingredients.csv")):
+        ingredients.append({
+            "name": row["name"],
+            "shelf_life": int(row["shelf_life"]) if row["shelf_life"] else None,
+            "available": row["available"] == "t",
+            "serving_unit": row["serving_unit"] or None,
+            "serving_size": float(row["serving_size"] or 100),
+            "density_g_per_ml": float(row["density_g_per_ml"]) if row.get("density_g_per_ml") else None,
+            "grams_per_piece": float(row["grams_per_piece"]) if row.get("grams_per_piece") else None,
+            **{n: float(row[n] or 0) for n in NUTRIENTS},
+        })
+
+    recipes, counts = [], []
+    quantities: Dict[str, List[Tuple[float, str]]] = defaultdict(list)
+    popularity = Counter({i["name"]: 1 for i in ingredients})
+    for row in _read_csv(os.path.join(data_dir, "recipes.csv")):
+        items = json.loads(row["ingredients"])
+        recipes.append({
+            "name": row["name"],
+            "serves": int(row["serves"] or 1),
+            "ingredients": [i["name"] for i in items],
+            "instructions": row["instructions"],
+            "meal_type": row["meal_type"],
+            "is_vegetarian": row["is_vegetarian"] == "t",
+        })
+        counts.append(len(items))
+        for item in items:
+            popularity[item["name"]] += 1
+            quantities[item["name"]].append((float(item["quantity"]), item.get("serving_unit")))
+
+    filled, total = Counter(), Counter()
+    slot_sizes = []
+    for row in _read_csv(os.path.join(data_dir, "weekly_plan.csv")):
+        ids = [i for i in row["recipe_ids"].strip("{}").split(",") if i]
+        total[row["meal_type"]] += 1
+        if ids:
+            filled[row["meal_type"]] += 1
+            slot_sizes.append(len(ids))
+
+    return Template(
+        ingredients=ingredients,
+        recipes=recipes,
+        ingredient_counts=[c for c in counts if c > 0] or [1],
+        popularity=dict(popularity),
+        quantities=dict(quantities),
+        availability_rate=sum(i["available"] for i in ingredients) / max(1, len(ingredients)),
+        slot_fill={meal: filled[meal] / total[meal] for meal in total},
+        slot_sizes=slot_sizes or [1],
+    )
+
+
+# --- Row generation ---
+
+@dataclass
+class GenerationResult:
+    out_dir: str
+    rows: Dict[str, int] = field(default_factory=dict)
+    first_user_id: int = 0
+    last_user_id: int = 0
+    seconds: float = 0.0
+
+
+def _weighted_sample(rng: random.Random, items: List[dict], weights: List[float], k: int) -> List[dict]:
+    """k distinct items, each drawn with probability proportional to its weight."""
+    keyed = sorted(zip(items, weights), key=lambda iw: rng.random() ** (1.0 / iw[1]), reverse=True)
+    return [item for item, _ in keyed[:k]]
+
+
+def _user_ingredients(rng: random.Random, template: Template, count: Optional[int], now: datetime.datetime) -> List[dict]:
+    catalog = template.ingredients
+    if count is None or count == len(catalog):
+        chosen = [dict(i) for i in catalog]
+    elif count < len(catalog):
+        weights = [template.popularity.get(i["name"], 1) for i in catalog]
+        chosen = [dict(i) for i in _weighted_sample(rng, catalog, weights, count)]
+    else:
+        # Tenants with more ingredients than the catalog add their own variants of it
+        chosen = [dict(i) for i in catalog]
+        for n in range(count - len(catalog)):
+            base = dict(rng.choice(catalog))
+            base["name"] = f"{base['name']} ({n + 2})"
+            for nutrient in NUTRIENTS:
+                base[nutrient] = round(base[nutrient] * rng.uniform(0.8, 1.2), 2)
+            chosen.append(base)
+
+    for ingredient in chosen:
+        ingredient["available"] = rng.random() < template.availability_rate
+        days_ago = rng.randint(0, max(1, 2 * (ingredient["shelf_life"] or 30)))
+        ingredient["last_available"] = now - datetime.timedelta(days=days_ago)
+    return chosen
+
+
+def _quantity(rng: random.Random, template: Template, ingredient: dict) -> Tuple[float, str]:
+    observed = template.quantities.get(ingredient["name"].split(" (")[0])
+    if observed:
+        quantity, unit = rng.choice(observed)
+        unit = unit or ingredient["serving_unit"]
+    else:
+        unit = ingredient["serving_unit"] or "g"
+        quantity = 100.0 if unit in WEIGHT_UNITS else 1.0
+    return round(quantity * rng.uniform(0.75, 1.25), 1), unit
+
+
+def _recipes_for_user(rng: random.Random, template: Template, count: int, user_id: int,
+                      ingredients_by_name: Dict[str, dict]) -> List[dict]:
+    index = IngredientIndex(dict(i, user_id=user_id) for i in ingredients_by_name.values())
+    names = list(ingredients_by_name)
+    cum_weights = list(itertools.accumulate(template.popularity.get(n.split(" (")[0], 1) for n in names))
+    variants: Counter = Counter()
+    recipes = []
+    for _ in range(count):
+        base = rng.choice(template.recipes)
+        target = rng.choice(template.ingredient_counts)
+        picked = [n for n in base["ingredients"] if n in ingredients_by_name]
+        rng.shuffle(picked)
+        picked = picked[:target]
+        while len(picked) < min(target, len(names)):
+            candidate = rng.choices(names, cum_weights=cum_weights)[0]
+            if candidate not in picked:
+                picked.append(candidate)
+
+        items = []
+        for name in picked:
+            quantity, unit = _quantity(rng, template, ingredients_by_name[name])
+            items.append({"id": ingredients_by_name[name].get("id"), "name": name, "quantity": quantity,
+                          "serving_unit": unit})
+
+        variants[base["name"]] += 1
+        n = variants[base["name"]]
+        recipes.append({
+            "name": base["name"] if n == 1 else f"{base['name']} #{n}",
+            "serves": base["serves"],
+            "ingredients": items,
+            "instructions": base["instructions"],
+            "meal_type": base["meal_type"],
+            "is_vegetarian": base["is_vegetarian"],
+            **recipe_nutrients(items, index, user_id),
+        })
+    return recipes
+
+
+def _csv_value(value) -> object:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=" ")
+    if isinstance(value, list) and all(isinstance(v, int) for v in value):
+        return "{" + ",".join(str(v) for v in value) + "}"
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return value
+
+
+def generate(out_dir: str, users: int, recipes_per_user: int, ingredients_per_user: Optional[int] = None,
+             seed: int = 42, id_start: Optional[Dict[str, int]] = None, password: str = "password",
+             template: Optional[Template] = None, weeks: int = 1,
+             today: Optional[datetime.date] = None) -> GenerationResult:
+    """Writes users, ingredients, recipes and plan_entries CSV files into `out_dir`; plans cover the last `weeks` weeks."""
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    template = template or load_template()
+    next_id = {table: (id_start or {}).get(table, 1) for table in ID_TABLES}
+    password_hash = CryptContext(schemes=["bcrypt"], deprecated="auto").hash(password)
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    mu = math.log(max(1, recipes_per_user)) - RECIPES_PER_USER_SIGMA ** 2 / 2
+    today = today or datetime.date.today()
+    this_week = today - datetime.timedelta(days=today.weekday())
+    week_starts = [this_week - datetime.timedelta(weeks=w) for w in reversed(range(max(1, weeks)))]
+
+    os.makedirs(out_dir, exist_ok=True)
+    files = {t: open(os.path.join(out_dir, f"{t}.csv"), "w", newline="", encoding="utf-8") for t in TABLE_COLUMNS}
+    writers = {t: csv.writer(f) for t, f in files.items()}
+    for table, columns in TABLE_COLUMNS.items():
+        writers[table].writerow(columns)
+    rows: Counter = Counter()
+    result = GenerationResult(out_dir=out_dir, first_user_id=next_id["users"])
+
+    def write(table: str, row: dict) -> Optional[int]:
+        row_id = None
+        if table in next_id:
+            row_id = row["id"] = next_id[table]
+            next_id[table] += 1
+        rows[table] += 1
+        writers[table].writerow([_csv_value(row.get(c)) for c in TABLE_COLUMNS[table]])
+        return row_id
+
+    try:
+        for _ in range(users):
+            user_id = next_id["users"]
+            write("users", {"email": f"user{user_id}@synthetic.example.com", "password_hash": password_hash})
+
+            ingredients = _user_ingredients(rng, template, ingredients_per_user, now)
+            for ingredient in ingredients:
+                ingredient["id"] = write("ingredients", dict(ingredient, user_id=user_id))
+            ingredients_by_name = {i["name"]: i for i in ingredients}
+
+            count = max(1, int(round(rng.lognormvariate(mu, RECIPES_PER_USER_SIGMA)))) if recipes_per_user else 0
+            by_meal_type: Dict[str, List[int]] = defaultdict(list)
+            all_recipe_ids = []
+            for recipe in _recipes_for_user(rng, template, count, user_id, ingredients_by_name):
+                recipe_id = write("recipes", dict(recipe, user_id=user_id))
+                by_meal_type[recipe["meal_type"]].append(recipe_id)
+                all_recipe_ids.append(recipe_id)
+
+            for week_start in week_starts:
+                for offset in range(len(DAYS)):
+                    plan_date = week_start + datetime.timedelta(days=offset)
+                    for meal_type, fill in template.slot_fill.items():
+                        recipe_ids = []
+                        if all_recipe_ids and rng.random() < fill:
+                            pool = by_meal_type.get(meal_type) or all_recipe_ids
+                            recipe_ids = rng.sample(pool, k=min(len(pool), rng.choice(template.slot_sizes)))
+                        write("plan_entries", {"user_id": user_id, "plan_date": plan_date.isoformat(),
+                                               "meal_type": meal_type, "recipe_ids": recipe_ids})
+    finally:
+        for f in files.values():
+            f.close()
+
+    result.rows = dict(rows)
+    result.last_user_id = next_id["users"] - 1
+    result.seconds = time.perf_counter() - started
+    return result
+
+
+# --- Loading ---
+
+def next_ids(engine) -> Dict[str, int]:
+    """First free id of every generated table, so generated rows do not collide with existing ones."""
+    with engine.connect() as conn:
+        return {
+            table: conn.exec_driver_sql(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}").scalar()
+            for table in ID_TABLES
+        }
+
+
+def load(engine, out_dir: str, keep_triggers: bool = False) -> Dict[str, float]:
+    """
+    COPYs the generated files in one transaction and returns seconds per table.
+
+    Unless `keep_triggers` is set, user triggers on recipes and plan_entries are
+    disabled for the load (this takes an exclusive lock on both tables): the
+    files already carry the nutrients and only reference recipes they define.
+    The nutrition rollups of the loaded users are then rebuilt in one pass.
+    """
+    import partitions
+    import rollups
+
+    first = last = None
+    user_ids = set()
+    with open(os.path.join(out_dir, "plan_entries.csv"), newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            # ISO dates order as strings
+            first = min(first or row["plan_date"], row["plan_date"])
+            last = max(last or row["plan_date"], row["plan_date"])
+            user_ids.add(int(row["user_id"]))
+    if first:
+        # COPY fails on rows for a month without a partition
+        with engine.begin() as conn:
+            partitions.ensure_partitions(conn, datetime.date.fromisoformat(first), datetime.date.fromisoformat(last))
+
+    timings = {}
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        if not keep_triggers:
+            for table in TRIGGER_TABLES:
+                cursor.execute(f"ALTER TABLE {table} DISABLE TRIGGER USER")
+        for table, columns in TABLE_COLUMNS.items():
+            started = time.perf_counter()
+            with open(os.path.join(out_dir, f"{table}.csv"), "rb") as f:
+                cursor.copy_expert(
+                    f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, HEADER true, ENCODING 'UTF8')",
+                    f,
+                )
+            timings[table] = time.perf_counter() - started
+        if not keep_triggers:
+            for table in TRIGGER_TABLES:
+                cursor.execute(f"ALTER TABLE {table} ENABLE TRIGGER USER")
+        for table in ID_TABLES:
+            cursor.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT COALESCE(MAX(id), 1) FROM {table}))"
+            )
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+
+    if not keep_triggers and user_ids:
+        started = time.perf_counter()
+        with engine.begin() as conn:
+            rollups.rebuild(conn, min(user_ids), max(user_ids))
+        timings["nutrition rollups"] = time.perf_counter() - started
+
+    # Fresh statistics, so that the first benchmark queries get realistic plans
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for table in [*TABLE_COLUMNS, "nutrition_daily", "nutrition_weekly"]:
+            conn.exec_driver_sql(f"ANALYZE {table}")
+    return timings
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Generate synthetic tenants from the seed catalog.")
+    parser.add_argument("--users", type=int, required=True, help="number of users to generate")
+    parser.add_argument("--recipes-per-user", type=int, default=100, help="mean recipes per user")
+    parser.add_argument("--ingredients-per-user", type=int, default=None,
+                        help="ingredients per user (default: the whole seed catalog)")
+    parser.add_argument("--weeks", type=int, default=1,
+                        help="weeks of plan history per user, ending with the current week")
+    parser.add_argument("--seed", type=int, default=42, help="random seed, for reproducible data sets")
+    parser.add_argument("--password", default="password", help="password of every generated user")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--out", help="directory to write COPY-ready CSV files to")
+    target.add_argument("--load", action="store_true", help="load into the database from POSTGRES_* settings")
+    parser.add_argument("--keep-triggers", action="store_true",
+                        help="fire the recipe and plan triggers during --load (slower, exercises them)")
+    args = parser.parse_args(argv)
+
+    engine = None
+    id_start = None
+    if args.load:
+        from database import engine
+        id_start = next_ids(engine)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_dir = args.out or tmp_dir
+        print(f"-- Generating {args.users} users into {out_dir}...")
+        result = generate(out_dir, args.users, args.recipes_per_user, args.ingredients_per_user,
+                          seed=args.seed, id_start=id_start, password=args.password, weeks=args.weeks)
+        total = sum(result.rows.values())
+        print(f"   {total} rows in {result.seconds:.1f}s ({total / max(result.seconds, 1e-9):.0f} rows/s)")
+        for table, count in result.rows.items():
+            print(f"   {table}: {count}")
+
+        if args.load:
+            print("-- Loading with COPY...")
+            for table, seconds in load(engine, out_dir, keep_triggers=args.keep_triggers).items():
+                rows = f"{result.rows[table]} rows in " if table in result.rows else ""
+                print(f"   {table}: {rows}{seconds:.1f}s")
+            print(f"✅ Loaded users {result.first_user_id}..{result.last_user_id}.")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(130)
@@ -0,0 +1,51 @@
+# gunicorn.conf.py
+# Production serving: several uvicorn workers behind one gunicorn master.
+# Every setting can be overridden from the environment.
+import glob
+import multiprocessing
+import os
+import tempfile
+
+bind = os.environ.get("MEALPLANNER_BIND", "0.0.0.0:5000")
+worker_class = "uvicorn.workers.UvicornWorker"
+# One worker per core by default so the backend uses the whole host
+workers = int(os.environ.get("WEB_CONCURRENCY") or multiprocessing.cpu_count())
+
+# Import the app once in the master; workers fork with it already loaded
+preload_app = os.environ.get("MEALPLANNER_PRELOAD", "1").lower() in ("1", "true", "yes")
+
+# Recycle workers after a number of requests (with jitter so they don't all restart together)
+max_requests = int(os.environ.get("MEALPLANNER_MAX_REQUESTS", "2000"))
+max_requests_jitter = int(os.environ.get("MEALPLANNER_MAX_REQUESTS_JITTER", "200"))
+
+# Time given to in-flight requests on shutdown/recycle, and the hard per-request limit
+graceful_timeout = int(os.environ.get("MEALPLANNER_GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.environ.get("MEALPLANNER_WORKER_TIMEOUT", "60"))
+keepalive = int(os.environ.get("MEALPLANNER_KEEPALIVE", "5"))
+
+# Workers publish metric snapshots here so /metrics reports all workers (see metrics.py).
+# Set before the app is preloaded, since metrics.py reads it at import.
+os.environ.setdefault("MEALPLANNER_METRICS_DIR", os.path.join(tempfile.gettempdir(), "mealplanner-metrics"))
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.environ.get("LOG_LEVEL", "info")
+
+
+def on_starting(server):
+    # Counters restart with the server; drop snapshots left by a previous run
+    for path in glob.glob(os.path.join(os.environ["MEALPLANNER_METRICS_DIR"], "*.json")):
+        os.remove(path)
+
+
+def worker_exit(server, worker):
+    # Keep the final counts of recycled workers in the aggregate
+    import metrics
+    metrics.write_snapshot()
+
+
+def post_fork(server, worker):
+    # Connections opened in the master (e.g. while preloading) must not be shared with the
+    # forked workers; drop them from the pool without closing the master's sockets.
+    from database import engine
+    engine.dispose(close=False)
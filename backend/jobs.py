@@ -0,0 +1,257 @@
+# jobs.py
+"""
+Postgres-backed background jobs, run by a small worker pool in every API process.
+
+Handlers enqueue work in their own transaction with `enqueue()`, so a job
+exists exactly when the change that asked for it was committed, and return
+straight away (202 with the job's URL where the client waits for a result).
+Workers claim the next job with `SELECT ... FOR UPDATE SKIP LOCKED`, so any
+number of workers across processes share the table without double-claiming.
+
+A job's handler runs in one transaction together with marking the job as
+succeeded: its database effects and its completion commit or roll back
+together. Failed jobs are retried with exponential backoff up to
+`max_attempts`; jobs whose worker died are requeued after
+MEALPLANNER_JOB_TIMEOUT_SECONDS.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from metrics import registry
+from models import Job
+
+logger = logging.getLogger("uvicorn")
+
+JOB_WORKERS = int(os.environ.get("MEALPLANNER_JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = float(os.environ.get("MEALPLANNER_JOB_POLL_SECONDS", "2"))
+JOB_TIMEOUT_SECONDS = int(os.environ.get("MEALPLANNER_JOB_TIMEOUT_SECONDS", "300"))
+JOB_RETRY_BASE_SECONDS = float(os.environ.get("MEALPLANNER_JOB_RETRY_BASE_SECONDS", "2"))
+JOB_RETENTION_HOURS = int(os.environ.get("MEALPLANNER_JOB_RETENTION_HOURS", "24"))
+MAINTENANCE_INTERVAL_SECONDS = 60
+
+# Priorities (lower runs first)
+PRIORITY_INTERACTIVE = 0    # a user is waiting on the result
+PRIORITY_DEFAULT = 100      # background consistency work
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+
+JOBS_PROCESSED = registry.counter(
+    "mealplanner_jobs_total", "Background job attempts by kind and outcome (succeeded, retried, failed).",
+    ["kind", "outcome"])
+JOB_SECONDS = registry.histogram(
+    "mealplanner_job_duration_seconds", "Background job run time by kind.",
+    ["kind"], (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+
+class JobError(Exception):
+    """Raised for jobs that cannot run (e.g. no handler for their kind)."""
+    pass
+
+
+# --- Handlers ---
+
+# kind -> handler(session, job); the returned bytes (typed by job.result_media_type)
+# or JSON-able value is the job's result
+HANDLERS: Dict[str, Callable[[Session, Job], Any]] = {}
+
+
+def job_handler(kind: str):
+    def register(fn: Callable[[Session, Job], Any]):
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+# Periodic housekeeping run by `maintain()`: fn(session), committed on its own
+MAINTENANCE_TASKS: List[Callable[[Session], None]] = []
+
+
+def maintenance_task(fn: Callable[[Session], None]) -> Callable[[Session], None]:
+    MAINTENANCE_TASKS.append(fn)
+    return fn
+
+
+# --- Enqueueing ---
+
+_wakeup = threading.Event()
+
+
+def enqueue(session: Session, kind: str, payload: Optional[dict] = None, user_id: Optional[int] = None,
+            priority: int = PRIORITY_DEFAULT, max_attempts: int = 3) -> Job:
+    """Adds a job to `session`; it becomes visible to workers when the session commits."""
+    job = Job(kind=kind, payload=payload or {}, user_id=user_id, priority=priority, max_attempts=max_attempts)
+    session.add(job)
+    session.flush()
+    session.info["jobs_enqueued"] = True
+    return job
+
+
+@event.listens_for(Session, "after_commit")
+def _wake_workers(session: Session) -> None:
+    # Workers in this process start on the new job now instead of at their next poll
+    if session.info.pop("jobs_enqueued", False):
+        _wakeup.set()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_enqueued(session: Session) -> None:
+    session.info.pop("jobs_enqueued", None)
+
+
+# --- Running ---
+
+def claim(session: Session, worker: str) -> Optional[Job]:
+    """Marks the next runnable job as running for `worker` and commits the claim."""
+    job = (
+        session.query(Job)
+        .filter(Job.status == QUEUED, Job.run_after <= text("now()"))
+        .order_by(Job.priority, Job.run_after, Job.id)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if job is None:
+        session.rollback()
+        return None
+    job.status = RUNNING
+    job.attempts = Job.attempts + 1
+    job.locked_by = worker
+    job.locked_at = text("now()")
+    session.commit()
+    return job
+
+
+def _fail(session: Session, job_id: int, error: BaseException) -> str:
+    job = session.get(Job, job_id)
+    job.last_error = f"{type(error).__name__}: {error}"
+    job.locked_by = job.locked_at = None
+    if job.attempts < job.max_attempts and not isinstance(error, JobError):
+        delay = JOB_RETRY_BASE_SECONDS * 2 ** (job.attempts - 1)
+        job.status = QUEUED
+        job.run_after = text(f"now() + interval '{delay:.3f} seconds'")
+        outcome = "retried"
+    else:
+        job.status = FAILED
+        job.finished_at = text("now()")
+        outcome = "failed"
+    session.commit()
+    return outcome
+
+
+def run_next(session_factory: Callable[[], Session], worker: str = "inline") -> bool:
+    """Claims and runs one job; False when there was nothing to run."""
+    session = session_factory()
+    try:
+        job = claim(session, worker)
+        if job is None:
+            return False
+        job_id, kind = job.id, job.kind
+        started = time.perf_counter()
+        try:
+            handler = HANDLERS.get(kind)
+            if handler is None:
+                raise JobError(f"No handler registered for job kind '{kind}'")
+            result = handler(session, job)
+            if isinstance(result, (bytes, bytearray)):
+                job.result_bytes = bytes(result)
+                job.result_media_type = job.result_media_type or "application/octet-stream"
+            else:
+                job.result = result
+            job.status = SUCCEEDED
+            job.finished_at = text("now()")
+            job.locked_by = job.locked_at = None
+            session.commit()
+            outcome = "succeeded"
+        except Exception as e:
+            session.rollback()
+            logger.warning("Job %s (%s) failed: %s", job_id, kind, e)
+            outcome = _fail(session, job_id, e)
+        elapsed = time.perf_counter() - started
+        registry.inc(JOBS_PROCESSED, [kind, outcome])
+        registry.observe(JOB_SECONDS, [kind], elapsed)
+        return True
+    finally:
+        session.close()
+
+
+def run_pending(session_factory: Callable[[], Session], limit: Optional[int] = None) -> int:
+    """Runs runnable jobs until none is left (or `limit` ran); returns how many ran."""
+    ran = 0
+    while (limit is None or ran < limit) and run_next(session_factory):
+        ran += 1
+    return ran
+
+
+def maintain(session: Session) -> None:
+    """Requeues jobs whose worker stopped responding, deletes old finished jobs and runs the maintenance tasks."""
+    requeued = session.execute(text(f"""
+        UPDATE jobs SET status = '{QUEUED}', locked_by = NULL, locked_at = NULL,
+                        last_error = 'worker timed out'
+        WHERE status = '{RUNNING}' AND locked_at < now() - interval '{JOB_TIMEOUT_SECONDS} seconds'
+    """)).rowcount
+    session.execute(text(f"""
+        DELETE FROM jobs
+        WHERE status IN ('{SUCCEEDED}', '{FAILED}')
+          AND finished_at < now() - interval '{JOB_RETENTION_HOURS} hours'
+    """))
+    session.commit()
+    if requeued:
+        logger.warning("Requeued %d jobs whose worker timed out", requeued)
+    for task in MAINTENANCE_TASKS:
+        try:
+            task(session)
+            session.commit()
+        except Exception:
+            session.rollback()
+            logger.exception("Maintenance task %s failed", task.__name__)
+
+
+class JobWorkerPool:
+    """Daemon threads that run jobs until stopped."""
+
+    def __init__(self, session_factory: Callable[[], Session], workers: int = JOB_WORKERS,
+                 poll_seconds: float = JOB_POLL_SECONDS) -> None:
+        self.session_factory = session_factory
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self._stop = threading.Event()
+        self._threads = []
+        self._last_maintenance = 0.0
+
+    def start(self) -> None:
+        prefix = f"{socket.gethostname()}:{os.getpid()}"
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, args=(f"{prefix}:{i}", i == 0),
+                                      name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.workers:
+            logger.info("Started %d job workers", self.workers)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        self._stop.set()
+        _wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self, name: str, maintains: bool) -> None:
+        while not self._stop.is_set():
+            try:
+                if maintains and time.monotonic() - self._last_maintenance >= MAINTENANCE_INTERVAL_SECONDS:
+                    self._last_maintenance = time.monotonic()
+                    with self.session_factory() as session:
+                        maintain(session)
+                if run_next(self.session_factory, name):
+                    continue
+            except Exception as e:
+                # e.g. the database is unreachable; keep polling
+                logger.warning("Job worker %s: %s", name, e)
+            _wakeup.wait(self.poll_seconds)
+            _wakeup.clear()
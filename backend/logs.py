@@ -0,0 +1,222 @@
+# logs.py
+"""
+Logging off the request path.
+
+`start()` (run by the app's lifespan, in each worker) moves the handlers of
+the server's loggers (`uvicorn`, `uvicorn.error`, `uvicorn.access`) behind a
+bounded queue. A request thread then only files the record on the queue, and
+one background thread formats it and writes it out, so a slow stdout never
+stalls a request. Records are filed unformatted when their arguments are
+plain values, which the writer thread can format safely later. Anything else
+(ORM objects, say) is formatted first, since by then it may have changed or
+belong to a session in use elsewhere. When the queue is full, records are
+dropped rather than waited for.
+
+Each record carries the request's `method`, `route` (the template, e.g.
+`/recipes/{recipe_id}`) and `user_id`, so formats can use `%(route)s`, and
+`MEALPLANNER_LOG_FORMAT=json` writes one JSON object per line with every such
+field. With `MEALPLANNER_LOG_LEVELS=uvicorn.requests=DEBUG`, every request
+also logs its status, latency and SQL statement count.
+
+Levels come from the environment: MEALPLANNER_LOG_LEVEL (default INFO) for
+`uvicorn`, and MEALPLANNER_LOG_LEVELS for any logger, as
+`name=LEVEL,name=LEVEL`. Debug records are sampled
+(MEALPLANNER_LOG_DEBUG_SAMPLE, the share kept, default 1) and capped at
+MEALPLANNER_LOG_DEBUG_PER_SECOND per logger (default 50). Dropped records are
+counted in `mealplanner_log_records_dropped_total`.
+"""
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Optional, Tuple
+
+from metrics import current_request_stats, registry
+
+LOG_LEVEL = os.environ.get("MEALPLANNER_LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.environ.get("MEALPLANNER_LOG_LEVELS", "")
+LOG_FORMAT = os.environ.get("MEALPLANNER_LOG_FORMAT", "text").lower()
+LOG_QUEUE_SIZE = int(os.environ.get("MEALPLANNER_LOG_QUEUE_SIZE", "10000"))
+DEBUG_SAMPLE = float(os.environ.get("MEALPLANNER_LOG_DEBUG_SAMPLE", "1"))
+DEBUG_PER_SECOND = float(os.environ.get("MEALPLANNER_LOG_DEBUG_PER_SECOND", "50"))
+
+# The server's loggers; the app's modules log to `uvicorn` and its children
+QUEUED_LOGGERS = ("uvicorn", "uvicorn.error", "uvicorn.access")
+
+LOG_RECORDS_DROPPED = registry.counter(
+    "mealplanner_log_records_dropped_total", "Log records dropped before being written, by reason.",
+    ["reason"])
+
+# Arguments of these types format the same now or later, in any thread
+_PLAIN_TYPES = (str, int, float, bool, type(None))
+# Attributes every LogRecord has; the others were added by `extra` or the request filter
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "log_target", "color_message"}
+
+
+def parse_levels(spec: str) -> Dict[str, int]:
+    """{logger name: level} from `name=LEVEL,name=LEVEL`; unknown levels are ignored."""
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        level = logging.getLevelName(level.strip().upper())
+        if name.strip() and isinstance(level, int):
+            levels[name.strip()] = level
+    return levels
+
+
+def apply_levels() -> None:
+    logging.getLogger("uvicorn").setLevel(LOG_LEVEL)
+    for name, level in parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+
+class RequestContextFilter(logging.Filter):
+    """Adds the current request's method, route and user to the record (in the logging thread)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        stats = current_request_stats()
+        for field, value in (("method", stats.scope.get("method") if stats else None),
+                             ("route", stats.route if stats else None),
+                             ("user_id", stats.user_id if stats else None)):
+            if not hasattr(record, field):
+                setattr(record, field, value)
+        return True
+
+
+class DebugSampler(logging.Filter):
+    """Keeps a share of the DEBUG records, and at most `per_second` a second from each logger."""
+
+    def __init__(self, sample: float = DEBUG_SAMPLE, per_second: float = DEBUG_PER_SECOND) -> None:
+        super().__init__()
+        self.sample = sample
+        self.per_second = per_second
+        self._lock = threading.Lock()
+        # logger name -> (tokens, last refill)
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        if self.sample < 1 and random.random() >= self.sample:
+            registry.inc(LOG_RECORDS_DROPPED, ["sampled"])
+            return False
+        now = time.monotonic()
+        with self._lock:
+            tokens, refilled = self._buckets.get(record.name, (self.per_second, now))
+            tokens = min(self.per_second, tokens + (now - refilled) * self.per_second)
+            if tokens < 1:
+                self._buckets[record.name] = (tokens, now)
+                registry.inc(LOG_RECORDS_DROPPED, ["rate_limited"])
+                return False
+            self._buckets[record.name] = (tokens - 1, now)
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Files records for the writer thread, formatting them only when that cannot wait."""
+
+    def __init__(self, log_queue: "queue.Queue[logging.LogRecord]", target: str) -> None:
+        super().__init__(log_queue)
+        # The logger whose handlers write this handler's records
+        self.target = target
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        args = record.args
+        plain = isinstance(args, tuple) and all(isinstance(a, _PLAIN_TYPES) for a in args) or args is None
+        if not plain:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # Tracebacks hold frames that are about to change
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.log_target = self.target
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            registry.inc(LOG_RECORDS_DROPPED, ["queue_full"])
+
+
+class _Listener(QueueListener):
+    """Writes each record with the handlers its logger had before they were queued."""
+
+    def __init__(self, log_queue, targets: Dict[str, List[logging.Handler]]) -> None:
+        super().__init__(log_queue)
+        self.targets = targets
+
+    def handle(self, record: logging.LogRecord) -> None:
+        for handler in self.targets.get(getattr(record, "log_target", ""), ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((k, v) for k, v in vars(record).items() if k not in _RECORD_ATTRIBUTES and v is not None)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+_listener: Optional[_Listener] = None
+# logger name -> the handlers it had before start()
+_original_handlers: Dict[str, List[logging.Handler]] = {}
+
+
+def start() -> None:
+    """Sets the levels and moves the server loggers' handlers behind the queue. Idempotent."""
+    global _listener
+    apply_levels()
+    if _listener is not None:
+        return
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+    targets = {}
+    for name in QUEUED_LOGGERS:
+        logger = logging.getLogger(name)
+        handlers = list(logger.handlers)
+        if not handlers and name == "uvicorn":
+            # Under gunicorn only uvicorn.error has handlers: the app's records would reach no handler
+            handlers = list(logging.getLogger("uvicorn.error").handlers)
+            logger.propagate = False
+        if not handlers:
+            continue
+        if LOG_FORMAT == "json":
+            for handler in handlers:
+                handler.setFormatter(JsonFormatter())
+        _original_handlers[name] = list(logger.handlers)
+        targets[name] = handlers
+        queued = NonBlockingQueueHandler(log_queue, name)
+        queued.addFilter(DebugSampler())
+        queued.addFilter(RequestContextFilter())
+        logger.handlers = [queued]
+    _listener = _Listener(log_queue, targets)
+    _listener.start()
+
+
+def stop() -> None:
+    """Writes out what is queued and gives the loggers their handlers back."""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
+    for name, handlers in _original_handlers.items():
+        logger = logging.getLogger(name)
+        logger.handlers = handlers
+        if name == "uvicorn" and not handlers:
+            logger.propagate = True
+    _original_handlers.clear()
+
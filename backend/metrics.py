@@ -0,0 +1,297 @@
+# metrics.py
+"""
+Per-route request metrics and SQL statement accounting, served in the
+Prometheus text format from /metrics.
+
+MetricsMiddleware times every HTTP request and labels it with the route
+template (e.g. `/recipes/{recipe_id}`), never the raw path. SQLAlchemy
+cursor events attribute each statement, its duration and the rows it returned
+to the request that issued it, and log statements slower than
+MEALPLANNER_SLOW_QUERY_MS.
+
+Metrics are kept per process. When MEALPLANNER_METRICS_DIR is set (gunicorn
+sets it for its workers), each worker also writes a snapshot there and
+/metrics serves the sum over all workers.
+
+The proxies (nginx.conf, Caddyfile) do not pass /metrics on; scrape the
+backend port. With MEALPLANNER_METRICS_TOKEN set, /metrics also wants
+`Authorization: Bearer <token>`.
+"""
+import contextvars
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("uvicorn")
+# One DEBUG record per request (logs.py), off unless MEALPLANNER_LOG_LEVELS enables it
+request_logger = logging.getLogger("uvicorn.requests")
+
+SLOW_QUERY_MS = float(os.environ.get("MEALPLANNER_SLOW_QUERY_MS", "200"))
+METRICS_DIR = os.environ.get("MEALPLANNER_METRICS_DIR")
+METRICS_TOKEN = os.environ.get("MEALPLANNER_METRICS_TOKEN")
+SNAPSHOT_INTERVAL_SECONDS = 1.0
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+class MetricsRegistry:
+    """A minimal thread-safe registry of labelled counters and histograms."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # name -> (type, help, label names, buckets)
+        self._meta: Dict[str, Tuple[str, str, Tuple[str, ...], Tuple[float, ...]]] = {}
+        # name -> {label values: value}; histogram values are [bucket counts..., sum, count]
+        self._values: Dict[str, Dict[Tuple[str, ...], object]] = {}
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str]) -> str:
+        self._meta[name] = ("counter", help_text, tuple(labels), ())
+        self._values.setdefault(name, {})
+        return name
+
+    def histogram(self, name: str, help_text: str, labels: Sequence[str], buckets: Sequence[float]) -> str:
+        self._meta[name] = ("histogram", help_text, tuple(labels), tuple(buckets))
+        self._values.setdefault(name, {})
+        return name
+
+    def inc(self, name: str, labels: Sequence[str], amount: float = 1.0) -> None:
+        key = tuple(str(v) for v in labels)
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0.0) + amount
+
+    def observe(self, name: str, labels: Sequence[str], value: float) -> None:
+        buckets = self._meta[name][3]
+        key = tuple(str(v) for v in labels)
+        with self._lock:
+            series = self._values[name]
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [0] * len(buckets) + [0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def value(self, name: str, labels: Sequence[str]):
+        with self._lock:
+            return self._values[name].get(tuple(str(v) for v in labels))
+
+    def snapshot(self) -> Dict[str, List]:
+        with self._lock:
+            return {
+                name: [[list(key), value if not isinstance(value, list) else list(value)]
+                       for key, value in series.items()]
+                for name, series in self._values.items()
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            for series in self._values.values():
+                series.clear()
+
+    def render(self, snapshots: Optional[List[Dict[str, List]]] = None) -> str:
+        """Prometheus text exposition of the given snapshots (default: this process only)."""
+        merged: Dict[str, Dict[Tuple[str, ...], object]] = {}
+        for snap in snapshots if snapshots is not None else [self.snapshot()]:
+            for name, series in snap.items():
+                target = merged.setdefault(name, {})
+                for key, value in series:
+                    key = tuple(key)
+                    if isinstance(value, list):
+                        current = target.get(key)
+                        target[key] = value[:] if current is None else [a + b for a, b in zip(current, value)]
+                    else:
+                        target[key] = target.get(key, 0.0) + value
+
+        lines = []
+        for name, (kind, help_text, label_names, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(merged.get(name, {}).items()):
+                labels = _format_labels(label_names, key)
+                if kind == "counter":
+                    lines.append(f"{name}{{{labels}}} {_format_number(value)}")
+                    continue
+                # Bucket counts are stored cumulatively (every bucket with value <= bound)
+                for bound, count in zip(buckets, value[:-2]):
+                    lines.append(f'{name}_bucket{{{labels},le="{_format_number(bound)}"}} {count}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {value[-1]}')
+                lines.append(f"{name}_sum{{{labels}}} {_format_number(value[-2])}")
+                lines.append(f"{name}_count{{{labels}}} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    def escape(v: str) -> str:
+        return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return ",".join(f'{n}="{escape(v)}"' for n, v in zip(names, values))
+
+
+def _format_number(value: float) -> str:
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+registry = MetricsRegistry()
+
+HTTP_REQUESTS = registry.counter(
+    "mealplanner_http_requests_total", "HTTP requests by route template and status code.",
+    ["method", "route", "status"])
+HTTP_LATENCY = registry.histogram(
+    "mealplanner_http_request_duration_seconds", "HTTP request latency by route template.",
+    ["method", "route"], LATENCY_BUCKETS)
+DB_STATEMENTS = registry.counter(
+    "mealplanner_db_statements_total", "SQL statements executed while serving a route.",
+    ["method", "route"])
+DB_STATEMENTS_PER_REQUEST = registry.histogram(
+    "mealplanner_db_statements_per_request", "SQL statements executed per request.",
+    ["method", "route"], STATEMENT_BUCKETS)
+DB_SECONDS = registry.counter(
+    "mealplanner_db_seconds_total", "Time spent executing SQL while serving a route.",
+    ["method", "route"])
+DB_ROWS = registry.counter(
+    "mealplanner_db_rows_total", "Rows returned by SQL statements while serving a route.",
+    ["method", "route"])
+DB_SLOW_STATEMENTS = registry.counter(
+    "mealplanner_db_slow_statements_total", "SQL statements slower than MEALPLANNER_SLOW_QUERY_MS.",
+    ["route"])
+
+
+# --- Per-request SQL accounting ---
+
+@dataclass
+class RequestStats:
+    scope: dict
+    statements: int = 0
+    db_seconds: float = 0.0
+    rows: int = 0
+    # Set once the request authenticates (auth_router.user_from_token)
+    user_id: Optional[int] = None
+
+    @property
+    def route(self) -> str:
+        route = self.scope.get("route")
+        return getattr(route, "path", UNMATCHED_ROUTE)
+
+
+_current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "mealplanner_request_stats", default=None
+)
+
+
+def current_request_stats() -> Optional[RequestStats]:
+    return _current_request.get()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_metrics_started", None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    stats = _current_request.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_seconds += elapsed
+        if cursor.description is not None and cursor.rowcount > 0:
+            stats.rows += cursor.rowcount
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        route = stats.route if stats is not None else "<background>"
+        registry.inc(DB_SLOW_STATEMENTS, [route])
+        logger.warning("Slow query (%.1f ms) on %s: %s", elapsed * 1000, route, " ".join(statement.split())[:500])
+
+
+# --- Middleware ---
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, so the per-request context reaches the endpoint's threadpool call."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self._last_snapshot = 0.0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope=scope)
+        token = _current_request.set(stats)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current_request.reset(token)
+            labels = [scope["method"], stats.route]
+            registry.inc(HTTP_REQUESTS, labels + [status_code])
+            registry.observe(HTTP_LATENCY, labels, elapsed)
+            registry.inc(DB_STATEMENTS, labels, stats.statements)
+            registry.observe(DB_STATEMENTS_PER_REQUEST, labels, stats.statements)
+            registry.inc(DB_SECONDS, labels, stats.db_seconds)
+            registry.inc(DB_ROWS, labels, stats.rows)
+            if request_logger.isEnabledFor(logging.DEBUG):
+                request_logger.debug("%s %s %s in %.1f ms", scope["method"], stats.route, status_code, elapsed * 1000,
+                                     extra={"method": scope["method"], "route": stats.route,
+                                            "user_id": stats.user_id, "status": status_code, "latency_ms": round(elapsed * 1000, 1),
+                                            "db_statements": stats.statements})
+            if METRICS_DIR and started - self._last_snapshot >= SNAPSHOT_INTERVAL_SECONDS:
+                self._last_snapshot = started
+                write_snapshot()
+
+
+# --- Multi-process aggregation ---
+
+def write_snapshot() -> None:
+    """Persists this worker's metrics so that any worker can serve the aggregate."""
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(tmp_path, path)
+
+
+def render_metrics() -> str:
+    if not METRICS_DIR:
+        return registry.render()
+    # Other workers' last snapshots plus this worker's live values
+    own = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    snapshots = [registry.snapshot()]
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        if path == own:
+            continue
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return registry.render(snapshots)
@@ -0,0 +1,523 @@
+# migrations.py
+"""
+Versioned schema migrations applied at boot by setup_db.
+
+Each migration runs once and is recorded in `schema_migrations` together with
+its checksum and how long it took. Migrations that build indexes CONCURRENTLY
+or add constraints as NOT VALID run outside a transaction, one statement at a
+time, so that only brief locks are taken on live tables. Every statement runs
+under a short `lock_timeout` and is retried with backoff if the lock cannot be
+acquired, instead of queueing behind (and blocking) application traffic.
+
+A migration whose `obsolete_when` query returns a row is recorded without
+running: the schema it would change no longer exists in that form.
+"""
+import hashlib
+import os
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import OperationalError
+
+from models import SchemaMigration
+
+LOCK_TIMEOUT_MS = int(os.environ.get("MEALPLANNER_MIGRATION_LOCK_TIMEOUT_MS", "5000"))
+LOCK_RETRIES = int(os.environ.get("MEALPLANNER_MIGRATION_LOCK_RETRIES", "5"))
+# Arbitrary constant so that only one booting container migrates at a time
+MIGRATION_ADVISORY_LOCK = 727_001
+
+LOCK_NOT_AVAILABLE = "55P03"
+
+
+class MigrationError(Exception):
+    """Raised when a migration cannot be applied."""
+    pass
+
+
+@dataclass
+class Step:
+    sql: str
+    # Skip the step when this query returns a row (guards for non-idempotent DDL)
+    unless: Optional[str] = None
+    # Index built by this step; an INVALID leftover from a failed concurrent build is dropped first
+    index: Optional[str] = None
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    steps: List[Step] = field(default_factory=list)
+    # Record the migration without running it when this query returns a row (not part of the checksum)
+    obsolete_when: Optional[str] = None
+
+    @property
+    def online(self) -> bool:
+        """Online migrations run outside a transaction, statement by statement."""
+        return any("CONCURRENTLY" in s.sql.upper() or "VALIDATE CONSTRAINT" in s.sql.upper() for s in self.steps)
+
+    @property
+    def checksum(self) -> str:
+        digest = hashlib.sha256()
+        for s in self.steps:
+            digest.update(s.sql.encode())
+            digest.update((s.unless or "").encode())
+        return digest.hexdigest()
+
+
+def _unique_via_index(table: str, constraint: str, columns: str) -> List[Step]:
+    """Unique constraint built from a concurrently created index, so writes are never blocked by the build."""
+    exists = f"SELECT 1 FROM pg_constraint WHERE conname = '{constraint}'"
+    return [
+        Step(
+            f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {constraint} ON {table} ({columns})",
+            unless=exists,
+            index=constraint,
+        ),
+        Step(f"ALTER TABLE {table} ADD CONSTRAINT {constraint} UNIQUE USING INDEX {constraint}", unless=exists),
+    ]
+
+
+def _check_not_valid(table: str, constraint: str, condition: str) -> List[Step]:
+    """CHECK constraint added NOT VALID (brief lock) and validated separately (no write lock)."""
+    return [
+        Step(
+            f"ALTER TABLE {table} ADD CONSTRAINT {constraint} CHECK ({condition}) NOT VALID",
+            unless=f"SELECT 1 FROM pg_constraint WHERE conname = '{constraint}'",
+        ),
+        Step(
+            f"ALTER TABLE {table} VALIDATE CONSTRAINT {constraint}",
+            unless=f"SELECT 1 FROM pg_constraint WHERE conname = '{constraint}' AND convalidated",
+        ),
+    ]
+
+
+def _sync_columns(table: str, entity: str, keys: str, concurrently: bool = True) -> List[Step]:
+    """Delta-sync row version and timestamp, their triggers and the (user_id, row_version) index."""
+    index = f"ix_{table}_user_id_row_version"
+    trigger_exists = f"SELECT 1 FROM pg_trigger WHERE tgname = '{{}}' AND tgrelid = '{table}'::regclass"
+    return [
+        # Constant defaults for the existing rows (no table rewrite); new rows get their transaction id
+        Step(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS row_version bigint NOT NULL DEFAULT 0"),
+        Step(f"ALTER TABLE {table} ALTER COLUMN row_version SET DEFAULT pg_current_xact_id()::text::bigint"),
+        Step(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS updated_at timestamp NOT NULL DEFAULT now()"),
+        Step(f"""
+            CREATE TRIGGER trg_sync_row_version
+            BEFORE UPDATE ON {table}
+            FOR EACH ROW
+            WHEN (OLD.* IS DISTINCT FROM NEW.*)
+            EXECUTE FUNCTION sync_touch_row()
+        """, unless=trigger_exists.format("trg_sync_row_version")),
+        Step(f"""
+            CREATE TRIGGER trg_sync_tombstone
+            AFTER DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION sync_record_tombstone('{entity}', {keys})
+        """, unless=trigger_exists.format("trg_sync_tombstone")),
+        # Partitioned tables cannot build indexes concurrently
+        Step(f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {index} "
+             f"ON {table} (user_id, row_version)", index=index if concurrently else None),
+    ]
+
+
+# Present once weekly_plan is the current-week view onto plan_entries (see migration 8)
+WEEKLY_PLAN_IS_VIEW = "SELECT 1 FROM pg_views WHERE schemaname = current_schema() AND viewname = 'weekly_plan'"
+
+
+# Present once ingredient names are unique whatever their case (see migration 10)
+INGREDIENT_NAMES_ARE_CASE_INSENSITIVE = "SELECT 1 FROM pg_class WHERE relname = 'uniq_user_ingredient_lower_name'"
+
+
+# --- Migrations ---
+# Append new migrations with the next version number; never edit one that has shipped.
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "ingredients_user_id_index", [
+        Step("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ingredients_user_id ON ingredients (user_id)",
+             index="ix_ingredients_user_id"),
+    ]),
+    Migration(2, "ingredients_unique_name_per_user", [
+        Step("ALTER TABLE ingredients DROP CONSTRAINT IF EXISTS ingredients_name_key"),
+        *_unique_via_index("ingredients", "uniq_user_ingredient_name", "user_id, name"),
+        Step("CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uniq_global_ingredient_name "
+             "ON ingredients (name) WHERE user_id IS NULL",
+             index="uniq_global_ingredient_name"),
+    ], obsolete_when=INGREDIENT_NAMES_ARE_CASE_INSENSITIVE),
+    Migration(3, "weekly_plan_unique_slot_per_user", [
+        Step("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_weekly_plan_user_id ON weekly_plan (user_id)",
+             index="ix_weekly_plan_user_id"),
+        Step("ALTER TABLE weekly_plan DROP CONSTRAINT IF EXISTS unique_day_meal"),
+        *_unique_via_index("weekly_plan", "unique_user_day_meal", "user_id, day, meal_type"),
+    ], obsolete_when=WEEKLY_PLAN_IS_VIEW),
+    Migration(4, "recipes_user_name_index", [
+        # Serves the per-user recipe listing ordered by name
+        Step("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_recipes_user_id_name ON recipes (user_id, name)",
+             index="ix_recipes_user_id_name"),
+    ]),
+    Migration(5, "weekly_plan_day_check", [
+        *_check_not_valid(
+            "weekly_plan", "ck_weekly_plan_day",
+            "day IN ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')",
+        ),
+    ], obsolete_when=WEEKLY_PLAN_IS_VIEW),
+    Migration(6, "recipes_ingredients_gin_index", [
+        # Serves the ingredient rename/delete lookups of the recipes using an ingredient
+        Step("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_recipes_ingredients "
+             "ON recipes USING gin (ingredients jsonb_path_ops)",
+             index="ix_recipes_ingredients"),
+    ]),
+    Migration(7, "recipe_nutrients_only_on_ingredient_change", [
+        # The unconditional BEFORE INSERT OR UPDATE trigger becomes an insert trigger plus an
+        # update trigger that only fires when the ingredients (or the owner) change
+        Step("DROP TRIGGER IF EXISTS trg_update_recipe_nutrients ON recipes",
+             unless="SELECT 1 FROM pg_trigger WHERE tgname = 'trg_update_recipe_nutrients' AND tgqual IS NOT NULL"),
+        Step("""
+            CREATE TRIGGER trg_update_recipe_nutrients
+            BEFORE UPDATE OF ingredients, user_id ON recipes
+            FOR EACH ROW
+            WHEN (OLD.ingredients IS DISTINCT FROM NEW.ingredients OR OLD.user_id IS DISTINCT FROM NEW.user_id)
+            EXECUTE FUNCTION calculate_recipe_nutrients()
+        """, unless="SELECT 1 FROM pg_trigger WHERE tgname = 'trg_update_recipe_nutrients' AND tgqual IS NOT NULL"),
+        Step("""
+            CREATE TRIGGER trg_insert_recipe_nutrients
+            BEFORE INSERT ON recipes
+            FOR EACH ROW EXECUTE FUNCTION calculate_recipe_nutrients()
+        """, unless="SELECT 1 FROM pg_trigger WHERE tgname = 'trg_insert_recipe_nutrients'"),
+    ]),
+    Migration(8, "dated_plan_entries", [
+        # The day-of-week slots become dated entries of the current week in the partitioned
+        # plan_entries table (created by the schema phase), and weekly_plan becomes a view onto them
+        Step("""
+            INSERT INTO plan_entries (user_id, plan_date, meal_type, recipe_ids)
+            SELECT p.user_id,
+                   plan_week_start(current_date) + array_position(
+                       ARRAY['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']::varchar[],
+                       p.day) - 1,
+                   p.meal_type, p.recipe_ids
+            FROM weekly_plan p
+            WHERE p.user_id IS NOT NULL
+            ON CONFLICT (user_id, plan_date, meal_type) DO NOTHING
+        """, unless=WEEKLY_PLAN_IS_VIEW),
+        Step("DROP TABLE weekly_plan", unless=WEEKLY_PLAN_IS_VIEW),
+        Step("""
+            CREATE VIEW weekly_plan AS
+            SELECT user_id, plan_date,
+                   (ARRAY['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'])
+                       [extract(isodow FROM plan_date)::int] AS day,
+                   meal_type, recipe_ids
+            FROM plan_entries
+            WHERE plan_date >= plan_week_start(current_date)
+              AND plan_date < plan_week_start(current_date) + 7
+        """, unless=WEEKLY_PLAN_IS_VIEW),
+    ]),
+    Migration(9, "sync_row_versions", [
+        # sync_tombstones and the trigger functions are created by the schema phase
+        *_sync_columns("ingredients", "ingredient", "'id'"),
+        *_sync_columns("recipes", "recipe", "'id'"),
+        *_sync_columns("plan_entries", "plan", "'plan_date', 'meal_type'", concurrently=False),
+    ]),
+    Migration(10, "recipe_ingredient_ids", [
+        # Recipe items get the id of the ingredient their name matched until now (exactly:
+        # the owner's, else a global one); items already carrying an id keep it otherwise
+        Step("""
+            UPDATE recipes r SET ingredients = (
+                SELECT jsonb_agg(e.item || jsonb_build_object('id', coalesce(
+                           (SELECT i.id FROM ingredients i WHERE i.user_id = r.user_id AND i.name = e.item ->> 'name'),
+                           (SELECT i.id FROM ingredients i WHERE i.user_id IS NULL AND i.name = e.item ->> 'name'),
+                           (e.item ->> 'id')::int
+                       )) ORDER BY e.ord)
+                FROM jsonb_array_elements(r.ingredients) WITH ORDINALITY AS e(item, ord))
+            WHERE jsonb_array_length(r.ingredients) > 0
+        """, unless=INGREDIENT_NAMES_ARE_CASE_INSENSITIVE),
+        # Names differing only in case are told apart by their id, which recipes now refer to
+        Step("""
+            UPDATE ingredients i SET name = left(i.name, 240) || ' (' || i.id || ')'
+            FROM (SELECT id, row_number() OVER (PARTITION BY user_id, lower(name) ORDER BY id) AS n
+                  FROM ingredients) d
+            WHERE d.id = i.id AND d.n > 1
+        """, unless=INGREDIENT_NAMES_ARE_CASE_INSENSITIVE),
+        Step("CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uniq_user_ingredient_lower_name "
+             "ON ingredients (user_id, lower(name))",
+             index="uniq_user_ingredient_lower_name"),
+        Step("CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uniq_global_ingredient_lower_name "
+             "ON ingredients (lower(name)) WHERE user_id IS NULL",
+             index="uniq_global_ingredient_lower_name"),
+        Step("ALTER TABLE ingredients DROP CONSTRAINT IF EXISTS uniq_user_ingredient_name"),
+        Step("DROP INDEX CONCURRENTLY IF EXISTS uniq_global_ingredient_name"),
+        Step("""
+            CREATE OR REPLACE FUNCTION canonical_recipe_ingredients(items jsonb, owner integer)
+            RETURNS jsonb AS $$
+                SELECT coalesce(jsonb_agg(e.item || jsonb_build_object('id', coalesce(
+                           (SELECT i.id FROM ingredients i
+                            WHERE i.id = (e.item ->> 'id')::int AND (i.user_id = owner OR i.user_id IS NULL)),
+                           (SELECT i.id FROM ingredients i
+                            WHERE i.user_id = owner AND lower(i.name) = lower(e.item ->> 'name')),
+                           (SELECT i.id FROM ingredients i
+                            WHERE i.user_id IS NULL AND lower(i.name) = lower(e.item ->> 'name'))
+                       )) ORDER BY e.ord), '[]'::jsonb)
+                FROM jsonb_array_elements(items) WITH ORDINALITY AS e(item, ord)
+            $$ LANGUAGE sql STABLE
+        """),
+        Step("""
+            CREATE OR REPLACE FUNCTION resolve_recipe_ingredients(items jsonb)
+            RETURNS jsonb AS $$
+                SELECT coalesce(jsonb_agg(
+                           CASE WHEN i.id IS NULL THEN e.item ELSE e.item || jsonb_build_object('name', i.name) END
+                           ORDER BY e.ord), '[]'::jsonb)
+                FROM jsonb_array_elements(items) WITH ORDINALITY AS e(item, ord)
+                LEFT JOIN ingredients i ON i.id = (e.item ->> 'id')::int
+            $$ LANGUAGE sql STABLE
+        """),
+        # The nutrient trigger sums the ingredients joined by id instead of looking each name up
+        Step("""
+            CREATE OR REPLACE FUNCTION calculate_recipe_nutrients()
+            RETURNS TRIGGER AS $$
+            BEGIN
+                NEW.ingredients := canonical_recipe_ingredients(NEW.ingredients, NEW.user_id);
+                SELECT coalesce(sum(i.protein * x.quantity / i.serving_size), 0),
+                       coalesce(sum(i.carbs * x.quantity / i.serving_size), 0),
+                       coalesce(sum(i.fat * x.quantity / i.serving_size), 0),
+                       coalesce(sum(i.fiber * x.quantity / i.serving_size), 0),
+                       coalesce(sum(i.energy * x.quantity / i.serving_size), 0),
+                       coalesce(sum(i.iron_mg * x.quantity / i.serving_size), 0),
+                       coalesce(sum(i.magnesium_mg * x.quantity / i.serving_size), 0),
+                       coalesce(sum(i.calcium_mg * x.quantity / i.serving_size), 0),
+                       coalesce(sum(i.potassium_mg * x.quantity / i.serving_size), 0),
+                       coalesce(sum(i.sodium_mg * x.quantity / i.serving_size), 0),
+                       coalesce(sum(i.vitamin_c_mg * x.quantity / i.serving_size), 0)
+                INTO NEW.protein, NEW.carbs, NEW.fat, NEW.fiber, NEW.energy, NEW.iron_mg, NEW.magnesium_mg,
+                     NEW.calcium_mg, NEW.potassium_mg, NEW.sodium_mg, NEW.vitamin_c_mg
+                FROM jsonb_to_recordset(NEW.ingredients) AS x(id int, quantity float)
+                JOIN ingredients i ON i.id = x.id;
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+        """),
+        # Items still without an id match an ingredient case-insensitively (or none)
+        Step("""
+            UPDATE recipes SET ingredients = canonical_recipe_ingredients(ingredients, user_id)
+            WHERE ingredients IS DISTINCT FROM canonical_recipe_ingredients(ingredients, user_id)
+        """),
+    ]),
+    Migration(11, "unit_conversions", [
+        # unit_conversions and convert_quantity() are created by the schema phase
+        Step("ALTER TABLE ingredients ADD COLUMN IF NOT EXISTS density_g_per_ml numeric, "
+             "ADD COLUMN IF NOT EXISTS grams_per_piece numeric"),
+        Step("""
+            CREATE OR REPLACE FUNCTION recipe_nutrients(items jsonb)
+            RETURNS TABLE (protein float, carbs float, fat float, fiber float, energy float, iron_mg float,
+                           magnesium_mg float, calcium_mg float, potassium_mg float, sodium_mg float,
+                           vitamin_c_mg float) AS $$
+                SELECT coalesce(sum(i.protein * q.quantity / i.serving_size), 0),
+                       coalesce(sum(i.carbs * q.quantity / i.serving_size), 0),
+                       coalesce(sum(i.fat * q.quantity / i.serving_size), 0),
+                       coalesce(sum(i.fiber * q.quantity / i.serving_size), 0),
+                       coalesce(sum(i.energy * q.quantity / i.serving_size), 0),
+                       coalesce(sum(i.iron_mg * q.quantity / i.serving_size), 0),
+                       coalesce(sum(i.magnesium_mg * q.quantity / i.serving_size), 0),
+                       coalesce(sum(i.calcium_mg * q.quantity / i.serving_size), 0),
+                       coalesce(sum(i.potassium_mg * q.quantity / i.serving_size), 0),
+                       coalesce(sum(i.sodium_mg * q.quantity / i.serving_size), 0),
+                       coalesce(sum(i.vitamin_c_mg * q.quantity / i.serving_size), 0)
+                FROM jsonb_to_recordset(items) AS x(id int, quantity float, serving_unit text)
+                JOIN ingredients i ON i.id = x.id
+                CROSS JOIN LATERAL (SELECT coalesce(
+                    convert_quantity(x.quantity, x.serving_unit, i.serving_unit, i.density_g_per_ml, i.grams_per_piece),
+                    x.quantity) AS quantity) q
+            $$ LANGUAGE sql STABLE
+        """),
+        # Recipe quantities are converted to their ingredient's unit before they are summed
+        Step("""
+            CREATE OR REPLACE FUNCTION calculate_recipe_nutrients()
+            RETURNS TRIGGER AS $$
+            BEGIN
+                NEW.ingredients := canonical_recipe_ingredients(NEW.ingredients, NEW.user_id);
+                SELECT * INTO NEW.protein, NEW.carbs, NEW.fat, NEW.fiber, NEW.energy, NEW.iron_mg, NEW.magnesium_mg,
+                              NEW.calcium_mg, NEW.potassium_mg, NEW.sodium_mg, NEW.vitamin_c_mg
+                FROM recipe_nutrients(NEW.ingredients);
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+        """),
+        Step("""
+            CREATE OR REPLACE FUNCTION ingredient_refresh_recipes()
+            RETURNS trigger AS $$
+            BEGIN
+                UPDATE recipes r SET (protein, carbs, fat, fiber, energy, iron_mg, magnesium_mg, calcium_mg,
+                                      potassium_mg, sodium_mg, vitamin_c_mg) =
+                    (SELECT * FROM recipe_nutrients(r.ingredients))
+                WHERE r.ingredients @> jsonb_build_array(jsonb_build_object('id', NEW.id));
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """),
+        Step("""
+            CREATE TRIGGER trg_ingredient_refresh_recipes
+            AFTER UPDATE OF serving_unit, serving_size, density_g_per_ml, grams_per_piece, protein, carbs, fat, fiber,
+                            energy, iron_mg, magnesium_mg, calcium_mg, potassium_mg, sodium_mg, vitamin_c_mg
+            ON ingredients
+            FOR EACH ROW
+            WHEN ((OLD.serving_unit, OLD.serving_size, OLD.density_g_per_ml, OLD.grams_per_piece, OLD.protein,
+                   OLD.carbs, OLD.fat, OLD.fiber, OLD.energy, OLD.iron_mg, OLD.magnesium_mg, OLD.calcium_mg,
+                   OLD.potassium_mg, OLD.sodium_mg, OLD.vitamin_c_mg)
+                  IS DISTINCT FROM (NEW.serving_unit, NEW.serving_size, NEW.density_g_per_ml, NEW.grams_per_piece,
+                                    NEW.protein, NEW.carbs, NEW.fat, NEW.fiber, NEW.energy, NEW.iron_mg,
+                                    NEW.magnesium_mg, NEW.calcium_mg, NEW.potassium_mg, NEW.sodium_mg,
+                                    NEW.vitamin_c_mg))
+            EXECUTE FUNCTION ingredient_refresh_recipes()
+        """, unless="SELECT 1 FROM pg_trigger WHERE tgname = 'trg_ingredient_refresh_recipes'"),
+        # Quantities given in another unit than their ingredient's were summed as they were
+        Step("""
+            UPDATE recipes r SET (protein, carbs, fat, fiber, energy, iron_mg, magnesium_mg, calcium_mg,
+                                  potassium_mg, sodium_mg, vitamin_c_mg) =
+                (SELECT * FROM recipe_nutrients(r.ingredients))
+        """),
+        # Recipes no longer rescale on unit changes: the jobs queued to do so have nothing left to do
+        Step("""
+            UPDATE jobs SET status = 'succeeded', result = '{"recipes": 0}', finished_at = now(),
+                            locked_by = NULL, locked_at = NULL
+            WHERE kind = 'propagate_ingredient_change' AND status IN ('queued', 'running')
+        """),
+    ]),
+    Migration(12, "expiry_notices", [
+        # notifications is created by the schema phase
+        Step("ALTER TABLE ingredients ADD COLUMN IF NOT EXISTS expiry_notified_at timestamp"),
+        # Only what expires from now on is news: what already has is not notified on upgrade
+        Step("""
+            UPDATE ingredients SET expiry_notified_at = now()
+            WHERE available AND user_id IS NOT NULL AND expiry_notified_at IS NULL
+              AND (last_available + shelf_life * interval '1 day') <= now() AT TIME ZONE 'UTC'
+        """),
+        Step("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ingredients_expiry_due "
+             "ON ingredients ((last_available + shelf_life * interval '1 day')) "
+             "WHERE available AND user_id IS NOT NULL AND expiry_notified_at IS NULL",
+             index="ix_ingredients_expiry_due"),
+        Step("""
+            CREATE OR REPLACE FUNCTION reset_expiry_notice()
+            RETURNS trigger AS $$
+            BEGIN
+                NEW.expiry_notified_at := NULL;
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+        """),
+        Step("""
+            CREATE TRIGGER trg_reset_expiry_notice
+            BEFORE UPDATE OF available, last_available, shelf_life ON ingredients
+            FOR EACH ROW
+            WHEN ((OLD.available, OLD.last_available, OLD.shelf_life)
+                  IS DISTINCT FROM (NEW.available, NEW.last_available, NEW.shelf_life))
+            EXECUTE FUNCTION reset_expiry_notice()
+        """, unless="SELECT 1 FROM pg_trigger WHERE tgname = 'trg_reset_expiry_notice'"),
+    ]),
+    Migration(13, "user_shards", [
+        # Everyone lives on the first database until MEALPLANNER_SHARDS adds more
+        Step("ALTER TABLE users ADD COLUMN IF NOT EXISTS shard smallint NOT NULL DEFAULT 0"),
+    ]),
+]
+
+
+# --- Runner ---
+
+def _is_lock_timeout(e: OperationalError) -> bool:
+    return getattr(e.orig, "pgcode", None) == LOCK_NOT_AVAILABLE
+
+
+def _with_lock_retry(action, label: str) -> None:
+    """Runs `action`, retrying with exponential backoff while it fails on lock_timeout."""
+    delay = 0.2
+    for attempt in range(1, LOCK_RETRIES + 1):
+        try:
+            action()
+            return
+        except OperationalError as e:
+            if not _is_lock_timeout(e) or attempt == LOCK_RETRIES:
+                raise
+            print(f"   {label}: lock not available (attempt {attempt}/{LOCK_RETRIES}), retrying in {delay:.1f}s...")
+            time.sleep(delay)
+            delay *= 2
+
+
+def _drop_invalid_index(conn: Connection, index: str) -> None:
+    invalid = conn.execute(text("""
+        SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = :name AND NOT i.indisvalid
+    """), {"name": index}).first()
+    if invalid:
+        print(f"   dropping invalid index {index} left by an earlier failed build")
+        _with_lock_retry(lambda: conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index}")), index)
+
+
+def _run_steps(conn: Connection, migration: Migration) -> None:
+    for step in migration.steps:
+        if step.unless and conn.execute(text(step.unless)).first():
+            continue
+        if not migration.online:
+            conn.execute(text(step.sql))
+            continue
+        if step.index:
+            _drop_invalid_index(conn, step.index)
+        # Outside a transaction each statement can be retried on its own
+        _with_lock_retry(lambda: conn.execute(text(step.sql)), migration.name)
+
+
+def _apply(engine: Engine, migration: Migration) -> float:
+    started = time.perf_counter()
+    if migration.online:
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text(f"SET lock_timeout = {LOCK_TIMEOUT_MS}"))
+            _run_steps(conn, migration)
+    else:
+        def run_in_transaction():
+            with engine.begin() as conn:
+                conn.execute(text(f"SET LOCAL lock_timeout = {LOCK_TIMEOUT_MS}"))
+                _run_steps(conn, migration)
+
+        # A lock timeout aborts the whole transaction, so the whole migration is retried
+        _with_lock_retry(run_in_transaction, migration.name)
+    return (time.perf_counter() - started) * 1000
+
+
+def run_migrations(engine: Engine, migrations: Optional[List[Migration]] = None) -> List[int]:
+    """Applies pending migrations in version order and returns the versions that were applied."""
+    migrations = sorted(migrations if migrations is not None else MIGRATIONS, key=lambda m: m.version)
+    SchemaMigration.__table__.create(bind=engine, checkfirst=True)
+    applied_now = []
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_conn:
+        lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_ADVISORY_LOCK})
+        try:
+            recorded = {
+                row.version: row.checksum
+                for row in lock_conn.execute(text("SELECT version, checksum FROM schema_migrations"))
+            }
+            for migration in migrations:
+                if migration.version in recorded:
+                    if recorded[migration.version] != migration.checksum:
+                        print(f"Warning: migration {migration.version} ({migration.name}) changed after it was applied.")
+                    continue
+                if migration.obsolete_when and lock_conn.execute(text(migration.obsolete_when)).first():
+                    print(f"-- Migration {migration.version} ({migration.name}) is obsolete on this schema, recording it.")
+                    duration_ms = 0.0
+                else:
+                    print(f"-- Applying migration {migration.version}: {migration.name}...")
+                    try:
+                        duration_ms = _apply(engine, migration)
+                    except Exception as e:
+                        raise MigrationError(f"Migration {migration.version} ({migration.name}) failed: {e}") from e
+                    print(f"   applied in {duration_ms:.1f} ms")
+                lock_conn.execute(
+                    text("""
+                        INSERT INTO schema_migrations (version, name, checksum, duration_ms)
+                        VALUES (:version, :name, :checksum, :duration_ms)
+                    """),
+                    {"version": migration.version, "name": migration.name,
+                     "checksum": migration.checksum, "duration_ms": duration_ms},
+                )
+                applied_now.append(migration.version)
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_ADVISORY_LOCK})
+
+    return applied_now
@@ -11,14 +11,23 @@ from sqlalchemy import (
     TIMESTAMP,
     DDL,
     event,
-    UniqueConstraint,
     ForeignKey,
     Index,
+    BigInteger,
+    SmallInteger,
+    Float,
+    LargeBinary,
+    Date,
+    MetaData,
+    Table,
+    FetchedValue,
     text as sa_text,
 )
 from sqlalchemy.dialects.postgresql import JSONB, ARRAY
+from sqlalchemy.orm import column_property
 from sqlalchemy.sql import func
 from database import Base
+from units import CONVERSIONS
 
 # --- Enums for Meal Types ---
 # Using Python's Enum class makes choices explicit and type-safe
@@ -51,6 +60,10 @@ class DaysOfWeek(str, enum.Enum):
     
 # --- ORM Models ---
 
+# Transaction ids only grow, so rows written since a delta-sync cursor have a row_version at or above it
+ROW_VERSION_DEFAULT = sa_text("pg_current_xact_id()::text::bigint")
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -58,10 +71,18 @@ class User(Base):
     email = Column(String(255), unique=True, nullable=False)
     password_hash = Column(String(255), nullable=False)
     created_at = Column(TIMESTAMP, server_default=func.now())
+    # The shard holding the user's data (shards.py). Shard 0 has every user, as the directory
+    # that logins read; other shards have a copy of the users they hold.
+    shard = Column(SmallInteger, nullable=False, server_default=sa_text("0"))
 
     def __repr__(self):
         return f"<User(email='{self.email}')>"
 
+# When a stocked ingredient runs out of shelf life, and the rows whose expiry is still to be notified
+INGREDIENT_EXPIRES_AT = "(last_available + shelf_life * interval '1 day')"
+EXPIRY_DUE_CONDITION = "available AND user_id IS NOT NULL AND expiry_notified_at IS NULL"
+
+
 class Ingredient(Base):
     __tablename__ = "ingredients"
 
@@ -73,6 +94,9 @@ class Ingredient(Base):
     last_available = Column(TIMESTAMP, default=func.now())
     serving_unit = Column(String(10), default=None)
     serving_size = Column(Numeric, default=100)
+    # For converting recipe quantities between mass, volume and pieces (units.py); unknown when NULL
+    density_g_per_ml = Column(Numeric, default=None)
+    grams_per_piece = Column(Numeric, default=None)
     protein = Column(Numeric(10, 2), default=0.0)
     carbs = Column(Numeric(10, 2), default=0.0)
     fat = Column(Numeric(10, 2), default=0.0)
@@ -85,10 +109,22 @@ class Ingredient(Base):
     potassium_mg = Column(Numeric(10, 2), default=0.0)
     sodium_mg = Column(Numeric(10, 2), default=0.0)
     vitamin_c_mg = Column(Numeric(10, 2), default=0.0)
+    # When the owner was sent the notice of its expiry (notifications.py); cleared by a trigger
+    # when the ingredient is restocked or its shelf life changes
+    expiry_notified_at = Column(TIMESTAMP, default=None)
+    # Delta sync (routers/sync_router.py): the id of the last transaction writing the row, and its time
+    row_version = Column(BigInteger, nullable=False, server_default=ROW_VERSION_DEFAULT, server_onupdate=FetchedValue())
+    updated_at = Column(TIMESTAMP, nullable=False, server_default=func.now(), server_onupdate=FetchedValue())
 
     __table_args__ = (
-        UniqueConstraint('user_id', 'name', name='uniq_user_ingredient_name'),
-        Index('uniq_global_ingredient_name', 'name', unique=True, postgresql_where=sa_text('user_id IS NULL')),
+        # Names are unique per tenant whatever their case, and looked up case-insensitively through these
+        Index('uniq_user_ingredient_lower_name', 'user_id', sa_text('lower(name)'), unique=True),
+        Index('uniq_global_ingredient_lower_name', sa_text('lower(name)'), unique=True,
+              postgresql_where=sa_text('user_id IS NULL')),
+        Index('ix_ingredients_user_id_row_version', 'user_id', 'row_version'),
+        # The users' stocked ingredients not yet notified, by expiry: the scheduler reads only those coming due
+        Index('ix_ingredients_expiry_due', sa_text(INGREDIENT_EXPIRES_AT),
+              postgresql_where=sa_text(EXPIRY_DUE_CONDITION)),
     )
 
     def __repr__(self):
@@ -101,6 +137,8 @@ class Recipe(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(255), nullable=False)
     serves = Column(Integer, default=2)
+    # [{"id", "name", "quantity", "serving_unit"}]: `id` is the ingredient's, filled in by the nutrient
+    # trigger; `name` is as written and may be stale after a rename, so read `resolved_ingredients`
     ingredients = Column(JSONB, nullable=False)
     instructions = Column(Text, nullable=False)
     meal_type = Column(Enum(RecipeMealType, name="recipe_meal_type_enum"), nullable=False)
@@ -118,104 +156,395 @@ class Recipe(Base):
     potassium_mg = Column(Numeric(10, 2), default=0.0)
     sodium_mg = Column(Numeric(10, 2), default=0.0)
     vitamin_c_mg = Column(Numeric(10, 2), default=0.0)
+    # Delta sync (routers/sync_router.py): the id of the last transaction writing the row, and its time
+    row_version = Column(BigInteger, nullable=False, server_default=ROW_VERSION_DEFAULT, server_onupdate=FetchedValue())
+    updated_at = Column(TIMESTAMP, nullable=False, server_default=func.now(), server_onupdate=FetchedValue())
+    # The ingredients with the current name of each, looked up by id in the same SELECT
+    resolved_ingredients = column_property(func.resolve_recipe_ingredients(ingredients, type_=JSONB))
 
+    __table_args__ = (
+        Index('ix_recipes_user_id_name', 'user_id', 'name'),
+        Index('ix_recipes_user_id_row_version', 'user_id', 'row_version'),
+        # Serves "which recipes use this ingredient" containment lookups (ingredients @> '[{"id": ...}]')
+        Index('ix_recipes_ingredients', 'ingredients', postgresql_using='gin',
+              postgresql_ops={'ingredients': 'jsonb_path_ops'}),
+    )
 
     def __repr__(self):
         return f"<Recipe(name='{self.name}')>"
 
 
-class WeeklyPlan(Base):
-    __tablename__ = "weekly_plan"
+class PlanEntry(Base):
+    """
+    One dated meal slot. The table is range-partitioned by month on plan_date
+    (see partitions.py), so the current week stays cheap to read however much
+    history accumulates, and old months can be detached.
+    """
+    __tablename__ = "plan_entries"
 
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id"), index=True, nullable=False)
-    day = Column(String(16), nullable=False)
-    meal_type = Column(Enum(RecipeMealType, name="plan_meal_type_enum"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    plan_date = Column(Date, primary_key=True)
+    meal_type = Column(Enum(RecipeMealType, name="plan_meal_type_enum"), primary_key=True)
     recipe_ids = Column(ARRAY(Integer))
+    # Delta sync (routers/sync_router.py): the id of the last transaction writing the row, and its time
+    row_version = Column(BigInteger, nullable=False, server_default=ROW_VERSION_DEFAULT, server_onupdate=FetchedValue())
+    updated_at = Column(TIMESTAMP, nullable=False, server_default=func.now(), server_onupdate=FetchedValue())
 
-    # Define the unique constraint directly in the model
     __table_args__ = (
-        UniqueConstraint('user_id', 'day', 'meal_type', name='unique_user_day_meal'),
+        # Serves "which days plan this recipe" lookups (recipe_ids @> ARRAY[id]) of the nutrition rollups
+        Index('ix_plan_entries_recipe_ids', 'recipe_ids', postgresql_using='gin'),
+        Index('ix_plan_entries_user_id_row_version', 'user_id', 'row_version'),
+        {"postgresql_partition_by": "RANGE (plan_date)"},
     )
 
+    def __repr__(self):
+        return f"<PlanEntry(plan_date='{self.plan_date}', meal_type='{self.meal_type.value}')>"
+
+
+# The day-of-week API reads the current week through the `weekly_plan` view.
+# The view is created by the plan_entries DDL below, so its table lives outside
+# Base.metadata where create_all would try to create it.
+weekly_plan_view = Table(
+    "weekly_plan", MetaData(),
+    Column("user_id", Integer),
+    Column("plan_date", Date),
+    Column("day", String(16)),
+    Column("meal_type", Enum(RecipeMealType, name="plan_meal_type_enum", create_type=False)),
+    Column("recipe_ids", ARRAY(Integer)),
+)
+
+
+class WeeklyPlan(Base):
+    """Read-only: the current week's PlanEntry rows keyed by day name. Write PlanEntry rows instead."""
+    __table__ = weekly_plan_view
+    __mapper_args__ = {
+        "primary_key": [weekly_plan_view.c.user_id, weekly_plan_view.c.day, weekly_plan_view.c.meal_type],
+    }
+
     def __repr__(self):
         return f"<WeeklyPlan(day='{self.day}', meal_type='{self.meal_type.value}')>"
 
+
+# Recipe nutrient columns summed by the nutrition rollups
+NUTRIENT_COLUMNS = [
+    "protein", "carbs", "fat", "fiber", "energy",
+    "iron_mg", "magnesium_mg", "calcium_mg", "potassium_mg", "sodium_mg", "vitamin_c_mg",
+]
+
+
+class NutritionDaily(Base):
+    """
+    Nutrients of one user's planned recipes per day, kept up to date by triggers
+    on plan_entries and recipes. Days without planned recipes have no row.
+    """
+    __tablename__ = "nutrition_daily"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    recipes = Column(Integer, nullable=False, server_default="0")
+    protein = Column(Numeric(12, 2), nullable=False, server_default="0")
+    carbs = Column(Numeric(12, 2), nullable=False, server_default="0")
+    fat = Column(Numeric(12, 2), nullable=False, server_default="0")
+    fiber = Column(Numeric(12, 2), nullable=False, server_default="0")
+    energy = Column(Numeric(12, 2), nullable=False, server_default="0")
+    iron_mg = Column(Numeric(12, 2), nullable=False, server_default="0")
+    magnesium_mg = Column(Numeric(12, 2), nullable=False, server_default="0")
+    calcium_mg = Column(Numeric(12, 2), nullable=False, server_default="0")
+    potassium_mg = Column(Numeric(12, 2), nullable=False, server_default="0")
+    sodium_mg = Column(Numeric(12, 2), nullable=False, server_default="0")
+    vitamin_c_mg = Column(Numeric(12, 2), nullable=False, server_default="0")
+
+    def __repr__(self):
+        return f"<NutritionDaily(user_id={self.user_id}, day='{self.day}')>"
+
+
+class NutritionWeekly(Base):
+    """Weekly (Monday to Sunday) totals of nutrition_daily, maintained with it."""
+    __tablename__ = "nutrition_weekly"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    week_start = Column(Date, primary_key=True)
+    days_planned = Column(Integer, nullable=False, server_default="0")
+    recipes = Column(Integer, nullable=False, server_default="0")
+    protein = Column(Numeric(12, 2), nullable=False, server_default="0")
+    carbs = Column(Numeric(12, 2), nullable=False, server_default="0")
+    fat = Column(Numeric(12, 2), nullable=False, server_default="0")
+    fiber = Column(Numeric(12, 2), nullable=False, server_default="0")
+    energy = Column(Numeric(12, 2), nullable=False, server_default="0")
+    iron_mg = Column(Numeric(12, 2), nullable=False, server_default="0")
+    magnesium_mg = Column(Numeric(12, 2), nullable=False, server_default="0")
+    calcium_mg = Column(Numeric(12, 2), nullable=False, server_default="0")
+    potassium_mg = Column(Numeric(12, 2), nullable=False, server_default="0")
+    sodium_mg = Column(Numeric(12, 2), nullable=False, server_default="0")
+    vitamin_c_mg = Column(Numeric(12, 2), nullable=False, server_default="0")
+
+    def __repr__(self):
+        return f"<NutritionWeekly(user_id={self.user_id}, week_start='{self.week_start}')>"
+
+
+class BootState(Base):
+    """Checksums of the boot steps (schema, seed files) already applied by setup_db."""
+    __tablename__ = "boot_state"
+
+    step = Column(String(255), primary_key=True)
+    checksum = Column(String(64), nullable=False)
+    applied_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<BootState(step='{self.step}')>"
+
+
+class SchemaMigration(Base):
+    """Versioned migrations applied by migrations.run_migrations."""
+    __tablename__ = "schema_migrations"
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    name = Column(String(255), nullable=False)
+    checksum = Column(String(64), nullable=False)
+    duration_ms = Column(Numeric(12, 1))
+    applied_at = Column(TIMESTAMP, server_default=func.now())
+
+    def __repr__(self):
+        return f"<SchemaMigration(version={self.version}, name='{self.name}')>"
+
+
+class Job(Base):
+    """Background work claimed by the job workers with SELECT ... FOR UPDATE SKIP LOCKED."""
+    __tablename__ = "jobs"
+
+    id = Column(BigInteger, primary_key=True)
+    kind = Column(String(64), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True, nullable=True)
+    payload = Column(JSONB, nullable=False, server_default=sa_text("'{}'::jsonb"))
+    # queued -> running -> succeeded | failed (or back to queued for a retry)
+    status = Column(String(16), nullable=False, server_default="queued")
+    # Lower runs first
+    priority = Column(Integer, nullable=False, server_default="100")
+    attempts = Column(Integer, nullable=False, server_default="0")
+    max_attempts = Column(Integer, nullable=False, server_default="3")
+    run_after = Column(TIMESTAMP, nullable=False, server_default=func.now())
+    locked_by = Column(String(255))
+    locked_at = Column(TIMESTAMP)
+    last_error = Column(Text)
+    result = Column(JSONB)
+    result_bytes = Column(LargeBinary)
+    result_media_type = Column(String(255))
+    created_at = Column(TIMESTAMP, nullable=False, server_default=func.now())
+    finished_at = Column(TIMESTAMP)
+
+    __table_args__ = (
+        # Serves the dequeue query: only queued jobs, in the order they are claimed
+        Index('ix_jobs_queued', 'priority', 'run_after', 'id', postgresql_where=sa_text("status = 'queued'")),
+    )
+
+    def __repr__(self):
+        return f"<Job(id={self.id}, kind='{self.kind}', status='{self.status}')>"
+
+
+class SyncTombstone(Base):
+    """A deleted recipe, ingredient or plan entry, kept so that delta-syncing clients learn of the delete."""
+    __tablename__ = "sync_tombstones"
+
+    id = Column(BigInteger, primary_key=True)
+    # No foreign key: the rows of a deleted user go with it. Null for the global catalog.
+    user_id = Column(Integer, nullable=True)
+    entity = Column(String(16), nullable=False)
+    # Key of the deleted row: {"id": ...}, or {"plan_date": ..., "meal_type": ...} for plan entries
+    entity_key = Column(JSONB, nullable=False)
+    row_version = Column(BigInteger, nullable=False, server_default=ROW_VERSION_DEFAULT)
+    deleted_at = Column(TIMESTAMP, nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        Index('ix_sync_tombstones_user_id_row_version', 'user_id', 'row_version'),
+        # Serves the purge of old tombstones
+        Index('ix_sync_tombstones_deleted_at', 'deleted_at'),
+    )
+
+    def __repr__(self):
+        return f"<SyncTombstone(entity='{self.entity}', entity_key={self.entity_key})>"
+
+
+class Notification(Base):
+    """A message in a user's inbox, e.g. the digest of their expiring ingredients (notifications.py)."""
+    __tablename__ = "notifications"
+
+    id = Column(BigInteger, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    kind = Column(String(32), nullable=False)
+    payload = Column(JSONB, nullable=False)
+    created_at = Column(TIMESTAMP, nullable=False, server_default=func.now())
+    read_at = Column(TIMESTAMP)
+
+    __table_args__ = (
+        # A user's inbox, newest first
+        Index('ix_notifications_user_id_id', 'user_id', 'id'),
+        # Serves the purge of old notifications
+        Index('ix_notifications_created_at', 'created_at'),
+    )
+
+    def __repr__(self):
+        return f"<Notification(id={self.id}, kind='{self.kind}')>"
+
+
+class UnitConversion(Base):
+    """How to convert a quantity between two serving units, filled from units.CONVERSIONS."""
+    __tablename__ = "unit_conversions"
+
+    from_unit = Column(String(10), primary_key=True)
+    to_unit = Column(String(10), primary_key=True)
+    # quantity * factor * density ^ density_power * grams_per_piece ^ piece_power
+    factor = Column(Float, nullable=False)
+    density_power = Column(SmallInteger, nullable=False)
+    piece_power = Column(SmallInteger, nullable=False)
+
+    def __repr__(self):
+        return f"<UnitConversion(from_unit='{self.from_unit}', to_unit='{self.to_unit}')>"
+
+
 # --- DDL for Triggers (Advanced SQLAlchemy) ---
 # This is the modern way to handle raw SQL triggers.
 # The trigger logic is attached to the table metadata.
 
 # 1. Nutrition Calculation Trigger for Recipes
-calculate_nutrition_func = DDL("""
+# Recipe items refer to their ingredient by id. Items written without one (or with the id
+# of an ingredient the recipe's owner cannot see) get it from their name, matched
+# case-insensitively among the owner's ingredients and then the global ones.
+recipe_ingredient_funcs = DDL("""
+    CREATE OR REPLACE FUNCTION canonical_recipe_ingredients(items jsonb, owner integer)
+    RETURNS jsonb AS $$
+        SELECT coalesce(jsonb_agg(e.item || jsonb_build_object('id', coalesce(
+                   (SELECT i.id FROM ingredients i
+                    WHERE i.id = (e.item ->> 'id')::int AND (i.user_id = owner OR i.user_id IS NULL)),
+                   (SELECT i.id FROM ingredients i
+                    WHERE i.user_id = owner AND lower(i.name) = lower(e.item ->> 'name')),
+                   (SELECT i.id FROM ingredients i
+                    WHERE i.user_id IS NULL AND lower(i.name) = lower(e.item ->> 'name'))
+               )) ORDER BY e.ord), '[]'::jsonb)
+        FROM jsonb_array_elements(items) WITH ORDINALITY AS e(item, ord)
+    $$ LANGUAGE sql STABLE;
+
+    CREATE OR REPLACE FUNCTION resolve_recipe_ingredients(items jsonb)
+    RETURNS jsonb AS $$
+        SELECT coalesce(jsonb_agg(
+                   CASE WHEN i.id IS NULL THEN e.item ELSE e.item || jsonb_build_object('name', i.name) END
+                   ORDER BY e.ord), '[]'::jsonb)
+        FROM jsonb_array_elements(items) WITH ORDINALITY AS e(item, ord)
+        LEFT JOIN ingredients i ON i.id = (e.item ->> 'id')::int
+    $$ LANGUAGE sql STABLE;
+""")
+
+# Each item's quantity is converted to its ingredient's serving unit (see units.py) before
+# scaling the nutrients per serving size; a quantity that cannot be converted counts as is.
+_recipe_nutrient_sums = ",\n               ".join(
+    f"coalesce(sum(i.{n} * q.quantity / i.serving_size), 0)" for n in NUTRIENT_COLUMNS)
+_recipe_nutrient_types = ", ".join(f"{n} float" for n in NUTRIENT_COLUMNS)
+
+recipe_nutrients_func = DDL(f"""
+    CREATE OR REPLACE FUNCTION recipe_nutrients(items jsonb)
+    RETURNS TABLE ({_recipe_nutrient_types}) AS $$
+        SELECT {_recipe_nutrient_sums}
+        FROM jsonb_to_recordset(items) AS x(id int, quantity float, serving_unit text)
+        JOIN ingredients i ON i.id = x.id
+        CROSS JOIN LATERAL (SELECT coalesce(
+            convert_quantity(x.quantity, x.serving_unit, i.serving_unit, i.density_g_per_ml, i.grams_per_piece),
+            x.quantity) AS quantity) q
+    $$ LANGUAGE sql STABLE;
+""")
+
+calculate_nutrition_func = DDL(f"""
     CREATE OR REPLACE FUNCTION calculate_recipe_nutrients()
     RETURNS TRIGGER AS $$
-    DECLARE
-        ing_record RECORD;
-        nutrient_data RECORD;
-        total_protein FLOAT := 0.0; 
-        total_carbs FLOAT := 0.0;
-        total_fat FLOAT := 0.0; 
-        total_fiber FLOAT := 0.0;
-        total_energy FLOAT := 0.0;
-        total_iron_mg FLOAT := 0.0;
-        total_magnesium_mg FLOAT := 0.0;
-        total_calcium_mg FLOAT := 0.0;
-        total_potassium_mg FLOAT := 0.0;
-        total_sodium_mg FLOAT := 0.0;
-        total_vitamin_c_mg FLOAT := 0.0;
     BEGIN
-        FOR ing_record IN SELECT * FROM jsonb_to_recordset(NEW.ingredients) AS x(name text, quantity float, unit text)
-        LOOP
-            -- If recipe is user-specific, prefer that user's ingredient values; else fall back to any matching name
-            IF NEW.user_id IS NOT NULL THEN
-                SELECT * INTO nutrient_data FROM ingredients WHERE name = ing_record.name AND user_id = NEW.user_id LIMIT 1;
-            END IF;
-            IF NOT FOUND THEN
-                SELECT * INTO nutrient_data FROM ingredients WHERE name = ing_record.name LIMIT 1;
-            END IF;
-            IF FOUND THEN
-                total_protein := total_protein + (nutrient_data.protein * ing_record.quantity / nutrient_data.serving_size);
-                total_carbs := total_carbs + (nutrient_data.carbs * ing_record.quantity/ nutrient_data.serving_size);
-                total_fat := total_fat + (nutrient_data.fat * ing_record.quantity/ nutrient_data.serving_size);
-                total_fiber := total_fiber + (nutrient_data.fiber * ing_record.quantity/ nutrient_data.serving_size);
-                total_energy := total_energy + (nutrient_data.energy * ing_record.quantity/ nutrient_data.serving_size);
-                total_iron_mg := total_iron_mg + (nutrient_data.iron_mg * ing_record.quantity/ nutrient_data.serving_size);
-                total_magnesium_mg := total_magnesium_mg + (nutrient_data.magnesium_mg * ing_record.quantity/ nutrient_data.serving_size);
-                total_calcium_mg := total_calcium_mg + (nutrient_data.calcium_mg * ing_record.quantity/ nutrient_data.serving_size);
-                total_potassium_mg := total_potassium_mg + (nutrient_data.potassium_mg * ing_record.quantity/ nutrient_data.serving_size);
-                total_sodium_mg := total_sodium_mg + (nutrient_data.sodium_mg * ing_record.quantity/ nutrient_data.serving_size);
-                total_vitamin_c_mg := total_vitamin_c_mg + (nutrient_data.vitamin_c_mg * ing_record.quantity/ nutrient_data.serving_size);
-            ELSE
-            END IF;
-        END LOOP;
-        NEW.protein := total_protein; 
-        NEW.carbs := total_carbs;
-        NEW.fat := total_fat; 
-        NEW.fiber := total_fiber;
-        NEW.energy := total_energy;
-        NEW.iron_mg := total_iron_mg;
-        NEW.magnesium_mg := total_magnesium_mg;
-        NEW.calcium_mg := total_calcium_mg;
-        NEW.potassium_mg := total_potassium_mg;
-        NEW.sodium_mg := total_sodium_mg;
-        NEW.vitamin_c_mg := total_vitamin_c_mg;
+        NEW.ingredients := canonical_recipe_ingredients(NEW.ingredients, NEW.user_id);
+        SELECT * INTO {", ".join(f"NEW.{n}" for n in NUTRIENT_COLUMNS)} FROM recipe_nutrients(NEW.ingredients);
         RETURN NEW;
     END;
     $$ LANGUAGE plpgsql;
 """)
 
-create_nutrition_trigger = DDL("""
-    CREATE TRIGGER trg_update_recipe_nutrients
-    BEFORE INSERT OR UPDATE ON recipes
+create_nutrition_insert_trigger = DDL("""
+    CREATE TRIGGER trg_insert_recipe_nutrients
+    BEFORE INSERT ON recipes
     FOR EACH ROW EXECUTE FUNCTION calculate_recipe_nutrients();
 """)
 
-# Associate the function and trigger with the Recipe table
+# Edits that leave the ingredients (and the owner, whose ingredients are looked up) alone
+# keep the stored nutrients instead of re-running the lookups.
+create_nutrition_update_trigger = DDL("""
+    CREATE TRIGGER trg_update_recipe_nutrients
+    BEFORE UPDATE OF ingredients, user_id ON recipes
+    FOR EACH ROW
+    WHEN (OLD.ingredients IS DISTINCT FROM NEW.ingredients OR OLD.user_id IS DISTINCT FROM NEW.user_id)
+    EXECUTE FUNCTION calculate_recipe_nutrients();
+""")
+
+# The ingredient columns recipe nutrients derive from: recipes using an ingredient are re-summed when they change
+RECIPE_NUTRIENT_INPUTS = ["serving_unit", "serving_size", "density_g_per_ml", "grams_per_piece",
+                                *NUTRIENT_COLUMNS]
+
+ingredient_refresh_recipes_func = DDL(f"""
+    CREATE OR REPLACE FUNCTION ingredient_refresh_recipes()
+    RETURNS trigger AS $$
+    BEGIN
+        UPDATE recipes r SET ({", ".join(NUTRIENT_COLUMNS)}) = (SELECT * FROM recipe_nutrients(r.ingredients))
+        WHERE r.ingredients @> jsonb_build_array(jsonb_build_object('id', NEW.id));
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+""")
+
+create_ingredient_refresh_recipes_trigger = DDL(f"""
+    CREATE TRIGGER trg_ingredient_refresh_recipes
+    AFTER UPDATE OF {", ".join(RECIPE_NUTRIENT_INPUTS)} ON ingredients
+    FOR EACH ROW
+    WHEN (({", ".join(f"OLD.{c}" for c in RECIPE_NUTRIENT_INPUTS)})
+          IS DISTINCT FROM ({", ".join(f"NEW.{c}" for c in RECIPE_NUTRIENT_INPUTS)}))
+    EXECUTE FUNCTION ingredient_refresh_recipes();
+""")
+
+# Associate the function and triggers with the Recipe table; the functions read ingredients and unit conversions
+Recipe.__table__.add_is_dependent_on(Ingredient.__table__)
+Recipe.__table__.add_is_dependent_on(UnitConversion.__table__)
+event.listen(Recipe.__table__, 'before_create', recipe_ingredient_funcs)
+event.listen(Recipe.__table__, 'before_create', recipe_nutrients_func)
 event.listen(Recipe.__table__, 'before_create', calculate_nutrition_func)
-event.listen(Recipe.__table__, 'after_create', create_nutrition_trigger)
+event.listen(Recipe.__table__, 'after_create', create_nutrition_insert_trigger)
+event.listen(Recipe.__table__, 'after_create', create_nutrition_update_trigger)
+event.listen(Recipe.__table__, 'after_create', ingredient_refresh_recipes_func)
+event.listen(Recipe.__table__, 'after_create', create_ingredient_refresh_recipes_trigger)
+
 
+# Unit conversions: the rows of units.CONVERSIONS, and quantity conversion over them
+_conversion_rows = ",\n        ".join(
+    f"('{from_unit}', '{to_unit}', {c.factor!r}, {c.density_power}, {c.piece_power})"
+    for (from_unit, to_unit), c in CONVERSIONS.items()
+)
+
+seed_unit_conversions = DDL(f"""
+    INSERT INTO unit_conversions (from_unit, to_unit, factor, density_power, piece_power) VALUES
+        {_conversion_rows}
+    ON CONFLICT (from_unit, to_unit) DO UPDATE SET
+        factor = EXCLUDED.factor, density_power = EXCLUDED.density_power, piece_power = EXCLUDED.piece_power;
+""")
 
-# 2. Foreign Key Check Trigger for WeeklyPlan
+# NULL when the units are unknown, or the density or piece weight needed is
+convert_quantity_func = DDL("""
+    CREATE OR REPLACE FUNCTION convert_quantity(quantity float, from_unit text, to_unit text,
+                                                density numeric, grams_per_piece numeric)
+    RETURNS float AS $$
+        SELECT quantity * c.factor
+               * CASE c.density_power WHEN 0 THEN 1 ELSE power(NULLIF(density, 0)::float, c.density_power) END
+               * CASE c.piece_power WHEN 0 THEN 1 ELSE power(NULLIF(grams_per_piece, 0)::float, c.piece_power) END
+        FROM unit_conversions c
+        WHERE c.from_unit = $2 AND c.to_unit = $3
+    $$ LANGUAGE sql STABLE;
+""")
+
+event.listen(UnitConversion.__table__, 'after_create', seed_unit_conversions)
+event.listen(UnitConversion.__table__, 'after_create', convert_quantity_func)
+
+
+# 2. Foreign Key Check Trigger for plan entries
 # NOTE: A many-to-many table is often a better design than ARRAY of foreign keys,
 # but this preserves your original structure.
 check_recipe_ids_func = DDL("""
@@ -237,11 +566,251 @@ check_recipe_ids_func = DDL("""
 """)
 
 create_recipe_ids_trigger = DDL("""
-    CREATE CONSTRAINT TRIGGER trg_check_recipe_ids_exist
-    AFTER INSERT OR UPDATE ON weekly_plan
+    CREATE CONSTRAINT TRIGGER trg_check_plan_recipe_ids_exist
+    AFTER INSERT OR UPDATE ON plan_entries
     DEFERRABLE INITIALLY DEFERRED
     FOR EACH ROW EXECUTE FUNCTION check_recipe_ids_exist();
 """)
 
-event.listen(WeeklyPlan.__table__, 'before_create', check_recipe_ids_func)
-event.listen(WeeklyPlan.__table__, 'after_create', create_recipe_ids_trigger)
\ No newline at end of file
+# 3. The current week: Monday to Sunday around current_date
+plan_week_start_func = DDL("""
+    CREATE OR REPLACE FUNCTION plan_week_start(d date)
+    RETURNS date AS $$
+        SELECT d - (extract(isodow FROM d)::int - 1);
+    $$ LANGUAGE sql IMMUTABLE;
+""")
+
+# Skipped while a pre-partitioning weekly_plan table exists: migration 8 moves
+# its rows into plan_entries and replaces it with this view.
+create_weekly_plan_view = DDL("""
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = current_schema() AND tablename = 'weekly_plan') THEN
+            CREATE OR REPLACE VIEW weekly_plan AS
+            SELECT user_id, plan_date,
+                   (ARRAY['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'])
+                       [extract(isodow FROM plan_date)::int] AS day,
+                   meal_type, recipe_ids
+            FROM plan_entries
+            WHERE plan_date >= plan_week_start(current_date)
+              AND plan_date < plan_week_start(current_date) + 7;
+        END IF;
+    END $$;
+""")
+
+
+def create_plan_partitions(target, connection, **kw):
+    # Rows can only be written into months that have a partition
+    import partitions
+    partitions.ensure_current(connection)
+
+
+event.listen(PlanEntry.__table__, 'before_create', check_recipe_ids_func)
+event.listen(PlanEntry.__table__, 'before_create', plan_week_start_func)
+event.listen(PlanEntry.__table__, 'after_create', create_recipe_ids_trigger)
+event.listen(PlanEntry.__table__, 'after_create', create_weekly_plan_view)
+event.listen(PlanEntry.__table__, 'after_create', create_plan_partitions)
+
+
+# 4. Nutrition rollups: a day is recomputed from its plan entries whenever they change,
+# and the days planning a recipe whenever its nutrients change or it is deleted.
+_sums = ", ".join(f"sum(r.{n})" for n in NUTRIENT_COLUMNS)
+_weekly_sums = ", ".join(f"sum({n})" for n in NUTRIENT_COLUMNS)
+_columns = ", ".join(NUTRIENT_COLUMNS)
+_updates = ", ".join(f"{n} = EXCLUDED.{n}" for n in ["recipes", *NUTRIENT_COLUMNS])
+
+refresh_nutrition_day_func = DDL(f"""
+    CREATE OR REPLACE FUNCTION refresh_nutrition_day(p_user integer, p_day date)
+    RETURNS void AS $$
+    DECLARE
+        week date := plan_week_start(p_day);
+    BEGIN
+        INSERT INTO nutrition_daily (user_id, day, recipes, {_columns})
+        SELECT p.user_id, p.plan_date, count(*), {_sums}
+        FROM plan_entries p JOIN recipes r ON r.id = ANY(p.recipe_ids)
+        WHERE p.user_id = p_user AND p.plan_date = p_day
+        GROUP BY p.user_id, p.plan_date
+        ON CONFLICT (user_id, day) DO UPDATE SET {_updates};
+        IF NOT FOUND THEN
+            DELETE FROM nutrition_daily WHERE user_id = p_user AND day = p_day;
+        END IF;
+
+        INSERT INTO nutrition_weekly (user_id, week_start, days_planned, recipes, {_columns})
+        SELECT user_id, week, count(*), sum(recipes), {_weekly_sums}
+        FROM nutrition_daily
+        WHERE user_id = p_user AND day >= week AND day < week + 7
+        GROUP BY user_id
+        ON CONFLICT (user_id, week_start) DO UPDATE SET days_planned = EXCLUDED.days_planned, {_updates};
+        IF NOT FOUND THEN
+            DELETE FROM nutrition_weekly WHERE user_id = p_user AND week_start = week;
+        END IF;
+    END;
+    $$ LANGUAGE plpgsql;
+""")
+
+plan_entry_nutrition_func = DDL("""
+    CREATE OR REPLACE FUNCTION plan_entry_refresh_nutrition()
+    RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM refresh_nutrition_day(NEW.user_id, NEW.plan_date);
+        END IF;
+        IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND (OLD.user_id, OLD.plan_date) IS DISTINCT FROM (NEW.user_id, NEW.plan_date)) THEN
+            PERFORM refresh_nutrition_day(OLD.user_id, OLD.plan_date);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+""")
+
+recipe_nutrition_func = DDL("""
+    CREATE OR REPLACE FUNCTION recipe_refresh_nutrition()
+    RETURNS trigger AS $$
+    BEGIN
+        PERFORM refresh_nutrition_day(d.user_id, d.plan_date)
+        FROM (SELECT DISTINCT user_id, plan_date FROM plan_entries WHERE recipe_ids @> ARRAY[OLD.id]) d;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+""")
+
+create_plan_entry_insert_delete_nutrition_trigger = DDL("""
+    CREATE TRIGGER trg_plan_entry_nutrition
+    AFTER INSERT OR DELETE ON plan_entries
+    FOR EACH ROW EXECUTE FUNCTION plan_entry_refresh_nutrition();
+""")
+
+create_plan_entry_update_nutrition_trigger = DDL("""
+    CREATE TRIGGER trg_plan_entry_nutrition_update
+    AFTER UPDATE ON plan_entries
+    FOR EACH ROW
+    WHEN ((OLD.user_id, OLD.plan_date, OLD.recipe_ids) IS DISTINCT FROM (NEW.user_id, NEW.plan_date, NEW.recipe_ids))
+    EXECUTE FUNCTION plan_entry_refresh_nutrition();
+""")
+
+create_recipe_nutrition_update_trigger = DDL(f"""
+    CREATE TRIGGER trg_recipe_nutrition_rollup
+    AFTER UPDATE ON recipes
+    FOR EACH ROW
+    WHEN (({", ".join(f"OLD.{n}" for n in NUTRIENT_COLUMNS)}) IS DISTINCT FROM ({", ".join(f"NEW.{n}" for n in NUTRIENT_COLUMNS)}))
+    EXECUTE FUNCTION recipe_refresh_nutrition();
+""")
+
+create_recipe_nutrition_delete_trigger = DDL("""
+    CREATE TRIGGER trg_recipe_nutrition_rollup_delete
+    AFTER DELETE ON recipes
+    FOR EACH ROW EXECUTE FUNCTION recipe_refresh_nutrition();
+""")
+
+# Existing databases got plan_entries before this index was declared on it
+create_plan_recipe_ids_index = DDL("""
+    CREATE INDEX IF NOT EXISTS ix_plan_entries_recipe_ids ON plan_entries USING gin (recipe_ids);
+""")
+
+# Rolls up the plan history already recorded when the rollup tables are added
+backfill_nutrition_rollups = DDL("""
+    SELECT refresh_nutrition_day(d.user_id, d.plan_date)
+    FROM (SELECT DISTINCT user_id, plan_date FROM plan_entries) d;
+""")
+
+# Created with nutrition_daily, so that existing databases get them when the rollup tables are added.
+# The triggers are on plan_entries and recipes, which must exist first.
+NutritionDaily.__table__.add_is_dependent_on(PlanEntry.__table__)
+NutritionDaily.__table__.add_is_dependent_on(Recipe.__table__)
+NutritionDaily.__table__.add_is_dependent_on(NutritionWeekly.__table__)
+event.listen(NutritionDaily.__table__, 'before_create', refresh_nutrition_day_func)
+event.listen(NutritionDaily.__table__, 'before_create', plan_entry_nutrition_func)
+event.listen(NutritionDaily.__table__, 'before_create', recipe_nutrition_func)
+event.listen(NutritionDaily.__table__, 'after_create', create_plan_entry_insert_delete_nutrition_trigger)
+event.listen(NutritionDaily.__table__, 'after_create', create_plan_entry_update_nutrition_trigger)
+event.listen(NutritionDaily.__table__, 'after_create', create_recipe_nutrition_update_trigger)
+event.listen(NutritionDaily.__table__, 'after_create', create_recipe_nutrition_delete_trigger)
+event.listen(NutritionDaily.__table__, 'after_create', create_plan_recipe_ids_index)
+event.listen(NutritionDaily.__table__, 'after_create', backfill_nutrition_rollups)
+
+
+# 5. Delta sync: every update stamps the row with the writing transaction and the time,
+# and every delete leaves a tombstone naming the deleted row's key.
+sync_touch_row_func = DDL("""
+    CREATE OR REPLACE FUNCTION sync_touch_row()
+    RETURNS trigger AS $$
+    BEGIN
+        NEW.row_version := pg_current_xact_id()::text::bigint;
+        NEW.updated_at := now();
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+""")
+
+# Arguments: the entity name, then the key columns of the table
+sync_record_tombstone_func = DDL("""
+    CREATE OR REPLACE FUNCTION sync_record_tombstone()
+    RETURNS trigger AS $$
+    DECLARE
+        old_row jsonb := to_jsonb(OLD);
+    BEGIN
+        INSERT INTO sync_tombstones (user_id, entity, entity_key)
+        SELECT OLD.user_id, TG_ARGV[0], jsonb_object_agg(k, old_row -> k)
+        FROM unnest(TG_ARGV[1:]) k;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+""")
+
+
+def _sync_triggers(table, entity, *key_columns):
+    keys = ", ".join(f"'{c}'" for c in key_columns)
+    return [
+        # Updates that change nothing keep their version
+        DDL(f"""
+            CREATE TRIGGER trg_sync_row_version
+            BEFORE UPDATE ON {table}
+            FOR EACH ROW
+            WHEN (OLD.* IS DISTINCT FROM NEW.*)
+            EXECUTE FUNCTION sync_touch_row();
+        """),
+        DDL(f"""
+            CREATE TRIGGER trg_sync_tombstone
+            AFTER DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION sync_record_tombstone('{entity}', {keys});
+        """),
+    ]
+
+
+# The functions come with sync_tombstones, which is created before the synced tables.
+# Existing databases get the columns and triggers from migration 9.
+event.listen(SyncTombstone.__table__, 'before_create', sync_touch_row_func)
+event.listen(SyncTombstone.__table__, 'before_create', sync_record_tombstone_func)
+for _table, _entity, _keys in (
+    (Ingredient.__table__, "ingredient", ("id",)),
+    (Recipe.__table__, "recipe", ("id",)),
+    (PlanEntry.__table__, "plan", ("plan_date", "meal_type")),
+):
+    _table.add_is_dependent_on(SyncTombstone.__table__)
+    for _ddl in _sync_triggers(_table.name, _entity, *_keys):
+        event.listen(_table, 'after_create', _ddl)
+
+
+# 6. Expiry notices: restocking an ingredient, or changing its shelf life, makes its
+# expiry news again for the scheduler in notifications.py
+reset_expiry_notice_func = DDL("""
+    CREATE OR REPLACE FUNCTION reset_expiry_notice()
+    RETURNS trigger AS $$
+    BEGIN
+        NEW.expiry_notified_at := NULL;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+""")
+
+create_reset_expiry_notice_trigger = DDL("""
+    CREATE TRIGGER trg_reset_expiry_notice
+    BEFORE UPDATE OF available, last_available, shelf_life ON ingredients
+    FOR EACH ROW
+    WHEN ((OLD.available, OLD.last_available, OLD.shelf_life)
+          IS DISTINCT FROM (NEW.available, NEW.last_available, NEW.shelf_life))
+    EXECUTE FUNCTION reset_expiry_notice();
+""")
+
+event.listen(Ingredient.__table__, 'after_create', reset_expiry_notice_func)
+event.listen(Ingredient.__table__, 'after_create', create_reset_expiry_notice_trigger)
@@ -0,0 +1,171 @@
+# notifications.py
+"""
+Expiry digests: each user is told once about their stocked ingredients that
+are expiring.
+
+An ingredient expires `shelf_life` days after it was last marked available.
+The job workers' maintenance runs `notify_expiring_ingredients()` every
+minute. It reads the ingredients of all tenants that expire within
+MEALPLANNER_EXPIRY_NOTICE_DAYS and that were not notified yet. A partial
+index on the expiry time holds only the ingredients still to be notified, so
+a run reads the rows coming due and nothing else, however many tenants and
+ingredients there are. The run stamps those rows `expiry_notified_at`, groups
+them into one digest per user and hands the digests to the sinks named in
+MEALPLANNER_NOTIFICATION_SINKS:
+
+- `inbox` stores them in `notifications`, read through GET /notifications
+- `log` logs them
+- `webhook` queues a job POSTing each digest as JSON to
+  MEALPLANNER_NOTIFICATION_WEBHOOK_URL, with the jobs' retries
+
+The stamps and the sinks' writes commit together. A run that fails notifies
+nobody, and the next run tries again. An advisory lock lets one process scan
+at a time. Restocking an ingredient, or changing its shelf life, clears its
+stamp (see models.py), so its next expiry is notified again.
+"""
+import datetime
+import json
+import logging
+import os
+import urllib.request
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from events import publish
+from jobs import enqueue, job_handler, maintenance_task
+from metrics import registry
+from models import EXPIRY_DUE_CONDITION, INGREDIENT_EXPIRES_AT, Job, Notification
+
+logger = logging.getLogger("uvicorn")
+
+# Ingredients expiring this many days ahead (or already expired) are notified
+EXPIRY_NOTICE_DAYS = float(os.environ.get("MEALPLANNER_EXPIRY_NOTICE_DAYS", "1"))
+# Ingredients notified per run at most, soonest expiry first; the rest wait for the next run
+EXPIRY_BATCH_SIZE = int(os.environ.get("MEALPLANNER_EXPIRY_BATCH_SIZE", "1000"))
+NOTIFICATION_SINKS = [
+    s.strip() for s in os.environ.get("MEALPLANNER_NOTIFICATION_SINKS", "inbox").split(",") if s.strip()
+]
+WEBHOOK_URL = os.environ.get("MEALPLANNER_NOTIFICATION_WEBHOOK_URL", "")
+NOTIFICATION_RETENTION_DAYS = int(os.environ.get("MEALPLANNER_NOTIFICATION_RETENTION_DAYS", "30"))
+
+EXPIRY_ADVISORY_LOCK = 727_002
+
+EXPIRY_DIGEST = "expiry_digest"
+
+DIGESTS_SENT = registry.counter(
+    "mealplanner_notification_digests_total", "Notification digests handed to each sink, by kind.",
+    ["kind", "sink"])
+
+
+@dataclass
+class Digest:
+    user_id: int
+    email: str
+    kind: str
+    # {"id", "name", "expires_at"} of each ingredient, soonest first
+    items: List[dict] = field(default_factory=list)
+
+    def payload(self) -> dict:
+        return {"kind": self.kind, "items": self.items}
+
+
+# --- Sinks ---
+
+# name -> sink(session, digests); runs in the transaction that marks the digests' rows notified
+SINKS: Dict[str, Callable[[Session, List[Digest]], None]] = {}
+
+
+def notification_sink(name: str):
+    def register(fn: Callable[[Session, List[Digest]], None]):
+        SINKS[name] = fn
+        return fn
+    return register
+
+
+@notification_sink("log")
+def log_sink(session: Session, digests: List[Digest]) -> None:
+    for digest in digests:
+        logger.info("%s for %s: %s", digest.kind, digest.email, ", ".join(i["name"] for i in digest.items))
+
+
+@notification_sink("inbox")
+def inbox_sink(session: Session, digests: List[Digest]) -> None:
+    notifications = [Notification(user_id=d.user_id, kind=d.kind, payload=d.payload()) for d in digests]
+    session.add_all(notifications)
+    session.flush()
+    for notification in notifications:
+        publish(session, notification.user_id, "notification", "created", [notification.id])
+
+
+@notification_sink("webhook")
+def webhook_sink(session: Session, digests: List[Digest]) -> None:
+    if not WEBHOOK_URL:
+        logger.warning("The webhook notification sink needs MEALPLANNER_NOTIFICATION_WEBHOOK_URL; skipped")
+        return
+    for digest in digests:
+        enqueue(session, "notification_webhook", {"email": digest.email, **digest.payload()},
+                user_id=digest.user_id)
+
+
+@job_handler("notification_webhook")
+def deliver_webhook(session: Session, job: Job) -> dict:
+    request = urllib.request.Request(
+        WEBHOOK_URL, data=json.dumps(job.payload).encode(), method="POST",
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return {"status": response.status}
+
+
+def deliver(session: Session, digests: List[Digest]) -> None:
+    for name in NOTIFICATION_SINKS:
+        sink = SINKS.get(name)
+        if sink is None:
+            logger.warning("Unknown notification sink '%s'", name)
+            continue
+        sink(session, digests)
+        for digest in digests:
+            registry.inc(DIGESTS_SENT, [digest.kind, name])
+
+
+# --- Scheduler ---
+
+@maintenance_task
+def notify_expiring_ingredients(db: Session) -> None:
+    # One process scans at a time; the others skip this round
+    if not db.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": EXPIRY_ADVISORY_LOCK}).scalar():
+        return
+    # Shelf life counts from last_available, which is written in UTC
+    horizon = datetime.datetime.utcnow() + datetime.timedelta(days=EXPIRY_NOTICE_DAYS)
+    rows = db.execute(text(f"""
+        WITH due AS (
+            SELECT id FROM ingredients
+            WHERE {EXPIRY_DUE_CONDITION} AND {INGREDIENT_EXPIRES_AT} <= :horizon
+            ORDER BY {INGREDIENT_EXPIRES_AT}
+            LIMIT :batch
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE ingredients i SET expiry_notified_at = now()
+        FROM due, users u
+        WHERE i.id = due.id AND u.id = i.user_id
+        RETURNING i.user_id, u.email, i.id, i.name, {INGREDIENT_EXPIRES_AT} AS expires_at
+    """), {"horizon": horizon, "batch": EXPIRY_BATCH_SIZE}).all()
+    if not rows:
+        return
+
+    digests: Dict[int, Digest] = {}
+    for row in sorted(rows, key=lambda r: (r.user_id, r.expires_at, r.name)):
+        digest = digests.setdefault(row.user_id, Digest(row.user_id, row.email, EXPIRY_DIGEST))
+        digest.items.append({"id": row.id, "name": row.name, "expires_at": row.expires_at.isoformat()})
+    deliver(db, list(digests.values()))
+    logger.info("Notified %d expiring ingredients in %d digests", len(rows), len(digests))
+
+
+@maintenance_task
+def purge_notifications(db: Session) -> None:
+    db.execute(text(
+        f"DELETE FROM notifications WHERE created_at < now() - interval '{NOTIFICATION_RETENTION_DAYS} days'"
+    ))
@@ -0,0 +1,77 @@
+# nutrients.py
+"""
+Recipe items resolved and their nutrients computed in Python, with the same
+rules as the `canonical_recipe_ingredients()` and `recipe_nutrients()` SQL
+functions behind the recipe triggers (models.py).
+
+An item names its ingredient by id, when that id is one of the owner's or a
+global ingredient, and otherwise by name, ignoring case: the owner's
+ingredient first, then the global one. Each item's quantity is converted to
+its ingredient's serving unit (units.py), or counted as is when it cannot be,
+and contributes the ingredient's nutrients per serving size in proportion.
+Items naming no known ingredient contribute nothing.
+
+The database stays the authority for stored recipes. This is for code that
+builds recipes outside it, e.g. generate_data.py, whose bulk loads switch the
+triggers off.
+"""
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+from units import convert_quantity
+
+NUTRIENTS = [
+    "protein", "carbs", "fat", "fiber", "energy",
+    "iron_mg", "magnesium_mg", "calcium_mg", "potassium_mg", "sodium_mg", "vitamin_c_mg",
+]
+
+
+class IngredientIndex:
+    """
+    Ingredients by id and by (owner, lowercased name), to resolve recipe items
+    against. Each ingredient is a mapping with its id, user_id (None for the
+    global ones), name, serving_unit, serving_size, density_g_per_ml,
+    grams_per_piece and NUTRIENTS.
+    """
+
+    def __init__(self, ingredients: Iterable[Mapping]) -> None:
+        self.by_id: Dict[int, Mapping] = {}
+        self._by_name: Dict[Tuple[Optional[int], str], Mapping] = {}
+        for ingredient in ingredients:
+            self.by_id[ingredient["id"]] = ingredient
+            self._by_name.setdefault((ingredient["user_id"], ingredient["name"].lower()), ingredient)
+
+    def resolve(self, item: Mapping, owner_id: Optional[int]) -> Optional[Mapping]:
+        """The ingredient of recipe `item` for a recipe of `owner_id` (None: a global recipe)."""
+        if item.get("id") is not None:
+            ingredient = self.by_id.get(int(item["id"]))
+            if ingredient is not None and ingredient["user_id"] in (owner_id, None):
+                return ingredient
+        name = item.get("name")
+        if name is None:
+            return None
+        if owner_id is not None and (owner_id, name.lower()) in self._by_name:
+            return self._by_name[(owner_id, name.lower())]
+        return self._by_name.get((None, name.lower()))
+
+
+def recipe_nutrients(items: List[dict], ingredients: IngredientIndex,
+                     owner_id: Optional[int]) -> Dict[str, float]:
+    """
+    Nutrients of recipe `items` ({"id", "name", "quantity", "serving_unit"},
+    either of id and name may be missing) of a recipe owned by `owner_id`,
+    rounded like the nutrient columns.
+    """
+    totals = {n: 0.0 for n in NUTRIENTS}
+    for item in items:
+        ingredient = ingredients.resolve(item, owner_id)
+        # What is NULL in SQL adds nothing to the sums
+        if ingredient is None or item.get("quantity") is None or ingredient["serving_size"] is None:
+            continue
+        quantity = convert_quantity(item["quantity"], item.get("serving_unit"), ingredient["serving_unit"],
+                                    ingredient["density_g_per_ml"], ingredient["grams_per_piece"])
+        if quantity is None:
+            quantity = item["quantity"]
+        for n in NUTRIENTS:
+            if ingredient[n] is not None:
+                totals[n] += float(ingredient[n]) * quantity / float(ingredient["serving_size"])
+    return {n: round(v, 2) for n, v in totals.items()}
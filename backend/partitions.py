@@ -0,0 +1,166 @@
+# partitions.py
+"""
+Monthly range partitions of `plan_entries`.
+
+Partitions are created ahead of time, at boot and by the job workers' periodic
+maintenance, for the last MEALPLANNER_PLAN_PARTITIONS_BEHIND_MONTHS and the
+next MEALPLANNER_PLAN_PARTITIONS_AHEAD_MONTHS. Requests never create one:
+creating a partition locks plan_entries until the transaction ends, so a
+request planning a week outside that range is rejected instead (see
+`covers`). Each partition holds one calendar month, so the current-week reads
+touch one or two small partitions whatever the length of the history. Old months can be detached, leaving a
+plain table to archive or drop, or dropped outright:
+
+    python partitions.py --list
+    python partitions.py --ensure
+    python partitions.py --prune --keep-months 12 [--drop]
+
+With MEALPLANNER_PLAN_RETENTION_MONTHS set, the maintenance also detaches
+months older than that many months. Detached tables are kept until someone
+drops them.
+"""
+import argparse
+import datetime
+import logging
+import os
+import re
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+logger = logging.getLogger("uvicorn")
+
+PLAN_TABLE = "plan_entries"
+PARTITIONS_AHEAD_MONTHS = int(os.environ.get("MEALPLANNER_PLAN_PARTITIONS_AHEAD_MONTHS", "3"))
+# Past weeks that can still be back-filled
+PARTITIONS_BEHIND_MONTHS = int(os.environ.get("MEALPLANNER_PLAN_PARTITIONS_BEHIND_MONTHS", "12"))
+# 0 keeps every month
+PLAN_RETENTION_MONTHS = int(os.environ.get("MEALPLANNER_PLAN_RETENTION_MONTHS", "0"))
+
+_PARTITION_NAME = re.compile(rf"^{PLAN_TABLE}_(\d{{4}})_(\d{{2}})$")
+
+
+def month_start(day: datetime.date) -> datetime.date:
+    return day.replace(day=1)
+
+
+def add_months(month: datetime.date, months: int) -> datetime.date:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: datetime.date) -> str:
+    return f"{PLAN_TABLE}_{month:%Y_%m}"
+
+
+def list_partitions(conn: Connection) -> List[Tuple[str, datetime.date]]:
+    """The monthly partitions attached to plan_entries, oldest first."""
+    names = conn.execute(text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = CAST(:parent AS regclass)
+    """), {"parent": PLAN_TABLE}).scalars()
+    partitions = []
+    for name in names:
+        match = _PARTITION_NAME.match(name)
+        if match:
+            partitions.append((name, datetime.date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def ensure_partitions(conn: Connection, first: datetime.date, last: datetime.date) -> List[str]:
+    """Creates the missing monthly partitions covering `first`..`last`; returns their names."""
+    existing = {month for _, month in list_partitions(conn)}
+    created = []
+    month = month_start(first)
+    while month <= last:
+        if month not in existing:
+            # Only a missing month takes the (brief) lock on plan_entries
+            name = partition_name(month)
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {PLAN_TABLE} "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+            ))
+            created.append(name)
+        month = add_months(month, 1)
+    return created
+
+
+def ensure_current(conn: Connection, today: Optional[datetime.date] = None) -> List[str]:
+    """Partitions for the months behind (down to the retention), the current week and the months ahead."""
+    today = today or conn.execute(text("SELECT current_date")).scalar()
+    behind = PARTITIONS_BEHIND_MONTHS
+    if PLAN_RETENTION_MONTHS > 0:
+        # Months the retention would detach again
+        behind = min(behind, PLAN_RETENTION_MONTHS)
+    first = min(add_months(month_start(today), -behind), today - datetime.timedelta(days=7))
+    return ensure_partitions(conn, first, add_months(month_start(today), PARTITIONS_AHEAD_MONTHS))
+
+
+def covers(conn: Connection, first: datetime.date, last: datetime.date) -> bool:
+    """Whether every month of `first`..`last` has a partition, so rows can be written there."""
+    existing = {month for _, month in list_partitions(conn)}
+    month = month_start(first)
+    while month <= last:
+        if month not in existing:
+            return False
+        month = add_months(month, 1)
+    return True
+
+
+def prune(conn: Connection, keep_months: int, drop: bool = False,
+          today: Optional[datetime.date] = None) -> List[str]:
+    """Detaches (or drops) the partitions of months before the last `keep_months`; returns their names."""
+    today = today or conn.execute(text("SELECT current_date")).scalar()
+    cutoff = add_months(month_start(today), -keep_months)
+    pruned = []
+    for name, month in list_partitions(conn):
+        if month >= cutoff:
+            break
+        conn.execute(text(f"ALTER TABLE {PLAN_TABLE} DETACH PARTITION {name}"))
+        if drop:
+            conn.execute(text(f"DROP TABLE {name}"))
+        pruned.append(name)
+    return pruned
+
+
+def maintain(conn: Connection) -> None:
+    """Periodic upkeep: the coming months' partitions, and the retention policy if one is set."""
+    created = ensure_current(conn)
+    if created:
+        logger.info("Created plan partitions: %s", ", ".join(created))
+    if PLAN_RETENTION_MONTHS > 0:
+        pruned = prune(conn, PLAN_RETENTION_MONTHS)
+        if pruned:
+            logger.info("Detached plan partitions: %s", ", ".join(pruned))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Manage the monthly partitions of plan_entries.")
+    parser.add_argument("--list", action="store_true", help="list the attached partitions")
+    parser.add_argument("--ensure", action="store_true",
+                        help="create partitions for the recent, current and coming months")
+    parser.add_argument("--prune", action="store_true", help="detach the partitions of old months")
+    parser.add_argument("--keep-months", type=int, default=PLAN_RETENTION_MONTHS or 12,
+                        help="months kept attached by --prune (default: %(default)s)")
+    parser.add_argument("--drop", action="store_true", help="drop pruned partitions instead of keeping them detached")
+    args = parser.parse_args(argv)
+
+    from database import engine
+
+    with engine.begin() as conn:
+        if args.ensure:
+            for name in ensure_current(conn):
+                print(f"created {name}")
+        if args.prune:
+            for name in prune(conn, args.keep_months, drop=args.drop):
+                print(f"{'dropped' if args.drop else 'detached'} {name}")
+        if args.list or not (args.ensure or args.prune):
+            for name, month in list_partitions(conn):
+                count = conn.execute(text(f"SELECT count(*) FROM {name}")).scalar()
+                print(f"{name}  {month:%Y-%m}  {count} rows")
+
+
+if __name__ == "__main__":
+    main()
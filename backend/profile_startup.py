@@ -0,0 +1,157 @@
+# profile_startup.py
+"""
+Cold start of an API worker: what importing the app costs, module by module,
+and how long a fresh server takes to answer its first request.
+
+    python profile_startup.py                      # both, 20 slowest modules
+    python profile_startup.py --imports --top 40
+    python profile_startup.py --first-request --runs 5 --path /health/ready
+
+Import times come from `python -X importtime` in a fresh interpreter, so
+nothing already imported here skews them. `self` is the module's own code,
+`total` includes what it imported first. The first request is timed from
+spawning `uvicorn app:app` to the first 200 response on `--path`, lifespan
+(job workers, event listeners) included unless `--lifespan off`.
+
+Optional subsystems import their heavy dependencies on first use (pylatex in
+utils.create_pdf_in_memory): they should not show up here.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@dataclass
+class ImportTiming:
+    module: str
+    self_us: int
+    total_us: int
+    # Nesting in the import tree: 0 for what `import <module>` itself triggered at the top
+    depth: int
+
+
+def parse_importtime(output: str) -> List[ImportTiming]:
+    """The `import time: self | cumulative | name` lines of `python -X importtime` output."""
+    timings = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # The header line
+            continue
+        name = fields[2].rstrip()
+        indent = len(name) - len(name.lstrip())
+        timings.append(ImportTiming(name.strip(), int(fields[0]), int(fields[1]), (indent - 1) // 2))
+    return timings
+
+
+def import_profile(module: str = "app") -> List[ImportTiming]:
+    """Imports `module` in a fresh interpreter and returns the time each module took."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR, env=os.environ.copy(), capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr)
+
+
+def _first_party(module: str) -> bool:
+    top = module.split(".")[0]
+    return os.path.exists(os.path.join(BACKEND_DIR, top + ".py")) or os.path.isdir(os.path.join(BACKEND_DIR, top))
+
+
+def report_imports(timings: List[ImportTiming], module: str, top: int) -> None:
+    root = next((t for t in reversed(timings) if t.module == module), None)
+    total_ms = root.total_us / 1000 if root else sum(t.self_us for t in timings) / 1000
+    print(f"import {module}: {total_ms:.1f} ms, {len(timings)} modules")
+
+    print(f"\nSlowest {top} modules (own code):")
+    print(f"{'self ms':>9} {'total ms':>9}  module")
+    for t in sorted(timings, key=lambda t: t.self_us, reverse=True)[:top]:
+        marker = "*" if _first_party(t.module) else " "
+        print(f"{t.self_us / 1000:9.1f} {t.total_us / 1000:9.1f} {marker}{t.module}")
+
+    by_package: Dict[str, int] = defaultdict(int)
+    for t in timings:
+        by_package[t.module.split(".")[0]] += t.self_us
+    print(f"\nSlowest {top} packages (own code of all their modules):")
+    for package, self_us in sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:top]:
+        marker = "*" if _first_party(package) else " "
+        print(f"{self_us / 1000:9.1f} {marker}{package}")
+    print("\n* this repository's modules")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_to_first_request(app: str = "app:app", path: str = "/health", lifespan: str = "on",
+                          timeout: float = 60.0) -> float:
+    """Seconds from spawning a uvicorn server for `app` to its first 200 response on `path`."""
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}{path}"
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--host", "127.0.0.1", "--port", str(port),
+         "--lifespan", lifespan, "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=os.environ.copy(),
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f"the server exited with status {server.returncode} before answering")
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except (urllib.error.URLError, ConnectionError, socket.timeout):
+                pass
+            time.sleep(0.005)
+        raise RuntimeError(f"no 200 from {url} within {timeout:.0f} s")
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Profile the cold start of an API worker.")
+    parser.add_argument("--imports", action="store_true", help="report import time per module")
+    parser.add_argument("--first-request", action="store_true", help="time a fresh server's first response")
+    parser.add_argument("--module", default="app", help="module whose import is profiled (default: %(default)s)")
+    parser.add_argument("--top", type=int, default=20, help="modules and packages listed (default: %(default)s)")
+    parser.add_argument("--app", default="app:app", help="ASGI app uvicorn serves (default: %(default)s)")
+    parser.add_argument("--path", default="/health", help="path of the first request (default: %(default)s)")
+    parser.add_argument("--lifespan", choices=["on", "off"], default="on",
+                        help="run the app's startup (job workers, event listeners) (default: %(default)s)")
+    parser.add_argument("--runs", type=int, default=3, help="servers started for --first-request (default: %(default)s)")
+    args = parser.parse_args(argv)
+    both = not (args.imports or args.first_request)
+
+    if args.imports or both:
+        report_imports(import_profile(args.module), args.module, args.top)
+    if args.first_request or both:
+        times = [time_to_first_request(args.app, args.path, args.lifespan) for _ in range(args.runs)]
+        print(f"\nFirst response on {args.path}: median {statistics.median(times) * 1000:.0f} ms, "
+              f"min {min(times) * 1000:.0f} ms, max {max(times) * 1000:.0f} ms over {len(times)} run(s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+# profiling.py
+"""
+On-demand profiles of single requests: where the time went, as sampled stacks,
+and the SQL statements the request ran, with their timings.
+
+A request is profiled when it carries `X-MealPlanner-Profile: 1` and
+authenticates as an admin (MEALPLANNER_ADMIN_EMAILS), or by chance, at
+MEALPLANNER_PROFILE_SAMPLE (the share of requests, default 0). Anyone can
+send the header, so its profile only starts once the request's token names
+an admin (`authenticated()`, from auth_router.py): other requests are
+neither sampled nor have their statements recorded. A thread of the worker
+then samples the request's stacks every
+MEALPLANNER_PROFILE_INTERVAL_MS (default 5), both in the event loop, while
+the request's task runs, and in the threadpool threads running its sync
+endpoint and dependencies. Requests that are not profiled pay one context
+variable lookup per SQL statement.
+
+The last MEALPLANNER_PROFILE_BUFFER (default 50) profiles are kept, in the
+worker, or, when MEALPLANNER_METRICS_DIR is set (gunicorn), as files under
+its `profiles/` directory, shared by all the workers. The responses of
+profiled admin requests name their profile in `X-MealPlanner-Profile-Id`.
+`/admin/profiles` serves them, `/admin/profiles/{id}/collapsed` as the
+collapsed stacks that flamegraph.pl, speedscope and inferno read.
+"""
+import asyncio
+import collections
+import contextvars
+import datetime
+import glob
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Deque, Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import METRICS_DIR, UNMATCHED_ROUTE
+
+PROFILE_SAMPLE = float(os.environ.get("MEALPLANNER_PROFILE_SAMPLE", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("MEALPLANNER_PROFILE_INTERVAL_MS", "5"))
+PROFILE_BUFFER = int(os.environ.get("MEALPLANNER_PROFILE_BUFFER", "50"))
+PROFILE_DIR = os.path.join(METRICS_DIR, "profiles") if METRICS_DIR else None
+
+PROFILE_HEADER = b"x-mealplanner-profile"
+PROFILE_ID_HEADER = b"x-mealplanner-profile-id"
+# Statements kept per profile, and characters per statement
+MAX_STATEMENTS = 1000
+MAX_STATEMENT_LENGTH = 2000
+
+
+@dataclass
+class Profile:
+    id: str
+    trigger: str  # "header" or "sampled"
+    method: str
+    path: str
+    started_at: str
+    interval_ms: float
+    route: str = UNMATCHED_ROUTE
+    status: Optional[int] = None
+    duration_ms: float = 0.0
+    user_id: Optional[int] = None
+    # Whether the request authenticated as an admin: header profiles are kept only then
+    admin: bool = False
+    samples: int = 0
+    # "outermost;...;innermost" frames -> samples
+    stacks: Dict[str, int] = field(default_factory=dict)
+    # {"offset_ms", "duration_ms", "statement"}, in the order they ran
+    statements: List[dict] = field(default_factory=list)
+    statements_dropped: int = 0
+
+    def summary(self) -> dict:
+        entry = asdict(self)
+        del entry["stacks"], entry["statements"], entry["admin"]
+        entry["statement_count"] = len(self.statements) + self.statements_dropped
+        entry["db_ms"] = round(sum(s["duration_ms"] for s in self.statements), 3)
+        return entry
+
+
+@dataclass
+class _Running:
+    """A profile being taken, and where to find its request's code."""
+    profile: Profile
+    loop: asyncio.AbstractEventLoop
+    loop_thread: int
+    task: Optional[asyncio.Task]
+    started: float
+    # Whether it is being sampled and its statements recorded
+    active: bool = False
+
+
+_current: contextvars.ContextVar[Optional[_Running]] = contextvars.ContextVar("mealplanner_profile", default=None)
+
+
+def authenticated(user_id: int, admin: bool) -> None:
+    """Names the current request's user; a header request starts being profiled here, and only for an admin."""
+    running = _current.get()
+    if running is None:
+        return
+    running.profile.user_id, running.profile.admin = user_id, admin
+    if admin and not running.active:
+        _start(running)
+
+
+def _start(running: _Running) -> None:
+    _sampler.add(running)
+    running.active = True
+
+
+# --- Sampling ---
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+
+def _stack(frame) -> str:
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def _runs_for(frame, running: _Running) -> bool:
+    """Whether a threadpool thread is running code of `running`'s request.
+
+    Executors run submitted calls with `context.run(...)` in a copy of the
+    submitter's context (anyio's worker threads, which serve FastAPI's sync
+    endpoints, keep it in a local named `context`), so the request's context
+    variable tells whose call it is.
+    """
+    while frame is not None:
+        if "context" in frame.f_code.co_varnames:
+            context = frame.f_locals.get("context")
+            if isinstance(context, contextvars.Context):
+                return context.get(_current) is running
+        frame = frame.f_back
+    return False
+
+
+class _Sampler:
+    """One thread per worker that samples the stacks of the requests being profiled."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._running: List[_Running] = []
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, running: _Running) -> None:
+        with self._lock:
+            self._running.append(running)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def remove(self, running: _Running) -> None:
+        with self._lock:
+            self._running.remove(running)
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while True:
+            with self._lock:
+                # Under the lock: a request's profile is complete once remove() returns
+                if self._running:
+                    self._sample(own)
+                else:
+                    self._wake.clear()
+                idle = not self._running
+            if idle:
+                self._wake.wait()
+            else:
+                time.sleep(PROFILE_INTERVAL_MS / 1000)
+
+    def _sample(self, own: int) -> None:
+        frames = sys._current_frames()
+        for r in self._running:
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                if ident == r.loop_thread:
+                    if r.task is None or asyncio.current_task(r.loop) is not r.task:
+                        continue
+                elif not _runs_for(frame, r):
+                    continue
+                stack = _stack(frame)
+                r.profile.stacks[stack] = r.profile.stacks.get(stack, 0) + 1
+                r.profile.samples += 1
+
+
+_sampler = _Sampler()
+
+
+# --- SQL statements ---
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    running = _current.get()
+    if context is not None and running is not None and running.active:
+        context._profile_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_profile_started", None)
+    running = _current.get()
+    if started is None or running is None:
+        return
+    profile = running.profile
+    if len(profile.statements) >= MAX_STATEMENTS:
+        profile.statements_dropped += 1
+        return
+    profile.statements.append({
+        "offset_ms": round((started - running.started) * 1000, 3),
+        "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+        "statement": " ".join(statement.split())[:MAX_STATEMENT_LENGTH],
+    })
+
+
+# --- Storage ---
+
+_profiles: Deque[Profile] = collections.deque(maxlen=PROFILE_BUFFER)
+_ids = itertools.count(1)
+
+
+def store(profile: Profile) -> None:
+    if not PROFILE_DIR:
+        _profiles.append(profile)
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{profile.id}.json")
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(asdict(profile), f)
+    os.replace(f"{path}.tmp", path)
+    # The oldest beyond the buffer go, whichever worker wrote them
+    for old in _profile_files()[PROFILE_BUFFER:]:
+        try:
+            os.remove(old)
+        except FileNotFoundError:
+            pass
+
+
+def _profile_files() -> List[str]:
+    """The stored profiles' files, newest first."""
+    paths = []
+    for path in glob.glob(os.path.join(PROFILE_DIR, "*.json")):
+        try:
+            paths.append((os.path.getmtime(path), path))
+        except FileNotFoundError:
+            continue
+    return [path for _, path in sorted(paths, reverse=True)]
+
+
+def stored_profiles() -> List[Profile]:
+    """The kept profiles, newest first."""
+    if not PROFILE_DIR:
+        return list(reversed(_profiles))
+    profiles = []
+    for path in _profile_files():
+        try:
+            with open(path) as f:
+                profiles.append(Profile(**json.load(f)))
+        except (OSError, ValueError, TypeError):
+            continue
+    return profiles
+
+
+def get_profile(profile_id: str) -> Optional[Profile]:
+    return next((p for p in stored_profiles() if p.id == profile_id), None)
+
+
+def clear() -> None:
+    _profiles.clear()
+    if PROFILE_DIR:
+        for path in _profile_files():
+            os.remove(path)
+
+
+def collapsed(profile: Profile) -> str:
+    """Brendan Gregg's collapsed stack format: one `frame;frame;frame samples` line per stack."""
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(profile.stacks.items()))
+
+
+# --- Middleware ---
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware, so the profile's context reaches the endpoint's threadpool call."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if dict(scope["headers"]).get(PROFILE_HEADER) == b"1":
+            trigger = "header"
+        elif PROFILE_SAMPLE > 0 and random.random() < PROFILE_SAMPLE:
+            trigger = "sampled"
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        profile = Profile(
+            id=f"{os.getpid()}-{next(_ids)}", trigger=trigger, method=scope["method"], path=scope["path"],
+            started_at=datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            interval_ms=PROFILE_INTERVAL_MS,
+        )
+        running = _Running(profile, asyncio.get_running_loop(), threading.get_ident(), asyncio.current_task(),
+                           time.perf_counter())
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                if _kept(profile):
+                    message = dict(message)
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (PROFILE_ID_HEADER, profile.id.encode())]
+            await send(message)
+
+        token = _current.set(running)
+        if trigger == "sampled":
+            _start(running)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if running.active:
+                _sampler.remove(running)
+            _current.reset(token)
+            profile.duration_ms = round((time.perf_counter() - running.started) * 1000, 3)
+            profile.route = getattr(scope.get("route"), "path", UNMATCHED_ROUTE)
+            if _kept(profile):
+                store(profile)
+
+
+def _kept(profile: Profile) -> bool:
+    # Header profiles are only taken for admins (authenticated())
+    return profile.trigger == "sampled" or profile.admin
@@ -0,0 +1,64 @@
+# rollups.py
+"""
+Daily and weekly nutrition rollups of the plan history.
+
+`nutrition_daily` holds one row per user and planned day with the summed
+nutrients of that day's recipes, `nutrition_weekly` one row per user and
+week (Monday to Sunday). Triggers keep both current as plan entries and
+recipes change (see models.py), so analytics read a few hundred small rows
+instead of re-joining recipes against months of plans.
+
+Bulk loads that disable the triggers rebuild the rollups afterwards:
+
+    python rollups.py --rebuild [--first-user 1000 --last-user 1999]
+"""
+import argparse
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from models import NUTRIENT_COLUMNS
+
+
+def rebuild(conn: Connection, first_user_id: Optional[int] = None, last_user_id: Optional[int] = None) -> int:
+    """Recomputes the rollups of the users in the id range (all users by default); returns the daily rows written."""
+    params = {"first": first_user_id if first_user_id is not None else -1,
+              "last": last_user_id if last_user_id is not None else 2 ** 31 - 1}
+    users = "user_id BETWEEN :first AND :last"
+    columns = ", ".join(NUTRIENT_COLUMNS)
+    conn.execute(text(f"DELETE FROM nutrition_daily WHERE {users}"), params)
+    conn.execute(text(f"DELETE FROM nutrition_weekly WHERE {users}"), params)
+    written = conn.execute(text(f"""
+        INSERT INTO nutrition_daily (user_id, day, recipes, {columns})
+        SELECT p.user_id, p.plan_date, count(*), {", ".join(f"sum(r.{n})" for n in NUTRIENT_COLUMNS)}
+        FROM plan_entries p JOIN recipes r ON r.id = ANY(p.recipe_ids)
+        WHERE p.{users}
+        GROUP BY p.user_id, p.plan_date
+    """), params).rowcount
+    conn.execute(text(f"""
+        INSERT INTO nutrition_weekly (user_id, week_start, days_planned, recipes, {columns})
+        SELECT user_id, plan_week_start(day), count(*), sum(recipes), {", ".join(f"sum({n})" for n in NUTRIENT_COLUMNS)}
+        FROM nutrition_daily
+        WHERE {users}
+        GROUP BY user_id, plan_week_start(day)
+    """), params)
+    return written
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Maintain the nutrition rollups of the plan history.")
+    parser.add_argument("--rebuild", action="store_true", required=True, help="recompute the rollups from plan_entries")
+    parser.add_argument("--first-user", type=int, default=None, help="first user id to rebuild")
+    parser.add_argument("--last-user", type=int, default=None, help="last user id to rebuild")
+    args = parser.parse_args(argv)
+
+    from database import engine
+
+    with engine.begin() as conn:
+        written = rebuild(conn, args.first_user, args.last_user)
+    print(f"Rebuilt {written} daily nutrition rows.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+from fastapi import APIRouter
+from fastapi import Depends, HTTPException
+from fastapi.responses import PlainTextResponse
+from typing import List
+
+import profiling
+from models import User
+from schemas import ProfileSchema, ProfileSummarySchema
+from routers.auth_router import get_admin_user
+
+admin_router = APIRouter(prefix="/admin", tags=["Admin"])
+
+
+def _get_profile(profile_id: str) -> profiling.Profile:
+    profile = profiling.get_profile(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile
+
+
+@admin_router.get("/profiles", response_model=List[ProfileSummarySchema])
+def get_profiles(admin: User = Depends(get_admin_user)):
+    """The kept request profiles (profiling.py), newest first."""
+    return [p.summary() for p in profiling.stored_profiles()]
+
+
+@admin_router.get("/profiles/{profile_id}", response_model=ProfileSchema)
+def get_profile(profile_id: str, admin: User = Depends(get_admin_user)):
+    profile = _get_profile(profile_id)
+    return {**profile.summary(), "stacks": profile.stacks, "statements": profile.statements}
+
+
+@admin_router.get("/profiles/{profile_id}/collapsed", response_class=PlainTextResponse)
+def get_profile_collapsed(profile_id: str, admin: User = Depends(get_admin_user)):
+    """The sampled stacks in the collapsed format of flamegraph.pl, speedscope and inferno."""
+    return profiling.collapsed(_get_profile(profile_id))
@@ -0,0 +1,117 @@
+from fastapi import APIRouter
+from fastapi import Depends, HTTPException, Query
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from typing import List, Optional
+from datetime import date, timedelta
+import enum
+
+from models import User, NutritionDaily, NutritionWeekly, NUTRIENT_COLUMNS
+from schemas import NutritionPointSchema, NutritionTrendsSchema, NutritionWindowSchema
+from database import get_db
+from routers.auth_router import get_current_user
+from routers.plan_router import week_start
+
+analytics_router = APIRouter(prefix="/analytics", tags=["Analytics"])
+
+# Rolling windows of /analytics/nutrition/trends, in days
+TREND_WINDOWS = (7, 30, 90)
+
+
+class Bucket(str, enum.Enum):
+    day = "day"
+    week = "week"
+
+
+# Longest range served per bucket size: a year of days, three years of weeks
+MAX_RANGE_DAYS = {Bucket.day: 366, Bucket.week: 3 * 366}
+
+
+def _nutrients(row) -> dict:
+    return {n: float(getattr(row, n) or 0) for n in NUTRIENT_COLUMNS}
+
+
+@analytics_router.get("/nutrition", response_model=List[NutritionPointSchema])
+def get_nutrition_series(
+    start: date, end: date, bucket: Bucket = Bucket.day,
+    db: Session = Depends(get_db), current_user: User = Depends(get_current_user),
+):
+    """Planned nutrients per day or per week from `start` to `end` (inclusive), read from the rollups."""
+    if end < start:
+        raise HTTPException(status_code=400, detail="end must not be before start")
+    if (end - start).days >= MAX_RANGE_DAYS[bucket]:
+        raise HTTPException(status_code=400,
+                            detail=f"At most {MAX_RANGE_DAYS[bucket]} days can be requested by {bucket.value}")
+    if bucket == Bucket.day:
+        rows = (
+            db.query(NutritionDaily)
+            .filter(NutritionDaily.user_id == current_user.id, NutritionDaily.day >= start, NutritionDaily.day <= end)
+            .order_by(NutritionDaily.day)
+            .all()
+        )
+        return [NutritionPointSchema(period_start=r.day, days_planned=1, recipes=r.recipes, nutrients=_nutrients(r))
+                for r in rows]
+    rows = (
+        db.query(NutritionWeekly)
+        .filter(NutritionWeekly.user_id == current_user.id,
+                NutritionWeekly.week_start >= week_start(start), NutritionWeekly.week_start <= end)
+        .order_by(NutritionWeekly.week_start)
+        .all()
+    )
+    return [NutritionPointSchema(period_start=r.week_start, days_planned=r.days_planned, recipes=r.recipes,
+                                 nutrients=_nutrients(r))
+            for r in rows]
+
+
+@analytics_router.get("/nutrition/trends", response_model=NutritionTrendsSchema)
+def get_nutrition_trends(
+    end: Optional[date] = Query(None, description="Last day of the windows; today by default"),
+    db: Session = Depends(get_db), current_user: User = Depends(get_current_user),
+):
+    """Rolling 7/30/90-day averages, per-nutrient trends and this week against last week."""
+    end = end or date.today()
+    longest = max(TREND_WINDOWS)
+    # One pass over at most `longest` daily rows computes every window
+    columns = []
+    for days in TREND_WINDOWS:
+        in_window = f"FILTER (WHERE day > CAST(:end AS date) - {days})"
+        columns.append(f"count(*) {in_window} AS days_{days}")
+        columns += [f"avg({n}) {in_window} AS {n}_{days}" for n in NUTRIENT_COLUMNS]
+    columns += [f"regr_slope({n}, day - CAST(:end AS date)) AS {n}_slope" for n in NUTRIENT_COLUMNS]
+    stats = db.execute(text(f"""
+        SELECT {", ".join(columns)} FROM nutrition_daily
+        WHERE user_id = :user_id AND day > CAST(:end AS date) - {longest} AND day <= :end
+    """), {"user_id": current_user.id, "end": end}).one()._mapping
+
+    this_week_start = week_start(end)
+    weeks = {
+        w.week_start: _nutrients(w)
+        for w in db.query(NutritionWeekly).filter(
+            NutritionWeekly.user_id == current_user.id,
+            NutritionWeekly.week_start.in_([this_week_start, this_week_start - timedelta(days=7)]),
+        )
+    }
+    empty = {n: 0.0 for n in NUTRIENT_COLUMNS}
+    this_week = weeks.get(this_week_start, empty)
+    last_week = weeks.get(this_week_start - timedelta(days=7), empty)
+
+    return NutritionTrendsSchema(
+        end=end,
+        windows=[
+            NutritionWindowSchema(
+                days=days, days_planned=stats[f"days_{days}"],
+                daily_average={n: round(float(stats[f"{n}_{days}"] or 0), 2) for n in NUTRIENT_COLUMNS},
+            )
+            for days in TREND_WINDOWS
+        ],
+        trend_per_day={
+            n: None if stats[f"{n}_slope"] is None else round(float(stats[f"{n}_slope"]), 4)
+            for n in NUTRIENT_COLUMNS
+        },
+        this_week=this_week,
+        last_week=last_week,
+        week_over_week_pct={
+            n: round((this_week[n] - last_week[n]) * 100 / last_week[n], 1) if last_week[n] else None
+            for n in NUTRIENT_COLUMNS
+        },
+    )
@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta, timezone
+import logging
 import os
 from typing import Optional
 
@@ -6,18 +7,30 @@ import jwt
 from fastapi import APIRouter, Depends, HTTPException, status, Header
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from passlib.context import CryptContext
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 
-from database import get_db
-from models import User, Recipe, Ingredient
+from database import get_db, shard_for_user, shard_of_session, shard_sessionmaker
+from events import publish
+from jobs import enqueue, job_handler, PRIORITY_INTERACTIVE
+from metrics import current_request_stats
+import profiling
+import shards
+from models import User, Recipe, Ingredient, Job
 from schemas import UserCreateSchema, UserSchema, TokenSchema
 
+logger = logging.getLogger("uvicorn")
+
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login", auto_error=False)
 
 SECRET_KEY = os.environ.get("MEALPLANNER_SECRET", "devsecret")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get("MEALPLANNER_TOKEN_MINUTES", "1440"))
+# New users start with a copy of this user's recipes and ingredients
+DEMO_EMAIL = "demo@demo.com"
+# Users allowed on the /admin endpoints, comma-separated
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get("MEALPLANNER_ADMIN_EMAILS", "").split(",") if e.strip()}
 
 
 def verify_password(plain_password: str, password_hash: str) -> bool:
@@ -36,37 +49,61 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 
+CREDENTIALS_EXCEPTION = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
+
+def user_from_token(db: Session, raw_token: Optional[str], purpose: Optional[str] = None) -> User:
+    """The user a token names. Access tokens have no `purpose`; single-purpose tokens (e.g. the
+    events stream tickets) are only accepted where that purpose is asked for."""
+    if not raw_token:
+        raise CREDENTIALS_EXCEPTION
+    try:
+        payload = jwt.decode(raw_token, SECRET_KEY, algorithms=["HS256"])
+        user_id_raw = payload.get("sub")
+        user_id: Optional[int] = int(user_id_raw) if user_id_raw is not None else None
+        if user_id is None or payload.get("purpose") != purpose:
+            raise CREDENTIALS_EXCEPTION
+    except Exception:
+        raise CREDENTIALS_EXCEPTION
+    user = db.query(User).filter(User.id == user_id).first()
+    # A token naming another shard than the user's predates a move (shards.py)
+    if user is None or user.shard != payload.get("shard", 0):
+        raise CREDENTIALS_EXCEPTION
+    stats = current_request_stats()
+    if stats is not None:
+        # For the request's metrics and log records (logs.py)
+        stats.user_id = user.id
+    # Starts the profile the request asked for, if the user may have it (profiling.py)
+    profiling.authenticated(user.id, is_admin(user))
+    return user
+
+
 def get_current_user(
     db: Session = Depends(get_db),
     token: Optional[str] = Depends(oauth2_scheme),
     x_forwarded_authorization: Optional[str] = Header(None, convert_underscores=False),
 ) -> User:
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
     # Determine token source: standard Authorization or X-Forwarded-Authorization
     raw_token = None
     if token:
         raw_token = token
     elif x_forwarded_authorization and x_forwarded_authorization.lower().startswith("bearer "):
         raw_token = x_forwarded_authorization.split(" ", 1)[1]
-    else:
-        raise credentials_exception
+    return user_from_token(db, raw_token)
 
-    try:
-        payload = jwt.decode(raw_token, SECRET_KEY, algorithms=["HS256"])
-        user_id_raw = payload.get("sub")
-        user_id: Optional[int] = int(user_id_raw) if user_id_raw is not None else None
-        if user_id is None:
-            raise credentials_exception
-    except Exception:
-        raise credentials_exception
-    user = db.query(User).filter(User.id == user_id).first()
-    if user is None:
-        raise credentials_exception
-    return user
+
+def is_admin(user: User) -> bool:
+    return user.email.lower() in ADMIN_EMAILS
+
+
+def get_admin_user(current_user: User = Depends(get_current_user)) -> User:
+    if not is_admin(current_user):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admins only")
+    return current_user
 
 
 auth_router = APIRouter(prefix="/auth", tags=["Auth"])
@@ -77,72 +114,111 @@ def signup(user_in: UserCreateSchema, db: Session = Depends(get_db)):
     existing = db.query(User).filter(User.email == user_in.email).first()
     if existing:
         raise HTTPException(status_code=409, detail="Email already registered")
+    demo = db.query(User.id, User.shard).filter(User.email == DEMO_EMAIL).first()
+    # The demo catalog is copied by a job worker on the user's shard, committed together with the user
+    clone_demo = {"demo_user_id": demo.id, "demo_shard": demo.shard} if demo else None
     user = User(email=user_in.email, password_hash=get_password_hash(user_in.password))
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    db.flush()
 
-    # Duplicate recipes and ingredients from demo user
-    demo_user = db.query(User).filter(User.email == "demo@demo.com").first()
-    if demo_user:
-        # Duplicate ingredients
-        for ingredient in db.query(Ingredient).filter(Ingredient.user_id == demo_user.id).all():
-            new_ingredient = Ingredient(
-                user_id=user.id,
-                name=ingredient.name,
-                shelf_life=ingredient.shelf_life,
-                available=False,
-                last_available=ingredient.last_available,
-                serving_unit=ingredient.serving_unit,
-                serving_size=ingredient.serving_size,
-                protein=ingredient.protein,
-                carbs=ingredient.carbs,
-                fat=ingredient.fat,
-                fiber=ingredient.fiber,
-                energy=ingredient.energy,
-                iron_mg=ingredient.iron_mg,
-                magnesium_mg=ingredient.magnesium_mg,
-                calcium_mg=ingredient.calcium_mg,
-                potassium_mg=ingredient.potassium_mg,
-                sodium_mg=ingredient.sodium_mg,
-                vitamin_c_mg=ingredient.vitamin_c_mg,
-            )
-            db.add(new_ingredient)
-
-        # Duplicate recipes
-        for recipe in db.query(Recipe).filter(Recipe.user_id == demo_user.id).all():
-            new_recipe = Recipe(
-                user_id=user.id,
-                name=recipe.name,
-                serves=recipe.serves,
-                ingredients=recipe.ingredients,
-                instructions=recipe.instructions,
-                meal_type=recipe.meal_type,
-                is_vegetarian=recipe.is_vegetarian,
-                protein=recipe.protein,
-                carbs=recipe.carbs,
-                fat=recipe.fat,
-                fiber=recipe.fiber,
-                energy=recipe.energy,
-                iron_mg=recipe.iron_mg,
-                magnesium_mg=recipe.magnesium_mg,
-                calcium_mg=recipe.calcium_mg,
-                potassium_mg=recipe.potassium_mg,
-                sodium_mg=recipe.sodium_mg,
-                vitamin_c_mg=recipe.vitamin_c_mg,
-            )
-            db.add(new_recipe)
+    # This database is the directory of all users; the user's shard gets a copy of the row (shards.py)
+    shard = shard_for_user(user.id)
+    if shard == 0:
+        if clone_demo:
+            enqueue(db, "clone_demo_data", clone_demo, user_id=user.id, priority=PRIORITY_INTERACTIVE)
         db.commit()
-
+    else:
+        # The directory commits first, with a job that copies the user over if the copy below fails
+        user.shard = shard
+        enqueue(db, "place_user", {"clone_demo": clone_demo}, user_id=user.id, priority=PRIORITY_INTERACTIVE,
+                max_attempts=10)
+        db.commit()
+        try:
+            shards.place_user(db, user.id, clone_demo)
+        except SQLAlchemyError as e:
+            logger.warning("User %d not copied to shard %d yet, a job retries: %s", user.id, shard, e)
+    db.refresh(user)
     return user
 
 
+@job_handler("clone_demo_data")
+def clone_demo_data(db: Session, job: Job) -> dict:
+    """Duplicates the demo user's recipes and ingredients for a new user."""
+    demo_user_id = job.payload["demo_user_id"]
+    demo_shard = job.payload.get("demo_shard", 0)
+    demo_db = db if demo_shard == shard_of_session(db) else shard_sessionmaker(demo_shard)()
+    try:
+        return _clone_demo_data(db, demo_db, demo_user_id, job.user_id)
+    finally:
+        if demo_db is not db:
+            demo_db.close()
+
+
+def _clone_demo_data(db: Session, demo_db: Session, demo_user_id: int, user_id: int) -> dict:
+    # Duplicate ingredients
+    ingredients = demo_db.query(Ingredient).filter(Ingredient.user_id == demo_user_id).all()
+    for ingredient in ingredients:
+        new_ingredient = Ingredient(
+            user_id=user_id,
+            name=ingredient.name,
+            shelf_life=ingredient.shelf_life,
+            available=False,
+            last_available=ingredient.last_available,
+            serving_unit=ingredient.serving_unit,
+            serving_size=ingredient.serving_size,
+            protein=ingredient.protein,
+            carbs=ingredient.carbs,
+            fat=ingredient.fat,
+            fiber=ingredient.fiber,
+            energy=ingredient.energy,
+            iron_mg=ingredient.iron_mg,
+            magnesium_mg=ingredient.magnesium_mg,
+            calcium_mg=ingredient.calcium_mg,
+            potassium_mg=ingredient.potassium_mg,
+            sodium_mg=ingredient.sodium_mg,
+            vitamin_c_mg=ingredient.vitamin_c_mg,
+        )
+        db.add(new_ingredient)
+    # Inserted first: the copied recipes find their ingredients among these by name
+    db.flush()
+
+    # Duplicate recipes
+    recipes = demo_db.query(Recipe).filter(Recipe.user_id == demo_user_id).all()
+    for recipe in recipes:
+        new_recipe = Recipe(
+            user_id=user_id,
+            name=recipe.name,
+            serves=recipe.serves,
+            ingredients=recipe.resolved_ingredients,
+            instructions=recipe.instructions,
+            meal_type=recipe.meal_type,
+            is_vegetarian=recipe.is_vegetarian,
+            protein=recipe.protein,
+            carbs=recipe.carbs,
+            fat=recipe.fat,
+            fiber=recipe.fiber,
+            energy=recipe.energy,
+            iron_mg=recipe.iron_mg,
+            magnesium_mg=recipe.magnesium_mg,
+            calcium_mg=recipe.calcium_mg,
+            potassium_mg=recipe.potassium_mg,
+            sodium_mg=recipe.sodium_mg,
+            vitamin_c_mg=recipe.vitamin_c_mg,
+        )
+        db.add(new_recipe)
+    # Too many rows to name: clients reload both collections
+    publish(db, user_id, "ingredient", "created")
+    publish(db, user_id, "recipe", "created")
+    return {"ingredients": len(ingredients), "recipes": len(recipes)}
+
+
 @auth_router.post("/login", response_model=TokenSchema)
 def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     user = db.query(User).filter(User.email == form_data.username).first()
     if not user or not verify_password(form_data.password, user.password_hash):
         raise HTTPException(status_code=400, detail="Incorrect email or password")
-    token = create_access_token({"sub": str(user.id)})
+    # The shard routes the user's requests (database.request_shard)
+    token = create_access_token({"sub": str(user.id), "shard": user.shard})
     return TokenSchema(access_token=token)
 
 
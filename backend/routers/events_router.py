@@ -0,0 +1,62 @@
+import os
+from datetime import timedelta
+from typing import Optional
+
+from fastapi import APIRouter
+from fastapi import Depends, HTTPException, Header, Query, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+
+from database import get_db
+from events import hub, event_stream
+from models import User
+from schemas import EventsTicketSchema
+from routers.auth_router import create_access_token, get_current_user, user_from_token
+
+ev_router = APIRouter(prefix="/events", tags=["Events"])
+
+# Tickets only open a stream, and only for this long: they travel in URLs, which end up in access logs
+TICKET_PURPOSE = "events"
+TICKET_SECONDS = int(os.environ.get("MEALPLANNER_EVENTS_TICKET_SECONDS", "30"))
+
+
+@ev_router.post("/ticket", response_model=EventsTicketSchema)
+def create_events_ticket(current_user: User = Depends(get_current_user)):
+    """A short-lived token for `GET /events?ticket=`, which EventSource can send where the access token must not go."""
+    ticket = create_access_token({"sub": str(current_user.id), "shard": current_user.shard, "purpose": TICKET_PURPOSE},
+                                 timedelta(seconds=TICKET_SECONDS))
+    return EventsTicketSchema(ticket=ticket, expires_in=TICKET_SECONDS)
+
+
+def get_stream_user_id(
+    db: Session = Depends(get_db),
+    ticket: Optional[str] = Query(None, description="From POST /events/ticket; EventSource cannot send headers"),
+    authorization: Optional[str] = Header(None),
+) -> int:
+    if ticket is not None:
+        user_id = user_from_token(db, ticket, purpose=TICKET_PURPOSE).id
+    else:
+        token = authorization.split(" ", 1)[1] if authorization and authorization.lower().startswith("bearer ") else None
+        user_id = user_from_token(db, token).id
+    # The stream outlives the request's session; give its connection back to the pool now
+    db.close()
+    return user_id
+
+
+@ev_router.get("", response_class=StreamingResponse)
+async def stream_events(user_id: int = Depends(get_stream_user_id)):
+    """Server-Sent Events with the current user's changes (see events.py for the format)."""
+    if not hub.running:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Live updates are not available")
+    subscription = hub.subscribe(user_id)
+
+    async def frames():
+        try:
+            async for frame in event_stream(subscription):
+                yield frame
+        finally:
+            hub.unsubscribe(subscription)
+
+    # Proxies must pass the stream through as it is written
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(frames(), media_type="text/event-stream", headers=headers)
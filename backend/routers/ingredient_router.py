@@ -1,9 +1,9 @@
 from fastapi import APIRouter
 from fastapi import Depends, HTTPException, Response, status, Query
+from sqlalchemy import func, inspect
 from sqlalchemy.orm import Session
-from sqlalchemy.orm.attributes import flag_modified
 from typing import List
-from models import Recipe, Ingredient, ServingUnits, User
+from models import Recipe, Ingredient, ServingUnits, User, RECIPE_NUTRIENT_INPUTS
 from schemas import IngredientSchema
 import datetime
 from typing import Optional
@@ -11,40 +11,43 @@ from sqlalchemy.exc import IntegrityError
 
 
 from database import get_db
+from catalog import global_catalog
+from events import publish
 from routers.auth_router import get_current_user
 import logging
 logger = logging.getLogger("uvicorn")
-logger.setLevel(logging.DEBUG)
 
 ing_router = APIRouter(prefix="/ingredients", tags=["Ingredients"])
 
+# Columns GET /ingredients can sort by
+SORTABLE_COLUMNS = [name for name in IngredientSchema.model_fields if name in Ingredient.__table__.c]
+
+
+def with_remaining_shelf_life(ing, now: datetime.datetime) -> IngredientSchema:
+    """The ingredient's schema (a copy, for cached ones) with the shelf life left since it was last marked available."""
+    ing_schema = ing.model_copy() if isinstance(ing, IngredientSchema) else IngredientSchema.model_validate(ing)
+    if ing.available and ing.last_available and ing.shelf_life is not None:
+        days_passed = (now.date() - ing.last_available.date()).days
+        ing_schema.remaining_shelf_life = max(0, ing.shelf_life - days_passed)
+    else:
+        ing_schema.remaining_shelf_life = ing.shelf_life
+    return ing_schema
+
 
 ## Ingredients
 @ing_router.get("", response_model=List[IngredientSchema])
 def get_ingredients_list(sort: Optional[str] = None, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    # Show user's ingredients and global stock (user_id is NULL)
-    query = db.query(Ingredient).filter((Ingredient.user_id == current_user.id) | (Ingredient.user_id == None))
-    
-    # Safe sorting
-    if sort and hasattr(Ingredient, sort):
-        query = query.order_by(getattr(Ingredient, sort))
-    else:
-        query = query.order_by(Ingredient.available.desc(), Ingredient.name)
-
-    db_ingredients = query.all()
+    # Show user's ingredients and global stock (user_id is NULL, from the shared cache)
+    db_ingredients = db.query(Ingredient).filter(Ingredient.user_id == current_user.id).all()
     
-    # Add remaining shelf life calculation
     now = datetime.datetime.utcnow()
-    result = []
-    for ing in db_ingredients:
-        ing_schema = IngredientSchema.model_validate(ing)
-        if ing.available and ing.last_available and ing.shelf_life is not None:
-            days_passed = (now.date() - ing.last_available.date()).days
-            ing_schema.remaining_shelf_life = max(0, ing.shelf_life - days_passed)
-        else:
-            ing_schema.remaining_shelf_life = ing.shelf_life
-        result.append(ing_schema)
-        
+    result = [with_remaining_shelf_life(ing, now) for ing in [*db_ingredients, *global_catalog.get(db).ingredients]]
+
+    # Safe sorting, with missing values last as in SQL
+    if sort in SORTABLE_COLUMNS:
+        result.sort(key=lambda i: (getattr(i, sort) is None, getattr(i, sort)))
+    else:
+        result.sort(key=lambda i: (not i.available, i.name))
     return result
 
 @ing_router.put("/{ingredient_id}", response_model=IngredientSchema)
@@ -57,6 +60,8 @@ def update_ingredient(
     shelf_life: Optional[int] = None,
     serving_unit: Optional[ServingUnits] = None,
     serving_size: Optional[float] = None,
+    density_g_per_ml: Optional[float] = None,
+    grams_per_piece: Optional[float] = None,
     energy: Optional[float] = None,
     protein: Optional[float] = None,
     carbs: Optional[float] = None,
@@ -81,48 +86,7 @@ def update_ingredient(
     if not db_ingredient:
         raise HTTPException(status_code=404, detail="Ingredient not found")
 
-    logger.info(f"Updating ingredient ID: {ingredient_id}: {db_ingredient.name}")
-    
-    # if we updating the availability status ignore updating recipes
-    logger.debug(f"Available {available}, Ingredient {db_ingredient.available}")
-    if available != None or available is not db_ingredient.available:
-        # Get the new values from the request payload
-        update_data = {}
-        if name is not None:
-            update_data['name'] = name
-        if serving_unit is not None:
-            update_data['serving_unit'] = getattr(serving_unit, 'value', serving_unit)
-        if serving_size is not None:
-            update_data['serving_size'] = serving_size
-
-        # 2. Check if name or unit, which are stored in recipes, have changed
-        should_sync_recipes = ('name' in update_data) or ('serving_unit' in update_data)
-
-        if should_sync_recipes:
-            # Find all recipes containing the old ingredient name
-            # Note: This query might need to be adapted based on your exact JSON structure
-            recipes_to_update = db.query(Recipe).filter(
-                    ((Recipe.user_id == current_user.id) | (Recipe.user_id == None))
-                ).all()
-            logger.info(f"Recipes to update: {[r.name for r in recipes_to_update]}")
-            for recipe in recipes_to_update:
-                # Create a new list for ingredients to avoid mutation issues
-                new_ingredients_list = []
-                for ingredient_in_recipe in recipe.ingredients:
-                    if name.lower() == ingredient_in_recipe['name'].lower():
-                        ingredient_in_recipe['name'] = update_data["name"]
-                        ingredient_in_recipe['serving_unit'] = update_data['serving_unit']
-                        logger.info(f"{db_ingredient.serving_unit} ==> {update_data['serving_unit']}")
-                        multiply_factor = 0.01 if (db_ingredient.serving_unit in ['g','ml']  and update_data['serving_unit'] in ['nos','tbsp','tsp','cup']) else 100
-                        ingredient_in_recipe['quantity'] = ingredient_in_recipe['quantity']*multiply_factor
-                    new_ingredients_list.append(ingredient_in_recipe)
-                
-                # Re-assign the list to the recipe object
-                recipe.ingredients = new_ingredients_list
-
-                # Flag the JSON column as modified to ensure it's saved
-                logger.info(f"Flaging update for recipe: {recipe.name}")
-                flag_modified(recipe, "ingredients")
+    logger.debug("Updating ingredient %s: %s", ingredient_id, db_ingredient.name)
 
     # 3. Update attributes only for the parameters that were provided
     if name is not None:
@@ -138,6 +102,10 @@ def update_ingredient(
         db_ingredient.serving_unit = getattr(serving_unit, 'value', serving_unit)
     if serving_size is not None:
         db_ingredient.serving_size = serving_size
+    if density_g_per_ml is not None:
+        db_ingredient.density_g_per_ml = density_g_per_ml
+    if grams_per_piece is not None:
+        db_ingredient.grams_per_piece = grams_per_piece
     if energy is not None:
         db_ingredient.energy = energy
     if protein is not None:
@@ -162,6 +130,15 @@ def update_ingredient(
         db_ingredient.vitamin_c_mg = vitamin_c_mg
     
 
+    publish(db, current_user.id, "ingredient", "updated", [ingredient_id])
+    # Recipes refer to the ingredient by id and keep their own units, so a rename or unit change
+    # leaves them alone. Their nutrients are re-summed by a trigger though (see models.py)
+    state = inspect(db_ingredient)
+    if any(state.attrs[column].history.has_changes() for column in RECIPE_NUTRIENT_INPUTS):
+        recipe_ids = [recipe_id for (recipe_id,) in db.query(Recipe.id).filter(
+            Recipe.user_id == current_user.id, Recipe.ingredients.contains([{"id": ingredient_id}]))]
+        if recipe_ids:
+            publish(db, current_user.id, "recipe", "updated", recipe_ids)
     try:
         # 4. Commit the changes to the database
         db.commit()
@@ -170,19 +147,21 @@ def update_ingredient(
     except IntegrityError: # Catch errors like duplicate names
         db.rollback()
         raise HTTPException(status_code=409, detail="Ingredient name already exists.")
-    
+
     return db_ingredient
 
+
 @ing_router.post("", response_model=IngredientSchema, status_code=201)
 def add_ingredient(name: str = Query(...),
                    shelf_life: str = Query(),
                    serving_unit: str = Query(),
                    db: Session = Depends(get_db),
                    current_user: User = Depends(get_current_user)):
-    logger.info(f"Adding new ingredient: {name}")
+    logger.debug("Adding new ingredient: %s", name)
 
     # Check if ingredient already exists to provide a clear error
-    existing_ingredient = db.query(Ingredient).filter(Ingredient.user_id == current_user.id, Ingredient.name == name).first()
+    existing_ingredient = db.query(Ingredient).filter(
+        Ingredient.user_id == current_user.id, func.lower(Ingredient.name) == name.lower()).first()
     if existing_ingredient:
         raise HTTPException(
             status_code=409, # 409 Conflict is a good status code for this
@@ -199,38 +178,41 @@ def add_ingredient(name: str = Query(...),
         available=False # Set default value
     )
     db.add(new_ingredient)
+    db.flush()
+    publish(db, current_user.id, "ingredient", "created", [new_ingredient.id])
     db.commit()
     db.refresh(new_ingredient)
     return new_ingredient
 
 @ing_router.delete("/{ingredient_id}", status_code=status.HTTP_204_NO_CONTENT)
 def delete_ingredient(ingredient_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    logger.info(f"Deleting ingredient with ID: {ingredient_id}")
+    logger.debug("Deleting ingredient %s", ingredient_id)
 
     # 1. Find the ingredient by its ID.
     db_ingredient = db.query(Ingredient).filter(Ingredient.id == ingredient_id, Ingredient.user_id == current_user.id).first()
-    all_recipes = db.query(Recipe).filter((Recipe.user_id == current_user.id) | (Recipe.user_id == None)).all()
-    
-    recipes_using_ingredient_list = []
-    
-    # find all recipes that are using this ingredient
-    for recipe in all_recipes:
-        for ingredient in recipe.ingredients:
-            if ingredient['name'] == db_ingredient.name:
-                recipes_using_ingredient_list.append(recipe.name)
-    if recipes_using_ingredient_list:
-        raise HTTPException(status_code=405, detail="Recipes:"+", ".join(recipes_using_ingredient_list)+" are using this ingredient")
-    
+
     # 2. If the ingredient doesn't exist, raise a 404 error.
     if not db_ingredient:
-        logger.warning(f"Ingredient with ID {ingredient_id} not found for deletion.")
+        logger.warning("Ingredient %s not found for deletion", ingredient_id)
         raise HTTPException(status_code=404, detail="Ingredient not found")
 
+    # find all recipes that are using this ingredient. Only the user's own can: global recipes
+    # refer to global ingredients (see canonical_recipe_ingredients in models.py)
+    recipes_using_ingredient_list = [
+        recipe_name for (recipe_name,) in db.query(Recipe.name).filter(
+            Recipe.user_id == current_user.id,
+            Recipe.ingredients.contains([{"id": ingredient_id}]),
+        )
+    ]
+    if recipes_using_ingredient_list:
+        raise HTTPException(status_code=405, detail="Recipes:"+", ".join(recipes_using_ingredient_list)+" are using this ingredient")
+
     # 3. If found, delete it and commit the change.
     db.delete(db_ingredient)
+    publish(db, current_user.id, "ingredient", "deleted", [ingredient_id])
     db.commit()
     
-    logger.info(f"Successfully deleted ingredient with ID: {ingredient_id}")
+    logger.info("Deleted ingredient %s", ingredient_id)
     # 4. Return a 204 No Content response.
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
@@ -0,0 +1,47 @@
+from fastapi import APIRouter
+from fastapi import Depends, HTTPException, Response, status
+from fastapi.responses import JSONResponse
+from sqlalchemy.orm import Session
+
+from database import get_db
+from jobs import QUEUED, RUNNING, FAILED
+from models import Job, User
+from schemas import JobSchema
+from routers.auth_router import get_current_user
+
+jobs_router = APIRouter(prefix="/jobs", tags=["Jobs"])
+
+
+def job_accepted(job: Job, body=None) -> JSONResponse:
+    """202 response for work handed to a job; clients poll the Location for its outcome."""
+    content = body if body is not None else JobSchema.model_validate(job).model_dump(mode="json")
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=content,
+                        headers={"Location": f"/jobs/{job.id}"})
+
+
+def _get_own_job(job_id: int, db: Session, current_user: User) -> Job:
+    job = db.query(Job).filter(Job.id == job_id, Job.user_id == current_user.id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@jobs_router.get("/{job_id}", response_model=JobSchema)
+def get_job(job_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    return _get_own_job(job_id, db, current_user)
+
+
+@jobs_router.get("/{job_id}/result", responses={202: {"model": JobSchema}, 409: {"model": JobSchema}})
+def get_job_result(job_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    job = _get_own_job(job_id, db, current_user)
+    if job.status in (QUEUED, RUNNING):
+        return job_accepted(job)
+    if job.status == FAILED:
+        return JSONResponse(status_code=status.HTTP_409_CONFLICT,
+                            content=JobSchema.model_validate(job).model_dump(mode="json"))
+    if job.result_bytes is not None:
+        filename = job.payload.get("filename") or f"{job.kind}-{job.id}"
+        headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+        return Response(content=job.result_bytes, media_type=job.result_media_type or "application/octet-stream",
+                        headers=headers)
+    return JSONResponse(content=job.result)
@@ -0,0 +1,43 @@
+from fastapi import APIRouter
+from fastapi import Depends, HTTPException, Query
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from typing import List
+
+from database import get_db
+from events import publish
+from models import Notification, User
+from schemas import NotificationSchema
+from routers.auth_router import get_current_user
+# Registers the expiry scheduler with the job workers' maintenance
+import notifications
+
+notifications_router = APIRouter(prefix="/notifications", tags=["Notifications"])
+
+
+@notifications_router.get("", response_model=List[NotificationSchema])
+def get_notifications(
+    unread: bool = Query(False, description="Only the notifications not marked read yet"),
+    limit: int = Query(50, ge=1, le=500),
+    db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
+):
+    """The user's inbox, newest first: the expiry digests of notifications.py."""
+    query = db.query(Notification).filter(Notification.user_id == current_user.id)
+    if unread:
+        query = query.filter(Notification.read_at == None)
+    return query.order_by(Notification.id.desc()).limit(limit).all()
+
+
+@notifications_router.put("/{notification_id}/read", response_model=NotificationSchema)
+def mark_notification_read(notification_id: int, db: Session = Depends(get_db),
+                           current_user: User = Depends(get_current_user)):
+    notification = db.query(Notification).filter(
+        Notification.id == notification_id, Notification.user_id == current_user.id).first()
+    if not notification:
+        raise HTTPException(status_code=404, detail="Notification not found")
+    if notification.read_at is None:
+        notification.read_at = text("now()")
+        publish(db, current_user.id, "notification", "updated", [notification_id])
+        db.commit()
+        db.refresh(notification)
+    return notification
@@ -1,37 +1,82 @@
 from fastapi import APIRouter
 from fastapi import Depends, HTTPException, Response, status, Query
 from fastapi.responses import StreamingResponse
+from sqlalchemy import func, text
 from sqlalchemy.orm import Session
 from typing import List, Dict
-from models import WeeklyPlan, RecipeMealType, DaysOfWeek, User, Recipe
-from schemas import PlanSlotSchema
+from datetime import date, timedelta
+from models import WeeklyPlan, PlanEntry, RecipeMealType, DaysOfWeek, User, Recipe, Job
+from schemas import PlanSlotSchema, PlanEntrySchema, JobSchema
 from utils import create_pdf_in_memory
 import io
+import partitions
+import storage
 
-from sqlalchemy.dialects.postgresql import insert
 from typing import Optional
 from sqlalchemy.exc import IntegrityError
 
 
 from database import get_db
+from catalog import global_catalog
+from coalesce import coalesced
+from events import publish
+from jobs import enqueue, job_handler, maintenance_task, PRIORITY_INTERACTIVE
 import logging
 
 logger = logging.getLogger("uvicorn")
-logger.setLevel(logging.DEBUG)
 
 pl_router = APIRouter(prefix="/weekly-plan", tags=["Weekly Plan"])
 
 from routers.auth_router import get_current_user
+from routers.jobs_router import job_accepted
+
+
+# Longest range /weekly-plan/entries returns at once
+MAX_HISTORY_DAYS = 366
+DAY_NAMES = [day.value for day in DaysOfWeek]
+
+
+def week_start(day: date) -> date:
+    """Monday of the week containing `day` (the same as SQL plan_week_start())."""
+    return day - timedelta(days=day.weekday())
+
+
+def day_name(plan_date: date) -> str:
+    return DAY_NAMES[plan_date.weekday()]
+
+
+@maintenance_task
+def maintain_plan_partitions(db: Session) -> None:
+    partitions.maintain(db.connection())
+
+
+def _check_partitioned(db: Session, first: date, last: date) -> None:
+    # Creating a partition here would lock plan_entries until this request commits (partitions.py)
+    if not partitions.covers(db.connection(), first, last):
+        raise HTTPException(status_code=400, detail=(
+            "That week is outside the plan history: weeks can be planned back to the oldest month kept "
+            f"and up to {partitions.PARTITIONS_AHEAD_MONTHS} months ahead"))
 
 
 ## Weekly Plan
 @pl_router.get("", response_model=Dict[str, Dict[str, List[int]]])
 def get_weekly_plan(
+    week_of: Optional[date] = Query(None, description="Any day of the week to read; the current week by default"),
     db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
 ):
-    db_plan_items = (
-        db.query(WeeklyPlan).filter(WeeklyPlan.user_id == current_user.id).all()
-    )
+    if week_of is None:
+        db_plan_items = (
+            db.query(WeeklyPlan.day, WeeklyPlan.meal_type, WeeklyPlan.recipe_ids)
+            .filter(WeeklyPlan.user_id == current_user.id).all()
+        )
+    else:
+        start = week_start(week_of)
+        db_plan_items = [
+            (day_name(item.plan_date), item.meal_type, item.recipe_ids)
+            for item in db.query(PlanEntry.plan_date, PlanEntry.meal_type, PlanEntry.recipe_ids)
+            .filter(PlanEntry.user_id == current_user.id,
+                    PlanEntry.plan_date >= start, PlanEntry.plan_date < start + timedelta(days=7))
+        ]
 
     # Initialize empty plan
     plan = {
@@ -39,30 +84,60 @@ def get_weekly_plan(
     }
 
     # Populate with data from DB
-    for item in db_plan_items:
-        key = getattr(item.meal_type, "value", item.meal_type)
-        plan[item.day][key] = item.recipe_ids if item.recipe_ids else []
+    for day, meal_type, recipe_ids in db_plan_items:
+        key = getattr(meal_type, "value", meal_type)
+        plan[day][key] = recipe_ids if recipe_ids else []
 
     return plan
 
 
+@pl_router.get("/entries", response_model=List[PlanEntrySchema])
+def get_plan_entries(
+    start: date, end: date,
+    db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
+):
+    """Dated plan entries from `start` to `end` (inclusive), oldest first; only the months in range are scanned."""
+    if end < start:
+        raise HTTPException(status_code=400, detail="end must not be before start")
+    if (end - start).days >= MAX_HISTORY_DAYS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_HISTORY_DAYS} days can be requested at once")
+    entries = (
+        db.query(PlanEntry.plan_date, PlanEntry.meal_type, PlanEntry.recipe_ids)
+        .filter(PlanEntry.user_id == current_user.id, PlanEntry.plan_date >= start, PlanEntry.plan_date <= end)
+        .order_by(PlanEntry.plan_date, PlanEntry.meal_type)
+        .all()
+    )
+    return [
+        PlanEntrySchema(plan_date=e.plan_date, day=day_name(e.plan_date), meal_type=e.meal_type,
+                        recipe_ids=e.recipe_ids or [])
+        for e in entries
+    ]
+
+
 @pl_router.put("", status_code=status.HTTP_201_CREATED)
 def set_weekly_plan_slot(
     slot: PlanSlotSchema,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    stmt = insert(WeeklyPlan).values(
+    offset = DAY_NAMES.index(slot.day.value)
+    if slot.week_of is None:
+        # The current week, as the database sees it
+        plan_date = func.plan_week_start(func.current_date()) + offset
+    else:
+        plan_date = week_start(slot.week_of) + timedelta(days=offset)
+        _check_partitioned(db, plan_date, plan_date)
+    stmt = storage.upsert(db, PlanEntry, dict(
         user_id=current_user.id,
-        day=slot.day,
+        plan_date=plan_date,
         meal_type=slot.meal_type,
         recipe_ids=slot.recipe_ids,
-    )
-    # Use ON CONFLICT to perform an "upsert"
-    stmt = stmt.on_conflict_do_update(
-        index_elements=["user_id", "day", "meal_type"],
-        set_=dict(recipe_ids=stmt.excluded.recipe_ids),
-    )
+    ), index_elements=["user_id", "plan_date", "meal_type"], update=["recipe_ids"])
+    if slot.week_of is None:
+        publish(db, current_user.id, "plan", "updated",
+                data={"day": slot.day.value, "meal_type": slot.meal_type.value, "recipe_ids": slot.recipe_ids or []})
+    else:
+        publish(db, current_user.id, "plan", "updated")
     try:
         db.execute(stmt)
         db.commit()
@@ -73,16 +148,54 @@ def set_weekly_plan_slot(
     return {"message": f"Plan for {slot.day.value} {slot.meal_type.value} updated"}
 
 
-@pl_router.get("/pdf", response_class=StreamingResponse)
-def get_weekly_plan_pdf(
-    db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
+@pl_router.post("/copy")
+def copy_weekly_plan(
+    from_week: Optional[date] = Query(None, description="Any day of the week to copy; the week before `to_week` by default"),
+    to_week: Optional[date] = Query(None, description="Any day of the week to fill; the current week by default"),
+    db: Session = Depends(get_db), current_user: User = Depends(get_current_user),
 ):
-    # Generate PDF logic here
+    """Copies one week's planned meals into the empty slots of another; slots already planned are kept."""
+    target = week_start(to_week) if to_week else db.query(func.plan_week_start(func.current_date())).scalar()
+    source = week_start(from_week) if from_week else target - timedelta(days=7)
+    if source == target:
+        raise HTTPException(status_code=400, detail="Cannot copy a week onto itself")
+    _check_partitioned(db, target, target + timedelta(days=6))
+    copied = db.execute(text("""
+        INSERT INTO plan_entries (user_id, plan_date, meal_type, recipe_ids)
+        SELECT user_id, plan_date + :shift, meal_type, kept.recipe_ids
+        FROM plan_entries p
+        -- Recipes deleted since that week, and any neither the user's nor global, are left out
+        CROSS JOIN LATERAL (
+            SELECT ARRAY(SELECT r FROM unnest(p.recipe_ids) r WHERE EXISTS (
+                SELECT 1 FROM recipes WHERE id = r AND (user_id = :user_id OR user_id IS NULL)
+            )) AS recipe_ids
+        ) kept
+        WHERE p.user_id = :user_id AND p.plan_date >= :source AND p.plan_date < CAST(:source AS date) + 7
+          AND cardinality(kept.recipe_ids) > 0
+        ON CONFLICT (user_id, plan_date, meal_type) DO UPDATE SET recipe_ids = EXCLUDED.recipe_ids
+        WHERE cardinality(coalesce(plan_entries.recipe_ids, '{}')) = 0
+    """), {"user_id": current_user.id, "source": source, "shift": (target - source).days}).rowcount
+    if copied:
+        publish(db, current_user.id, "plan", "updated")
+    db.commit()
+    return {"copied": copied, "from_week": source, "to_week": target}
+
+
+def build_plan_pdf(db: Session, user_id: int) -> bytes:
     db_plan_items = (
-        db.query(WeeklyPlan).filter(WeeklyPlan.user_id == current_user.id).all()
+        db.query(WeeklyPlan.day, WeeklyPlan.meal_type, WeeklyPlan.recipe_ids)
+        .filter(WeeklyPlan.user_id == user_id).all()
     )
 
-    recipes = db.query(Recipe).filter(Recipe.user_id == current_user.id).all()
+    # Only the names of the planned recipes are needed; the global ones are cached
+    planned_ids = {rid for item in db_plan_items for rid in (item.recipe_ids or [])}
+    global_recipes = global_catalog.get(db).recipes_by_id
+    recipe_names_by_id = {rid: global_recipes[rid].name for rid in planned_ids if rid in global_recipes}
+    own_ids = planned_ids - recipe_names_by_id.keys()
+    if own_ids:
+        recipe_names_by_id.update(
+            db.query(Recipe.id, Recipe.name).filter(Recipe.id.in_(own_ids), Recipe.user_id == user_id).all()
+        )
 
     # Initialize empty plan
     plan = {
@@ -91,19 +204,41 @@ def get_weekly_plan_pdf(
 
     # Populate with data from DB
     for item in db_plan_items:
-        recipe_names = []
         key = getattr(item.meal_type, "value", item.meal_type)
-        if item.recipe_ids:
-            # get recipe names
-            recipe_names = [
-                recipe.name for recipe in recipes if recipe.id in item.recipe_ids
-            ]
-        plan[item.day][key] = recipe_names if recipe_names else []
+        plan[item.day][key] = [
+            recipe_names_by_id[rid] for rid in (item.recipe_ids or []) if rid in recipe_names_by_id
+        ]
+
+    # Generate the PDF content in memory
+    return create_pdf_in_memory(plan)
+
+
+@job_handler("weekly_plan_pdf")
+def render_plan_pdf(db: Session, job: Job) -> bytes:
+    job.result_media_type = "application/pdf"
+    return build_plan_pdf(db, job.user_id)
 
-    # 3. Generate the PDF content in memory
-    pdf_bytes = create_pdf_in_memory(plan)
 
-    # 4. Stream the PDF back to the client
+@pl_router.post("/pdf", status_code=status.HTTP_202_ACCEPTED, response_model=JobSchema)
+def export_weekly_plan_pdf(
+    db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
+):
+    """Renders the PDF on a job worker; download it from /jobs/{id}/result once it has succeeded."""
+    job = enqueue(db, "weekly_plan_pdf", {"filename": "weekly_meal_plan.pdf"}, user_id=current_user.id,
+                  priority=PRIORITY_INTERACTIVE)
+    db.commit()
+    return job_accepted(job)
+
+
+@pl_router.get("/pdf", response_class=StreamingResponse)
+def get_weekly_plan_pdf(
+    db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
+):
+    # Tabs and devices asking at the same time share one query and LaTeX render
+    pdf_bytes = coalesced(db, "/weekly-plan/pdf", current_user.id, (),
+                          lambda: build_plan_pdf(db, current_user.id))
+
+    # Stream the PDF back to the client
     pdf_stream = io.BytesIO(pdf_bytes)
 
     headers = {"Content-Disposition": 'attachment; filename="weekly_meal_plan.pdf"'}
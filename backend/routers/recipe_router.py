@@ -7,9 +7,11 @@ from schemas import RecipeSchema, RecipeCreateUpdateSchema
 from database import SessionLocal
 
 from database import get_db
+from catalog import global_catalog
+from coalesce import coalesced
+from events import publish
 import logging
 logger = logging.getLogger("uvicorn")
-logger.setLevel(logging.DEBUG)
 
 rec_router = APIRouter(prefix="/recipes", tags=["Recipes"])
 
@@ -18,22 +20,21 @@ from routers.auth_router import get_current_user
 ## Recipes
 @rec_router.get("", response_model=List[RecipeSchema])
 def get_recipes(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_recipes = (
-        db.query(Recipe)
-        .filter((Recipe.user_id == None) | (Recipe.user_id == current_user.id))
-        .order_by(Recipe.name)
-        .all()
-    )
-    return db_recipes
+    def load_recipes():
+        # The user's own recipes from the database, the global ones from the shared cache
+        db_recipes = db.query(Recipe).filter(Recipe.user_id == current_user.id).order_by(Recipe.name).all()
+        own = [RecipeSchema.model_validate(r) for r in db_recipes]
+        return sorted([*own, *global_catalog.get(db).recipes], key=lambda r: r.name)
+
+    # Identical concurrent listings share one query
+    return coalesced(db, "/recipes", current_user.id, (), load_recipes)
 
 @rec_router.get("/{recipe_id}", response_model=RecipeSchema)
 def get_recipe(recipe_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_recipe = (
-        db.query(Recipe)
-        .filter(Recipe.id == recipe_id)
-        .filter((Recipe.user_id == None) | (Recipe.user_id == current_user.id))
-        .first()
-    )
+    global_recipe = global_catalog.get(db).recipes_by_id.get(recipe_id)
+    if global_recipe is not None:
+        return global_recipe
+    db_recipe = db.query(Recipe).filter(Recipe.id == recipe_id, Recipe.user_id == current_user.id).first()
     if not db_recipe:
         raise HTTPException(status_code=404, detail="Recipe not found")
     return db_recipe
@@ -44,10 +45,18 @@ def add_recipe(recipe: RecipeCreateUpdateSchema, db: Session = Depends(get_db),
     data = recipe.model_dump()
     new_recipe = Recipe(**data, user_id=current_user.id)
     db.add(new_recipe)
+    db.flush()
+    publish(db, current_user.id, "recipe", "created", [new_recipe.id])
     db.commit()
     db.refresh(new_recipe)
     return new_recipe
 
+def _with_stored_ids(items: List[dict], stored: List[dict]) -> List[dict]:
+    """Items sent without an id get the one stored for their name, so resending a recipe unchanged writes nothing."""
+    stored_ids = {item["name"].lower(): item.get("id") for item in stored}
+    return [item if item.get("id") is not None else dict(item, id=stored_ids.get(item["name"].lower()))
+            for item in items]
+
 @rec_router.put("/{recipe_id}",  response_model=RecipeSchema)
 def update_recipe(recipe_id: int, recipe: RecipeCreateUpdateSchema, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
     db_recipe = db.query(Recipe).filter(Recipe.id == recipe_id, Recipe.user_id == current_user.id).first()
@@ -55,9 +64,20 @@ def update_recipe(recipe_id: int, recipe: RecipeCreateUpdateSchema, db: Session
         raise HTTPException(status_code=404, detail="Recipe not found or not owned by user")
     
     update_data = recipe.model_dump(exclude_unset=True)
-    for key, value in update_data.items():
+    if "ingredients" in update_data:
+        update_data["ingredients"] = _with_stored_ids(update_data["ingredients"], db_recipe.resolved_ingredients)
+    # Write only the columns that change: the nutrient trigger runs only when ingredients do.
+    # The ingredients are compared as read back, with current names
+    current = {key: getattr(db_recipe, key) for key in update_data}
+    if "ingredients" in current:
+        current["ingredients"] = db_recipe.resolved_ingredients
+    changed = {key: value for key, value in update_data.items() if current[key] != value}
+    if not changed:
+        return db_recipe
+    for key, value in changed.items():
         setattr(db_recipe, key, value)
-        
+
+    publish(db, current_user.id, "recipe", "updated", [db_recipe.id])
     db.commit()
     db.refresh(db_recipe)
     return db_recipe
@@ -68,5 +88,6 @@ def delete_recipe(recipe_id: int, db: Session = Depends(get_db), current_user: U
     if not db_recipe:
         raise HTTPException(status_code=404, detail="Recipe not found or not owned by user")
     db.delete(db_recipe)
+    publish(db, current_user.id, "recipe", "deleted", [recipe_id])
     db.commit()
     return Response(status_code=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
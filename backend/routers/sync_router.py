@@ -0,0 +1,122 @@
+from fastapi import APIRouter
+from fastapi import Depends, HTTPException, Query
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+from typing import Optional, Tuple
+import datetime
+import os
+
+from models import User, Recipe, Ingredient, PlanEntry, SyncTombstone
+from schemas import PlanEntrySchema, PlanKeySchema, RecipeSchema, SyncDeletedSchema, SyncSchema
+from database import get_db
+from catalog import owned_or_global
+from jobs import maintenance_task
+from routers.auth_router import get_current_user
+from routers.ingredient_router import with_remaining_shelf_life
+from routers.plan_router import day_name
+import logging
+
+logger = logging.getLogger("uvicorn")
+
+sync_router = APIRouter(prefix="/sync", tags=["Sync"])
+
+# Deletes are remembered this long; clients that last synced earlier get a full sync
+TOMBSTONE_RETENTION_DAYS = int(os.environ.get("MEALPLANNER_SYNC_TOMBSTONE_DAYS", "30"))
+
+
+def _parse_cursor(since: str) -> Tuple[int, int, int]:
+    """(row version, issued at as a unix time, shard) of a cursor returned by an earlier sync."""
+    try:
+        parts = since.split(".")
+        # Cursors issued before sharding have no shard: they are all shard 0's
+        if len(parts) == 2:
+            parts.append("0")
+        version, issued, shard = parts
+        return int(version), int(issued), int(shard)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid sync cursor")
+
+
+@maintenance_task
+def purge_sync_tombstones(db: Session) -> None:
+    purged = db.execute(text(
+        f"DELETE FROM sync_tombstones WHERE deleted_at < now() - interval '{TOMBSTONE_RETENTION_DAYS} days'"
+    )).rowcount
+    if purged:
+        logger.info("Purged %d sync tombstones", purged)
+
+
+@sync_router.get("", response_model=SyncSchema)
+def sync(
+    since: Optional[str] = Query(None, description="Cursor of the previous sync; everything when omitted"),
+    db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
+):
+    """
+    Recipes, ingredients and plan entries (from the current week on) changed since
+    the cursor, and those deleted since. Rows are versioned by the transaction
+    that last wrote them, and the new cursor is the oldest transaction still
+    running, so a write that commits after this sync is returned by the next one
+    (a row may come back twice, never not at all). Apply the deletes first.
+    """
+    # Taken before reading anything: every transaction older than it is visible to the reads below
+    snapshot = db.execute(text(
+        "SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS version, "
+        "extract(epoch FROM now())::bigint AS issued"
+    )).one()
+    version, full = 0, True
+    if since:
+        version, issued, shard = _parse_cursor(since)
+        # Row versions are a shard's own: a user moved since syncs everything again
+        full = snapshot.issued - issued > TOMBSTONE_RETENTION_DAYS * 86400 or shard != current_user.shard
+        if full:
+            version = 0
+
+    recipes = (
+        owned_or_global(db.query(Recipe).filter(Recipe.row_version >= version), Recipe.user_id, current_user.id)
+        .order_by(Recipe.id)
+        .all()
+    )
+    ingredients = (
+        owned_or_global(db.query(Ingredient).filter(Ingredient.row_version >= version),
+                        Ingredient.user_id, current_user.id)
+        .order_by(Ingredient.id)
+        .all()
+    )
+    entries = (
+        db.query(PlanEntry.plan_date, PlanEntry.meal_type, PlanEntry.recipe_ids)
+        .filter(PlanEntry.user_id == current_user.id, PlanEntry.row_version >= version,
+                PlanEntry.plan_date >= func.plan_week_start(func.current_date()))
+        .order_by(PlanEntry.plan_date, PlanEntry.meal_type)
+        .all()
+    )
+
+    deleted = SyncDeletedSchema()
+    if not full:
+        tombstones = (
+            owned_or_global(db.query(SyncTombstone.id, SyncTombstone.entity, SyncTombstone.entity_key)
+                            .filter(SyncTombstone.row_version >= version),
+                            SyncTombstone.user_id, current_user.id)
+            .order_by(SyncTombstone.id)
+            .all()
+        )
+        for _, entity, key in tombstones:
+            if entity == "recipe":
+                deleted.recipes.append(key["id"])
+            elif entity == "ingredient":
+                deleted.ingredients.append(key["id"])
+            elif entity == "plan":
+                deleted.plan.append(PlanKeySchema(**key))
+
+    now = datetime.datetime.utcnow()
+    return SyncSchema(
+        cursor=f"{snapshot.version}.{snapshot.issued}.{current_user.shard}",
+        full=full,
+        recipes=[RecipeSchema.model_validate(r) for r in recipes],
+        ingredients=[with_remaining_shelf_life(i, now) for i in ingredients],
+        plan=[
+            PlanEntrySchema(plan_date=e.plan_date, day=day_name(e.plan_date), meal_type=e.meal_type,
+                            recipe_ids=e.recipe_ids or [])
+            for e in entries
+        ],
+        deleted=deleted,
+    )
@@ -5,16 +5,16 @@ from fastapi import Depends, HTTPException, Response, status, Query
 
 from sqlalchemy.orm import Session
 from typing import List, Dict
-from models import WeeklyPlan, ServingUnits, Recipe, DaysOfWeek, User, Ingredient
+from models import WeeklyPlan, ServingUnits, Recipe, DaysOfWeek, User
 from schemas import ShoppingListItemSchema
-from sqlalchemy import func
+from sqlalchemy import func, text
 
 
 
 from database import get_db
+from coalesce import coalesced
 import logging
 logger = logging.getLogger("uvicorn")
-logger.setLevel(logging.DEBUG)
 
 
 util_router = APIRouter(prefix="/utilities", tags=["Utilities"])
@@ -46,29 +46,43 @@ def get_nutrition_for_day(day: DaysOfWeek, db: Session = Depends(get_db), curren
         "energy": float(result.total_energy)
     }
 
-@util_router.get("/shopping-list", tags=["Utilities"], response_model=Dict[str, ShoppingListItemSchema])
+@util_router.get("/shopping-list", tags=["Utilities"], response_model=Dict[str, ShoppingListItemSchema],
+                 response_model_exclude_unset=True)
 def get_shopping_list(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    # Get all recipes in the user's weekly plan
-    weekly_plan_recipes = db.query(Recipe).join(WeeklyPlan, Recipe.id == func.any(WeeklyPlan.recipe_ids)).filter(WeeklyPlan.user_id == current_user.id).all()
-
-    # Get all ingredients available to the user
-    available_ingredients = db.query(Ingredient).filter(Ingredient.user_id == current_user.id, Ingredient.available == True).all()
-    available_ingredient_names = {ing.name.lower() for ing in available_ingredients}
-
-    shopping_list = {}
-
-    for recipe in weekly_plan_recipes:
-        for ingredient_in_recipe in recipe.ingredients:
-            ingredient_name = ingredient_in_recipe['name'].lower()
-            if ingredient_name not in available_ingredient_names:
-                quantity = ingredient_in_recipe['quantity']
-                serving_unit = ingredient_in_recipe['serving_unit']
-
-                if ingredient_name not in shopping_list:
-                    shopping_list[ingredient_name] = {"quantity": 0.0, "serving_unit": serving_unit}
-                
-                # Assuming consistent serving units for simplicity in aggregation
-                # In a real app, you'd need unit conversion logic here
-                shopping_list[ingredient_name]["quantity"] += quantity
-
-    return shopping_list
\ No newline at end of file
+    def build_shopping_list():
+        # Every ingredient of the recipes in the user's weekly plan, under its current name and in its
+        # unit where the quantity converts (see units.py), summed. A global recipe's global ingredient
+        # counts as available when the user has one of the same name in stock
+        rows = db.execute(text("""
+            SELECT lower(coalesce(i.name, x.name)) AS name,
+                   CASE WHEN q.quantity IS NULL THEN x.serving_unit ELSE i.serving_unit END AS serving_unit,
+                   sum(coalesce(q.quantity, x.quantity)) AS quantity,
+                   bool_or(q.quantity IS NOT NULL) AS converted
+            FROM weekly_plan p
+            JOIN recipes r ON r.id = ANY(p.recipe_ids)
+            CROSS JOIN LATERAL jsonb_to_recordset(r.ingredients)
+                AS x(id int, name text, quantity float, serving_unit text)
+            LEFT JOIN ingredients i ON i.id = x.id
+            CROSS JOIN LATERAL (SELECT convert_quantity(x.quantity, x.serving_unit, i.serving_unit,
+                                                        i.density_g_per_ml, i.grams_per_piece) AS quantity) q
+            WHERE p.user_id = :user_id
+              AND NOT EXISTS (
+                  SELECT 1 FROM ingredients a
+                  WHERE a.user_id = :user_id AND a.available
+                    AND (a.id = x.id OR lower(a.name) = lower(coalesce(i.name, x.name))))
+            GROUP BY 1, 2
+            ORDER BY 1, 4 DESC, 2
+        """), {"user_id": current_user.id}).all()
+
+        # One entry per name, in the ingredient's own unit; quantities that do not convert go with it
+        shopping_list: Dict[str, dict] = {}
+        for name, serving_unit, quantity, _ in rows:
+            if name not in shopping_list:
+                shopping_list[name] = {"quantity": quantity, "serving_unit": serving_unit}
+            else:
+                shopping_list[name].setdefault("other_units", []).append(
+                    {"quantity": quantity, "serving_unit": serving_unit})
+        return shopping_list
+
+    # Identical concurrent requests share one computation
+    return coalesced(db, "/utilities/shopping-list", current_user.id, (), build_shopping_list)
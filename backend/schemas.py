@@ -1,6 +1,6 @@
-from pydantic import BaseModel, ConfigDict, EmailStr
+from pydantic import AliasChoices, BaseModel, ConfigDict, EmailStr, Field
 from models import RecipeMealType, ServingUnits, DaysOfWeek
-from typing import List, Optional
+from typing import Dict, List, Optional
 import datetime
 
 
@@ -19,7 +19,13 @@ class TokenSchema(BaseModel):
     access_token: str
     token_type: str = "bearer"
 
+class EventsTicketSchema(BaseModel):
+    ticket: str
+    expires_in: int
+
 class IngredientItemSchema(BaseModel):
+    # The ingredient's id; when omitted the recipe's ingredient is found by name (ignoring case)
+    id: Optional[int] = None
     name: str
     quantity: float
     serving_unit: ServingUnits
@@ -30,7 +36,8 @@ class RecipeSchema(BaseModel):
     id: int
     name: str
     serves: int
-    ingredients: List[IngredientItemSchema]
+    # Read from the ORM with the ingredients' current names
+    ingredients: List[IngredientItemSchema] = Field(validation_alias=AliasChoices("resolved_ingredients", "ingredients"))
     instructions: str
     meal_type: RecipeMealType
     is_vegetarian: bool
@@ -39,6 +46,7 @@ class RecipeSchema(BaseModel):
     fat: float
     fiber: float
     energy: float
+    updated_at: Optional[datetime.datetime] = None
 
 class RecipeCreateUpdateSchema(BaseModel):
     name: str
@@ -52,6 +60,14 @@ class PlanSlotSchema(BaseModel):
     day: DaysOfWeek
     meal_type: RecipeMealType
     recipe_ids: Optional[List[int]] = []
+    # Any day of the week to plan; the current week when omitted
+    week_of: Optional[datetime.date] = None
+
+class PlanEntrySchema(BaseModel):
+    plan_date: datetime.date
+    day: DaysOfWeek
+    meal_type: RecipeMealType
+    recipe_ids: List[int]
 
 class IngredientSchema(BaseModel):
     model_config = ConfigDict(from_attributes=True)
@@ -64,6 +80,8 @@ class IngredientSchema(BaseModel):
     last_available: Optional[datetime.datetime]
     serving_unit: ServingUnits
     serving_size: float
+    density_g_per_ml: Optional[float] = None
+    grams_per_piece: Optional[float] = None
     energy: float
     protein: float
     carbs: float
@@ -76,6 +94,7 @@ class IngredientSchema(BaseModel):
     sodium_mg: float
     vitamin_c_mg: float
     remaining_shelf_life: Optional[int] = None
+    updated_at: Optional[datetime.datetime] = None
 
 class IngredientUpdateSchema(BaseModel):
     available: Optional[bool] = None
@@ -83,6 +102,8 @@ class IngredientUpdateSchema(BaseModel):
     name: Optional[str] = None
     serving_unit: Optional[ServingUnits] = None
     serving_size: Optional[float] = None
+    density_g_per_ml: Optional[float] = None
+    grams_per_piece: Optional[float] = None
     energy: Optional[float] = None
     protein: Optional[float] = None
     carbs: Optional[float] = None
@@ -98,6 +119,107 @@ class IngredientUpdateSchema(BaseModel):
 class HealthCheckSchema(BaseModel):
     status: str = "OK"
 
-class ShoppingListItemSchema(BaseModel):
+class ReadinessSchema(BaseModel):
+    status: str = "OK"
+    database: str = "OK"
+    pool: Dict[str, int] = {}
+
+class ShoppingListQuantitySchema(BaseModel):
     quantity: float
     serving_unit: str
+
+class ShoppingListItemSchema(ShoppingListQuantitySchema):
+    # Quantities in units that do not convert to the ingredient's, one per unit; left out when there are none
+    other_units: List[ShoppingListQuantitySchema] = []
+
+class JobSchema(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    kind: str
+    status: str
+    attempts: int
+    max_attempts: int
+    last_error: Optional[str] = None
+    created_at: datetime.datetime
+    finished_at: Optional[datetime.datetime] = None
+
+class NotificationSchema(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    kind: str
+    # For expiry digests: {"kind", "items": [{"id", "name", "expires_at"}]}
+    payload: dict
+    created_at: datetime.datetime
+    read_at: Optional[datetime.datetime] = None
+
+class ProfileSummarySchema(BaseModel):
+    # "<pid>-<n>"
+    id: str
+    # "header" (X-MealPlanner-Profile) or "sampled" (MEALPLANNER_PROFILE_SAMPLE)
+    trigger: str
+    method: str
+    route: str
+    path: str
+    status: Optional[int] = None
+    started_at: datetime.datetime
+    duration_ms: float
+    user_id: Optional[int] = None
+    interval_ms: float
+    samples: int
+    statement_count: int
+    db_ms: float
+
+class ProfileStatementSchema(BaseModel):
+    # From the start of the request
+    offset_ms: float
+    duration_ms: float
+    statement: str
+
+class ProfileSchema(ProfileSummarySchema):
+    # "outermost;...;innermost" frames -> samples
+    stacks: Dict[str, int]
+    statements: List[ProfileStatementSchema]
+    statements_dropped: int = 0
+
+class NutritionPointSchema(BaseModel):
+    # First day of the bucket (the Monday for weekly buckets)
+    period_start: datetime.date
+    days_planned: int
+    recipes: int
+    nutrients: Dict[str, float]
+
+class NutritionWindowSchema(BaseModel):
+    days: int
+    days_planned: int
+    # Averages over the days that had planned recipes
+    daily_average: Dict[str, float]
+
+class NutritionTrendsSchema(BaseModel):
+    end: datetime.date
+    windows: List[NutritionWindowSchema]
+    # Least-squares change per day over the longest window
+    trend_per_day: Dict[str, Optional[float]]
+    this_week: Dict[str, float]
+    last_week: Dict[str, float]
+    week_over_week_pct: Dict[str, Optional[float]]
+
+class PlanKeySchema(BaseModel):
+    plan_date: datetime.date
+    meal_type: RecipeMealType
+
+class SyncDeletedSchema(BaseModel):
+    recipes: List[int] = []
+    ingredients: List[int] = []
+    plan: List[PlanKeySchema] = []
+
+class SyncSchema(BaseModel):
+    # Pass back as `since` on the next sync
+    cursor: str
+    # True when the collections are complete and replace what the client has
+    full: bool
+    recipes: List[RecipeSchema]
+    ingredients: List[IngredientSchema]
+    plan: List[PlanEntrySchema]
+    deleted: SyncDeletedSchema
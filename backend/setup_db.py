@@ -1,142 +1,202 @@
 # setup_db.py
 import csv
+import hashlib
+import os
 import sys
-import json  # <-- ADD THIS IMPORT
-from typing import Any, Dict, Optional, Callable
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
 
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import Session
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.schema import CreateIndex, CreateTable, DDLElement
 from sqlalchemy.sql import text
 
-from database import engine, Base, SessionLocal
-from models import Ingredient, Recipe, WeeklyPlan, RecipeMealType, User
+from database import engine, Base, SessionLocal, shard_count, shard_engine, shard_sessionmaker
+from models import Ingredient, Recipe, PlanEntry, User, BootState
+import partitions
+import shards
+import storage
+from migrations import run_migrations, MigrationError
 from sqlalchemy import text as sa_text
 from passlib.context import CryptContext
 
+# Set MEALPLANNER_FORCE_BOOT=1 to ignore recorded checksums and re-run every step.
+FORCE_BOOT = os.environ.get("MEALPLANNER_FORCE_BOOT", "0").lower() in ("1", "true", "yes")
+
+
 # --- Custom Exception ---
 class DataLoadError(Exception):
     """Custom exception for data loading errors."""
     pass
 
 
-# --- Data Transformation Functions ---
+# --- Boot bookkeeping ---
+
+_phase_timings: List[Tuple[str, float]] = []
+
+
+@contextmanager
+def boot_phase(name: str) -> Iterator[None]:
+    """Times one phase of the boot sequence and records it for the final report."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        _phase_timings.append((name, elapsed_ms))
+        print(f"   [{name}] {elapsed_ms:.1f} ms")
+
+
+def _checksum(*parts: bytes) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part)
+    return digest.hexdigest()
 
-def _transform_common_types(row: Dict[str, Any]) -> Dict[str, Any]:
-    """
-    Helper function to convert common string types from a CSV row.
-    Handles numbers and booleans.
-    """
-    processed_row = row.copy()
-    for key, value in processed_row.items():
-        if value == '':
-            processed_row[key] = None
-            continue
-        if key in [
-            'protein', 'carbs', 'fat', 'fiber', 'energy',
-            'iron_mg', 'magnesium_mg', 'calcium_mg', 'potassium_mg', 'sodium_mg', 'vitamin_c_mg',
-            'shelf_life', 'serving_size', 'id', 'serves']:
-            if value is not None:
-                try:
-                    processed_row[key] = float(value) if '.' in value else int(value)
-                except (ValueError, TypeError):
-                    pass # Keep as is if conversion fails
-        elif key in ['is_vegetarian', 'available']:
-            processed_row[key] = value.lower() in ['true', '1', 't']
-
-    if DEFAULT_USER_ID is not None:
-        processed_row['user_id'] = DEFAULT_USER_ID
-        
-    return processed_row
-
-
-def transform_recipe_row(row: Dict[str, Any]) -> Dict[str, Any]:
-    """Transforms a recipe row, parsing the ingredients JSON and setting the meal_type enum."""
-    processed_row = _transform_common_types(row)
-    
-    # Convert meal_type enum
-    if processed_row.get('meal_type'):
-        processed_row['meal_type'] = RecipeMealType(processed_row['meal_type'])
-        
-    # vvvvvvvv THE FIX IS HERE vvvvvvvv
-    # Parse the ingredients string into a Python list of dictionaries
-    ingredients_str = processed_row.get('ingredients')
-    if ingredients_str and isinstance(ingredients_str, str):
-        try:
-            processed_row['ingredients'] = json.loads(ingredients_str)
-        except json.JSONDecodeError:
-            print(f"Warning: Could not decode ingredients JSON for row: {row}")
-            processed_row['ingredients'] = [] # Default to an empty array on error
-    # ^^^^^^^^ END OF FIX ^^^^^^^^^^
-            
-    return processed_row
 
+def is_applied(session: Session, step: str, checksum: str) -> bool:
+    """True when `step` was already applied with exactly this checksum."""
+    if FORCE_BOOT:
+        return False
+    recorded = session.get(BootState, step)
+    return recorded is not None and recorded.checksum == checksum
+
+
+def mark_applied(session: Session, step: str, checksum: str) -> None:
+    session.execute(storage.upsert(session, BootState, dict(step=step, checksum=checksum), index_elements=["step"],
+                                   update=["checksum"], assign=dict(applied_at=func.now())))
+
+
+def schema_fingerprint() -> str:
+    """Checksum of the DDL `create_all` would emit, including trigger DDL attached to tables."""
+    dialect = postgresql.dialect()
+    parts = []
+    for table in Base.metadata.sorted_tables:
+        parts.append(str(CreateTable(table).compile(dialect=dialect)).encode())
+        for index in sorted(table.indexes, key=lambda i: i.name or ""):
+            parts.append(str(CreateIndex(index).compile(dialect=dialect)).encode())
+        for listener in list(table.dispatch.before_create) + list(table.dispatch.after_create):
+            if isinstance(listener, DDLElement):
+                parts.append(str(listener.statement).encode())
+    return _checksum(*parts)
+
+
+def ensure_default_user(session: Session) -> None:
+    """Creates the demo user only when no user exists yet."""
+    if session.query(User.id).limit(1).scalar() is not None:
+        return
+    # Hashing is deliberately slow, so only pay for it when the user is actually missing
+    pwd = CryptContext(schemes=["bcrypt"], deprecated="auto").hash("demo123")
+    session.execute(sa_text("""
+        INSERT INTO users (email, password_hash)
+        SELECT 'demo@demo.com', :pwd
+        WHERE NOT EXISTS (SELECT 1 FROM users);
+    """), {"pwd": pwd})
+
+
+# --- Data Loading ---
 
 DEFAULT_USER_ID: Optional[int] = 1
 
 
-def transform_weekly_plan_row(row: Dict[str, Any]) -> Dict[str, Any]:
-    """Transforms a weekly_plan row, handling recipe_ids array and meal_type enum."""
-    processed_row = _transform_common_types(row)
-    # Handle meal_type enum
-    if processed_row.get('meal_type'):
-        processed_row['meal_type'] = RecipeMealType(processed_row['meal_type']).value
-    # Handle recipe_ids array
-    recipe_ids_str = processed_row.get("recipe_ids", "")
-    if recipe_ids_str and recipe_ids_str not in ["{}", ""]:
-        processed_row["recipe_ids"] = [int(x) for x in recipe_ids_str.strip("{}").split(",")]
-    else:
-        processed_row["recipe_ids"] = []
-    # Attach default user id for seed data
-
-    return processed_row
-
-
-def transform_ingredient_row(row: Dict[str, Any]) -> Dict[str, Any]:
-    processed_row = _transform_common_types(row)
-    # Keep CSV-loaded ingredients as global stock (no user_id)
-    return processed_row
-
-
-def load_data_from_csv(
-    session: Session,
-    model: Base,
-    file_path: str,
-    transform_func: Optional[Callable[[Dict], Dict]] = None
-) -> None:
-    """Loads data from a CSV file into a database table using SQLAlchemy."""
+def _conflict_clause(model: Base, columns: List[str]) -> str:
+    """The ON CONFLICT behaviour used when seeding each table."""
+    if model == Ingredient:
+        updates = [c for c in columns if c not in ("id", "name", "user_id")]
+        assignments = ", ".join(f"{c} = EXCLUDED.{c}" for c in updates)
+        return f"ON CONFLICT (user_id, lower(name)) DO UPDATE SET {assignments}"
+    if model == Recipe:
+        return "ON CONFLICT (id) DO NOTHING"
+    if model == PlanEntry:
+        # Fills the current week's free slots; never overwrites what the user planned
+        return "ON CONFLICT (user_id, plan_date, meal_type) DO NOTHING"
+    return ""
+
+
+# CSV columns that do not map one-to-one onto the model's table:
+# {csv column: (table column, SQL over the staged text value) or None to ignore it}
+SEED_COLUMN_MAP = {
+    # The seed plan is a day-of-week template, loaded into the current week
+    PlanEntry: {
+        "id": None,
+        "day": ("plan_date", "plan_week_start(current_date) + array_position("
+                "ARRAY['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'], {value}) - 1"),
+    },
+}
+
+
+def load_data_from_csv(session: Session, model: Base, file_path: str) -> bool:
+    """
+    Streams a CSV file into a temporary staging table with COPY and upserts it into
+    the model's table in one INSERT ... SELECT. Returns False when the file is
+    unchanged since the last successful load and the work was skipped.
+    """
+    table = model.__table__
     try:
-        print(f"-- Loading data from {file_path} into {model.__tablename__}...")
-        with open(file_path, "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            data = [transform_func(row) if transform_func else row for row in reader]
+        with open(file_path, "rb") as f:
+            checksum = _checksum(f.read(), str(DEFAULT_USER_ID).encode())
+        step = f"seed:{table.name}"
+        if is_applied(session, step, checksum):
+            print(f"-- {file_path} unchanged, skipping {table.name}.")
+            return False
 
-            if not data:
+        print(f"-- Loading data from {file_path} into {table.name}...")
+        with open(file_path, "r", encoding="utf-8", newline="") as f:
+            header = next(csv.reader(f), None)
+            if not header:
                 print(f"   No data found in {file_path}. Skipping.")
-                return
-
-            stmt = insert(model).values(data)
-            
-            if model == Ingredient:
-                update_dict = {
-                    col.name: stmt.excluded[col.name]
-                    for col in model.__table__.columns
-                    if not col.primary_key and col.name not in ('name','user_id')
-                }
-                stmt = stmt.on_conflict_do_update(index_elements=['user_id','name'], set_=update_dict)
-            elif model == Recipe:
-                stmt = stmt.on_conflict_do_nothing(index_elements=['id'])
-            elif model == WeeklyPlan:
-                # Upsert per user/week slot
-                stmt = stmt.on_conflict_do_update(
-                    index_elements=['user_id', 'day', 'meal_type'],
-                    set_=dict(recipe_ids=stmt.excluded.recipe_ids)
-                )
-
-            session.execute(stmt)
-            print(f"   Successfully loaded and upserted {len(data)} rows.")
+                return False
+            mapped = SEED_COLUMN_MAP.get(model, {})
+            unknown = [c for c in header if c not in table.columns and c not in mapped]
+            if unknown:
+                raise DataLoadError(f"Unknown columns in {file_path}: {', '.join(unknown)}")
+
+            staging = f"stage_{table.name}"
+            staging_columns = ", ".join(f"{c} text" for c in header)
+            session.execute(text(f"CREATE TEMP TABLE {staging} ({staging_columns}) ON COMMIT DROP"))
+
+        with open(file_path, "rb") as f:
+            cursor = session.connection().connection.cursor()
+            cursor.copy_expert(
+                f"COPY {staging} ({', '.join(header)}) FROM STDIN WITH (FORMAT csv, HEADER true, ENCODING 'UTF8')", f
+            )
+
+        # Cast the text staging columns to the real column types in SQL
+        dialect = postgresql.dialect()
+        override_user = DEFAULT_USER_ID is not None and "user_id" in table.columns
+        columns, select_list = [], []
+        for c in header:
+            if override_user and c == "user_id":
+                continue
+            if c in mapped:
+                if mapped[c] is None:
+                    continue
+                column, expression = mapped[c]
+                columns.append(column)
+                select_list.append(expression.format(value=f"NULLIF({c}, '')"))
+                continue
+            columns.append(c)
+            select_list.append(f"CAST(NULLIF({c}, '') AS {table.columns[c].type.compile(dialect=dialect)})")
+        if override_user:
+            columns.append("user_id")
+            select_list.append(":user_id")
+        result = session.execute(
+            text(
+                f"INSERT INTO {table.name} ({', '.join(columns)}) "
+                f"SELECT {', '.join(select_list)} FROM {staging} "
+                f"{_conflict_clause(model, columns)}"
+            ),
+            {"user_id": DEFAULT_USER_ID},
+        )
+        mark_applied(session, step, checksum)
+        print(f"   Successfully loaded and upserted {result.rowcount} rows.")
+        return True
 
     except FileNotFoundError:
         print(f"Warning: CSV file not found at {file_path}. Skipping...")
+        return False
     except (IOError, csv.Error) as e:
         raise DataLoadError(f"Error reading CSV file {file_path}: {e}") from e
     except ValueError as e:
@@ -145,162 +205,83 @@ def load_data_from_csv(
 
 # --- Main Logic ---
 
+def setup_schema(engine, session_factory, suffix: str = "") -> None:
+    """Schema, plan partitions and migrations of one database; `suffix` tells the shards' phases apart."""
+    with boot_phase(f"boot_state{suffix}"):
+        BootState.__table__.create(bind=engine, checkfirst=True)
+
+    with boot_phase(f"schema{suffix}"):
+        with session_factory() as session:
+            checksum = schema_fingerprint()
+            if is_applied(session, "schema:create_all", checksum):
+                print("Schema unchanged, skipping create_all.")
+            else:
+                print("Executing schema setup...")
+                Base.metadata.create_all(bind=engine)
+                mark_applied(session, "schema:create_all", checksum)
+                print("Schema and triggers created successfully.")
+            session.commit()
+
+    with boot_phase(f"partitions{suffix}"):
+        # Months roll over between boots; creating the missing partitions is cheap
+        with engine.begin() as conn:
+            created = partitions.ensure_current(conn)
+        print(f"Created plan partitions: {', '.join(created)}" if created else "Plan partitions up to date.")
+
+    with boot_phase(f"migrations{suffix}"):
+        applied = run_migrations(engine)
+        print(f"{len(applied)} migration(s) applied." if applied else "Schema migrations up to date.")
+
+
 def setup_database() -> None:
-    """Sets up the database by creating tables and loading initial data."""
+    """Sets up the database by creating tables and loading initial data, skipping steps already applied."""
+    boot_started = time.perf_counter()
     try:
-        print("Executing schema setup...")
-        Base.metadata.create_all(bind=engine)
-        print("Schema and triggers created successfully.")
-
-        # Ensure new micronutrient columns exist for existing databases
-        
-        with engine.connect() as conn:
-            # print("Ensuring micronutrient columns exist on 'ingredients' table...")
-            # conn.execute(sa_text("""
-            #     ALTER TABLE IF EXISTS ingredients 
-            #     ADD COLUMN IF NOT EXISTS iron_mg numeric(10,2) DEFAULT 0.0;
-            # """))
-            # conn.execute(sa_text("""
-            #     ALTER TABLE IF EXISTS ingredients 
-            #     ADD COLUMN IF NOT EXISTS magnesium_mg numeric(10,2) DEFAULT 0.0;
-            # """))
-            # conn.execute(sa_text("""
-            #     ALTER TABLE IF EXISTS ingredients 
-            #     ADD COLUMN IF NOT EXISTS calcium_mg numeric(10,2) DEFAULT 0.0;
-            # """))
-            # conn.execute(sa_text("""
-            #     ALTER TABLE IF EXISTS ingredients 
-            #     ADD COLUMN IF NOT EXISTS potassium_mg numeric(10,2) DEFAULT 0.0;
-            # """))
-            # conn.execute(sa_text("""
-            #     ALTER TABLE IF EXISTS ingredients 
-            #     ADD COLUMN IF NOT EXISTS sodium_mg numeric(10,2) DEFAULT 0.0;
-            # """))
-            # conn.execute(sa_text("""
-            #     ALTER TABLE IF EXISTS ingredients 
-            #     ADD COLUMN IF NOT EXISTS vitamin_c_mg numeric(10,2) DEFAULT 0.0;
-            # """))
-            # User and multi-tenant adjustments
-            # print("Ensuring 'users' table and user_id columns exist...")
-            # conn.execute(sa_text("""
-            #     CREATE TABLE IF NOT EXISTS users (
-            #         id SERIAL PRIMARY KEY,
-            #         email VARCHAR(255) UNIQUE NOT NULL,
-            #         password_hash VARCHAR(255) NOT NULL,
-            #         created_at TIMESTAMP DEFAULT now()
-            #     );
-            # """))
-            # # Add user_id to recipes if missing
-            # conn.execute(sa_text("""
-            #     ALTER TABLE IF EXISTS recipes 
-            #     ADD COLUMN IF NOT EXISTS user_id INTEGER NULL REFERENCES users(id);
-            # """))
-            # conn.execute(sa_text("""
-            #     CREATE INDEX IF NOT EXISTS ix_recipes_user_id ON recipes(user_id);
-            # """))
-            # # Add user_id to weekly_plan and update unique constraint
-            # conn.execute(sa_text("""
-            #     ALTER TABLE IF EXISTS weekly_plan 
-            #     ADD COLUMN IF NOT EXISTS user_id INTEGER NULL REFERENCES users(id);
-            # """))
-            # # Add user_id to ingredients and make name unique per user, but allow a single global copy (user_id NULL)
-            # conn.execute(sa_text("""
-            #     ALTER TABLE IF EXISTS ingredients
-            #     ADD COLUMN IF NOT EXISTS user_id INTEGER NULL REFERENCES users(id);
-            # """))
-            conn.execute(sa_text("""
-                CREATE INDEX IF NOT EXISTS ix_ingredients_user_id ON ingredients(user_id);
-            """))
-            conn.execute(sa_text("""
-                DO $$
-                BEGIN
-                    IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'ingredients_name_key') THEN
-                        ALTER TABLE ingredients DROP CONSTRAINT ingredients_name_key;
-                    END IF;
-                END$$;
-            """))
-            conn.execute(sa_text("""
-                DO $$
-                BEGIN
-                    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uniq_user_ingredient_name') THEN
-                        ALTER TABLE ingredients ADD CONSTRAINT uniq_user_ingredient_name UNIQUE (user_id, name);
-                    END IF;
-                END$$;
-            """))
-            conn.execute(sa_text("""
-                DO $$
-                BEGIN
-                    IF NOT EXISTS (
-                        SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace 
-                        WHERE c.relname = 'uniq_global_ingredient_name' AND n.nspname = 'public'
-                    ) THEN
-                        CREATE UNIQUE INDEX uniq_global_ingredient_name ON ingredients(name) WHERE user_id IS NULL;
-                    END IF;
-                END$$;
-            """))
-            conn.execute(sa_text("""
-                CREATE INDEX IF NOT EXISTS ix_weekly_plan_user_id ON weekly_plan(user_id);
-            """))
-            # Drop old unique constraint if exists and create new one
-            conn.execute(sa_text("""
-                DO $$
-                BEGIN
-                    IF EXISTS (
-                        SELECT 1 FROM pg_constraint WHERE conname = 'unique_day_meal'
-                    ) THEN
-                        ALTER TABLE weekly_plan DROP CONSTRAINT unique_day_meal;
-                    END IF;
-                END$$;
-            """))
-            conn.execute(sa_text("""
-                DO $$
-                BEGIN
-                    IF NOT EXISTS (
-                        SELECT 1 FROM pg_constraint WHERE conname = 'unique_user_day_meal'
-                    ) THEN
-                        ALTER TABLE weekly_plan ADD CONSTRAINT unique_user_day_meal UNIQUE (user_id, day, meal_type);
-                    END IF;
-                END$$;
-            """))
-            # Ensure at least one default user exists for seed data
-            # Insert default demo user with a bcrypt hash if none exists
-            pwd = CryptContext(schemes=["bcrypt"], deprecated="auto").hash("demo123")
-            conn.execute(sa_text(f"""
-                INSERT INTO users (email, password_hash)
-                SELECT 'demo@demo.com', :pwd
-                WHERE NOT EXISTS (SELECT 1 FROM users);
-            """), {"pwd": pwd})
-            # Backfill weekly_plan user_id if null
-            conn.execute(sa_text("""
-                UPDATE weekly_plan 
-                SET user_id = (SELECT id FROM users ORDER BY id LIMIT 1)
-                WHERE user_id IS NULL;
-            """))
-            conn.commit()
-
-        with SessionLocal() as session:
-            print("Loading initial data...")
-            # Set DEFAULT_USER_ID for transformation
-            global DEFAULT_USER_ID
-            DEFAULT_USER_ID = session.query(User.id).order_by(User.id).limit(1).scalar()
-            # Keep stock ingredients as global (user_id NULL); do not backfill
-            load_data_from_csv(session, Ingredient, "data/ingredients.csv", transform_ingredient_row)
-            load_data_from_csv(session, Recipe, "data/recipes.csv", transform_recipe_row)
-            load_data_from_csv(session, WeeklyPlan, "data/weekly_plan.csv", transform_weekly_plan_row)
-            
-            print("-- Updating '*_id_seq' sequence...")
-            session.execute(text("SELECT setval('recipes_id_seq', (SELECT MAX(id) FROM recipes));"))
-            session.execute(text("SELECT setval('ingredients_id_seq', (SELECT MAX(id) FROM ingredients));"))
-            session.execute(text("SELECT setval('weekly_plan_id_seq', (SELECT MAX(id) FROM weekly_plan));"))
-            
-            session.commit()
+        setup_schema(engine, SessionLocal)
+
+        with boot_phase("default_user"):
+            with SessionLocal() as session:
+                ensure_default_user(session)
+                session.commit()
+
+        with boot_phase("seed"):
+            with SessionLocal() as session:
+                # Set DEFAULT_USER_ID for the seed rows
+                global DEFAULT_USER_ID
+                DEFAULT_USER_ID = session.query(User.id).order_by(User.id).limit(1).scalar()
+                loaded = [
+                    load_data_from_csv(session, Ingredient, "data/ingredients.csv"),
+                    load_data_from_csv(session, Recipe, "data/recipes.csv"),
+                    load_data_from_csv(session, PlanEntry, "data/weekly_plan.csv"),
+                ]
+
+                if any(loaded):
+                    print("-- Updating '*_id_seq' sequence...")
+                    session.execute(text("SELECT setval('recipes_id_seq', (SELECT MAX(id) FROM recipes));"))
+                    session.execute(text("SELECT setval('ingredients_id_seq', (SELECT MAX(id) FROM ingredients));"))
+
+                session.commit()
+
+        # The other shards get the schema and the global catalog; their users come with signups and moves
+        for shard in range(1, shard_count()):
+            print(f"-- Shard {shard}")
+            setup_schema(shard_engine(shard), shard_sessionmaker(shard), suffix=f"@{shard}")
+        if shard_count() > 1:
+            with boot_phase("shards"):
+                for sequence in shards.align_sequences():
+                    print(f"Aligned {sequence} with the shard's ids.")
+                updated = shards.replicate_global_catalog()
+                print(f"Copied the global catalog to shard(s) {', '.join(map(str, updated))}." if updated
+                      else "The global catalog is up to date on every shard.")
 
-        print("Database setup completed successfully.")
+        total_ms = (time.perf_counter() - boot_started) * 1000
+        summary = ", ".join(f"{name}={ms:.1f}ms" for name, ms in _phase_timings)
+        print(f"Database setup completed successfully in {total_ms:.1f} ms ({summary}).")
 
-    except (DataLoadError, Exception) as e:
+    except (DataLoadError, MigrationError, Exception) as e:
         print(f"An error occurred during database setup: {e}", file=sys.stderr)
         sys.exit(1)
 
 
 if __name__ == "__main__":
-    setup_database()
\ No newline at end of file
+    setup_database()
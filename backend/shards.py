@@ -0,0 +1,329 @@
+# shards.py
+"""
+Users spread over several databases (shards) to scale writes horizontally.
+
+Shard 0 is the database configured by the POSTGRES_* variables; shards 1, 2,
+... are the SQLAlchemy URLs listed in MEALPLANNER_SHARDS. Without it there is
+one shard and nothing here does anything. Every shard has the full schema
+(setup_db.py sets them all up) and the whole global catalog; a user's own
+recipes, ingredients, plan and notifications live on exactly one of them.
+
+- Signup places a new user on the shard given by a hash of their id
+  (database.shard_for_user). Shard 0 keeps every user as the directory that
+  logins read, with the shard each one lives on; that shard has a copy of the
+  user row for its foreign keys. The directory row commits first, with a
+  `place_user` job; signup then copies the user over itself, and the job
+  retries the copy if that failed (`place_user`, which is idempotent).
+- Login puts the shard into the access token, and `get_db` opens each
+  request's session on the shard of its token (database.request_shard).
+- The global catalog is written on shard 0 and copied to the other shards at
+  boot and by the job workers' maintenance (`replicate_global_catalog`).
+- Each shard generates ids that are its number modulo MAX_SHARDS
+  (`align_sequences`), so a user's rows keep their ids when they move.
+- This tool moves users between shards: `--rebalance` moves everyone whose
+  hash points elsewhere, e.g. after a shard was added.
+
+    python shards.py --status
+    python shards.py --rebalance [--dry-run]
+    python shards.py --move USER_ID --to SHARD
+    python shards.py --replicate
+
+A move copies the user's rows to the new shard, points the directory there
+and deletes them from the old one, holding the user's rows locked
+meanwhile. A move that fails leaves the user where they were; running it
+again clears what it had copied. Moved users sign in again, as their tokens
+name the old shard, and their clients get a full sync.
+"""
+import argparse
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, insert, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+import database
+import partitions
+import storage
+from database import MAX_SHARDS
+from jobs import enqueue, job_handler, maintenance_task, PRIORITY_INTERACTIVE
+from models import Ingredient, Job, Notification, NutritionDaily, NutritionWeekly, PlanEntry, Recipe, SyncTombstone, User
+
+logger = logging.getLogger("uvicorn")
+
+REPLICATION_ADVISORY_LOCK = 727_003
+
+# A user's rows, in the order they are copied (recipes find their ingredients, plans their recipes)
+TENANT_TABLES = [Ingredient.__table__, Recipe.__table__, PlanEntry.__table__, Notification.__table__]
+# The global catalog, in the same order
+CATALOG_TABLES = [Ingredient.__table__, Recipe.__table__]
+# Sequences of the rows that move between shards with their ids
+SHARDED_SEQUENCES = [("ingredients", "id"), ("recipes", "id"), ("notifications", "id")]
+
+
+class MoveError(Exception):
+    """Raised when a user cannot be moved to another shard."""
+    pass
+
+
+def _copied_columns(table) -> list:
+    # The row version is the writing transaction's, on the database it is written to
+    return [c for c in table.columns if c.name != "row_version"]
+
+
+# --- Ids ---
+
+def align_sequences() -> List[str]:
+    """
+    Makes shard k generate ids that are k modulo MAX_SHARDS, from above every id
+    in use on any shard. Returns the sequences changed; aligned ones are left alone.
+    """
+    count = database.shard_count()
+    if count == 1:
+        return []
+    if count > MAX_SHARDS:
+        raise ValueError(f"{count} shards configured; at most {MAX_SHARDS} are supported")
+    engines = [database.shard_engine(shard) for shard in range(count)]
+    changed = []
+    for table, column in SHARDED_SEQUENCES:
+        states = []
+        for engine in engines:
+            with engine.connect() as conn:
+                sequence = conn.execute(text("SELECT pg_get_serial_sequence(:t, :c)"),
+                                        {"t": table, "c": column}).scalar()
+                increment, last_value, top = conn.execute(text(f"""
+                    SELECT s.seqincrement, q.last_value, (SELECT coalesce(max({column}), 0) FROM {table})
+                    FROM pg_sequence s, {sequence} q
+                    WHERE s.seqrelid = CAST(:sequence AS regclass)
+                """), {"sequence": sequence}).one()
+                states.append((sequence, increment, last_value, top))
+        base = (max(max(last_value, top) for _, _, last_value, top in states) // MAX_SHARDS + 1) * MAX_SHARDS
+        for shard, (engine, (sequence, increment, last_value, _)) in enumerate(zip(engines, states)):
+            if increment == MAX_SHARDS and last_value % MAX_SHARDS == shard:
+                continue
+            with engine.begin() as conn:
+                # START too, so that TRUNCATE ... RESTART IDENTITY keeps to the shard's ids
+                conn.execute(text(f"ALTER SEQUENCE {sequence} INCREMENT BY {MAX_SHARDS} "
+                                  f"START WITH {base + shard} RESTART WITH {base + shard}"))
+            changed.append(f"{sequence} on shard {shard}")
+    return changed
+
+
+# --- Global catalog ---
+
+def _catalog_fingerprint(conn: Connection) -> str:
+    parts = []
+    for table in CATALOG_TABLES:
+        columns = ", ".join(c.name for c in _copied_columns(table))
+        parts.append(f"(SELECT coalesce(string_agg(t::text, '|' ORDER BY t.id), '') "
+                     f"FROM (SELECT {columns} FROM {table.name} WHERE user_id IS NULL) t)")
+    return conn.execute(text(f"SELECT md5({' || '.join(parts)})")).scalar()
+
+
+def _replace_catalog(conn: Connection, rows: Dict[str, List[dict]]) -> None:
+    # Rows gone from shard 0 first (recipes before the ingredients they use), then the rest upserted
+    for table in reversed(CATALOG_TABLES):
+        ids = [r["id"] for r in rows[table.name]]
+        conn.execute(table.delete().where(table.c.user_id == None, table.c.id.notin_(ids)))
+    for table in CATALOG_TABLES:
+        if not rows[table.name]:
+            continue
+        conn.execute(storage.upsert(conn, table, rows[table.name], index_elements=["id"],
+                                    update=[c.name for c in _copied_columns(table) if c.name != "id"]))
+
+
+def replicate_global_catalog() -> List[int]:
+    """Copies shard 0's global catalog to every shard whose copy differs; returns those shards."""
+    updated = []
+    if database.shard_count() == 1:
+        return updated
+    with database.shard_engine(0).connect() as source:
+        fingerprint = _catalog_fingerprint(source)
+        rows: Optional[Dict[str, List[dict]]] = None
+        for shard in range(1, database.shard_count()):
+            with database.shard_engine(shard).begin() as target:
+                if _catalog_fingerprint(target) == fingerprint:
+                    continue
+                if rows is None:
+                    rows = {
+                        table.name: [dict(r) for r in source.execute(
+                            select(*_copied_columns(table)).where(table.c.user_id == None).order_by(table.c.id)
+                        ).mappings()]
+                        for table in CATALOG_TABLES
+                    }
+                _replace_catalog(target, rows)
+            updated.append(shard)
+    return updated
+
+
+@maintenance_task
+def replicate_catalog_to_shards(db: Session) -> None:
+    # Run from shard 0's maintenance, by one process at a time
+    if database.shard_count() == 1 or database.shard_of_session(db) != 0:
+        return
+    if not db.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": REPLICATION_ADVISORY_LOCK}).scalar():
+        return
+    updated = replicate_global_catalog()
+    if updated:
+        logger.info("Copied the global catalog to shard(s) %s", ", ".join(map(str, updated)))
+
+
+# --- Placing new users ---
+
+def place_user(directory: Session, user_id: int, clone_demo: Optional[dict]) -> bool:
+    """
+    Copies user `user_id` from the directory to the shard it names, with the
+    `clone_demo_data` job (payload `clone_demo`) when given, in one shard
+    transaction. Does nothing when the shard has the user already; returns
+    whether this call copied them.
+    """
+    user = directory.query(User.id, User.email, User.password_hash, User.shard).filter(User.id == user_id).first()
+    if user is None or user.shard == 0:
+        return False
+    home = database.shard_sessionmaker(user.shard)()
+    try:
+        # A concurrent copy waits on the row and then inserts nothing, job and all
+        placed = home.execute(pg_insert(User).values(**user._asdict()).on_conflict_do_nothing(
+            index_elements=["id"]).returning(User.id)).first() is not None
+        if placed and clone_demo:
+            enqueue(home, "clone_demo_data", clone_demo, user_id=user_id, priority=PRIORITY_INTERACTIVE)
+        home.commit()
+    finally:
+        home.close()
+    return placed
+
+
+@job_handler("place_user")
+def place_user_job(db: Session, job: Job) -> dict:
+    """Copies a new user to their shard, where signup did not get to (see place_user)."""
+    return {"placed": place_user(db, job.user_id, job.payload.get("clone_demo"))}
+
+
+# --- Moving users ---
+
+def _delete_user_data(conn: Connection, user_id: int, drop_user: bool) -> None:
+    for table in reversed(TENANT_TABLES):
+        conn.execute(table.delete().where(table.c.user_id == user_id))
+    for table in (NutritionDaily.__table__, NutritionWeekly.__table__, Job.__table__):
+        conn.execute(table.delete().where(table.c.user_id == user_id))
+    # The deletes above are a move, not news for the user's clients
+    conn.execute(SyncTombstone.__table__.delete().where(SyncTombstone.user_id == user_id))
+    if drop_user:
+        conn.execute(User.__table__.delete().where(User.id == user_id))
+
+
+def _set_directory_shard(conn: Connection, user_id: int, shard: int) -> None:
+    conn.execute(User.__table__.update().where(User.id == user_id).values(shard=shard))
+
+
+def move_user(user_id: int, target: int) -> Dict[str, int]:
+    """Moves the user's rows to shard `target`; returns the rows moved per table."""
+    with database.shard_engine(0).connect() as directory:
+        source = directory.execute(select(User.shard).where(User.id == user_id)).scalar()
+    if source is None:
+        raise MoveError(f"No user {user_id}")
+    if not 0 <= target < database.shard_count():
+        raise MoveError(f"No shard {target}")
+    if source == target:
+        return {}
+
+    with database.shard_engine(source).connect() as source_conn:
+        with source_conn.begin():
+            # Holds off the user's writes (new rows take a key share lock on the user) until the move commits
+            user = source_conn.execute(
+                select(User.__table__).where(User.id == user_id).with_for_update()
+            ).mappings().one()
+            pending = source_conn.execute(
+                select(func.count()).select_from(Job).where(Job.user_id == user_id, Job.status.in_(("queued", "running")))
+            ).scalar()
+            if pending:
+                raise MoveError(f"User {user_id} has {pending} unfinished job(s); move them later")
+            rows = {
+                table.name: [dict(r) for r in source_conn.execute(
+                    select(*_copied_columns(table)).where(table.c.user_id == user_id).with_for_update()
+                ).mappings()]
+                for table in TENANT_TABLES
+            }
+
+            with database.shard_engine(target).begin() as target_conn:
+                # What an interrupted earlier move left behind
+                _delete_user_data(target_conn, user_id, drop_user=target != 0)
+                if target == 0:
+                    _set_directory_shard(target_conn, user_id, target)
+                else:
+                    target_conn.execute(insert(User.__table__).values({**user, "shard": target}))
+                plan_dates = [r["plan_date"] for r in rows[PlanEntry.__tablename__]]
+                if plan_dates:
+                    partitions.ensure_partitions(target_conn, min(plan_dates), max(plan_dates))
+                for table in TENANT_TABLES:
+                    if rows[table.name]:
+                        target_conn.execute(insert(table), rows[table.name])
+            if source != 0 and target != 0:
+                with database.shard_engine(0).begin() as directory:
+                    _set_directory_shard(directory, user_id, target)
+
+            _delete_user_data(source_conn, user_id, drop_user=source != 0)
+            if source == 0:
+                _set_directory_shard(source_conn, user_id, target)
+    logger.info("Moved user %d from shard %d to shard %d", user_id, source, target)
+    return {name: len(table_rows) for name, table_rows in rows.items()}
+
+
+def misplaced_users() -> List[Tuple[int, int, int]]:
+    """(user id, shard, shard it hashes to) of the users living elsewhere than their hash says."""
+    # The seed data is loaded for the demo user on shard 0
+    from routers.auth_router import DEMO_EMAIL
+
+    with database.shard_engine(0).connect() as directory:
+        users = directory.execute(
+            select(User.id, User.shard).where(User.email != DEMO_EMAIL).order_by(User.id)
+        ).all()
+    return [(user_id, shard, database.shard_for_user(user_id)) for user_id, shard in users
+            if shard != database.shard_for_user(user_id)]
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Inspect the shards and move users between them.")
+    parser.add_argument("--status", action="store_true", help="count the users and rows on each shard")
+    parser.add_argument("--rebalance", action="store_true", help="move every user to the shard they hash to")
+    parser.add_argument("--dry-run", action="store_true", help="with --rebalance, list the moves without moving")
+    parser.add_argument("--move", type=int, metavar="USER_ID", help="move one user (with --to)")
+    parser.add_argument("--to", type=int, metavar="SHARD", help="the shard --move moves the user to")
+    parser.add_argument("--replicate", action="store_true", help="copy the global catalog to every shard now")
+    args = parser.parse_args(argv)
+
+    if args.replicate:
+        updated = replicate_global_catalog()
+        print(f"Copied the global catalog to shard(s) {', '.join(map(str, updated))}." if updated
+              else "The global catalog is up to date on every shard.")
+    if args.move is not None:
+        if args.to is None:
+            parser.error("--move needs --to")
+        moved = move_user(args.move, args.to)
+        print(f"Moved user {args.move} to shard {args.to}: "
+              + ", ".join(f"{count} {name}" for name, count in moved.items()))
+    if args.rebalance:
+        for user_id, shard, target in misplaced_users():
+            if args.dry_run:
+                print(f"would move user {user_id} from shard {shard} to shard {target}")
+                continue
+            try:
+                moved = move_user(user_id, target)
+            except MoveError as e:
+                print(f"skipped user {user_id}: {e}")
+                continue
+            print(f"moved user {user_id} from shard {shard} to shard {target} ({sum(moved.values())} rows)")
+    if args.status or not (args.replicate or args.move is not None or args.rebalance):
+        with database.shard_engine(0).connect() as directory:
+            placed = dict(directory.execute(select(User.shard, func.count()).group_by(User.shard)).all())
+        for shard in range(database.shard_count()):
+            with database.shard_engine(shard).connect() as conn:
+                counts = [conn.execute(select(func.count()).select_from(table).where(table.c.user_id != None)).scalar()
+                          for table in TENANT_TABLES]
+            print(f"shard {shard}  {placed.get(shard, 0)} users  "
+                  + "  ".join(f"{count} {table.name}" for table, count in zip(TENANT_TABLES, counts)))
+
+
+if __name__ == "__main__":
+    main()
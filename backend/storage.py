@@ -0,0 +1,38 @@
+# storage.py
+"""
+Statements built for the dialect of the connection they run on.
+
+`upsert` builds the dialect's INSERT ... ON CONFLICT DO UPDATE; Postgres and
+SQLite share the form, so the app's upserts are not tied to Postgres. The
+schema still is: it uses Postgres types (JSONB, ARRAY), the partitioned plan
+table, plpgsql triggers, NOTIFY for live updates and advisory locks.
+"""
+from typing import Iterable, Mapping, Optional, Sequence, Union
+
+from sqlalchemy import Insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def dialect_name(db: Union[Session, Connection]) -> str:
+    bind = db.get_bind() if isinstance(db, Session) else db
+    return bind.dialect.name
+
+
+def upsert(db: Union[Session, Connection], table, values: Union[Mapping, Sequence[Mapping]],
+           index_elements: Sequence[str], update: Iterable[str], assign: Optional[Mapping] = None) -> Insert:
+    """
+    INSERT `values` into `table`; rows conflicting on `index_elements` get
+    the inserted values of the `update` columns, and the `assign` values.
+    """
+    insert = _INSERTS.get(dialect_name(db))
+    if insert is None:
+        raise NotImplementedError(f"No upsert for the {dialect_name(db)} dialect")
+    stmt = insert(table).values(values)
+    return stmt.on_conflict_do_update(
+        index_elements=list(index_elements),
+        set_={**{column: stmt.excluded[column] for column in update}, **(assign or {})},
+    )
@@ -0,0 +1,78 @@
+# units.py
+"""
+Conversion between the serving units (models.ServingUnits).
+
+Each unit has a dimension (mass, volume or count) and a factor to the base
+unit of its dimension (g, ml, nos). Within a dimension the factors are all a
+conversion needs. Across dimensions it also needs the ingredient's density
+(g per ml) or weight per piece (g per nos). So every conversion is a constant
+factor times the density and the piece weight, each raised to -1, 0 or 1.
+CONVERSIONS precomputes that for every pair of units. The same rows fill the
+`unit_conversions` table read by the `convert_quantity()` SQL function (see
+models.py), so SQL and Python convert alike.
+
+A quantity converts to None (NULL in SQL) when the density or piece weight it
+needs is unknown.
+"""
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+# unit -> (dimension, factor to the dimension's base unit)
+UNITS: Dict[str, Tuple[str, float]] = {
+    "g": ("mass", 1.0),
+    "ml": ("volume", 1.0),
+    "cup": ("volume", 240.0),
+    "tbsp": ("volume", 15.0),
+    "tsp": ("volume", 5.0),
+    "nos": ("count", 1.0),
+}
+
+# Base unit of each dimension to grams, as powers of (density, grams per piece)
+_TO_GRAMS = {"mass": (0, 0), "volume": (1, 0), "count": (0, 1)}
+
+
+class Conversion(NamedTuple):
+    factor: float
+    density_power: int
+    piece_power: int
+
+
+def _conversion(from_unit: str, to_unit: str) -> Conversion:
+    (from_dimension, from_factor), (to_dimension, to_factor) = UNITS[from_unit], UNITS[to_unit]
+    (from_density, from_piece), (to_density, to_piece) = _TO_GRAMS[from_dimension], _TO_GRAMS[to_dimension]
+    return Conversion(from_factor / to_factor, from_density - to_density, from_piece - to_piece)
+
+
+CONVERSIONS: Dict[Tuple[str, str], Conversion] = {
+    (from_unit, to_unit): _conversion(from_unit, to_unit) for from_unit in UNITS for to_unit in UNITS
+}
+
+
+def _multiplier(conversion: Conversion, density: Optional[float], grams_per_piece: Optional[float]) -> Optional[float]:
+    multiplier = conversion.factor
+    for value, power in ((density, conversion.density_power), (grams_per_piece, conversion.piece_power)):
+        if power:
+            if not value:
+                return None
+            multiplier *= float(value) ** power
+    return multiplier
+
+
+def convert_quantities(quantities: Sequence[Optional[float]], from_units: Sequence[Optional[str]], to_unit: str,
+                       density: Optional[float] = None,
+                       grams_per_piece: Optional[float] = None) -> List[Optional[float]]:
+    """Quantities of one ingredient, each in its own unit, in `to_unit`; one multiplier is worked out per unit."""
+    multipliers: Dict[Optional[str], Optional[float]] = {}
+    converted = []
+    for quantity, from_unit in zip(quantities, from_units):
+        if from_unit not in multipliers:
+            conversion = CONVERSIONS.get((from_unit, to_unit))
+            multipliers[from_unit] = conversion and _multiplier(conversion, density, grams_per_piece)
+        multiplier = multipliers[from_unit]
+        converted.append(None if multiplier is None or quantity is None else quantity * multiplier)
+    return converted
+
+
+def convert_quantity(quantity: Optional[float], from_unit: Optional[str], to_unit: str,
+                     density: Optional[float] = None, grams_per_piece: Optional[float] = None) -> Optional[float]:
+    """`quantity` of `from_unit` in `to_unit`, as the convert_quantity() SQL function computes it."""
+    return convert_quantities([quantity], [from_unit], to_unit, density, grams_per_piece)[0]
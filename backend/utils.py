@@ -2,9 +2,6 @@ import tempfile
 import os
 from io import BytesIO
 from datetime import datetime
-from pylatex import Document, Command, Center
-from pylatex.utils import NoEscape, bold
-from pylatex.table import Tabularx
 from fastapi import HTTPException
 
 
@@ -13,6 +10,11 @@ def create_pdf_in_memory(plan: dict) -> bytes:
     Generates a PDF meal plan with meals as rows and days as columns.
     Fixes text overflow and adds a timestamp.
     """
+    # Imported on first use: only the PDF job needs pylatex, not every worker start
+    from pylatex import Document, Command, Center
+    from pylatex.utils import NoEscape, bold
+    from pylatex.table import Tabularx
+
     # Use a temporary directory to avoid file conflicts
     with tempfile.TemporaryDirectory() as temp_dir:
         filepath = os.path.join(temp_dir, "meal_plan")
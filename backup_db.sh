@@ -12,8 +12,8 @@ TABLES_TO_BACKUP="recipes weekly_plan ingredients"
 for TABLE in $TABLES_TO_BACKUP; do
     echo "Backing up table $TABLE from container $CONTAINER_NAME to $TABLE.csv ..."
 
-    # Get all columns except 'user_id'
-    COLUMNS=$(docker exec $CONTAINER_NAME psql -U $DB_USER -d $DB_NAME -Atc "SELECT string_agg(quote_ident(column_name), ', ' ORDER BY ordinal_position) FROM information_schema.columns  WHERE table_name = '$TABLE' AND column_name <> 'user_id'")
+    # Get all columns except 'user_id', the delta-sync versions (and the dates of the weekly_plan view: the seed is a day-of-week template)
+    COLUMNS=$(docker exec $CONTAINER_NAME psql -U $DB_USER -d $DB_NAME -Atc "SELECT string_agg(quote_ident(column_name), ', ' ORDER BY ordinal_position) FROM information_schema.columns  WHERE table_name = '$TABLE' AND column_name NOT IN ('user_id', 'plan_date', 'row_version', 'updated_at')")
 
     if [ -z "$COLUMNS" ]; then
         echo "No columns found for table $TABLE (maybe only has user_id?)"
@@ -22,7 +22,7 @@ for TABLE in $TABLES_TO_BACKUP; do
 
     # Run COPY with the filtered columns
     docker exec  $CONTAINER_NAME psql -U $DB_USER -d $DB_NAME -c \
-    "COPY (SELECT $COLUMNS FROM $TABLE ORDER BY id) TO STDOUT WITH CSV HEADER" \
+    "COPY (SELECT $COLUMNS FROM $TABLE ORDER BY 1) TO STDOUT WITH CSV HEADER" \
     > "./backend/data/${TABLE}.csv"
 
     if [ $? -ne 0 ]; then
@@ -200,6 +200,16 @@ document.addEventListener('DOMContentLoaded', () => {
                                             <select id="edit-ingredient-unit" class="mt-1 block w-full rounded-sm border-stone-300 shadow-sm focus:border-teal-500 focus:ring-teal-500" required></select>
                                         </div>
                                     </div>
+                                    <div class="grid grid-cols-2 gap-2">
+                                        <div class="mb-2">
+                                            <label class="block text-sm font-medium text-stone-700">Density (g/ml)</label>
+                                            <input type="number" id="edit-ingredient-density" class="mt-1 block w-full rounded-sm border-stone-300 shadow-sm focus:border-teal-500 focus:ring-teal-500" value="${ing.density_g_per_ml ?? ''}" min="0" step="any">
+                                        </div>
+                                        <div class="mb-2">
+                                            <label class="block text-sm font-medium text-stone-700">Grams per piece</label>
+                                            <input type="number" id="edit-ingredient-grams-per-piece" class="mt-1 block w-full rounded-sm border-stone-300 shadow-sm focus:border-teal-500 focus:ring-teal-500" value="${ing.grams_per_piece ?? ''}" min="0" step="any">
+                                        </div>
+                                    </div>
                                     <div class="mb-4">
                                         <label id="edit-kcal-label" class="block text-sm font-medium text-stone-700">Energy (kcal)</label>
                                         <input type="number" id="edit-ingredient-kcal" class="mt-1 block w-full rounded-sm border-stone-300 shadow-sm focus:border-teal-500 focus:ring-teal-500" value="${ing.energy}" min="0" step="any">
@@ -290,6 +300,8 @@ document.addEventListener('DOMContentLoaded', () => {
                         const newShelfLife = document.getElementById('edit-ingredient-shelf-life').value.trim();
                         const newUnit = document.getElementById('edit-ingredient-unit').value.trim();
                         const newServingSize = document.getElementById('edit-ingredient-serving-size').value.trim();
+                        const density = document.getElementById('edit-ingredient-density').value.trim();
+                        const gramsPerPiece = document.getElementById('edit-ingredient-grams-per-piece').value.trim();
                         let energy = document.getElementById('edit-ingredient-kcal').value.trim();
                         let protein = document.getElementById('edit-ingredient-protein').value.trim();
                         let carbs = document.getElementById('edit-ingredient-carbs').value.trim();
@@ -343,6 +355,9 @@ document.addEventListener('DOMContentLoaded', () => {
                                 sodium_mg: sodium,
                                 vitamin_c_mg: vitaminC
                             });
+                            // Optional: recipe quantities in other units convert through them
+                            if (density) params.set('density_g_per_ml', density);
+                            if (gramsPerPiece) params.set('grams_per_piece', gramsPerPiece);
                             const resp = await fetch(`${API_BASE}/ingredients/${id}?${params.toString()}`, {
                                 method: 'PUT',
                                 headers: authHeaders()
@@ -465,5 +480,21 @@ document.addEventListener('DOMContentLoaded', () => {
             listSection.innerHTML = '<div class="text-red-600">Failed to load ingredient list.</div>';
         }
     }
+    // Reload the list when ingredients change elsewhere, but not under someone typing
+    let reloadTimer = null;
+    const scheduleReload = () => {
+        clearTimeout(reloadTimer);
+        reloadTimer = setTimeout(() => {
+            if (document.activeElement && document.activeElement.matches('input, select')) {
+                scheduleReload();
+                return;
+            }
+            renderShoppingList();
+        }, 500);
+    };
+    window.subscribeToChanges((change) => {
+        if (change.entity === 'ingredient') scheduleReload();
+    }, scheduleReload);
+
     renderShoppingList();
 });
@@ -0,0 +1,95 @@
+// Live updates: the backend pushes compact change events over Server-Sent Events
+// (see backend/events.py), so pages can patch what they show instead of reloading it.
+window.subscribeToChanges = function (onChange, onResync) {
+    if (!localStorage.getItem('token') || !window.EventSource) return null;
+    let source = null;
+    let closed = false;
+    let connectedBefore = false;
+    let retryDelay = 1000;
+
+    // EventSource cannot send headers, and URLs end up in access logs: the stream opens with
+    // a short-lived ticket instead of the access token. A ticket outlives only its first
+    // connection, so every reconnect fetches a new one rather than letting the browser retry.
+    async function connect() {
+        if (closed) return;
+        let ticket = null;
+        try {
+            const response = await fetch('/api/events/ticket', {
+                method: 'POST',
+                headers: { 'Authorization': 'Bearer ' + localStorage.getItem('token') },
+            });
+            if (response.status === 401) return;
+            if (response.ok) ticket = (await response.json()).ticket;
+        } catch (e) {
+            ticket = null;
+        }
+        if (!ticket) {
+            setTimeout(connect, retryDelay);
+            retryDelay = Math.min(retryDelay * 2, 30000);
+            return;
+        }
+        source = new EventSource(`/api/events?ticket=${encodeURIComponent(ticket)}`);
+        source.addEventListener('change', (e) => onChange(JSON.parse(e.data)));
+        source.addEventListener('resync', () => onResync());
+        // Anything sent while the stream was down is lost
+        source.addEventListener('open', () => {
+            if (connectedBefore) onResync();
+            connectedBefore = true;
+            retryDelay = 1000;
+        });
+        source.addEventListener('error', () => {
+            source.close();
+            setTimeout(connect, retryDelay);
+            retryDelay = Math.min(retryDelay * 2, 30000);
+        });
+    }
+
+    connect();
+    return {
+        close() {
+            closed = true;
+            if (source) source.close();
+        },
+    };
+};
+
+// Delta sync: the recipes are kept in localStorage and refreshed with only what changed
+// since the last visit (see backend/routers/sync_router.py).
+window.syncRecipes = async function (headers) {
+    const token = localStorage.getItem('token') || '';
+    let cache = null;
+    try {
+        cache = JSON.parse(localStorage.getItem('recipe-sync'));
+    } catch (e) {
+        cache = null;
+    }
+    // Another user's copy is of no use
+    if (!cache || cache.token !== token || !cache.ingredientNames) cache = { token, cursor: null, recipes: {}, ingredientNames: {} };
+    const params = cache.cursor ? `?since=${encodeURIComponent(cache.cursor)}` : '';
+    const response = await fetch(`/api/sync${params}`, { headers });
+    if (!response.ok) return { response, recipes: null };
+    const delta = await response.json();
+    if (delta.full) {
+        cache.recipes = {};
+        cache.ingredientNames = {};
+    }
+    delta.deleted.recipes.forEach(id => { delete cache.recipes[id]; });
+    delta.recipes.forEach(r => { cache.recipes[r.id] = r; });
+    // A renamed ingredient comes back on its own: its recipes refer to it by id
+    delta.deleted.ingredients.forEach(id => { delete cache.ingredientNames[id]; });
+    delta.ingredients.forEach(i => { cache.ingredientNames[i.id] = i.name; });
+    cache.cursor = delta.cursor;
+    try {
+        localStorage.setItem('recipe-sync', JSON.stringify(cache));
+    } catch (e) {
+        // Over quota: the next visit syncs in full
+        localStorage.removeItem('recipe-sync');
+    }
+    const recipes = Object.values(cache.recipes)
+        .map(r => ({
+            ...r,
+            ingredients: r.ingredients.map(i => ({ ...i, name: cache.ingredientNames[i.id] || i.name })),
+        }))
+        .sort((a, b) => a.name.localeCompare(b.name));
+    return { response, recipes };
+};
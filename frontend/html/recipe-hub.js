@@ -191,9 +191,9 @@ document.addEventListener('DOMContentLoaded', () => {
 
     async function fetchRecipes() {
         try {
-            const response = await fetch(`${API_BASE}/recipes`, { headers: authHeaders() });
+            const { response, recipes: synced } = await window.syncRecipes(authHeaders());
             if (handleAuthError(response)) return;
-            recipes = await response.json();
+            recipes = synced || [];
             renderRecipes(); // Initial render
         } catch (error) {
             console.error('Error fetching recipes:', error);
@@ -369,7 +369,7 @@ document.addEventListener('DOMContentLoaded', () => {
                             </div>
                             <div id="ingredient-select-list" class="space-y-2 max-h-72 overflow-y-auto border rounded p-2 bg-stone-50">
                                 ${ingredientList.map(ing => {
-            const sel = selectedIngredients.find(si => si.name === ing.name);
+            const sel = selectedIngredients.find(si => si.id != null ? si.id === ing.id : si.name.toLowerCase() === ing.name.toLowerCase());
             return `
                                     <div class="ingredient-item flex items-center space-x-2">
                                         <input type="checkbox" class="ingredient-checkbox" data-id="${ing.id}" ${sel ? 'checked' : ''}>
@@ -557,7 +557,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const ingredientName = parent.querySelector('span').textContent;
             const qty = parent.querySelector('.ingredient-qty').value;
             const serving_unit = parent.querySelector('.ingredient-unit').textContent;
-            ingredients.push({ name: ingredientName, quantity: parseFloat(qty) || 0, serving_unit: serving_unit });
+            ingredients.push({ id: parseInt(cb.dataset.id) || null, name: ingredientName, quantity: parseFloat(qty) || 0, serving_unit: serving_unit });
         });
         const recipeData = { name, serves, ingredients, instructions, meal_type, is_vegetarian };
         try {
@@ -585,5 +585,37 @@ document.addEventListener('DOMContentLoaded', () => {
             console.error('Error saving recipe:', error);
         }
     };
+    // Follow changes made in other tabs and on other devices, so slot
+    // assignments always extend the current plan
+    async function refreshRecipe(id) {
+        const response = await fetch(`${API_BASE}/recipes/${id}`, { headers: authHeaders() });
+        if (handleAuthError(response)) return;
+        const index = recipes.findIndex(r => r.id === id);
+        if (!response.ok) {
+            if (index !== -1) recipes.splice(index, 1);
+            return;
+        }
+        const recipe = await response.json();
+        if (index === -1) recipes.push(recipe); else recipes[index] = recipe;
+    }
+
+    window.subscribeToChanges(async (change) => {
+        if (change.entity === 'plan' && change.data) {
+            const { day, meal_type, recipe_ids } = change.data;
+            weeklyPlan[day] = { ...(weeklyPlan[day] || {}), [meal_type]: recipe_ids };
+        } else if (change.entity === 'plan') {
+            fetchWeeklyPlan();
+        } else if (change.entity === 'recipe') {
+            if (!change.ids.length) return fetchRecipes();
+            if (change.action === 'deleted') {
+                recipes = recipes.filter(r => !change.ids.includes(r.id));
+            } else {
+                await Promise.all(change.ids.map(refreshRecipe));
+            }
+            renderRecipes();
+        }
+    }, () => { fetchWeeklyPlan(); fetchRecipes(); });
+
+    fetchWeeklyPlan();
     fetchRecipes();
-});
\ No newline at end of file
+});
@@ -24,9 +24,9 @@ document.addEventListener('DOMContentLoaded', () => {
 
     async function fetchRecipes() {
         try {
-            const response = await fetch(`${API_BASE}/recipes`, { headers: authHeaders() });
+            const { response, recipes: synced } = await window.syncRecipes(authHeaders());
             if (handleAuthError(response)) return;
-            recipes = await response.json();
+            recipes = synced || [];
             fetchWeeklyPlan();
         } catch (error) {
             console.error('Error fetching recipes:', error);
@@ -279,5 +279,49 @@ document.addEventListener('DOMContentLoaded', () => {
         overlay.addEventListener('click', () => overlay.remove());
     };
 
+    // Follow changes made in other tabs and on other devices
+    async function refreshRecipe(id) {
+        const response = await fetch(`${API_BASE}/recipes/${id}`, { headers: authHeaders() });
+        if (handleAuthError(response)) return;
+        const index = recipes.findIndex(r => r.id === id);
+        if (!response.ok) {
+            if (index !== -1) recipes.splice(index, 1);
+            return;
+        }
+        const recipe = await response.json();
+        if (index === -1) recipes.push(recipe); else recipes[index] = recipe;
+    }
+
+    document.getElementById('repeat-week-btn').addEventListener('click', async () => {
+        try {
+            // Fills this week's empty slots from last week's plan
+            const resp = await fetch(`${API_BASE}/weekly-plan/copy`, { method: 'POST', headers: authHeaders() });
+            if (handleAuthError(resp)) return;
+            if (!resp.ok) throw new Error('Failed to copy last week');
+            fetchWeeklyPlan();
+        } catch (error) {
+            console.error('Error copying last week:', error);
+        }
+    });
+
+    window.subscribeToChanges(async (change) => {
+        if (change.entity === 'plan' && change.data) {
+            const { day, meal_type, recipe_ids } = change.data;
+            weeklyPlan[day] = { ...(weeklyPlan[day] || {}), [meal_type]: recipe_ids };
+            renderPlanner();
+        } else if (change.entity === 'plan') {
+            // Several slots changed at once (e.g. a copied week)
+            fetchWeeklyPlan();
+        } else if (change.entity === 'recipe') {
+            if (!change.ids.length) return fetchRecipes();
+            if (change.action === 'deleted') {
+                recipes = recipes.filter(r => !change.ids.includes(r.id));
+            } else {
+                await Promise.all(change.ids.map(refreshRecipe));
+            }
+            renderPlanner();
+        }
+    }, fetchRecipes);
+
     fetchRecipes();
-});
\ No newline at end of file
+});
@@ -10,8 +10,10 @@ DB_USER=postgres
 
 # --- IMPORTANT ---
 # List tables in the order they should be restored to respect foreign key constraints.
-# Parent tables (like ingredients, recipes) must be restored BEFORE child tables (weekly_plan).
-TABLES_TO_RESTORE="ingredients recipes weekly_plan"
+# Parent tables (like ingredients, recipes) must be restored BEFORE child tables.
+# weekly_plan is a view onto the dated plan_entries table; its backup is a day-of-week
+# template that setup_db loads into the current week (backend/data/weekly_plan.csv).
+TABLES_TO_RESTORE="ingredients recipes"
 
 # for each table in the list, perform a restore
 for TABLE in $TABLES_TO_RESTORE; do
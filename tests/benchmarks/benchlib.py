@@ -0,0 +1,370 @@
+"""
+Helpers for the load/benchmark suite: volume seeding, a weighted mixed
+workload over every router, concurrent drivers and latency reporting.
+"""
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import text
+
+import generate_data
+from models import DaysOfWeek, RecipeMealType
+from routers.auth_router import create_access_token
+
+
+def env_int(name: str, default: int) -> int:
+    return int(os.environ.get(name, default))
+
+
+BENCH_USERS = env_int("MEALPLANNER_BENCH_USERS", 20)
+BENCH_RECIPES_PER_USER = env_int("MEALPLANNER_BENCH_RECIPES_PER_USER", 100)
+BENCH_INGREDIENTS_PER_USER = env_int("MEALPLANNER_BENCH_INGREDIENTS_PER_USER", 150)
+# Weeks of plan history per user, so current-week reads run against a realistic table
+BENCH_PLAN_WEEKS = env_int("MEALPLANNER_BENCH_PLAN_WEEKS", 26)
+BENCH_CLIENTS = env_int("MEALPLANNER_BENCH_CLIENTS", 8)
+BENCH_REQUESTS = env_int("MEALPLANNER_BENCH_REQUESTS", 2000)
+BENCH_PASSWORD = "bench-password"
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+BENCH_OUTPUT = os.environ.get("MEALPLANNER_BENCH_OUTPUT", os.path.join(RESULTS_DIR, "latest.json"))
+BENCH_BASELINE = os.environ.get("MEALPLANNER_BENCH_BASELINE")
+# A p95 this many times worse than the baseline fails the comparison
+BENCH_TOLERANCE = float(os.environ.get("MEALPLANNER_BENCH_TOLERANCE", "1.5"))
+
+
+# --- Seeding ---
+
+@dataclass
+class BenchUser:
+    id: int
+    email: str
+    headers: Dict[str, str]
+    recipe_ids: List[int] = field(default_factory=list)
+    ingredient_ids: List[int] = field(default_factory=list)
+    # Cursor of the user's last /sync
+    sync_cursor: Optional[str] = None
+
+
+def seed_volume(engine, users: int = BENCH_USERS, recipes_per_user: int = BENCH_RECIPES_PER_USER,
+                ingredients_per_user: int = BENCH_INGREDIENTS_PER_USER, seed: int = 7) -> List[BenchUser]:
+    """Seeds users shaped like real tenants (see generate_data.py) and returns them with tokens."""
+    with tempfile.TemporaryDirectory() as out_dir:
+        result = generate_data.generate(
+            out_dir, users, recipes_per_user, ingredients_per_user, seed=seed,
+            id_start=generate_data.next_ids(engine), password=BENCH_PASSWORD, weeks=BENCH_PLAN_WEEKS,
+        )
+        generate_data.load(engine, out_dir)
+
+    with engine.connect() as conn:
+        rows = conn.execute(text("""
+            SELECT u.id, u.email,
+                   ARRAY(SELECT r.id FROM recipes r WHERE r.user_id = u.id ORDER BY r.id) AS recipe_ids,
+                   ARRAY(SELECT i.id FROM ingredients i WHERE i.user_id = u.id ORDER BY i.id) AS ingredient_ids
+            FROM users u WHERE u.id BETWEEN :first AND :last ORDER BY u.id
+        """), {"first": result.first_user_id, "last": result.last_user_id}).all()
+
+    return [
+        BenchUser(
+            id=row.id, email=row.email,
+            headers={"Authorization": f"Bearer {create_access_token({'sub': str(row.id)})}"},
+            recipe_ids=list(row.recipe_ids), ingredient_ids=list(row.ingredient_ids),
+        )
+        for row in rows
+    ]
+
+
+# --- Workload ---
+
+def pdf_available() -> bool:
+    return shutil.which("pdflatex") is not None
+
+
+CATALOG_NAMES = [i["name"] for i in generate_data.load_template().ingredients]
+
+
+def _recipe_payload(rng: random.Random, name: str) -> dict:
+    return {
+        "name": name, "serves": 2, "instructions": "Stir.", "meal_type": "dinner", "is_vegetarian": True,
+        "ingredients": [{"name": rng.choice(CATALOG_NAMES), "quantity": 50, "serving_unit": "g"}],
+    }
+
+
+def op_list_recipes(client, user, rng):
+    return client.get("/recipes", headers=user.headers)
+
+
+def op_get_recipe(client, user, rng):
+    return client.get(f"/recipes/{rng.choice(user.recipe_ids)}", headers=user.headers)
+
+
+def op_edit_recipe(client, user, rng):
+    created = client.post("/recipes", json=_recipe_payload(rng, "bench tmp"), headers=user.headers)
+    if created.status_code != 201:
+        return created
+    recipe_id = created.json()["id"]
+    client.put(f"/recipes/{recipe_id}", json=_recipe_payload(rng, "bench tmp 2"), headers=user.headers)
+    return client.delete(f"/recipes/{recipe_id}", headers=user.headers)
+
+
+def _edited_recipe(client, user, rng):
+    """An owned recipe as an update payload."""
+    recipe = client.get(f"/recipes/{rng.choice(user.recipe_ids)}", headers=user.headers).json()
+    payload = {key: recipe[key] for key in ("name", "serves", "ingredients", "instructions", "meal_type",
+                                            "is_vegetarian")}
+    return recipe["id"], payload
+
+
+def op_edit_recipe_text(client, user, rng):
+    recipe_id, payload = _edited_recipe(client, user, rng)
+    payload["instructions"] = f"{payload['instructions'].split(' | ')[0]} | edit {rng.randint(0, 10**6)}"
+    return client.put(f"/recipes/{recipe_id}", json=payload, headers=user.headers)
+
+
+def op_edit_recipe_ingredients(client, user, rng):
+    recipe_id, payload = _edited_recipe(client, user, rng)
+    for item in payload["ingredients"]:
+        item["quantity"] = round(item["quantity"] * rng.uniform(0.8, 1.2), 1)
+    return client.put(f"/recipes/{recipe_id}", json=payload, headers=user.headers)
+
+
+def op_list_ingredients(client, user, rng):
+    return client.get("/ingredients", headers=user.headers)
+
+
+def op_toggle_ingredient(client, user, rng):
+    ingredient_id = rng.choice(user.ingredient_ids)
+    return client.put(f"/ingredients/{ingredient_id}", params={"available": rng.random() < 0.5},
+                      headers=user.headers)
+
+
+def op_add_delete_ingredient(client, user, rng):
+    created = client.post("/ingredients", params={"name": f"tmp {rng.random()}", "shelf_life": 3,
+                                                  "serving_unit": "g"}, headers=user.headers)
+    if created.status_code != 201:
+        return created
+    return client.delete(f"/ingredients/{created.json()['id']}", headers=user.headers)
+
+
+def op_get_plan(client, user, rng):
+    return client.get("/weekly-plan", headers=user.headers)
+
+
+def op_set_plan_slot(client, user, rng):
+    slot = {"day": rng.choice(list(DaysOfWeek)).value, "meal_type": rng.choice(list(RecipeMealType)).value,
+            "recipe_ids": rng.sample(user.recipe_ids, k=min(len(user.recipe_ids), rng.randint(0, 2)))}
+    return client.put("/weekly-plan", json=slot, headers=user.headers)
+
+
+def op_plan_history(client, user, rng):
+    end = datetime.date.today()
+    start = end - datetime.timedelta(weeks=rng.choice((4, 12, 26)))
+    return client.get("/weekly-plan/entries", params={"start": start.isoformat(), "end": end.isoformat()},
+                      headers=user.headers)
+
+
+def op_nutrition_trends(client, user, rng):
+    return client.get("/analytics/nutrition/trends", headers=user.headers)
+
+
+def op_delta_sync(client, user, rng):
+    resp = client.get("/sync", params={"since": user.sync_cursor} if user.sync_cursor else {}, headers=user.headers)
+    if resp.status_code == 200:
+        user.sync_cursor = resp.json()["cursor"]
+    return resp
+
+
+def op_shopping_list(client, user, rng):
+    return client.get("/utilities/shopping-list", headers=user.headers)
+
+
+def op_nutrition(client, user, rng):
+    return client.get(f"/utilities/nutrition/{rng.choice(list(DaysOfWeek)).value}", headers=user.headers)
+
+
+def op_plan_pdf(client, user, rng):
+    return client.get("/weekly-plan/pdf", headers=user.headers)
+
+
+def op_me(client, user, rng):
+    return client.get("/auth/me", headers=user.headers)
+
+
+def op_login(client, user, rng):
+    return client.post("/auth/login", data={"username": user.email, "password": BENCH_PASSWORD},
+                       headers={"Content-Type": "application/x-www-form-urlencoded"})
+
+
+# Relative weights, roughly what the pages do when they open and edit
+MIXED_WORKLOAD: Dict[str, tuple] = {
+    "GET /recipes": (op_list_recipes, 20),
+    "GET /recipes/{id}": (op_get_recipe, 8),
+    "POST+PUT+DELETE /recipes": (op_edit_recipe, 3),
+    "GET /ingredients": (op_list_ingredients, 15),
+    "PUT /ingredients/{id}": (op_toggle_ingredient, 6),
+    "POST+DELETE /ingredients": (op_add_delete_ingredient, 2),
+    "GET /weekly-plan": (op_get_plan, 15),
+    "PUT /weekly-plan": (op_set_plan_slot, 10),
+    "GET /weekly-plan/entries": (op_plan_history, 2),
+    "GET /analytics/nutrition/trends": (op_nutrition_trends, 2),
+    "GET /sync?since": (op_delta_sync, 4),
+    "GET /utilities/shopping-list": (op_shopping_list, 8),
+    "GET /utilities/nutrition/{day}": (op_nutrition, 8),
+    "GET /auth/me": (op_me, 3),
+    "POST /auth/login": (op_login, 1),
+    "GET /weekly-plan/pdf": (op_plan_pdf, 1),
+}
+
+
+# Recipe editing sessions, where most edits change text rather than ingredients
+EDIT_HEAVY_WORKLOAD: Dict[str, tuple] = {
+    "GET+PUT /recipes/{id} (text)": (op_edit_recipe_text, 8),
+    "GET+PUT /recipes/{id} (ingredients)": (op_edit_recipe_ingredients, 2),
+    "GET /recipes/{id}": (op_get_recipe, 2),
+    "GET /recipes": (op_list_recipes, 1),
+}
+
+# Update triggers for the recipe nutrients, as before and after conditional recomputation
+NUTRIENT_UPDATE_TRIGGERS: Dict[str, str] = {
+    "unconditional": """
+        CREATE TRIGGER trg_update_recipe_nutrients
+        BEFORE UPDATE ON recipes
+        FOR EACH ROW EXECUTE FUNCTION calculate_recipe_nutrients()
+    """,
+    "on_ingredient_change": """
+        CREATE TRIGGER trg_update_recipe_nutrients
+        BEFORE UPDATE OF ingredients, user_id ON recipes
+        FOR EACH ROW
+        WHEN (OLD.ingredients IS DISTINCT FROM NEW.ingredients OR OLD.user_id IS DISTINCT FROM NEW.user_id)
+        EXECUTE FUNCTION calculate_recipe_nutrients()
+    """,
+}
+
+
+def install_nutrient_update_trigger(engine, variant: str) -> None:
+    with engine.begin() as conn:
+        conn.execute(text("DROP TRIGGER IF EXISTS trg_update_recipe_nutrients ON recipes"))
+        conn.execute(text(NUTRIENT_UPDATE_TRIGGERS[variant]))
+
+
+def default_workload() -> Dict[str, tuple]:
+    workload = dict(MIXED_WORKLOAD)
+    if not pdf_available():
+        workload.pop("GET /weekly-plan/pdf")
+    return workload
+
+
+# --- Driver and report ---
+
+@dataclass
+class EndpointResult:
+    latencies_ms: List[float] = field(default_factory=list)
+    errors: int = 0
+
+    def summary(self, wall_seconds: float) -> dict:
+        lat = sorted(self.latencies_ms)
+        return {
+            "count": len(lat),
+            "errors": self.errors,
+            "throughput_rps": round(len(lat) / wall_seconds, 2) if wall_seconds else 0.0,
+            "mean_ms": round(statistics.fmean(lat), 2) if lat else None,
+            "p50_ms": percentile(lat, 50),
+            "p95_ms": percentile(lat, 95),
+            "p99_ms": percentile(lat, 99),
+            "max_ms": round(lat[-1], 2) if lat else None,
+        }
+
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return round(sorted_values[rank], 2)
+
+
+def run_workload(client_factory: Callable[[], object], users: List[BenchUser], workload: Dict[str, tuple],
+                 clients: int = BENCH_CLIENTS, total_requests: int = BENCH_REQUESTS, seed: int = 11) -> dict:
+    """Runs `total_requests` weighted operations spread over `clients` concurrent clients."""
+    names = list(workload)
+    weights = [workload[n][1] for n in names]
+    results = {name: EndpointResult() for name in names}
+    lock = threading.Lock()
+
+    def client_loop(worker: int, count: int) -> None:
+        rng = random.Random(seed + worker)
+        client = client_factory()
+        for _ in range(count):
+            name = rng.choices(names, weights)[0]
+            user = rng.choice(users)
+            started = time.perf_counter()
+            try:
+                resp = workload[name][0](client, user, rng)
+                ok = resp.status_code < 400
+            except Exception:
+                ok = False
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with lock:
+                results[name].latencies_ms.append(elapsed_ms)
+                if not ok:
+                    results[name].errors += 1
+
+    per_client = [total_requests // clients + (1 if i < total_requests % clients else 0) for i in range(clients)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        for future in [pool.submit(client_loop, i, n) for i, n in enumerate(per_client)]:
+            future.result()
+    wall = time.perf_counter() - started
+
+    endpoints = {name: r.summary(wall) for name, r in results.items() if r.latencies_ms}
+    total = sum(e["count"] for e in endpoints.values())
+    return {
+        "config": {
+            "users": len(users), "clients": clients, "requests": total_requests,
+            "recipes_per_user": BENCH_RECIPES_PER_USER, "ingredients_per_user": BENCH_INGREDIENTS_PER_USER,
+            "pdf": "GET /weekly-plan/pdf" in workload,
+        },
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(total / wall, 2) if wall else 0.0,
+        "error_rate": round(sum(e["errors"] for e in endpoints.values()) / total, 4) if total else 0.0,
+        "endpoints": endpoints,
+    }
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"{report['throughput_rps']} req/s over {report['wall_seconds']}s, error rate {report['error_rate']:.2%} "
+        f"({report['config']})",
+        f"{'endpoint':34} {'count':>6} {'err':>4} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8}",
+    ]
+    for name, e in sorted(report["endpoints"].items()):
+        lines.append(f"{name:34} {e['count']:>6} {e['errors']:>4} {e['throughput_rps']:>8} "
+                     f"{e['p50_ms']:>8} {e['p95_ms']:>8} {e['p99_ms']:>8}")
+    return "\n".join(lines)
+
+
+def save_report(report: dict, path: str = BENCH_OUTPUT) -> str:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return path
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float = BENCH_TOLERANCE) -> List[str]:
+    """Endpoints whose p95 regressed by more than `tolerance` times the baseline."""
+    regressions = []
+    for name, current in report["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if not previous or not previous.get("p95_ms") or current["p95_ms"] is None:
+            continue
+        if current["p95_ms"] > previous["p95_ms"] * tolerance:
+            regressions.append(f"{name}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+    return regressions
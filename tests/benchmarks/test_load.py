@@ -0,0 +1,94 @@
+"""
+Load and benchmark suite. Skipped unless MEALPLANNER_BENCH=1, e.g.:
+
+    MEALPLANNER_BENCH=1 MEALPLANNER_BENCH_USERS=50 pytest -s tests/benchmarks
+
+By default requests run in-process against the test database. Set
+MEALPLANNER_BENCH_URL to drive a running server instead; it must use the same
+database the suite seeds.
+"""
+import json
+import os
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from app import app
+import benchlib
+
+pytestmark = [
+    pytest.mark.skipif(os.environ.get("MEALPLANNER_BENCH") != "1", reason="set MEALPLANNER_BENCH=1 to run benchmarks"),
+    # Concurrent clients on connections of their own, timed without the other workers' load
+    pytest.mark.committed,
+    pytest.mark.serial,
+]
+
+RAMP_LEVELS = [int(c) for c in os.environ.get("MEALPLANNER_BENCH_RAMP", "1,2,4,8,16,32").split(",")]
+RAMP_REQUESTS_PER_LEVEL = benchlib.env_int("MEALPLANNER_BENCH_RAMP_REQUESTS", 400)
+# A level "falls over" when more requests than this fail
+RAMP_MAX_ERROR_RATE = 0.05
+
+
+@pytest.fixture()
+def bench_users(engine):
+    return benchlib.seed_volume(engine)
+
+
+@pytest.fixture()
+def client_factory(test_client):
+    # test_client installs the DB override that in-process clients rely on
+    url = os.environ.get("MEALPLANNER_BENCH_URL")
+    if url:
+        return lambda: httpx.Client(base_url=url, timeout=120)
+    return lambda: TestClient(app)
+
+
+def test_mixed_workload(client_factory, bench_users):
+    report = benchlib.run_workload(client_factory, bench_users, benchlib.default_workload())
+    print("\n" + benchlib.format_report(report))
+    print(f"Saved to {benchlib.save_report(report)}")
+
+    assert report["error_rate"] < 0.01
+    if benchlib.BENCH_BASELINE:
+        with open(benchlib.BENCH_BASELINE) as f:
+            regressions = benchlib.compare_to_baseline(report, json.load(f))
+        assert not regressions, "p95 regressions against baseline:\n" + "\n".join(regressions)
+
+
+def test_concurrency_ramp(client_factory, bench_users):
+    """Raises the number of concurrent clients until errors appear, recording throughput and tail latency."""
+    levels = []
+    for clients in RAMP_LEVELS:
+        report = benchlib.run_workload(client_factory, bench_users, benchlib.default_workload(),
+                                       clients=clients, total_requests=RAMP_REQUESTS_PER_LEVEL)
+        p99 = max((e["p99_ms"] for e in report["endpoints"].values()), default=None)
+        levels.append({"clients": clients, "throughput_rps": report["throughput_rps"],
+                       "error_rate": report["error_rate"], "worst_p99_ms": p99})
+        print(f"\n{clients:>3} clients: {report['throughput_rps']} req/s, worst p99 {p99} ms, "
+              f"errors {report['error_rate']:.2%}")
+        if report["error_rate"] > RAMP_MAX_ERROR_RATE:
+            break
+
+    path = os.path.join(os.path.dirname(benchlib.BENCH_OUTPUT), "ramp.json")
+    benchlib.save_report({"levels": levels}, path)
+    assert levels
+
+
+def test_edit_heavy_workload(client_factory, bench_users, engine):
+    """Text-heavy recipe edits with the unconditional nutrient trigger and with the current conditional one."""
+    reports = {}
+    try:
+        for variant in benchlib.NUTRIENT_UPDATE_TRIGGERS:
+            benchlib.install_nutrient_update_trigger(engine, variant)
+            reports[variant] = benchlib.run_workload(client_factory, bench_users, benchlib.EDIT_HEAVY_WORKLOAD)
+    finally:
+        benchlib.install_nutrient_update_trigger(engine, "on_ingredient_change")
+
+    for variant, report in reports.items():
+        print(f"\n[{variant}]\n" + benchlib.format_report(report))
+    path = benchlib.save_report({"variants": reports},
+                                os.path.join(os.path.dirname(benchlib.BENCH_OUTPUT), "edit_heavy.json"))
+    print(f"Saved to {path}")
+
+    assert all(report["error_rate"] < 0.01 for report in reports.values())
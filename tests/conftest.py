@@ -1,10 +1,14 @@
+import inspect
 import os
 import sys
-from typing import Iterator, Dict
+import time
+from contextlib import contextmanager
+from typing import Iterator, Dict, Optional, Tuple
 
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Connection, make_url
 from sqlalchemy.orm import sessionmaker
 from testcontainers.postgres import PostgresContainer
 
@@ -25,6 +29,8 @@ os.environ.setdefault("POSTGRES_DB", "mealplanner_test")
 os.environ.setdefault("POSTGRES_HOST", "localhost")
 os.environ.setdefault("MEALPLANNER_SECRET", "testsecret")
 os.environ.setdefault("MEALPLANNER_TOKEN_MINUTES", "60")
+# Tests write global rows behind the app's back: look for changes on every request
+os.environ.setdefault("MEALPLANNER_CATALOG_CHECK_SECONDS", "0")
 
 
 TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
@@ -33,11 +39,56 @@ TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
 # Import after env vars are set
 from app import app  # type: ignore  # noqa: E402
 from database import get_db, Base  # type: ignore  # noqa: E402
+from query_budget import QueryRecorder  # noqa: E402
+from catalog import global_catalog  # noqa: E402
+import jobs  # noqa: E402
+import partitions  # noqa: E402
+import setup_db  # noqa: E402
+from routers import auth_router  # noqa: E402
+
+# Every test signs a user up and logs in: hash at bcrypt's lowest cost instead of the production one
+auth_router.pwd_context.update(bcrypt__rounds=4)
+
+
+# Builds of the template database are serialized across pytest-xdist workers with this lock
+TEMPLATE_ADVISORY_LOCK = 727_900
+# Held shared by every test of an xdist worker, exclusively by `serial` ones
+SERIAL_ADVISORY_LOCK = 727_901
+SERIAL_TURNSTILE_LOCK = 727_902
+# Each worker gets its own clone of the template: gw0, gw1, ... or "main" without xdist
+WORKER = os.environ.get("PYTEST_XDIST_WORKER", "main")
+
+
+def pytest_configure(config) -> None:
+    config.addinivalue_line(
+        "markers", "committed: the test commits for real (other connections, threads, NOTIFY); "
+                   "its tables are truncated afterwards instead of rolled back")
+    config.addinivalue_line(
+        "markers", "serial: runs while no other xdist worker is inside a test. For assertions on "
+                   "pg_snapshot_xmin (sync cursors, catalog checks), which any transaction on the server holds back")
+
+
+def pytest_collection_modifyitems(items) -> None:
+    # Tests that take the engine open connections of their own, which only see committed rows
+    for item in items:
+        if "engine" in _own_arguments(item):
+            item.add_marker(pytest.mark.committed)
+
+
+def _own_arguments(item) -> Tuple[str, ...]:
+    try:
+        return tuple(inspect.signature(item.function).parameters)
+    except (AttributeError, TypeError, ValueError):
+        return ()
 
 
 @pytest.fixture(scope="session")
 def pg_container() -> Iterator[str]:
-    # Spin up an ephemeral PostgreSQL container for the whole test session
+    # A server to create the test databases on: TEST_DATABASE_URL names a database on one already running
+    # (a local Postgres, or a container shared by the xdist workers); else an ephemeral container
+    if TEST_DATABASE_URL:
+        yield TEST_DATABASE_URL
+        return
     with PostgresContainer("postgres:15-alpine") as postgres:
         url = postgres.get_connection_url()
         # Expose connection details for any code that relies on env vars (optional)
@@ -45,11 +96,113 @@ def pg_container() -> Iterator[str]:
         yield url
 
 
+def _template_database(conn: Connection) -> str:
+    """Name of the template database for the current schema, built by whichever worker gets there first."""
+    # Named after the schema's fingerprint: a schema change builds a new template, stale ones are dropped
+    name = f"mealplanner_template_{setup_db.schema_fingerprint()[:12]}"
+    conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": TEMPLATE_ADVISORY_LOCK})
+    try:
+        existing = conn.execute(text(
+            "SELECT datname FROM pg_database WHERE datname LIKE 'mealplanner\\_template\\_%'"
+        )).scalars().all()
+        if name in existing:
+            return name
+        for stale in existing:
+            conn.execute(text(f"DROP DATABASE IF EXISTS {stale}"))
+        # Built under another name and renamed when complete, so a crash never leaves a half-built template
+        building = f"{name}_building"
+        conn.execute(text(f"DROP DATABASE IF EXISTS {building}"))
+        conn.execute(text(f"CREATE DATABASE {building} ENCODING 'UTF8' TEMPLATE template0"))
+        template = create_engine(conn.engine.url.set(database=building))
+        try:
+            # Tables, triggers and the rows their DDL seeds (unit conversions)
+            Base.metadata.create_all(bind=template)
+        finally:
+            # Cloning needs the template to have no connections
+            template.dispose()
+        conn.execute(text(f"ALTER DATABASE {building} RENAME TO {name}"))
+        return name
+    finally:
+        conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": TEMPLATE_ADVISORY_LOCK})
+
+
+@pytest.fixture(scope="session")
+def server_lock(pg_container: str) -> Iterator[Optional[Connection]]:
+    # Advisory locks are per database: the workers meet in the one pg_container names
+    if WORKER == "main":
+        yield None
+        return
+    admin = create_engine(pg_container, isolation_level="AUTOCOMMIT")
+    try:
+        with admin.connect() as conn:
+            yield conn
+    finally:
+        admin.dispose()
+
+
+@pytest.fixture(scope="session")
+def test_database_url(pg_container: str, server_lock) -> Iterator[str]:
+    # This worker's database, cloned from the template: a file copy instead of running the DDL again
+    base = make_url(pg_container)
+    admin = create_engine(base, isolation_level="AUTOCOMMIT")
+    name = f"mealplanner_test_{WORKER}_{os.getpid()}"
+    try:
+        with server_share(server_lock), admin.connect() as conn:
+            template = _template_database(conn)
+            conn.execute(text(f"DROP DATABASE IF EXISTS {name}"))
+            conn.execute(text(f"CREATE DATABASE {name} TEMPLATE {template}"))
+        url = base.set(database=name).render_as_string(hide_password=False)
+        # The template may predate this month: the plan partitions around today, as the maintenance keeps them
+        clone = create_engine(url)
+        with clone.begin() as conn:
+            partitions.ensure_current(conn)
+        clone.dispose()
+        yield url
+        with server_share(server_lock), admin.connect() as conn:
+            conn.execute(text(f"DROP DATABASE IF EXISTS {name}"))
+    finally:
+        admin.dispose()
+
+
+def _poll(conn, sql: str, key: int) -> None:
+    # Polled rather than waited for: a statement waiting for a lock holds back pg_snapshot_xmin as well
+    while not conn.execute(text(sql), {"key": key}).scalar():
+        time.sleep(0.01)
+
+
+@contextmanager
+def server_share(server_lock: Optional[Connection], serial: bool = False) -> Iterator[None]:
+    """Writes to the server from a worker: shared with the other workers, or `serial` with none of them."""
+    if server_lock is None:
+        yield
+        return
+    if serial:
+        # The turnstile keeps further tests from starting while this one waits for the running ones
+        _poll(server_lock, "SELECT pg_try_advisory_lock(:key)", SERIAL_TURNSTILE_LOCK)
+        _poll(server_lock, "SELECT pg_try_advisory_lock(:key)", SERIAL_ADVISORY_LOCK)
+    else:
+        _poll(server_lock, "SELECT pg_try_advisory_lock_shared(:key)", SERIAL_TURNSTILE_LOCK)
+        _poll(server_lock, "SELECT pg_try_advisory_lock_shared(:key)", SERIAL_ADVISORY_LOCK)
+        server_lock.execute(text("SELECT pg_advisory_unlock_shared(:key)"), {"key": SERIAL_TURNSTILE_LOCK})
+    try:
+        yield
+    finally:
+        if serial:
+            server_lock.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SERIAL_ADVISORY_LOCK})
+            server_lock.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SERIAL_TURNSTILE_LOCK})
+        else:
+            server_lock.execute(text("SELECT pg_advisory_unlock_shared(:key)"), {"key": SERIAL_ADVISORY_LOCK})
+
+
+@pytest.fixture(autouse=True)
+def serial_tests(request, server_lock) -> Iterator[None]:
+    with server_share(server_lock, serial=request.node.get_closest_marker("serial") is not None):
+        yield
+
+
 @pytest.fixture(scope="session")
-def db_setup(pg_container: str):
-    engine = create_engine(pg_container)
-    # Create all tables once for the test session (includes triggers via SQLAlchemy DDL events)
-    Base.metadata.create_all(bind=engine)
+def db_setup(test_database_url: str):
+    engine = create_engine(test_database_url)
     try:
         yield engine
     finally:
@@ -61,25 +214,67 @@ def engine(db_setup):
     return db_setup
 
 
-@pytest.fixture(scope="session")
-def SessionTesting(engine):
-    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+@pytest.fixture()
+def SessionTesting(request, engine) -> Iterator[sessionmaker]:
+    if request.node.get_closest_marker("committed"):
+        yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        return
+    # Everything the test writes stays in one transaction that is rolled back at the end. Sessions join it:
+    # their commits release a SAVEPOINT, their rollbacks roll back to it
+    connection = engine.connect()
+    transaction = connection.begin()
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=connection,
+                           join_transaction_mode="create_savepoint")
+    event.listen(factory, "before_commit", _check_deferred_constraints)
+    try:
+        yield factory
+    finally:
+        transaction.rollback()
+        connection.close()
+
+
+def _check_deferred_constraints(session) -> None:
+    # Deferred constraints are checked at COMMIT, which a released savepoint is not: check them now so the
+    # commit fails where it would have. Every deferrable constraint is INITIALLY DEFERRED, so ALL DEFERRED
+    # restores them afterwards
+    session.flush()
+    session.execute(text("SET CONSTRAINTS ALL IMMEDIATE"))
+    session.execute(text("SET CONSTRAINTS ALL DEFERRED"))
 
 
 def _truncate_all_tables(engine) -> None:
     # Use TRUNCATE to quickly clean data and reset identities
     with engine.begin() as connection:
         # Order matters due to FKs and triggers
-        connection.execute(text("TRUNCATE TABLE weekly_plan RESTART IDENTITY CASCADE"))
+        connection.execute(text("TRUNCATE TABLE jobs RESTART IDENTITY"))
+        connection.execute(text("TRUNCATE TABLE plan_entries"))
         connection.execute(text("TRUNCATE TABLE recipes RESTART IDENTITY CASCADE"))
         connection.execute(text("TRUNCATE TABLE ingredients RESTART IDENTITY CASCADE"))
         connection.execute(text("TRUNCATE TABLE users RESTART IDENTITY CASCADE"))
+        connection.execute(text("TRUNCATE TABLE boot_state"))
+        connection.execute(text("TRUNCATE TABLE schema_migrations"))
+        connection.execute(text("TRUNCATE TABLE sync_tombstones RESTART IDENTITY"))
+
+
+# Whether rolled-back tests ran since the last truncation: their rows are gone, but not the ids they took
+_sequences_advanced = False
 
 
 @pytest.fixture(autouse=True)
-def clean_db(engine):
-    _truncate_all_tables(engine)
+def clean_db(request, engine, serial_tests):
+    global _sequences_advanced
+    global_catalog.invalidate()
+    committed = request.node.get_closest_marker("committed") is not None
+    # Committed tests start from ids 1, as on a fresh database
+    if committed and _sequences_advanced:
+        _truncate_all_tables(engine)
     yield
+    # Rolled-back tests leave no rows behind; committed ones are cleaned up after
+    if committed:
+        _truncate_all_tables(engine)
+        _sequences_advanced = False
+    elif "SessionTesting" in request.fixturenames:
+        _sequences_advanced = True
 
 
 @pytest.fixture()
@@ -91,6 +286,22 @@ def db_session(SessionTesting) -> Iterator:
         session.close()
 
 
+@pytest.fixture()
+def run_jobs(SessionTesting):
+    # The app's job workers only start with the server; tests run queued jobs inline
+    return lambda: jobs.run_pending(SessionTesting)
+
+
+@pytest.fixture()
+def query_recorder(engine) -> Iterator[QueryRecorder]:
+    # Records the statements issued by the test engine inside `with query_recorder.record():`
+    recorder = QueryRecorder(engine)
+    try:
+        yield recorder
+    finally:
+        recorder.close()
+
+
 @pytest.fixture()
 def test_client(SessionTesting) -> Iterator[TestClient]:
     # Override app DB dependency to use our test sessionmaker
@@ -0,0 +1,104 @@
+"""
+Query-count harness for the per-endpoint SQL budgets in test_query_budgets.py.
+
+QueryRecorder hooks the test engine's cursor events and records every
+statement issued while it is active, with the rows it returned. A Budget caps
+statement count and rows fetched, and can require that given tables are never
+read with a sequential scan. Scans are detected by re-planning each recorded
+SELECT with `enable_seqscan = off`: if the plan still has a Seq Scan on a
+table, no index can serve that query, however small the test data is.
+"""
+import json
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+
+@dataclass
+class RecordedStatement:
+    statement: str
+    parameters: object
+    rows: int
+
+
+@dataclass
+class Budget:
+    statements: int
+    rows: int
+    no_seq_scan_on: Tuple[str, ...] = ()
+
+
+class QueryRecorder:
+    def __init__(self, engine) -> None:
+        self.engine = engine
+        self.statements: List[RecordedStatement] = []
+        self._active = False
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def close(self) -> None:
+        event.remove(self.engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not self._active:
+            return
+        rows = cursor.rowcount if cursor.description is not None and cursor.rowcount > 0 else 0
+        self.statements.append(RecordedStatement(statement, parameters, rows))
+
+    @contextmanager
+    def record(self) -> Iterator["QueryRecorder"]:
+        self.statements = []
+        self._active = True
+        try:
+            yield self
+        finally:
+            self._active = False
+
+    @property
+    def rows(self) -> int:
+        return sum(s.rows for s in self.statements)
+
+    def seq_scans(self, tables: Sequence[str]) -> List[Tuple[str, str]]:
+        """(table, statement) pairs for recorded SELECTs that can only read `tables` sequentially."""
+        found = []
+        with self.engine.connect() as conn:
+            conn.exec_driver_sql("SET enable_seqscan = off")
+            for recorded in self.statements:
+                if not recorded.statement.lstrip().upper().startswith("SELECT"):
+                    continue
+                plan = conn.exec_driver_sql(
+                    "EXPLAIN (FORMAT JSON) " + recorded.statement, recorded.parameters or {}
+                ).scalar()
+                plan = json.loads(plan) if isinstance(plan, str) else plan
+                for relation in _seq_scanned_relations(plan[0]["Plan"]):
+                    # A partition counts as its partitioned table
+                    relation = conn.exec_driver_sql(
+                        "SELECT coalesce((SELECT inhparent::regclass::text FROM pg_inherits "
+                        "WHERE inhrelid = CAST(%(r)s AS regclass)), %(r)s)", {"r": relation}
+                    ).scalar()
+                    if relation in tables:
+                        found.append((relation, recorded.statement))
+            conn.exec_driver_sql("RESET enable_seqscan")
+        return found
+
+    def check(self, budget: Budget, label: str) -> None:
+        problems = []
+        if len(self.statements) > budget.statements:
+            problems.append(f"{len(self.statements)} statements (budget {budget.statements})")
+        if self.rows > budget.rows:
+            problems.append(f"{self.rows} rows fetched (budget {budget.rows})")
+        for table, statement in self.seq_scans(budget.no_seq_scan_on):
+            problems.append(f"sequential scan on {table}: {' '.join(statement.split())[:200]}")
+        if problems:
+            issued = "\n".join(f"  [{s.rows} rows] {' '.join(s.statement.split())[:200]}" for s in self.statements)
+            raise AssertionError(f"{label} is over its query budget: " + "; ".join(problems) + "\n" + issued)
+
+
+def _seq_scanned_relations(node: dict, found: Optional[List[str]] = None) -> List[str]:
+    found = [] if found is None else found
+    if node.get("Node Type") == "Seq Scan":
+        found.append(node.get("Relation Name"))
+    for child in node.get("Plans", []):
+        _seq_scanned_relations(child, found)
+    return found
@@ -0,0 +1,149 @@
+import datetime
+
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+import rollups
+
+TODAY = datetime.date.today()
+MONDAY = TODAY - datetime.timedelta(days=TODAY.weekday())
+LAST_MONDAY = MONDAY - datetime.timedelta(weeks=1)
+
+
+def _setup_recipes(test_client, auth_headers):
+    test_client.post("/ingredients", params={"name": "Rice", "shelf_life": 300, "serving_unit": "g"},
+                     headers=auth_headers)
+    ids = []
+    for name, grams in (("Rice bowl", 100), ("Big rice bowl", 300)):
+        ids.append(test_client.post("/recipes", json={
+            "name": name, "serves": 1, "instructions": "Boil", "meal_type": "lunch", "is_vegetarian": True,
+            "ingredients": [{"name": "Rice", "quantity": grams, "serving_unit": "g"}],
+        }, headers=auth_headers).json()["id"])
+    return ids
+
+
+def _plan(test_client, auth_headers, day, meal_type, recipe_ids, week_of):
+    resp = test_client.put("/weekly-plan", json={"day": day, "meal_type": meal_type, "recipe_ids": recipe_ids,
+                                                 "week_of": week_of.isoformat()}, headers=auth_headers)
+    assert resp.status_code == 201, resp.text
+
+
+def _energise_rice(engine, energy_per_100g):
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE ingredients SET energy = :e, serving_size = 100 WHERE name = 'Rice'"),
+                     {"e": energy_per_100g})
+        # Touch the ingredient lists so the recipes' nutrients are recomputed
+        conn.execute(text("""UPDATE recipes SET ingredients = ingredients || '[{"name": "-"}]'"""))
+        conn.execute(text("UPDATE recipes SET ingredients = ingredients - -1"))
+
+
+def _daily(engine):
+    with engine.connect() as conn:
+        return {r.day: (r.recipes, float(r.energy))
+                for r in conn.execute(text("SELECT day, recipes, energy FROM nutrition_daily ORDER BY day"))}
+
+
+def test_rollups_follow_plan_and_recipe_changes(engine, test_client: TestClient, auth_headers):
+    small, big = _setup_recipes(test_client, auth_headers)
+    _energise_rice(engine, 100)
+
+    _plan(test_client, auth_headers, "Monday", "lunch", [small], LAST_MONDAY)
+    _plan(test_client, auth_headers, "Monday", "dinner", [big], LAST_MONDAY)
+    _plan(test_client, auth_headers, "Tuesday", "lunch", [small, big], MONDAY)
+    assert _daily(engine) == {LAST_MONDAY: (2, 400.0), MONDAY + datetime.timedelta(days=1): (2, 400.0)}
+
+    # An emptied slot leaves the day; a day with nothing planned has no row
+    _plan(test_client, auth_headers, "Monday", "dinner", [], LAST_MONDAY)
+    assert _daily(engine)[LAST_MONDAY] == (1, 100.0)
+    _plan(test_client, auth_headers, "Monday", "lunch", [], LAST_MONDAY)
+    assert LAST_MONDAY not in _daily(engine)
+
+    # Recipe nutrients changing (here through their ingredient) reach every day planning them
+    _energise_rice(engine, 200)
+    assert _daily(engine) == {MONDAY + datetime.timedelta(days=1): (2, 800.0)}
+    test_client.delete(f"/recipes/{big}", headers=auth_headers)
+    assert _daily(engine) == {MONDAY + datetime.timedelta(days=1): (1, 200.0)}
+
+    with engine.connect() as conn:
+        weeks = conn.execute(text("SELECT week_start, days_planned, recipes, energy FROM nutrition_weekly")).all()
+    assert [(w.week_start, w.days_planned, w.recipes, float(w.energy)) for w in weeks] == [(MONDAY, 1, 1, 200.0)]
+
+
+def test_rebuild_matches_the_triggers(engine, test_client: TestClient, auth_headers):
+    small, big = _setup_recipes(test_client, auth_headers)
+    _energise_rice(engine, 150)
+    for week in (LAST_MONDAY, MONDAY):
+        _plan(test_client, auth_headers, "Wednesday", "lunch", [small], week)
+        _plan(test_client, auth_headers, "Friday", "dinner", [small, big], week)
+
+    def snapshot():
+        with engine.connect() as conn:
+            return (conn.execute(text("SELECT * FROM nutrition_daily ORDER BY user_id, day")).all(),
+                    conn.execute(text("SELECT * FROM nutrition_weekly ORDER BY user_id, week_start")).all())
+
+    maintained = snapshot()
+    with engine.begin() as conn:
+        assert rollups.rebuild(conn) == 4
+    assert snapshot() == maintained
+
+
+def test_nutrition_series_by_day_and_week(engine, test_client: TestClient, auth_headers):
+    small, big = _setup_recipes(test_client, auth_headers)
+    _energise_rice(engine, 100)
+    _plan(test_client, auth_headers, "Monday", "lunch", [small], LAST_MONDAY)
+    _plan(test_client, auth_headers, "Sunday", "lunch", [big], LAST_MONDAY)
+    _plan(test_client, auth_headers, "Monday", "lunch", [big], MONDAY)
+
+    days = test_client.get("/analytics/nutrition", params={
+        "start": LAST_MONDAY.isoformat(), "end": TODAY.isoformat()}, headers=auth_headers).json()
+    assert [(d["period_start"], d["nutrients"]["energy"]) for d in days] == [
+        (LAST_MONDAY.isoformat(), 100.0),
+        ((LAST_MONDAY + datetime.timedelta(days=6)).isoformat(), 300.0),
+        (MONDAY.isoformat(), 300.0),
+    ]
+
+    # A range starting mid-week still gets that whole week
+    weeks = test_client.get("/analytics/nutrition", params={
+        "start": (LAST_MONDAY + datetime.timedelta(days=3)).isoformat(), "end": TODAY.isoformat(), "bucket": "week",
+    }, headers=auth_headers).json()
+    assert [(w["period_start"], w["days_planned"], w["recipes"], w["nutrients"]["energy"]) for w in weeks] == [
+        (LAST_MONDAY.isoformat(), 2, 2, 400.0),
+        (MONDAY.isoformat(), 1, 1, 300.0),
+    ]
+
+    too_long = test_client.get("/analytics/nutrition", params={
+        "start": (TODAY - datetime.timedelta(days=400)).isoformat(), "end": TODAY.isoformat()}, headers=auth_headers)
+    assert too_long.status_code == 400
+    by_week = test_client.get("/analytics/nutrition", params={
+        "start": (TODAY - datetime.timedelta(days=400)).isoformat(), "end": TODAY.isoformat(), "bucket": "week",
+    }, headers=auth_headers)
+    assert by_week.status_code == 200
+
+
+def test_nutrition_trends(engine, test_client: TestClient, auth_headers):
+    small, big = _setup_recipes(test_client, auth_headers)
+    _energise_rice(engine, 100)
+    # Eating more every week: 100 kcal a day two weeks ago, 300 last week
+    two_weeks_ago = MONDAY - datetime.timedelta(weeks=2)
+    for day in ("Monday", "Wednesday"):
+        _plan(test_client, auth_headers, day, "lunch", [small], two_weeks_ago)
+        _plan(test_client, auth_headers, day, "lunch", [big], LAST_MONDAY)
+
+    sunday = MONDAY - datetime.timedelta(days=1)
+    trends = test_client.get("/analytics/nutrition/trends", params={"end": sunday.isoformat()},
+                             headers=auth_headers).json()
+    assert trends["end"] == sunday.isoformat()
+    week, month, quarter = trends["windows"]
+    assert (week["days"], week["days_planned"], week["daily_average"]["energy"]) == (7, 2, 300.0)
+    assert (month["days"], month["days_planned"], month["daily_average"]["energy"]) == (30, 4, 200.0)
+    assert quarter["days"] == 90
+    assert trends["trend_per_day"]["energy"] > 0
+    assert trends["this_week"]["energy"] == 600.0
+    assert trends["last_week"]["energy"] == 200.0
+    assert trends["week_over_week_pct"]["energy"] == 200.0
+    assert trends["week_over_week_pct"]["protein"] is None
+
+    empty = test_client.get("/analytics/nutrition/trends", params={"end": "2001-01-01"},
+                            headers=auth_headers).json()
+    assert empty["windows"][0]["days_planned"] == 0
+    assert empty["trend_per_day"]["energy"] is None
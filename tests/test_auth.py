@@ -22,7 +22,7 @@ def test_login_wrong_password(test_client: TestClient):
     )
     assert resp.status_code == 400
 
-def test_signup_duplicates_demo_user_data(test_client: TestClient, db_session: Session):
+def test_signup_duplicates_demo_user_data(test_client: TestClient, db_session: Session, run_jobs):
     # 1. Create a demo user and some data
     demo_user_data = {"email": "demo@demo.com", "password": "demopass"}
     test_client.post("/auth/signup", json=demo_user_data)
@@ -38,6 +38,8 @@ def test_signup_duplicates_demo_user_data(test_client: TestClient, db_session: S
     signup_resp = test_client.post("/auth/signup", json=new_user_data)
     assert signup_resp.status_code == 201
     new_user_id = signup_resp.json()["id"]
+    # The copy is made by a background job
+    assert run_jobs() == 1
 
     # 3. Verify the data was duplicated
     demo_ingredients = db_session.query(Ingredient).filter(Ingredient.user_id == demo_user.id).all()
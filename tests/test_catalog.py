@@ -0,0 +1,97 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+from catalog import global_catalog
+from models import Ingredient
+
+
+# The catalog checks for changes since its load's pg_snapshot_xmin, which transactions elsewhere hold back
+pytestmark = pytest.mark.serial
+
+def _global_recipe(engine, name, ingredient="Rice"):
+    with engine.begin() as conn:
+        return conn.execute(text("""
+            INSERT INTO recipes (name, serves, ingredients, instructions, meal_type, is_vegetarian)
+            VALUES (:name, 2, CAST(:ingredients AS jsonb), 'Cook', 'dinner', true) RETURNING id
+        """), {"name": name, "ingredients": f'[{{"name": "{ingredient}", "quantity": 100, "serving_unit": "g"}}]'}
+        ).scalar()
+
+
+def _names(test_client, auth_headers):
+    return [r["name"] for r in test_client.get("/recipes", headers=auth_headers).json()]
+
+
+def test_global_rows_are_merged_with_the_users_own(engine, db_session, test_client: TestClient, auth_headers):
+    stew = _global_recipe(engine, "Global stew")
+    db_session.add(Ingredient(name="Salt", available=True, serving_unit="g"))
+    db_session.commit()
+    test_client.post("/recipes", json={
+        "name": "Apple pie", "serves": 4, "instructions": "Bake", "meal_type": "snack", "is_vegetarian": True,
+        "ingredients": [],
+    }, headers=auth_headers)
+    test_client.post("/ingredients", params={"name": "Apple", "shelf_life": 20, "serving_unit": "nos"},
+                     headers=auth_headers)
+
+    assert _names(test_client, auth_headers) == ["Apple pie", "Global stew"]
+    assert test_client.get(f"/recipes/{stew}", headers=auth_headers).json()["name"] == "Global stew"
+    ingredients = test_client.get("/ingredients", headers=auth_headers).json()
+    # Available first, then by name
+    assert [i["name"] for i in ingredients] == ["Salt", "Apple"]
+    by_shelf_life = test_client.get("/ingredients", params={"sort": "shelf_life"}, headers=auth_headers).json()
+    assert [i["name"] for i in by_shelf_life] == ["Apple", "Salt"]
+
+
+def test_global_catalog_changes_are_noticed(engine, test_client: TestClient, auth_headers, query_recorder):
+    stew = _global_recipe(engine, "Global stew")
+    assert _names(test_client, auth_headers) == ["Global stew"]
+
+    # Unchanged: one small check instead of re-reading the catalog
+    with query_recorder.record():
+        assert _names(test_client, auth_headers) == ["Global stew"]
+    assert not any("pg_snapshot_xmin" in s.statement for s in query_recorder.statements)
+
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE recipes SET name = 'Global soup' WHERE id = :id"), {"id": stew})
+    assert _names(test_client, auth_headers) == ["Global soup"]
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM recipes WHERE id = :id"), {"id": stew})
+    assert _names(test_client, auth_headers) == []
+    assert test_client.get(f"/recipes/{stew}", headers=auth_headers).status_code == 404
+
+
+def test_writes_committing_after_a_load_are_noticed(engine, test_client: TestClient, auth_headers):
+    stew = _global_recipe(engine, "Global stew")
+    with engine.connect() as slow:
+        slow.begin()
+        slow.execute(text("UPDATE recipes SET name = 'Global soup' WHERE id = :id"), {"id": stew})
+        # Loaded while the update is in flight
+        assert _names(test_client, auth_headers) == ["Global stew"]
+        slow.commit()
+    assert _names(test_client, auth_headers) == ["Global soup"]
+
+
+def test_checks_are_spaced_out(engine, test_client: TestClient, auth_headers, monkeypatch):
+    monkeypatch.setattr(global_catalog, "check_seconds", 60)
+    _global_recipe(engine, "Global stew")
+    assert _names(test_client, auth_headers) == ["Global stew"]
+    _global_recipe(engine, "Global soup")
+    # Served from the cache until the next check is due
+    assert _names(test_client, auth_headers) == ["Global stew"]
+    global_catalog.invalidate()
+    assert _names(test_client, auth_headers) == ["Global soup", "Global stew"]
+
+
+def test_global_recipes_use_global_ingredients(engine, db_session, test_client: TestClient, auth_headers):
+    test_client.post("/ingredients", params={"name": "Rice", "shelf_life": 300, "serving_unit": "g"},
+                     headers=auth_headers)
+    own_rice = test_client.get("/ingredients", headers=auth_headers).json()[0]["id"]
+    global_rice = Ingredient(name="Rice", serving_unit="g")
+    db_session.add(global_rice)
+    db_session.commit()
+    risotto = _global_recipe(engine, "Global risotto", ingredient="rice")
+
+    item = test_client.get(f"/recipes/{risotto}", headers=auth_headers).json()["ingredients"][0]
+    assert (item["id"], item["name"]) == (global_rice.id, "Rice")
+    # Not the user's Rice, which stays theirs to delete
+    assert test_client.delete(f"/ingredients/{own_rice}", headers=auth_headers).status_code == 204
@@ -0,0 +1,126 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+
+import coalesce
+from coalesce import COALESCE_REQUESTS, CoalesceTimeout, SingleFlight
+from metrics import registry
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+def test_identical_calls_share_one_computation():
+    registry.reset()
+    flight = SingleFlight(timeout=5)
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        return {"answer": 42}
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        futures = [pool.submit(flight.do, "key", compute, "test") for _ in range(5)]
+        _wait_for(lambda: flight.waiting("key") == 4)
+        release.set()
+        results = [f.result() for f in futures]
+
+    assert len(calls) == 1
+    assert all(result == {"answer": 42} for result, _ in results)
+    assert sum(1 for _, shared in results if shared) == 4
+    assert registry.value(COALESCE_REQUESTS, ["test", "leader"]) == 1
+    assert registry.value(COALESCE_REQUESTS, ["test", "shared"]) == 4
+    assert flight.in_flight() == 0
+
+
+def test_errors_reach_every_waiting_caller():
+    flight = SingleFlight(timeout=5)
+    started, release = threading.Event(), threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError("boom")
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        leader = pool.submit(flight.do, "key", fail, "test")
+        started.wait(5)
+        followers = [pool.submit(flight.do, "key", fail, "test") for _ in range(2)]
+        _wait_for(lambda: flight.waiting("key") == 2)
+        release.set()
+        for future in [leader] + followers:
+            with pytest.raises(ValueError, match="boom"):
+                future.result()
+
+    # A failed computation is not remembered
+    assert flight.do("key", lambda: "ok") == ("ok", False)
+
+
+def test_follower_times_out():
+    registry.reset()
+    flight = SingleFlight(timeout=0.05)
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "late"
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(flight.do, "key", slow, "test")
+        started.wait(5)
+        with pytest.raises(CoalesceTimeout):
+            flight.do("key", slow, "test")
+        release.set()
+        assert leader.result() == ("late", False)
+    assert registry.value(COALESCE_REQUESTS, ["test", "timeout"]) == 1
+
+
+def test_reads_pinned_to_the_primary_do_not_join_replica_reads():
+    sessions = {target: Session() for target in ("replica", "primary")}
+    for target, db in sessions.items():
+        db.info["read_target"] = target
+    started, release = threading.Event(), threading.Event()
+
+    def lagging_replica():
+        started.set()
+        release.wait(5)
+        return "before the write"
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(coalesce.coalesced, sessions["replica"], "/test", 1, (), lagging_replica)
+        started.wait(5)
+        # The writer's own reload, pinned to the primary, computes afresh instead of waiting on the replica
+        assert coalesce.coalesced(sessions["primary"], "/test", 1, (), lambda: "after the write") == "after the write"
+        # Other replica reads still share
+        follower = pool.submit(coalesce.coalesced, sessions["replica"], "/test", 1, (), lambda: "not run")
+        _wait_for(lambda: coalesce.flights.waiting(("/test", 1, (), coalesce.data_version(1), "replica")) == 1)
+        release.set()
+        assert leader.result() == follower.result() == "before the write"
+
+
+def test_writes_start_a_new_flight(test_client: TestClient, auth_headers):
+    me = test_client.get("/auth/me", headers=auth_headers).json()
+    before = coalesce.data_version(me["id"])
+
+    resp = test_client.post(
+        "/ingredients",
+        params={"name": "Tomato", "shelf_life": 5, "serving_unit": "g"},
+        headers=auth_headers,
+    )
+    assert resp.status_code == 201
+    assert coalesce.data_version(me["id"]) == before + 1
+
+    # Coalesced routes still serve plain responses
+    assert test_client.get("/recipes", headers=auth_headers).json() == []
+    assert test_client.get("/utilities/shopping-list", headers=auth_headers).json() == {}
@@ -0,0 +1,142 @@
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import coalesce
+import events
+from events import EventHub, event_stream
+from routers import events_router
+
+# NOTIFY is only delivered on a real commit
+pytestmark = pytest.mark.committed
+
+
+@pytest.fixture()
+def event_hub(engine):
+    hub = EventHub()
+    hub.start(engine)
+    assert hub.connected.wait(5)
+    try:
+        yield hub
+    finally:
+        hub.stop()
+
+
+def _user_id(test_client, auth_headers):
+    return test_client.get("/auth/me", headers=auth_headers).json()["id"]
+
+
+def _collect(hub, user_id, write, expected=1, timeout=5.0):
+    """Runs `write` (blocking) while subscribed as `user_id`; returns the events received."""
+    async def main():
+        subscription = hub.subscribe(user_id)
+        try:
+            await asyncio.to_thread(write)
+            received = []
+            try:
+                while len(received) < expected:
+                    received.append(await asyncio.wait_for(subscription.queue.get(), timeout))
+                # Nothing else should follow
+                received.append(await asyncio.wait_for(subscription.queue.get(), 0.3))
+            except asyncio.TimeoutError:
+                pass
+            return received
+        finally:
+            hub.unsubscribe(subscription)
+    return asyncio.run(main())
+
+
+def test_writes_notify_the_users_streams(test_client: TestClient, auth_headers, event_hub):
+    user_id = _user_id(test_client, auth_headers)
+
+    def write():
+        resp = test_client.put("/weekly-plan", json={"day": "Monday", "meal_type": "lunch", "recipe_ids": []},
+                               headers=auth_headers)
+        assert resp.status_code == 201
+        resp = test_client.post("/ingredients", params={"name": "Tomato", "shelf_life": 5, "serving_unit": "g"},
+                                headers=auth_headers)
+        assert resp.status_code == 201
+
+    plan, ingredient = _collect(event_hub, user_id, write, expected=2)
+    assert plan == {"entity": "plan", "action": "updated", "ids": [],
+                    "data": {"day": "Monday", "meal_type": "lunch", "recipe_ids": []}}
+    assert ingredient["entity"] == "ingredient" and ingredient["action"] == "created"
+    assert len(ingredient["ids"]) == 1
+
+
+def test_other_users_and_failed_writes_send_nothing(test_client: TestClient, auth_headers, event_hub):
+    user_id = _user_id(test_client, auth_headers)
+
+    def write():
+        # Rolled back: the recipe id does not exist
+        resp = test_client.put("/weekly-plan", json={"day": "Monday", "meal_type": "lunch", "recipe_ids": [999]},
+                               headers=auth_headers)
+        assert resp.status_code == 400
+
+    assert _collect(event_hub, user_id + 1, lambda: None, expected=0) == []
+    assert _collect(event_hub, user_id, write, expected=0) == []
+
+
+def test_events_bump_coalescing_versions():
+    hub = EventHub()
+    before = coalesce.data_version(4242)
+    hub.dispatch(json.dumps({"user_id": 4242, "entity": "recipe", "action": "deleted", "ids": [1]}))
+    assert coalesce.data_version(4242) == before + 1
+    hub.dispatch("not json")
+
+
+def test_slow_subscribers_are_told_to_resync(monkeypatch):
+    monkeypatch.setattr(events, "SUBSCRIBER_QUEUE_SIZE", 2)
+    hub = EventHub()
+
+    async def main():
+        subscription = hub.subscribe(7)
+        for i in range(3):
+            hub.dispatch(json.dumps({"user_id": 7, "entity": "recipe", "action": "updated", "ids": [i]}))
+        await asyncio.sleep(0)
+        return [subscription.queue.get_nowait() for _ in range(subscription.queue.qsize())]
+
+    assert asyncio.run(main()) == [events.RESYNC]
+
+
+def test_event_stream_frames():
+    hub = EventHub()
+
+    async def main():
+        subscription = hub.subscribe(7)
+        stream = event_stream(subscription, heartbeat=0.01)
+        frames = [await stream.__anext__(), await stream.__anext__()]
+        hub.dispatch(json.dumps({"user_id": 7, "entity": "recipe", "action": "created", "ids": [3]}))
+        frames.append(await stream.__anext__())
+        await stream.aclose()
+        return frames
+
+    retry, keepalive, change = asyncio.run(main())
+    assert retry.startswith("retry: ")
+    assert keepalive == ": keepalive\n\n"
+    assert change == 'event: change\ndata: {"entity":"recipe","action":"created","ids":[3]}\n\n'
+
+
+def test_events_endpoint_requires_a_ticket(test_client: TestClient, auth_headers):
+    assert test_client.get("/events").status_code == 401
+    assert test_client.get("/events", params={"ticket": "invalid"}).status_code == 401
+    # The access token never goes in the URL
+    token = auth_headers["Authorization"].split(" ", 1)[1]
+    assert test_client.get("/events", params={"ticket": token}).status_code == 401
+    assert test_client.post("/events/ticket").status_code == 401
+
+    ticket = test_client.post("/events/ticket", headers=auth_headers).json()
+    assert ticket["expires_in"] == events_router.TICKET_SECONDS
+    # Authenticated, but this process has no listener running
+    assert test_client.get("/events", params={"ticket": ticket["ticket"]}).status_code == 503
+    assert test_client.get("/events", headers=auth_headers).status_code == 503
+    # A ticket opens nothing else
+    assert test_client.get("/auth/me", headers={"Authorization": f"Bearer {ticket['ticket']}"}).status_code == 401
+
+
+def test_tickets_expire(monkeypatch, test_client: TestClient, auth_headers):
+    monkeypatch.setattr(events_router, "TICKET_SECONDS", -1)
+    ticket = test_client.post("/events/ticket", headers=auth_headers).json()["ticket"]
+    assert test_client.get("/events", params={"ticket": ticket}).status_code == 401
@@ -1,5 +1,7 @@
 from fastapi.testclient import TestClient
 
+from models import Job
+
 
 def test_add_list_update_delete_ingredient(test_client: TestClient, auth_headers):
     # Initially empty
@@ -48,6 +50,21 @@ def test_add_existing_ingredient(test_client: TestClient, auth_headers):
     )
     assert resp.status_code == 409  # Bad Request or Conflict
 
+    # Names are unique whatever their case, on add and on rename
+    resp = test_client.post(
+        "/ingredients",
+        params={"name": "onion", "shelf_life": 10, "serving_unit": "g"},
+        headers=auth_headers,
+    )
+    assert resp.status_code == 409
+    shallot = test_client.post(
+        "/ingredients",
+        params={"name": "Shallot", "shelf_life": 10, "serving_unit": "g"},
+        headers=auth_headers,
+    ).json()
+    resp = test_client.put(f"/ingredients/{shallot['id']}", params={"name": "ONION"}, headers=auth_headers)
+    assert resp.status_code == 409
+
 def test_update_non_existent_ingredient(test_client: TestClient, auth_headers):
     resp = test_client.put("/ingredients/9999", params={"available": True}, headers=auth_headers)
     assert resp.status_code == 404
@@ -63,3 +80,28 @@ def test_get_ingredient_unauthorized(test_client: TestClient):
     assert resp.status_code == 401
 
 
+
+
+def test_ingredient_unit_change_reaches_recipes(test_client: TestClient, auth_headers, db_session):
+    tomato = test_client.post("/ingredients", params={"name": "Tomato", "shelf_life": 5, "serving_unit": "g"},
+                              headers=auth_headers).json()
+    test_client.put(f"/ingredients/{tomato['id']}", params={"energy": 20}, headers=auth_headers)
+    recipe = test_client.post("/recipes", json={
+        "name": "Salad", "serves": 1, "instructions": "Chop", "meal_type": "lunch", "is_vegetarian": True,
+        "ingredients": [{"name": "Tomato", "quantity": 200, "serving_unit": "g"}],
+    }, headers=auth_headers).json()
+    assert recipe["energy"] == 40
+
+    # Counted in pieces now: the recipe keeps its grams, converted through the piece weight
+    resp = test_client.put(f"/ingredients/{tomato['id']}", params={
+        "serving_unit": "nos", "serving_size": 1, "grams_per_piece": 50, "energy": 15}, headers=auth_headers)
+    assert resp.status_code == 200
+    resp = test_client.put(f"/ingredients/{tomato['id']}", params={"name": "Cherry tomato"}, headers=auth_headers)
+    assert resp.status_code == 200
+
+    recipe = test_client.get(f"/recipes/{recipe['id']}", headers=auth_headers).json()
+    assert recipe["ingredients"] == [
+        {"id": tomato["id"], "name": "Cherry tomato", "quantity": 200, "serving_unit": "g"}]
+    # 200 g = 4 pieces of 15 kcal, re-summed in the same transaction as the change: no job to wait for
+    assert recipe["energy"] == 60
+    assert db_session.query(Job).count() == 0
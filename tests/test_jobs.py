@@ -0,0 +1,153 @@
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+import jobs
+from jobs import JOBS_PROCESSED, JobWorkerPool
+from metrics import registry
+from models import Job
+from routers import plan_router
+
+
+def _queue(SessionTesting, kind, priority=jobs.PRIORITY_DEFAULT, max_attempts=3):
+    with SessionTesting() as session:
+        job = jobs.enqueue(session, kind, {"n": 1}, priority=priority, max_attempts=max_attempts)
+        session.commit()
+        return job.id
+
+
+def test_jobs_run_by_priority(SessionTesting, monkeypatch):
+    ran = []
+    monkeypatch.setitem(jobs.HANDLERS, "record", lambda session, job: ran.append(job.id))
+    low = _queue(SessionTesting, "record", priority=100)
+    high = _queue(SessionTesting, "record", priority=0)
+
+    assert jobs.run_pending(SessionTesting) == 2
+    assert ran == [high, low]
+    with SessionTesting() as session:
+        assert {job.status for job in session.query(Job)} == {"succeeded"}
+
+
+# Two workers, two connections
+@pytest.mark.committed
+def test_claimed_jobs_are_skipped_by_other_workers(SessionTesting):
+    first = _queue(SessionTesting, "record")
+    second = _queue(SessionTesting, "record")
+
+    with SessionTesting() as holder, SessionTesting() as other:
+        # A worker in the middle of claiming keeps its row locked
+        locked = holder.query(Job).filter(Job.id == first).with_for_update().one()
+        claimed = jobs.claim(other, "other")
+        assert claimed.id == second and claimed.status == "running"
+        assert jobs.claim(other, "other") is None
+        holder.rollback()
+        assert locked.id == first
+
+
+def test_failed_jobs_retry_with_backoff(SessionTesting, monkeypatch):
+    registry.reset()
+    monkeypatch.setattr(jobs, "JOB_RETRY_BASE_SECONDS", 0)
+    attempts = []
+
+    def flaky(session, job):
+        attempts.append(job.attempts)
+        if len(attempts) < 3:
+            raise RuntimeError("try again")
+        return {"ok": True}
+
+    monkeypatch.setitem(jobs.HANDLERS, "flaky", flaky)
+    job_id = _queue(SessionTesting, "flaky")
+
+    assert jobs.run_pending(SessionTesting) == 3
+    assert attempts == [1, 2, 3]
+    with SessionTesting() as session:
+        job = session.get(Job, job_id)
+        assert (job.status, job.result) == ("succeeded", {"ok": True})
+    assert registry.value(JOBS_PROCESSED, ["flaky", "retried"]) == 2
+    assert registry.value(JOBS_PROCESSED, ["flaky", "succeeded"]) == 1
+
+
+def test_retries_wait_for_backoff_and_give_up(SessionTesting, monkeypatch):
+    def broken(session, job):
+        session.execute(text("INSERT INTO boot_state (step, checksum) VALUES ('rolled back', '')"))
+        raise ValueError("broken")
+
+    monkeypatch.setitem(jobs.HANDLERS, "broken", broken)
+    job_id = _queue(SessionTesting, "broken", max_attempts=2)
+
+    # The retry is not due yet
+    assert jobs.run_pending(SessionTesting) == 1
+    with SessionTesting() as session:
+        session.execute(text("UPDATE jobs SET run_after = now()"))
+        session.commit()
+    assert jobs.run_pending(SessionTesting) == 1
+
+    with SessionTesting() as session:
+        job = session.get(Job, job_id)
+        assert (job.status, job.attempts, job.last_error) == ("failed", 2, "ValueError: broken")
+        # The handler's writes rolled back with it
+        assert session.execute(text("SELECT count(*) FROM boot_state")).scalar() == 0
+
+
+def test_stale_running_jobs_are_requeued(SessionTesting):
+    job_id = _queue(SessionTesting, "record")
+    with SessionTesting() as session:
+        jobs.claim(session, "crashed")
+        session.execute(text("UPDATE jobs SET locked_at = now() - interval '1 day'"))
+        session.commit()
+        jobs.maintain(session)
+        job = session.get(Job, job_id)
+        assert (job.status, job.locked_by) == ("queued", None)
+
+
+# The workers' threads have connections of their own
+@pytest.mark.committed
+def test_worker_pool_runs_enqueued_jobs(SessionTesting, monkeypatch):
+    done = threading.Event()
+    monkeypatch.setitem(jobs.HANDLERS, "signal", lambda session, job: done.set())
+    pool = JobWorkerPool(SessionTesting, workers=2, poll_seconds=30)
+    pool.start()
+    try:
+        # The commit wakes the idle workers well before their next poll
+        _queue(SessionTesting, "signal")
+        assert done.wait(5)
+    finally:
+        pool.stop()
+
+
+def test_plan_pdf_job(test_client: TestClient, auth_headers, run_jobs, monkeypatch):
+    monkeypatch.setattr(plan_router, "create_pdf_in_memory", lambda plan: b"%PDF-1.4")
+
+    resp = test_client.post("/weekly-plan/pdf", headers=auth_headers)
+    assert resp.status_code == 202
+    job = resp.json()
+    assert resp.headers["location"] == f"/jobs/{job['id']}"
+    assert job["status"] == "queued"
+
+    pending = test_client.get(f"/jobs/{job['id']}/result", headers=auth_headers)
+    assert pending.status_code == 202
+
+    assert run_jobs() == 1
+    assert test_client.get(f"/jobs/{job['id']}", headers=auth_headers).json()["status"] == "succeeded"
+    result = test_client.get(f"/jobs/{job['id']}/result", headers=auth_headers)
+    assert result.status_code == 200
+    assert result.headers["content-type"] == "application/pdf"
+    assert 'filename="weekly_meal_plan.pdf"' in result.headers["content-disposition"]
+    assert result.content == b"%PDF-1.4"
+
+
+def test_jobs_are_private(test_client: TestClient, auth_headers):
+    job_id = test_client.post("/weekly-plan/pdf", headers=auth_headers).json()["id"]
+
+    test_client.post("/auth/signup", json={"email": "other@example.com", "password": "pass1234"})
+    token = test_client.post(
+        "/auth/login",
+        data={"username": "other@example.com", "password": "pass1234"},
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    ).json()["access_token"]
+    other = {"Authorization": f"Bearer {token}"}
+    assert test_client.get(f"/jobs/{job_id}", headers=other).status_code == 404
+    assert test_client.get(f"/jobs/{job_id}/result", headers=other).status_code == 404
+
@@ -0,0 +1,86 @@
+import logging
+import threading
+from typing import Iterator, List
+
+import pytest
+from fastapi.testclient import TestClient
+
+import logs
+from metrics import registry
+
+
+class Capture(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.records: List[logging.LogRecord] = []
+        self.threads = set()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.threads.add(threading.get_ident())
+        self.records.append(record)
+
+
+@pytest.fixture()
+def captured(monkeypatch) -> Iterator[Capture]:
+    """The `uvicorn` logger's records, written through the queue."""
+    capture = Capture()
+    uvicorn_logger = logging.getLogger("uvicorn")
+    monkeypatch.setattr(uvicorn_logger, "handlers", [capture])
+    monkeypatch.setattr(uvicorn_logger, "level", uvicorn_logger.level)
+    requests_logger = logging.getLogger("uvicorn.requests")
+    monkeypatch.setattr(requests_logger, "level", requests_logger.level)
+    monkeypatch.setattr(logs, "LOG_LEVELS", "uvicorn=DEBUG,uvicorn.requests=DEBUG")
+    registry.reset()
+    logs.start()
+    try:
+        yield capture
+    finally:
+        logs.stop()
+
+
+def test_levels_are_parsed_from_the_environment_format():
+    assert logs.parse_levels("uvicorn=warning, sqlalchemy.engine=INFO,bad=LOUD,,=DEBUG") == {
+        "uvicorn": logging.WARNING, "sqlalchemy.engine": logging.INFO}
+
+
+def test_debug_records_are_rate_limited_per_logger():
+    sampler = logs.DebugSampler(sample=1, per_second=3)
+    registry.reset()
+
+    def kept(name, level=logging.DEBUG):
+        return sampler.filter(logging.makeLogRecord({"name": name, "levelno": level}))
+
+    assert [kept("uvicorn") for _ in range(5)] == [True, True, True, False, False]
+    # Another logger has its own budget, other levels none
+    assert kept("uvicorn.requests") and kept("uvicorn", logging.INFO)
+    assert registry.value(logs.LOG_RECORDS_DROPPED, ["rate_limited"]) == 2
+    assert not logs.DebugSampler(sample=0).filter(logging.makeLogRecord({"levelno": logging.DEBUG}))
+
+
+def test_request_records_are_written_off_the_request_thread_with_their_context(
+        captured, test_client: TestClient, auth_headers):
+    resp = test_client.post("/ingredients", params={"name": "Leek", "shelf_life": 10, "serving_unit": "g"},
+                            headers=auth_headers)
+    assert resp.status_code == 201
+    me = test_client.get("/auth/me", headers=auth_headers).json()["id"]
+    logs.stop()
+
+    added = next(r for r in captured.records if r.getMessage() == "Adding new ingredient: Leek")
+    assert (added.method, added.route, added.user_id) == ("POST", "/ingredients", me)
+    summary = next(r for r in captured.records if r.name == "uvicorn.requests" and r.route == "/ingredients")
+    assert (summary.status, summary.user_id) == (201, me) and summary.db_statements > 0
+    assert threading.get_ident() not in captured.threads
+
+
+def test_arguments_that_may_change_are_formatted_by_the_caller(captured):
+    class Mutable:
+        name = "before"
+
+        def __str__(self):
+            return self.name
+
+    value = Mutable()
+    logging.getLogger("uvicorn").warning("%s and %d", value, 3)
+    value.name = "after"
+    logs.stop()
+    assert [r.getMessage() for r in captured.records] == ["before and 3"]
@@ -0,0 +1,80 @@
+import logging
+
+from fastapi.testclient import TestClient
+
+import metrics
+
+
+def _value(name, *labels):
+    return metrics.registry.value(name, labels) or 0
+
+
+def test_requests_are_labelled_by_route_template(test_client: TestClient, auth_headers):
+    before = _value(metrics.HTTP_REQUESTS, "GET", "/recipes/{recipe_id}", "404")
+    resp = test_client.get("/recipes/424242", headers=auth_headers)
+    assert resp.status_code == 404
+
+    assert _value(metrics.HTTP_REQUESTS, "GET", "/recipes/{recipe_id}", "404") == before + 1
+    latency = metrics.registry.value(metrics.HTTP_LATENCY, ["GET", "/recipes/{recipe_id}"])
+    assert latency[-1] >= 1
+
+
+def test_db_statements_and_rows_are_attributed_to_route(test_client: TestClient, auth_headers):
+    test_client.post("/ingredients", params={"name": "Salt", "shelf_life": 100, "serving_unit": "g"},
+                     headers=auth_headers)
+    statements_before = _value(metrics.DB_STATEMENTS, "GET", "/ingredients")
+    rows_before = _value(metrics.DB_ROWS, "GET", "/ingredients")
+
+    resp = test_client.get("/ingredients", headers=auth_headers)
+    assert resp.status_code == 200
+
+    # At least the user lookup and the ingredient listing
+    assert _value(metrics.DB_STATEMENTS, "GET", "/ingredients") >= statements_before + 2
+    assert _value(metrics.DB_ROWS, "GET", "/ingredients") >= rows_before + 2
+    assert _value(metrics.DB_SECONDS, "GET", "/ingredients") > 0
+
+
+def test_metrics_endpoint_serves_prometheus_text(test_client: TestClient):
+    test_client.get("/health/live")
+    resp = test_client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    body = resp.text
+    assert "# TYPE mealplanner_http_request_duration_seconds histogram" in body
+    assert 'mealplanner_http_requests_total{method="GET",route="/health/live",status="200"}' in body
+    assert 'route="/health/live",le="+Inf"}' in body
+
+
+def test_metrics_token_is_required_when_set(monkeypatch, test_client: TestClient):
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "scrape-secret")
+    assert test_client.get("/metrics").status_code == 401
+    assert test_client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert test_client.get("/metrics", headers={"Authorization": "Bearer scrape-secret"}).status_code == 200
+
+
+def test_unmatched_paths_share_one_label(test_client: TestClient):
+    test_client.get("/no/such/path/1")
+    test_client.get("/no/such/path/2")
+    assert _value(metrics.HTTP_REQUESTS, "GET", metrics.UNMATCHED_ROUTE, "404") >= 2
+
+
+def test_slow_queries_are_logged(test_client: TestClient, auth_headers, monkeypatch, caplog):
+    monkeypatch.setattr(metrics, "SLOW_QUERY_MS", 0)
+    with caplog.at_level(logging.WARNING, logger="uvicorn"):
+        test_client.get("/recipes", headers=auth_headers)
+    assert any("Slow query" in r.getMessage() and "/recipes" in r.getMessage() for r in caplog.records)
+
+
+def test_registry_merges_worker_snapshots():
+    registry = metrics.MetricsRegistry()
+    registry.counter("c_total", "help", ["route"])
+    registry.histogram("h_seconds", "help", ["route"], (0.1, 1.0))
+    registry.inc("c_total", ["/a"], 2)
+    registry.observe("h_seconds", ["/a"], 0.05)
+    registry.observe("h_seconds", ["/a"], 0.5)
+
+    body = registry.render([registry.snapshot(), registry.snapshot()])
+    assert 'c_total{route="/a"} 4' in body
+    assert 'h_seconds_bucket{route="/a",le="0.1"} 2' in body
+    assert 'h_seconds_bucket{route="/a",le="1"} 4' in body
+    assert 'h_seconds_count{route="/a"} 4' in body
@@ -0,0 +1,85 @@
+import pytest
+from sqlalchemy import text
+
+import migrations
+from migrations import Migration, Step, run_migrations
+
+
+@pytest.fixture()
+def scratch_table(engine):
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS migration_scratch"))
+        conn.execute(text("CREATE TABLE migration_scratch (id serial PRIMARY KEY, owner int, label text)"))
+        conn.execute(text("INSERT INTO migration_scratch (owner, label) VALUES (1, 'a'), (2, 'b')"))
+    yield "migration_scratch"
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS migration_scratch"))
+
+
+def test_builtin_migrations_apply_on_fresh_schema_and_are_recorded(engine):
+    applied = run_migrations(engine)
+    assert applied == [m.version for m in migrations.MIGRATIONS]
+    # Second boot has nothing left to do
+    assert run_migrations(engine) == []
+
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT version, duration_ms FROM schema_migrations ORDER BY version")).all()
+    assert [r.version for r in rows] == applied
+    assert all(r.duration_ms is not None for r in rows)
+
+
+def test_online_migration_builds_index_and_constraints(engine, scratch_table):
+    migration = Migration(9001, "scratch_online", [
+        Step(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_scratch_owner ON {scratch_table} (owner)",
+             index="ix_scratch_owner"),
+        *migrations._unique_via_index(scratch_table, "uniq_scratch_owner_label", "owner, label"),
+        *migrations._check_not_valid(scratch_table, "ck_scratch_owner", "owner > 0"),
+    ])
+    assert migration.online
+    assert run_migrations(engine, [migration]) == [9001]
+
+    with engine.connect() as conn:
+        constraints = dict(conn.execute(text("""
+            SELECT conname, convalidated FROM pg_constraint
+            WHERE conrelid = 'migration_scratch'::regclass AND contype IN ('u', 'c')
+        """)).all())
+        index = conn.execute(text("SELECT 1 FROM pg_indexes WHERE indexname = 'ix_scratch_owner'")).first()
+    assert constraints == {"uniq_scratch_owner_label": True, "ck_scratch_owner": True}
+    assert index is not None
+
+
+def test_failed_concurrent_build_leaves_no_invalid_index(engine, scratch_table):
+    with engine.begin() as conn:
+        conn.execute(text(f"INSERT INTO {scratch_table} (owner, label) VALUES (1, 'a')"))
+    migration = Migration(9002, "scratch_duplicate", [
+        Step(f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uniq_scratch_dup ON {scratch_table} (owner, label)",
+             index="uniq_scratch_dup"),
+    ])
+    with pytest.raises(migrations.MigrationError):
+        run_migrations(engine, [migration])
+
+    # Fix the data; the retry drops the INVALID index left behind and rebuilds it
+    with engine.begin() as conn:
+        conn.execute(text(f"DELETE FROM {scratch_table} WHERE id = 3"))
+    assert run_migrations(engine, [migration]) == [9002]
+    with engine.connect() as conn:
+        valid = conn.execute(text("""
+            SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = 'uniq_scratch_dup'
+        """)).scalar()
+    assert valid is True
+
+
+def test_lock_timeout_is_retried(engine, scratch_table, monkeypatch):
+    monkeypatch.setattr(migrations, "LOCK_TIMEOUT_MS", 50)
+    monkeypatch.setattr(migrations, "LOCK_RETRIES", 2)
+    migration = Migration(9003, "scratch_locked", [Step(f"ALTER TABLE {scratch_table} ADD COLUMN note text")])
+
+    with engine.connect() as blocker:
+        blocker.begin()
+        blocker.execute(text(f"LOCK TABLE {scratch_table} IN ACCESS EXCLUSIVE MODE"))
+        with pytest.raises(migrations.MigrationError):
+            run_migrations(engine, [migration])
+        blocker.rollback()
+
+    assert run_migrations(engine, [migration]) == [9003]
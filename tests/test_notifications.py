@@ -0,0 +1,124 @@
+import json
+
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+import notifications
+from models import Job
+
+
+def _stock(engine, test_client, auth_headers, name, shelf_life, days_ago):
+    ingredient_id = test_client.post("/ingredients", params={"name": name, "shelf_life": shelf_life,
+                                                             "serving_unit": "g"}, headers=auth_headers).json()["id"]
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE ingredients SET available = true, last_available = "
+                          "timezone('UTC', now()) - make_interval(days => :d) WHERE id = :id"),
+                     {"d": days_ago, "id": ingredient_id})
+    return ingredient_id
+
+
+def _notify(db_session):
+    notifications.notify_expiring_ingredients(db_session)
+    db_session.commit()
+
+
+def _inbox(test_client, auth_headers):
+    resp = test_client.get("/notifications", headers=auth_headers)
+    assert resp.status_code == 200
+    return resp.json()
+
+
+def test_expiring_ingredients_are_notified_once_in_a_digest(engine, db_session, test_client: TestClient,
+                                                             auth_headers):
+    milk = _stock(engine, test_client, auth_headers, "Milk", shelf_life=3, days_ago=5)
+    spinach = _stock(engine, test_client, auth_headers, "Spinach", shelf_life=4, days_ago=4)
+    _stock(engine, test_client, auth_headers, "Rice", shelf_life=300, days_ago=5)
+    # Not in stock: nothing to expire
+    test_client.post("/ingredients", params={"name": "Cream", "shelf_life": 1, "serving_unit": "g"},
+                     headers=auth_headers)
+
+    _notify(db_session)
+    inbox = _inbox(test_client, auth_headers)
+    assert [n["kind"] for n in inbox] == ["expiry_digest"]
+    assert [(i["id"], i["name"]) for i in inbox[0]["payload"]["items"]] == [(milk, "Milk"), (spinach, "Spinach")]
+
+    # Told once
+    _notify(db_session)
+    assert len(_inbox(test_client, auth_headers)) == 1
+
+    # Restocked: expires again later
+    test_client.put(f"/ingredients/{milk}", params={"available": True}, headers=auth_headers)
+    _notify(db_session)
+    assert len(_inbox(test_client, auth_headers)) == 1
+    test_client.put(f"/ingredients/{milk}", params={"shelf_life": 0}, headers=auth_headers)
+    _notify(db_session)
+    inbox = _inbox(test_client, auth_headers)
+    assert [[i["name"] for i in n["payload"]["items"]] for n in inbox] == [["Milk"], ["Milk", "Spinach"]]
+
+    resp = test_client.put(f"/notifications/{inbox[0]['id']}/read", headers=auth_headers)
+    assert resp.status_code == 200 and resp.json()["read_at"]
+    unread = test_client.get("/notifications", params={"unread": True}, headers=auth_headers).json()
+    assert [n["id"] for n in unread] == [inbox[1]["id"]]
+
+
+def test_digests_are_per_user(engine, db_session, test_client: TestClient, auth_headers):
+    _stock(engine, test_client, auth_headers, "Milk", shelf_life=1, days_ago=2)
+    test_client.post("/auth/signup", json={"email": "other@example.com", "password": "pass1234"})
+    token = test_client.post(
+        "/auth/login",
+        data={"username": "other@example.com", "password": "pass1234"},
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    ).json()["access_token"]
+    other = {"Authorization": f"Bearer {token}"}
+    _stock(engine, test_client, other, "Yoghurt", shelf_life=1, days_ago=2)
+    _stock(engine, test_client, other, "Bread", shelf_life=2, days_ago=2)
+
+    _notify(db_session)
+    assert [[i["name"] for i in n["payload"]["items"]] for n in _inbox(test_client, auth_headers)] == [["Milk"]]
+    mine = _inbox(test_client, auth_headers)[0]["id"]
+    assert [[i["name"] for i in n["payload"]["items"]] for n in _inbox(test_client, other)] == [
+        ["Yoghurt", "Bread"]]
+    assert test_client.put(f"/notifications/{mine}/read", headers=other).status_code == 404
+
+
+def test_the_scan_reads_only_due_rows_through_the_index(engine):
+    with engine.connect() as conn:
+        conn.exec_driver_sql("SET enable_seqscan = off")
+        plan = conn.execute(text(f"""
+            EXPLAIN (FORMAT JSON)
+            SELECT id FROM ingredients
+            WHERE {notifications.EXPIRY_DUE_CONDITION} AND {notifications.INGREDIENT_EXPIRES_AT} <= now()
+            ORDER BY {notifications.INGREDIENT_EXPIRES_AT} LIMIT 100
+        """)).scalar()
+    assert "ix_ingredients_expiry_due" in json.dumps(plan)
+
+
+def test_webhook_sink_delivers_through_a_job(engine, db_session, test_client: TestClient, auth_headers,
+                                            run_jobs, monkeypatch):
+    monkeypatch.setattr(notifications, "NOTIFICATION_SINKS", ["log", "webhook"])
+    monkeypatch.setattr(notifications, "WEBHOOK_URL", "http://hooks.example/expiry")
+    posted = []
+
+    class Response:
+        status = 204
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    def urlopen(request, timeout):
+        posted.append((request.full_url, json.loads(request.data)))
+        return Response()
+
+    monkeypatch.setattr(notifications.urllib.request, "urlopen", urlopen)
+    _stock(engine, test_client, auth_headers, "Milk", shelf_life=1, days_ago=2)
+
+    _notify(db_session)
+    # Not stored in the inbox, which is not among the sinks
+    assert _inbox(test_client, auth_headers) == []
+    assert run_jobs() == 1
+    assert [(url, body["email"], [i["name"] for i in body["items"]]) for url, body in posted] == [
+        ("http://hooks.example/expiry", "user@example.com", ["Milk"])]
+    assert db_session.query(Job.status).filter(Job.kind == "notification_webhook").scalar() == "succeeded"
@@ -0,0 +1,83 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+
+from models import Ingredient
+from nutrients import NUTRIENTS, IngredientIndex, recipe_nutrients
+
+
+def _ingredient_index(db: Session, owner_id: int) -> IngredientIndex:
+    """The ingredients a recipe of `owner_id` can use: theirs and the global ones."""
+    columns = ["id", "user_id", "name", "serving_unit", "serving_size", "density_g_per_ml",
+               "grams_per_piece"] + NUTRIENTS
+    rows = db.query(*(getattr(Ingredient, c) for c in columns)).filter(
+        (Ingredient.user_id == owner_id) | Ingredient.user_id.is_(None)).all()
+    return IngredientIndex(row._asdict() for row in rows)
+
+
+def _add_ingredients(test_client: TestClient, auth_headers, *ingredients) -> dict:
+    ids = {}
+    for name, unit, params in ingredients:
+        ingredient = test_client.post("/ingredients", params={"name": name, "shelf_life": 10, "serving_unit": unit},
+                                      headers=auth_headers).json()
+        test_client.put(f"/ingredients/{ingredient['id']}", params=params, headers=auth_headers)
+        ids[name] = ingredient["id"]
+    return ids
+
+
+def _add_recipe(test_client: TestClient, auth_headers, items) -> dict:
+    return test_client.post("/recipes", json={
+        "name": "Omelette", "serves": 1, "instructions": "Whisk", "meal_type": "breakfast", "is_vegetarian": True,
+        "ingredients": items,
+    }, headers=auth_headers).json()
+
+
+def test_python_nutrients_match_the_recipe_trigger(test_client: TestClient, db_session: Session, auth_headers):
+    _add_ingredients(
+        test_client, auth_headers,
+        ("Olive oil", "g", {"energy": 884, "fat": 100, "density_g_per_ml": 0.92}),
+        ("Egg", "g", {"energy": 143, "protein": 12.6, "grams_per_piece": 50}),
+        ("Milk", "ml", {"energy": 64, "calcium_mg": 120, "serving_size": 250}),
+    )
+    items = [
+        {"name": "Olive oil", "quantity": 2, "serving_unit": "tbsp"},
+        {"name": "Egg", "quantity": 3, "serving_unit": "nos"},
+        # Not convertible without a density: counted as written
+        {"name": "Milk", "quantity": 100, "serving_unit": "g"},
+        {"name": "Unknown", "quantity": 1, "serving_unit": "g"},
+    ]
+    recipe = _add_recipe(test_client, auth_headers, items)
+
+    user_id = test_client.get("/auth/me", headers=auth_headers).json()["id"]
+    computed = recipe_nutrients(items, _ingredient_index(db_session, user_id), user_id)
+    # The recipe API returns the macronutrients
+    assert {n: recipe[n] for n in NUTRIENTS if n in recipe} == pytest.approx(
+        {n: computed[n] for n in NUTRIENTS if n in recipe}, abs=0.01)
+    assert computed["energy"] == pytest.approx(884 * 27.6 / 100 + 143 * 150 / 100 + 64 * 100 / 250, abs=0.01)
+
+
+def test_items_resolve_by_id_then_by_name_ignoring_case(test_client: TestClient, db_session: Session,
+                                                          auth_headers):
+    ids = _add_ingredients(
+        test_client, auth_headers,
+        ("Butter", "g", {"energy": 717, "fat": 81}),
+        ("Egg", "g", {"energy": 143, "protein": 12.6}),
+    )
+    user_id = test_client.get("/auth/me", headers=auth_headers).json()["id"]
+    ingredients = _ingredient_index(db_session, user_id)
+    items = [
+        # Found by its id, whatever it is called
+        {"id": ids["Egg"], "name": "Eggs, as they were called", "quantity": 100, "serving_unit": "g"},
+        {"name": "bUTTER", "quantity": 10, "serving_unit": "g"},
+    ]
+    recipe = _add_recipe(test_client, auth_headers, items)
+
+    assert [ingredients.resolve(i, user_id)["id"] for i in items] == [ids["Egg"], ids["Butter"]]
+    computed = recipe_nutrients(items, ingredients, user_id)
+    assert computed["energy"] == pytest.approx(143 + 71.7) == pytest.approx(recipe["energy"])
+    assert computed["fat"] == pytest.approx(recipe["fat"]) and computed["protein"] == pytest.approx(recipe["protein"])
+    # An item with only an id counts the same
+    id_only = [{"id": ids["Egg"], "quantity": 100, "serving_unit": "g"}]
+    assert recipe_nutrients(id_only, ingredients, user_id)["energy"] == pytest.approx(143)
+    # Another user's recipe cannot use these ingredients, by id or by name
+    assert recipe_nutrients(items, ingredients, user_id + 1000)["energy"] == 0
@@ -0,0 +1,191 @@
+import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+import migrations
+import partitions
+from migrations import Migration, run_migrations
+
+TODAY = datetime.date.today()
+MONDAY = TODAY - datetime.timedelta(days=TODAY.weekday())
+
+
+def _recipe(test_client, auth_headers, name="Salad"):
+    return test_client.post("/recipes", json={
+        "name": name, "serves": 1, "instructions": "Chop", "meal_type": "lunch", "is_vegetarian": True,
+        "ingredients": [],
+    }, headers=auth_headers).json()["id"]
+
+
+def _plan(test_client, auth_headers, day, recipe_ids, week_of=None):
+    slot = {"day": day, "meal_type": "lunch", "recipe_ids": recipe_ids}
+    if week_of is not None:
+        slot["week_of"] = week_of.isoformat()
+    resp = test_client.put("/weekly-plan", json=slot, headers=auth_headers)
+    assert resp.status_code == 201, resp.text
+    return resp
+
+
+def test_past_weeks_are_kept_apart_from_the_current_week(test_client: TestClient, auth_headers):
+    recipe_id = _recipe(test_client, auth_headers)
+    # Within the months kept partitioned behind
+    last_year = MONDAY - datetime.timedelta(weeks=40)
+    _plan(test_client, auth_headers, "Tuesday", [recipe_id], week_of=last_year + datetime.timedelta(days=3))
+    _plan(test_client, auth_headers, "Monday", [])
+
+    current = test_client.get("/weekly-plan", headers=auth_headers).json()
+    assert current["Tuesday"]["lunch"] == []
+    past = test_client.get("/weekly-plan", params={"week_of": last_year.isoformat()}, headers=auth_headers).json()
+    assert past["Tuesday"]["lunch"] == [recipe_id]
+
+    entries = test_client.get("/weekly-plan/entries", params={
+        "start": last_year.isoformat(), "end": TODAY.isoformat()}, headers=auth_headers).json()
+    assert entries == [
+        {"plan_date": (last_year + datetime.timedelta(days=1)).isoformat(), "day": "Tuesday",
+         "meal_type": "lunch", "recipe_ids": [recipe_id]},
+        {"plan_date": MONDAY.isoformat(), "day": "Monday", "meal_type": "lunch", "recipe_ids": []},
+    ]
+
+
+def test_history_ranges_are_bounded(test_client: TestClient, auth_headers):
+    resp = test_client.get("/weekly-plan/entries", params={
+        "start": (TODAY - datetime.timedelta(days=800)).isoformat(), "end": TODAY.isoformat()}, headers=auth_headers)
+    assert resp.status_code == 400
+    resp = test_client.get("/weekly-plan/entries", params={
+        "start": TODAY.isoformat(), "end": (TODAY - datetime.timedelta(days=1)).isoformat()}, headers=auth_headers)
+    assert resp.status_code == 400
+
+
+def test_copy_last_week_fills_only_empty_slots(test_client: TestClient, auth_headers):
+    salad = _recipe(test_client, auth_headers, "Salad")
+    soup = _recipe(test_client, auth_headers, "Soup")
+    gone = _recipe(test_client, auth_headers, "Gone")
+    last_week = MONDAY - datetime.timedelta(weeks=1)
+    _plan(test_client, auth_headers, "Monday", [salad], week_of=last_week)
+    _plan(test_client, auth_headers, "Tuesday", [salad, gone], week_of=last_week)
+    _plan(test_client, auth_headers, "Wednesday", [salad], week_of=last_week)
+    # Already planned this week
+    _plan(test_client, auth_headers, "Monday", [soup])
+    # Planned but emptied again
+    _plan(test_client, auth_headers, "Wednesday", [])
+    test_client.delete(f"/recipes/{gone}", headers=auth_headers)
+
+    resp = test_client.post("/weekly-plan/copy", headers=auth_headers)
+    assert resp.status_code == 200
+    assert resp.json() == {"copied": 2, "from_week": last_week.isoformat(), "to_week": MONDAY.isoformat()}
+
+    plan = test_client.get("/weekly-plan", headers=auth_headers).json()
+    assert plan["Monday"]["lunch"] == [soup]
+    assert plan["Tuesday"]["lunch"] == [salad]
+    assert plan["Wednesday"]["lunch"] == [salad]
+
+    resp = test_client.post("/weekly-plan/copy", params={"from_week": TODAY.isoformat()}, headers=auth_headers)
+    assert resp.status_code == 400
+
+
+def test_weeks_without_a_partition_are_rejected_without_ddl(test_client: TestClient, auth_headers, db_session):
+    salad = _recipe(test_client, auth_headers)
+    before = partitions.list_partitions(db_session.connection())
+    far = MONDAY + datetime.timedelta(days=366 * 3)
+    resp = test_client.put("/weekly-plan", json={"day": "Monday", "meal_type": "lunch", "recipe_ids": [salad],
+                                                 "week_of": far.isoformat()}, headers=auth_headers)
+    assert resp.status_code == 400
+    resp = test_client.post("/weekly-plan/copy", params={"to_week": far.isoformat()}, headers=auth_headers)
+    assert resp.status_code == 400
+    assert partitions.list_partitions(db_session.connection()) == before
+
+
+def test_copy_leaves_out_other_users_recipes(test_client: TestClient, auth_headers, db_session):
+    salad = _recipe(test_client, auth_headers)
+    last_week = MONDAY - datetime.timedelta(weeks=1)
+    test_client.post("/auth/signup", json={"email": "other@example.com", "password": "pass1234"})
+    other = db_session.execute(text("SELECT id FROM users WHERE email = 'other@example.com'")).scalar()
+    theirs = db_session.execute(text("""
+        INSERT INTO recipes (user_id, name, serves, ingredients, instructions, meal_type, is_vegetarian)
+        VALUES (:user_id, 'Theirs', 1, '[]', 'Stir', 'lunch', true) RETURNING id
+    """), {"user_id": other}).scalar()
+    me = test_client.get("/auth/me", headers=auth_headers).json()["id"]
+    # Planned around the API, which checks ownership on write
+    db_session.execute(text("""
+        INSERT INTO plan_entries (user_id, plan_date, meal_type, recipe_ids)
+        VALUES (:me, :monday, 'lunch', ARRAY[:salad, :theirs]), (:me, CAST(:monday AS date) + 1, 'lunch', ARRAY[:theirs])
+    """), {"me": me, "monday": last_week, "salad": salad, "theirs": theirs})
+    db_session.commit()
+
+    assert test_client.post("/weekly-plan/copy", headers=auth_headers).json()["copied"] == 1
+    plan = test_client.get("/weekly-plan", headers=auth_headers).json()
+    assert plan["Monday"]["lunch"] == [salad]
+    assert plan["Tuesday"]["lunch"] == []
+
+
+def test_partitions_are_created_ahead_and_pruned(engine, monkeypatch):
+    monkeypatch.setattr(partitions, "PARTITIONS_BEHIND_MONTHS", 1)
+    # Long before any other test data, so pruning leaves the real months alone
+    today = datetime.date(2001, 6, 15)
+    with engine.begin() as conn:
+        created = partitions.ensure_current(conn, today=today)
+        assert created[:2] == ["plan_entries_2001_05", "plan_entries_2001_06"]
+        assert partitions.ensure_current(conn, today=today) == []
+        conn.execute(text("INSERT INTO users (id, email, password_hash) VALUES (9001, 'old@example.com', 'x')"))
+        conn.execute(text("""
+            INSERT INTO plan_entries (user_id, plan_date, meal_type, recipe_ids)
+            VALUES (9001, '2001-06-20', 'lunch', '{}'), (9001, '2001-08-02', 'lunch', '{}')
+        """))
+
+    try:
+        with engine.begin() as conn:
+            pruned = partitions.prune(conn, keep_months=1, today=datetime.date(2001, 8, 10))
+            assert pruned == ["plan_entries_2001_05", "plan_entries_2001_06"]
+            remaining = conn.execute(text("SELECT plan_date FROM plan_entries WHERE user_id = 9001")).scalars().all()
+            assert remaining == [datetime.date(2001, 8, 2)]
+            # Detached, not dropped: the rows are still there to archive
+            assert conn.execute(text("SELECT count(*) FROM plan_entries_2001_06")).scalar() == 1
+    finally:
+        with engine.begin() as conn:
+            for month in range(5, 10):
+                conn.execute(text(f"DROP TABLE IF EXISTS plan_entries_2001_{month:02d}"))
+
+
+@pytest.fixture()
+def legacy_weekly_plan(engine):
+    """The pre-partitioning schema: weekly_plan as a table of day-of-week slots."""
+    with engine.begin() as conn:
+        conn.execute(text("ALTER VIEW weekly_plan RENAME TO weekly_plan_current"))
+        conn.execute(text("""
+            CREATE TABLE weekly_plan (
+                id serial PRIMARY KEY, user_id int REFERENCES users (id), day varchar(16),
+                meal_type plan_meal_type_enum, recipe_ids int[]
+            )
+        """))
+    yield
+    with engine.begin() as conn:
+        conn.execute(text("DROP VIEW IF EXISTS weekly_plan"))
+        conn.execute(text("DROP TABLE IF EXISTS weekly_plan"))
+        conn.execute(text("ALTER VIEW weekly_plan_current RENAME TO weekly_plan"))
+
+
+def test_legacy_weekly_plan_moves_into_the_current_week(engine, test_client, auth_headers, legacy_weekly_plan):
+    with engine.begin() as conn:
+        user_id = conn.execute(text("SELECT id FROM users")).scalar()
+        conn.execute(text("INSERT INTO weekly_plan (user_id, day, meal_type, recipe_ids) "
+                          "VALUES (:u, 'Wednesday', 'dinner', '{}')"), {"u": user_id})
+
+    dated = next(m for m in migrations.MIGRATIONS if m.name == "dated_plan_entries")
+    legacy = [m for m in migrations.MIGRATIONS if m.obsolete_when == migrations.WEEKLY_PLAN_IS_VIEW]
+    # The migrations of the old table still run on it; then it is replaced by the view
+    assert run_migrations(engine, [*legacy, dated]) == [*(m.version for m in legacy), dated.version]
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT duration_ms FROM schema_migrations WHERE version = :v"),
+                            {"v": legacy[0].version}).scalar() > 0
+        assert conn.execute(text(migrations.WEEKLY_PLAN_IS_VIEW)).first() is not None
+        rows = conn.execute(text("SELECT plan_date, meal_type FROM plan_entries")).all()
+    assert [(r.plan_date, r.meal_type) for r in rows] == [(MONDAY + datetime.timedelta(days=2), "dinner")]
+    assert test_client.get("/weekly-plan", headers=auth_headers).json()["Wednesday"]["dinner"] == []
+
+
+def test_obsolete_migrations_are_recorded_without_running(engine):
+    migration = Migration(9010, "needs_old_table", [migrations.Step("SELECT * FROM no_such_table")],
+                          obsolete_when="SELECT 1")
+    assert run_migrations(engine, [migration]) == [9010]
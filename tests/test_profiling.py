@@ -0,0 +1,109 @@
+import re
+import time
+from typing import Dict, Iterator
+
+import pytest
+from fastapi.testclient import TestClient
+
+import profiling
+from routers import auth_router, utilities_router
+
+
+@pytest.fixture()
+def profiles(monkeypatch) -> Iterator[None]:
+    monkeypatch.setattr(auth_router, "ADMIN_EMAILS", {"user@example.com"})
+    monkeypatch.setattr(profiling, "PROFILE_INTERVAL_MS", 1.0)
+    profiling.clear()
+    try:
+        yield
+    finally:
+        profiling.clear()
+
+
+def _other_user(test_client) -> Dict[str, str]:
+    test_client.post("/auth/signup", json={"email": "other@example.com", "password": "pass1234"})
+    token = test_client.post(
+        "/auth/login", data={"username": "other@example.com", "password": "pass1234"},
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    ).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_admins_profile_a_request_and_read_its_flame_graph(profiles, monkeypatch, test_client: TestClient,
+                                                           auth_headers):
+    coalesced = utilities_router.coalesced
+
+    def slow_coalesced(*args):
+        time.sleep(0.05)
+        return coalesced(*args)
+
+    monkeypatch.setattr(utilities_router, "coalesced", slow_coalesced)
+    resp = test_client.get("/utilities/shopping-list", headers={**auth_headers, "X-MealPlanner-Profile": "1"})
+    assert resp.status_code == 200
+    profile_id = resp.headers["X-MealPlanner-Profile-Id"]
+
+    listed = test_client.get("/admin/profiles", headers=auth_headers).json()
+    assert [(p["id"], p["trigger"], p["route"], p["status"]) for p in listed] == [
+        (profile_id, "header", "/utilities/shopping-list", 200)]
+    assert listed[0]["duration_ms"] >= 50 and listed[0]["samples"] > 0
+
+    profile = test_client.get(f"/admin/profiles/{profile_id}", headers=auth_headers).json()
+    assert any("weekly_plan" in s["statement"] for s in profile["statements"])
+    assert listed[0]["statement_count"] == len(profile["statements"])
+    # Sampled in the threadpool thread running the sync endpoint
+    assert any("get_shopping_list (utilities_router.py" in stack and "slow_coalesced" in stack
+               for stack in profile["stacks"])
+
+    collapsed = test_client.get(f"/admin/profiles/{profile_id}/collapsed", headers=auth_headers)
+    assert collapsed.headers["content-type"].startswith("text/plain")
+    lines = collapsed.text.splitlines()
+    assert lines and all(re.fullmatch(r"[^;]+(;[^;]+)* \d+", line) for line in lines)
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) == profile["samples"]
+
+
+def test_only_admins_get_profiles(profiles, test_client: TestClient, auth_headers):
+    other = _other_user(test_client)
+    resp = test_client.get("/utilities/shopping-list", headers={**other, "X-MealPlanner-Profile": "1"})
+    assert resp.status_code == 200 and "X-MealPlanner-Profile-Id" not in resp.headers
+    assert test_client.get("/admin/profiles", headers=other).status_code == 403
+    assert test_client.get("/admin/profiles", headers=auth_headers).json() == []
+    assert test_client.get("/admin/profiles/1-1/collapsed", headers=auth_headers).status_code == 404
+
+
+def test_header_requests_are_sampled_only_once_an_admin_is_known(profiles, monkeypatch, test_client: TestClient,
+                                                                  auth_headers):
+    started = []
+    monkeypatch.setattr(profiling._sampler, "add", started.append)
+    monkeypatch.setattr(profiling._sampler, "remove", lambda running: None)
+    requests = []
+    running_class = profiling._Running
+
+    def running(*args):
+        requests.append(running_class(*args))
+        return requests[-1]
+
+    monkeypatch.setattr(profiling, "_Running", running)
+    other = _other_user(test_client)
+    # Unauthenticated, a bad token, and a user who is no admin
+    for headers in ({}, {"Authorization": "Bearer nonsense"}, other):
+        resp = test_client.get("/utilities/shopping-list", headers={**headers, "X-MealPlanner-Profile": "1"})
+        assert "X-MealPlanner-Profile-Id" not in resp.headers
+    assert started == []
+    assert [(r.active, r.profile.statements) for r in requests] == [(False, [])] * 3
+
+    resp = test_client.get("/utilities/shopping-list", headers={**auth_headers, "X-MealPlanner-Profile": "1"})
+    assert started == requests[3:] and started[0].profile.id == resp.headers["X-MealPlanner-Profile-Id"]
+    assert started[0].profile.statements
+
+
+def test_sampled_requests_are_kept_in_a_bounded_buffer(profiles, monkeypatch, test_client: TestClient,
+                                                       auth_headers):
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE", 1.0)
+    monkeypatch.setattr(profiling, "_profiles", profiling.collections.deque(maxlen=2))
+    for _ in range(3):
+        assert test_client.get("/health").status_code == 200
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE", 0.0)
+
+    listed = test_client.get("/admin/profiles", headers=auth_headers).json()
+    assert [(p["trigger"], p["route"], p["user_id"]) for p in listed] == [("sampled", "/health", None)] * 2
+    assert listed[0]["started_at"] > listed[1]["started_at"]
@@ -0,0 +1,238 @@
+"""
+Per-endpoint SQL budgets: statements issued, rows fetched, and tables that must
+be reached through an index. The data set gives the requesting user, another
+user and the global catalog a few dozen rows each, so an endpoint that loads
+more than it serves (or issues a statement per row) goes over its budget.
+"""
+import pytest
+from fastapi.testclient import TestClient
+
+import datetime
+
+from catalog import global_catalog
+from models import Ingredient, PlanEntry, Recipe, User
+import partitions
+from query_budget import Budget
+
+# Budgets count the statements of real transactions, and the scan check plans them on another connection.
+# Transactions elsewhere would hold back the catalog's snapshot and make it reload
+pytestmark = [pytest.mark.committed, pytest.mark.serial]
+
+RECIPES = 40
+GLOBAL_RECIPES = 10
+INGREDIENTS = 40
+INGREDIENTS_PER_RECIPE = 3
+PLANNED_DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+RECIPES_PER_SLOT = 2
+
+INDEXED = ("users", "recipes", "ingredients", "plan_entries", "nutrition_daily", "nutrition_weekly", "sync_tombstones")
+
+# One row for the authenticated user on every endpoint
+USER = 1
+# Writes send their change events in one SELECT pg_notify(...) before committing
+NOTIFY = 1
+PLAN_ROWS = len(PLANNED_DAYS) * 2
+
+
+def _recipe(user_id, i, name_prefix="Recipe"):
+    return Recipe(
+        user_id=user_id,
+        name=f"{name_prefix} {i:03d}",
+        serves=2,
+        ingredients=[
+            {"name": f"ingredient-{(i + k) % INGREDIENTS}", "quantity": 100, "serving_unit": "g"}
+            for k in range(INGREDIENTS_PER_RECIPE)
+        ],
+        instructions="Cook",
+        meal_type="lunch" if i % 2 else "dinner",
+        is_vegetarian=True,
+    )
+
+
+def _ingredient(user_id, name):
+    return Ingredient(user_id=user_id, name=name, shelf_life=7, serving_unit="g", serving_size=100,
+                      available=name.endswith("0"))
+
+
+@pytest.fixture()
+def budget_data(test_client: TestClient, auth_headers, db_session, monkeypatch):
+    test_client.post("/auth/signup", json={"email": "other@example.com", "password": "pass1234"})
+    user = db_session.query(User).filter(User.email == "user@example.com").one()
+    other = db_session.query(User).filter(User.email == "other@example.com").one()
+
+    for owner in (user, other):
+        db_session.add_all(_ingredient(owner.id, f"ingredient-{i}") for i in range(INGREDIENTS))
+    db_session.add(_ingredient(user.id, "unused"))
+    db_session.flush()
+    for owner in (user, other):
+        db_session.add_all(_recipe(owner.id, i) for i in range(RECIPES))
+    db_session.add_all(_recipe(None, i, "Global") for i in range(GLOBAL_RECIPES))
+    db_session.flush()
+
+    recipe_ids = [r.id for r in db_session.query(Recipe.id).filter(Recipe.user_id == user.id).order_by(Recipe.id)]
+    today = datetime.date.today()
+    monday = today - datetime.timedelta(days=today.weekday())
+    partitions.ensure_partitions(db_session.connection(), monday - datetime.timedelta(days=28), monday)
+    for d, day in enumerate(PLANNED_DAYS):
+        for m, meal_type in enumerate(["lunch", "dinner"]):
+            start = (d * 2 + m) * RECIPES_PER_SLOT
+            # The same week a month earlier, which must not be read
+            for plan_date in (monday + datetime.timedelta(days=d), monday - datetime.timedelta(days=28 - d)):
+                db_session.add(PlanEntry(user_id=user.id, plan_date=plan_date, meal_type=meal_type,
+                                         recipe_ids=recipe_ids[start:start + RECIPES_PER_SLOT]))
+    db_session.commit()
+
+    ingredients = {i.name: i.id for i in db_session.query(Ingredient).filter(Ingredient.user_id == user.id)}
+    # Budgets are for the steady state: the global catalog cached and not due for a check
+    monkeypatch.setattr(global_catalog, "check_seconds", 60)
+    global_catalog.get(db_session)
+    return {"headers": auth_headers, "recipe_ids": recipe_ids, "ingredients": ingredients}
+
+
+READ_BUDGETS = [
+    # The global recipes come from the catalog cache
+    ("/recipes", Budget(statements=2, rows=USER + RECIPES, no_seq_scan_on=INDEXED)),
+    ("/ingredients", Budget(statements=2, rows=USER + INGREDIENTS + 1, no_seq_scan_on=INDEXED)),
+    ("/weekly-plan", Budget(statements=2, rows=USER + PLAN_ROWS, no_seq_scan_on=INDEXED)),
+    ("/utilities/nutrition/Monday", Budget(statements=2, rows=USER + 1, no_seq_scan_on=INDEXED)),
+    # Only the list itself: the planned recipes use ingredient-0 to -29, of which -0, -10 and -20 are available
+    ("/utilities/shopping-list", Budget(
+        statements=2, rows=USER + PLAN_ROWS * RECIPES_PER_SLOT + INGREDIENTS_PER_RECIPE - 1 - 3,
+        no_seq_scan_on=INDEXED)),
+    ("/auth/me", Budget(statements=1, rows=USER, no_seq_scan_on=INDEXED)),
+    # The rollups of every window in one row, and this week's total (last week has no plan)
+    ("/analytics/nutrition/trends", Budget(statements=3, rows=USER + 1 + 1, no_seq_scan_on=INDEXED)),
+    # A first sync: the cursor, then everything the user sees (the plan from this week on)
+    ("/sync", Budget(statements=5, rows=USER + 1 + RECIPES + GLOBAL_RECIPES + INGREDIENTS + 1 + PLAN_ROWS,
+                     no_seq_scan_on=INDEXED)),
+]
+
+
+@pytest.mark.parametrize("path,budget", READ_BUDGETS, ids=[p for p, _ in READ_BUDGETS])
+def test_read_endpoint_budgets(test_client: TestClient, budget_data, query_recorder, path, budget):
+    with query_recorder.record():
+        resp = test_client.get(path, headers=budget_data["headers"])
+    assert resp.status_code == 200
+    query_recorder.check(budget, f"GET {path}")
+
+
+def test_get_recipe_budget(test_client: TestClient, budget_data, query_recorder):
+    recipe_id = budget_data["recipe_ids"][0]
+    with query_recorder.record():
+        resp = test_client.get(f"/recipes/{recipe_id}", headers=budget_data["headers"])
+    assert resp.status_code == 200
+    query_recorder.check(Budget(statements=2, rows=USER + 1, no_seq_scan_on=INDEXED), "GET /recipes/{recipe_id}")
+
+
+def test_weekly_plan_pdf_budget(test_client: TestClient, budget_data, query_recorder, monkeypatch):
+    # PDF rendering needs pdflatex; only the queries are under test here
+    import routers.plan_router as plan_router
+    monkeypatch.setattr(plan_router, "create_pdf_in_memory", lambda plan: b"%PDF")
+
+    with query_recorder.record():
+        resp = test_client.get("/weekly-plan/pdf", headers=budget_data["headers"])
+    assert resp.status_code == 200
+    planned = PLAN_ROWS * RECIPES_PER_SLOT
+    query_recorder.check(Budget(statements=3, rows=USER + PLAN_ROWS + planned, no_seq_scan_on=INDEXED),
+                         "GET /weekly-plan/pdf")
+
+
+def test_plan_history_budget(test_client: TestClient, budget_data, query_recorder):
+    today = datetime.date.today()
+    start = today - datetime.timedelta(days=today.weekday() + 28)
+    with query_recorder.record():
+        resp = test_client.get("/weekly-plan/entries", params={"start": start.isoformat(),
+                                                               "end": (start + datetime.timedelta(days=6)).isoformat()},
+                               headers=budget_data["headers"])
+    assert resp.status_code == 200
+    query_recorder.check(Budget(statements=2, rows=USER + PLAN_ROWS, no_seq_scan_on=INDEXED),
+                         "GET /weekly-plan/entries")
+
+
+def test_delta_sync_budget(test_client: TestClient, budget_data, query_recorder):
+    cursor = test_client.get("/sync", headers=budget_data["headers"]).json()["cursor"]
+    recipe_id = budget_data["recipe_ids"][0]
+    test_client.delete(f"/recipes/{recipe_id}", headers=budget_data["headers"])
+    with query_recorder.record():
+        resp = test_client.get("/sync", params={"since": cursor}, headers=budget_data["headers"])
+    assert resp.json()["deleted"]["recipes"] == [recipe_id]
+    # Nothing changed but the one tombstone: the unchanged rows are skipped by index
+    query_recorder.check(Budget(statements=6, rows=USER + 1 + 1, no_seq_scan_on=INDEXED), "GET /sync?since")
+
+
+def test_update_recipe_budget(test_client: TestClient, budget_data, query_recorder):
+    recipe_id = budget_data["recipe_ids"][0]
+    payload = {
+        "name": "Renamed", "serves": 2, "instructions": "Cook", "meal_type": "lunch", "is_vegetarian": True,
+        "ingredients": [{"name": "ingredient-1", "quantity": 50, "serving_unit": "g"}],
+    }
+    with query_recorder.record():
+        resp = test_client.put(f"/recipes/{recipe_id}", json=payload, headers=budget_data["headers"])
+    assert resp.status_code == 200
+    query_recorder.check(Budget(statements=4 + NOTIFY, rows=USER + 2 + NOTIFY, no_seq_scan_on=INDEXED),
+                         "PUT /recipes/{recipe_id}")
+
+
+def test_availability_update_does_not_touch_recipes(test_client: TestClient, budget_data, query_recorder):
+    ingredient_id = budget_data["ingredients"]["ingredient-1"]
+    with query_recorder.record():
+        resp = test_client.put(f"/ingredients/{ingredient_id}", params={"available": True},
+                               headers=budget_data["headers"])
+    assert resp.status_code == 200
+    query_recorder.check(Budget(statements=4 + NOTIFY, rows=USER + 2 + NOTIFY),
+                         "PUT /ingredients/{ingredient_id}?available")
+    assert not any("FROM recipes" in s.statement for s in query_recorder.statements)
+
+
+def test_rename_ingredient_budget(test_client: TestClient, budget_data, query_recorder, db_session):
+    ingredient_id = budget_data["ingredients"]["ingredient-5"]
+    with query_recorder.record():
+        resp = test_client.put(f"/ingredients/{ingredient_id}", params={"name": "ingredient-five"},
+                               headers=budget_data["headers"])
+    assert resp.status_code == 200
+    # Recipes refer to the ingredient by id: a rename updates the one row
+    query_recorder.check(Budget(statements=4 + NOTIFY, rows=USER + 2 + NOTIFY),
+                         "PUT /ingredients/{ingredient_id}?name")
+    assert not any("FROM recipes" in s.statement for s in query_recorder.statements)
+    renamed = db_session.query(Recipe).filter(Recipe.ingredients.contains([{"id": ingredient_id}])).all()
+    assert len(renamed) == INGREDIENTS_PER_RECIPE
+    assert all(any(i["name"] == "ingredient-five" for i in r.resolved_ingredients) for r in renamed)
+
+
+def test_ingredient_unit_change_budget(test_client: TestClient, budget_data, query_recorder):
+    ingredient_id = budget_data["ingredients"]["ingredient-5"]
+    with query_recorder.record():
+        resp = test_client.put(f"/ingredients/{ingredient_id}", params={"serving_unit": "nos"},
+                               headers=budget_data["headers"])
+    assert resp.status_code == 200
+    # Recipes keep their own units, and their nutrients are re-summed by a trigger: the request
+    # only looks up the INGREDIENTS_PER_RECIPE recipes using ingredient-5 to tell their clients
+    using = INGREDIENTS_PER_RECIPE
+    query_recorder.check(Budget(statements=5 + NOTIFY, rows=USER + 2 + using + NOTIFY, no_seq_scan_on=INDEXED),
+                         "PUT /ingredients/{ingredient_id}?serving_unit")
+
+def test_delete_ingredient_budget(test_client: TestClient, budget_data, query_recorder):
+    with query_recorder.record():
+        resp = test_client.delete(f"/ingredients/{budget_data['ingredients']['ingredient-7']}",
+                                  headers=budget_data["headers"])
+    assert resp.status_code == 405
+    # ingredient-7 is used by INGREDIENTS_PER_RECIPE of the user's recipes (the global ones use global ingredients)
+    using = INGREDIENTS_PER_RECIPE
+    query_recorder.check(Budget(statements=3, rows=USER + 1 + using, no_seq_scan_on=INDEXED),
+                         "DELETE /ingredients/{ingredient_id} (in use)")
+
+    with query_recorder.record():
+        resp = test_client.delete(f"/ingredients/{budget_data['ingredients']['unused']}",
+                                  headers=budget_data["headers"])
+    assert resp.status_code == 204
+    query_recorder.check(Budget(statements=4 + NOTIFY, rows=USER + 1 + NOTIFY, no_seq_scan_on=INDEXED),
+                         "DELETE /ingredients/{ingredient_id}")
+
+
+def test_budget_violation_is_reported(engine, query_recorder):
+    with query_recorder.record():
+        with engine.connect() as conn:
+            for _ in range(3):
+                conn.exec_driver_sql("SELECT name FROM recipes WHERE instructions = 'Cook'").all()
+    with pytest.raises(AssertionError, match="3 statements .budget 2.*sequential scan on recipes"):
+        query_recorder.check(Budget(statements=2, rows=10, no_seq_scan_on=("recipes",)), "example")
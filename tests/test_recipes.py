@@ -1,4 +1,5 @@
 from fastapi.testclient import TestClient
+from sqlalchemy import text
 
 
 def test_recipe_crud(test_client: TestClient, auth_headers):
@@ -90,3 +91,78 @@ def test_recipe_unauthorized(test_client: TestClient):
     assert resp.status_code == 401
 
 
+
+
+def test_text_edit_keeps_stored_nutrients(test_client: TestClient, auth_headers, engine):
+    test_client.post(
+        "/ingredients",
+        params={"name": "Tomato", "shelf_life": 5, "serving_unit": "g"},
+        headers=auth_headers,
+    )
+    recipe_payload = {
+        "name": "Tomato Salad",
+        "serves": 2,
+        "ingredients": [{"name": "Tomato", "quantity": 100, "serving_unit": "g"}],
+        "instructions": "Mix and serve",
+        "meal_type": "lunch",
+        "is_vegetarian": True,
+    }
+    recipe = test_client.post("/recipes", json=recipe_payload, headers=auth_headers).json()
+
+    # Marker value that only a nutrient recomputation would overwrite
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE recipes SET protein = 42 WHERE id = :id"), {"id": recipe["id"]})
+
+    resp = test_client.put(
+        f"/recipes/{recipe['id']}",
+        json=dict(recipe_payload, name="Tomato Salad 2", instructions="Toss"),
+        headers=auth_headers,
+    )
+    assert resp.status_code == 200
+    assert resp.json()["name"] == "Tomato Salad 2"
+    assert resp.json()["protein"] == 42
+
+    resp = test_client.put(
+        f"/recipes/{recipe['id']}",
+        json=dict(recipe_payload, ingredients=[{"name": "Tomato", "quantity": 200, "serving_unit": "g"}]),
+        headers=auth_headers,
+    )
+    assert resp.status_code == 200
+    assert resp.json()["protein"] == 0
+
+
+def test_recipes_refer_to_ingredients_by_id(test_client: TestClient, auth_headers, engine):
+    tomato = test_client.post(
+        "/ingredients",
+        params={"name": "Tomato", "shelf_life": 5, "serving_unit": "g"},
+        headers=auth_headers,
+    ).json()
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE ingredients SET protein = 1, serving_size = 100 WHERE id = :id"),
+                     {"id": tomato["id"]})
+    # Matched by name, ignoring case
+    recipe = test_client.post("/recipes", json={
+        "name": "Tomato Salad", "serves": 2, "instructions": "Mix", "meal_type": "lunch", "is_vegetarian": True,
+        "ingredients": [{"name": "tomato", "quantity": 300, "serving_unit": "g"},
+                        {"name": "Basil", "quantity": 5, "serving_unit": "g"}],
+    }, headers=auth_headers).json()
+    assert [(i["id"], i["name"]) for i in recipe["ingredients"]] == [(tomato["id"], "Tomato"), (None, "Basil")]
+    assert recipe["protein"] == 3
+
+    # A rename shows in the recipe, which still uses the ingredient
+    resp = test_client.put(f"/ingredients/{tomato['id']}", params={"name": "Plum tomato"}, headers=auth_headers)
+    assert resp.status_code == 200
+    recipe = test_client.get(f"/recipes/{recipe['id']}", headers=auth_headers).json()
+    assert recipe["ingredients"][0]["name"] == "Plum tomato"
+    resp = test_client.delete(f"/ingredients/{tomato['id']}", headers=auth_headers)
+    assert resp.status_code == 405
+    assert "Tomato Salad" in resp.json()["detail"]
+
+    # Resending the recipe as shown (without ids) changes nothing
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE recipes SET protein = 42"))
+    resp = test_client.put(f"/recipes/{recipe['id']}", json={
+        **{k: recipe[k] for k in ("name", "serves", "instructions", "meal_type", "is_vegetarian")},
+        "ingredients": [{k: i[k] for k in ("name", "quantity", "serving_unit")} for i in recipe["ingredients"]],
+    }, headers=auth_headers)
+    assert resp.json()["protein"] == 42
@@ -0,0 +1,75 @@
+from typing import Iterator
+
+import pytest
+from fastapi.testclient import TestClient
+
+import database
+from app import app
+from metrics import registry
+
+
+# The replica is read through an engine of its own, which only sees committed rows
+pytestmark = pytest.mark.committed
+
+
+@pytest.fixture()
+def replicated(monkeypatch, SessionTesting, test_database_url) -> Iterator[None]:
+    # The test database stands in for its own replica, through an engine of its own
+    monkeypatch.setattr(database, "SessionLocal", SessionTesting)
+    monkeypatch.setattr(database, "REPLICA_URLS", {0: [test_database_url]})
+    monkeypatch.setattr(database, "_replicas", {})
+    try:
+        yield
+    finally:
+        for factories in database._replicas.values():
+            for factory in factories:
+                factory.kw["bind"].dispose()
+
+
+def _reads(target):
+    return registry.value(database.DB_READS, [0, target]) or 0
+
+
+def _headers(client):
+    client.post("/auth/signup", json={"email": "user@example.com", "password": "pass1234"})
+    token = client.post("/auth/login", data={"username": "user@example.com", "password": "pass1234"},
+                        headers={"Content-Type": "application/x-www-form-urlencoded"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_reads_go_to_the_replica_once_it_has_the_clients_writes(replicated):
+    client = TestClient(app)
+    headers = _headers(client)
+    resp = client.post("/ingredients", params={"name": "Leek", "shelf_life": 10, "serving_unit": "g"},
+                       headers=headers)
+    assert resp.status_code == 201
+    lsn = resp.headers[database.READ_LSN_HEADER]
+    assert client.cookies[database.READ_LSN_COOKIE] == lsn
+
+    # The cookie comes back; the replica has replayed it, so it serves the read
+    replica = _reads("replica")
+    assert [i["name"] for i in client.get("/ingredients", headers=headers).json()] == ["Leek"]
+    assert _reads("replica") == replica + 1
+
+    # A replica behind the client's last write leaves its reads on the primary
+    pinned = _reads("primary_pinned")
+    resp = client.get("/ingredients", headers={**headers, database.READ_LSN_HEADER: "FFFFFFFF/FFFFFFFF"})
+    assert [i["name"] for i in resp.json()] == ["Leek"]
+    assert _reads("primary_pinned") == pinned + 1
+
+    # Coalesced reads are keyed by where they read (coalesce.py)
+    for min_lsn, target in ((lsn, "replica"), ("FFFFFFFF/FFFFFFFF", "primary")):
+        db = database.read_session(0, min_lsn)
+        try:
+            assert db.info["read_target"] == target
+        finally:
+            db.close()
+
+
+def test_reads_fall_back_to_the_primary_without_a_replica(replicated, monkeypatch):
+    monkeypatch.setattr(database, "REPLICA_URLS", {0: ["postgresql+psycopg2://nobody@127.0.0.1:1/none"]})
+    client = TestClient(app)
+    headers = _headers(client)
+    fallback = _reads("primary_fallback")
+    assert client.get("/ingredients", headers=headers).status_code == 200
+    assert _reads("primary_fallback") == fallback + 1
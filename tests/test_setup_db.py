@@ -0,0 +1,45 @@
+import os
+
+from sqlalchemy.orm import Session
+
+import setup_db
+from models import BootState, Ingredient, Recipe, PlanEntry, WeeklyPlan, User
+
+
+DATA_DIR = os.path.join(os.path.dirname(setup_db.__file__), "data")
+
+
+def _seed(session: Session):
+    return [
+        setup_db.load_data_from_csv(session, Ingredient, os.path.join(DATA_DIR, "ingredients.csv")),
+        setup_db.load_data_from_csv(session, Recipe, os.path.join(DATA_DIR, "recipes.csv")),
+        setup_db.load_data_from_csv(session, PlanEntry, os.path.join(DATA_DIR, "weekly_plan.csv")),
+    ]
+
+
+def test_seed_loads_once_then_skips(db_session: Session, monkeypatch):
+    db_session.add(User(email="demo@demo.com", password_hash="x"))
+    db_session.commit()
+    user_id = db_session.query(User.id).scalar()
+    monkeypatch.setattr(setup_db, "DEFAULT_USER_ID", user_id)
+
+    assert _seed(db_session) == [True, True, True]
+    db_session.commit()
+
+    ingredients = db_session.query(Ingredient).filter(Ingredient.user_id == user_id).count()
+    recipes = db_session.query(Recipe).filter(Recipe.user_id == user_id).count()
+    assert ingredients > 0 and recipes > 0
+    # Nutrients are still computed by the trigger for COPY-loaded rows
+    assert db_session.query(Recipe).filter(Recipe.energy > 0).count() > 0
+    assert db_session.query(BootState).filter(BootState.step.like("seed:%")).count() == 3
+    # The day-of-week seed plan lands in the current week
+    assert db_session.query(WeeklyPlan).filter(WeeklyPlan.user_id == user_id).count() == \
+        db_session.query(PlanEntry).filter(PlanEntry.user_id == user_id).count() > 0
+
+    # Unchanged files are skipped on the next boot
+    assert _seed(db_session) == [False, False, False]
+    assert db_session.query(Ingredient).filter(Ingredient.user_id == user_id).count() == ingredients
+
+
+def test_schema_fingerprint_is_stable():
+    assert setup_db.schema_fingerprint() == setup_db.schema_fingerprint()
@@ -0,0 +1,219 @@
+import datetime
+from typing import Dict, Iterator, List
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+
+import database
+import jobs
+import shards
+from app import app
+from conftest import _truncate_all_tables, server_share
+from database import Base, MAX_SHARDS
+from models import Ingredient, User
+
+# Requests route to engines of their own, which only see committed rows
+pytestmark = pytest.mark.committed
+
+MONDAY = datetime.date.today() - datetime.timedelta(days=datetime.date.today().weekday())
+
+
+@pytest.fixture(scope="module")
+def shard_urls(test_database_url, server_lock) -> Iterator[List[str]]:
+    # Two more databases on the test server stand in for two more Postgres instances
+    base = make_url(test_database_url)
+    admin = create_engine(base, isolation_level="AUTOCOMMIT")
+    names = [f"{base.database}_shard{shard}" for shard in (1, 2)]
+    urls = [base.set(database=name).render_as_string(hide_password=False) for name in names]
+    with server_share(server_lock):
+        with admin.connect() as conn:
+            for name in names:
+                conn.execute(text(f"DROP DATABASE IF EXISTS {name}"))
+                conn.execute(text(f"CREATE DATABASE {name}"))
+        for url in urls:
+            shard_engine = create_engine(url)
+            Base.metadata.create_all(bind=shard_engine)
+            shard_engine.dispose()
+    try:
+        yield urls
+    finally:
+        with server_share(server_lock), admin.connect() as conn:
+            for name in names:
+                conn.execute(text(f"DROP DATABASE IF EXISTS {name}"))
+        admin.dispose()
+
+
+@pytest.fixture()
+def sharded(monkeypatch, engine, SessionTesting, shard_urls) -> Iterator[None]:
+    # Shard 0 is the test database
+    monkeypatch.setattr(database, "SessionLocal", SessionTesting)
+    monkeypatch.setattr(database, "SHARD_URLS", shard_urls)
+    monkeypatch.setattr(database, "_shards", {})
+    for shard in (1, 2):
+        _truncate_all_tables(database.shard_engine(shard))
+    shards.align_sequences()
+    try:
+        yield
+    finally:
+        for factory in database._shards.values():
+            factory.kw["bind"].dispose()
+        # Back to the single database's ids
+        with engine.begin() as conn:
+            for table, column in shards.SHARDED_SEQUENCES:
+                sequence = conn.execute(text("SELECT pg_get_serial_sequence(:t, :c)"), {"t": table, "c": column}).scalar()
+                conn.execute(text(f"ALTER SEQUENCE {sequence} INCREMENT BY 1 START WITH 1 RESTART"))
+
+
+@pytest.fixture()
+def client(sharded) -> TestClient:
+    # No get_db override: the app routes each request itself
+    return TestClient(app)
+
+
+def _login(client, email) -> Dict[str, str]:
+    token = client.post("/auth/login", data={"username": email, "password": "pass1234"},
+                        headers={"Content-Type": "application/x-www-form-urlencoded"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+def _signup(client, email) -> Dict[str, str]:
+    assert client.post("/auth/signup", json={"email": email, "password": "pass1234"}).status_code == 201
+    return _login(client, email)
+
+
+def _scalar(shard, sql, **params):
+    with database.shard_engine(shard).connect() as conn:
+        return conn.execute(text(sql), params).scalar()
+
+
+def _user_on(client, shard):
+    """Signs users up until one lands on `shard`; returns (id, email, headers)."""
+    for i in range(50):
+        email = f"user{shard}-{i}@example.com"
+        headers = _signup(client, email)
+        user_id = client.get("/auth/me", headers=headers).json()["id"]
+        if database.shard_for_user(user_id) == shard:
+            return user_id, email, headers
+    raise AssertionError(f"nobody hashed to shard {shard}")
+
+
+def test_users_live_on_their_shard(client):
+    placed = {}
+    for shard in (0, 1, 2):
+        user_id, _, headers = _user_on(client, shard)
+        resp = client.post("/ingredients", params={"name": f"Leek {shard}", "shelf_life": 10, "serving_unit": "g"},
+                           headers=headers)
+        assert resp.status_code == 201, resp.text
+        placed[shard] = (user_id, resp.json()["id"])
+
+    for shard, (user_id, ingredient_id) in placed.items():
+        # The directory on shard 0 knows everyone, each shard has its own users' rows
+        assert _scalar(0, "SELECT shard FROM users WHERE id = :id", id=user_id) == shard
+        for other in (0, 1, 2):
+            assert _scalar(other, "SELECT count(*) FROM ingredients WHERE user_id = :id", id=user_id) == (
+                other == shard)
+        # Ids never collide across shards, so rows can move with theirs
+        assert ingredient_id % MAX_SHARDS == shard
+    assert _scalar(1, "SELECT count(*) FROM users") == _scalar(0, "SELECT count(*) FROM users WHERE shard = 1")
+
+
+def test_signup_copies_the_demo_data_across_shards(client, db_session):
+    demo = User(email="demo@demo.com", password_hash="x")
+    db_session.add(demo)
+    db_session.flush()
+    db_session.add(Ingredient(user_id=demo.id, name="Okra", serving_unit="g"))
+    db_session.commit()
+    _, _, headers = _user_on(client, 2)
+    assert jobs.run_pending(database.shard_sessionmaker(2)) == 1
+    assert [i["name"] for i in client.get("/ingredients", headers=headers).json()] == ["Okra"]
+
+
+def test_a_user_not_copied_to_their_shard_is_placed_by_a_job(client, monkeypatch, db_session):
+    demo = User(email="demo@demo.com", password_hash="x")
+    db_session.add(demo)
+    db_session.commit()
+
+    def shard_unreachable(*args):
+        raise OperationalError("INSERT INTO users", {}, Exception("server closed the connection"))
+
+    with monkeypatch.context() as m:
+        m.setattr(shards, "place_user", shard_unreachable)
+        for i in range(50):
+            resp = client.post("/auth/signup", json={"email": f"lost{i}@example.com", "password": "pass1234"})
+            assert resp.status_code == 201
+            user_id = resp.json()["id"]
+            if database.shard_for_user(user_id) == 1:
+                break
+    # In the directory, not yet on the shard
+    assert _scalar(0, "SELECT shard FROM users WHERE id = :id", id=user_id) == 1
+    assert _scalar(1, "SELECT count(*) FROM users WHERE id = :id", id=user_id) == 0
+    headers = _login(client, f"lost{i}@example.com")
+    assert client.get("/auth/me", headers=headers).status_code == 401
+
+    jobs.run_pending(database.shard_sessionmaker(0))
+    assert client.get("/auth/me", headers=headers).json()["id"] == user_id
+    # Copied once, with one demo clone job
+    assert not shards.place_user(db_session, user_id, {"demo_user_id": demo.id, "demo_shard": 0})
+    assert _scalar(1, "SELECT count(*) FROM jobs WHERE user_id = :id AND kind = 'clone_demo_data'", id=user_id) == 1
+
+
+def test_the_global_catalog_is_replicated_to_every_shard(client, engine, db_session):
+    db_session.add(Ingredient(name="Rice", serving_unit="g", energy=130))
+    db_session.commit()
+    with engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO recipes (name, serves, ingredients, instructions, meal_type, is_vegetarian)
+            VALUES ('Global risotto', 1, '[{"name": "Rice", "quantity": 200, "serving_unit": "g"}]', 'Stir',
+                    'dinner', true)
+        """))
+    assert shards.replicate_global_catalog() == [1, 2]
+    # Unchanged copies are left alone
+    assert shards.replicate_global_catalog() == []
+
+    _, _, headers = _user_on(client, 1)
+    recipes = client.get("/recipes", headers=headers).json()
+    assert [(r["name"], r["energy"]) for r in recipes] == [("Global risotto", 260)]
+
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM recipes WHERE user_id IS NULL"))
+        conn.execute(text("UPDATE ingredients SET energy = 100 WHERE user_id IS NULL"))
+    assert shards.replicate_global_catalog() == [1, 2]
+    assert client.get("/recipes", headers=headers).json() == []
+    assert _scalar(2, "SELECT energy FROM ingredients WHERE user_id IS NULL") == 100
+
+
+def test_moving_a_user_keeps_their_data_and_ids(client):
+    user_id, email, headers = _user_on(client, 1)
+    leek = client.post("/ingredients", params={"name": "Leek", "shelf_life": 10, "serving_unit": "g"},
+                       headers=headers).json()["id"]
+    soup = client.post("/recipes", json={
+        "name": "Soup", "serves": 1, "instructions": "Boil", "meal_type": "lunch", "is_vegetarian": True,
+        "ingredients": [{"name": "Leek", "quantity": 100, "serving_unit": "g"}],
+    }, headers=headers).json()["id"]
+    client.put("/weekly-plan", json={"day": "Monday", "meal_type": "lunch", "recipe_ids": [soup]}, headers=headers)
+    cursor = client.get("/sync", headers=headers).json()["cursor"]
+
+    assert shards.move_user(user_id, 2) == {"ingredients": 1, "recipes": 1, "plan_entries": 1, "notifications": 0}
+    assert _scalar(0, "SELECT shard FROM users WHERE id = :id", id=user_id) == 2
+    assert _scalar(1, "SELECT count(*) FROM users WHERE id = :id", id=user_id) == 0
+    assert _scalar(1, "SELECT count(*) FROM sync_tombstones") == 0
+
+    # The old token names the old shard
+    assert client.get("/recipes", headers=headers).status_code == 401
+    headers = _login(client, email)
+    recipe = client.get(f"/recipes/{soup}", headers=headers).json()
+    assert recipe["ingredients"][0]["id"] == leek
+    plan = client.get("/weekly-plan", headers=headers).json()
+    assert plan["Monday"]["lunch"] == [soup]
+    assert client.get("/sync", params={"since": cursor}, headers=headers).json()["full"] is True
+
+    # Back home by hash
+    assert shards.misplaced_users() == [(user_id, 2, 1)]
+    shards.move_user(user_id, 1)
+    assert shards.misplaced_users() == []
+    assert _scalar(2, "SELECT count(*) FROM recipes WHERE user_id = :id", id=user_id) == 0
+    assert _scalar(1, "SELECT count(*) FROM plan_entries WHERE user_id = :id AND plan_date = :d",
+                   id=user_id, d=MONDAY) == 1
@@ -0,0 +1,18 @@
+from profile_startup import import_profile, parse_importtime
+
+
+def test_importtime_output_is_parsed():
+    output = """import time: self [us] | cumulative | imported package
+import time:       120 |        120 |     _io
+import time:      1500 |       1620 |   database
+import time:       300 |       1920 | app
+"""
+    timings = parse_importtime(output)
+    assert [(t.module, t.self_us, t.total_us, t.depth) for t in timings] == [
+        ("_io", 120, 120, 2), ("database", 1500, 1620, 1), ("app", 300, 1920, 0)]
+
+
+def test_pdf_rendering_is_not_loaded_at_startup():
+    modules = {t.module for t in import_profile("app")}
+    assert "routers.plan_router" in modules
+    assert not any(m.split(".")[0] == "pylatex" for m in modules)
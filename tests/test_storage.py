@@ -0,0 +1,17 @@
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, select
+
+import storage
+
+
+def test_upserts_run_on_sqlite():
+    metadata = MetaData()
+    table = Table("counters", metadata, Column("name", String, primary_key=True), Column("value", Integer),
+                  Column("note", String))
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        for value in (1, 2):
+            conn.execute(storage.upsert(conn, table, {"name": "a", "value": value, "note": "new"},
+                                        index_elements=["name"], update=["value"], assign={"note": "updated"}))
+        assert conn.execute(select(table)).all() == [("a", 2, "updated")]
+
@@ -0,0 +1,132 @@
+import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+from routers import sync_router
+
+# Cursors are pg_snapshot_xmin values: a transaction open elsewhere makes the syncs resend rows
+pytestmark = pytest.mark.serial
+
+TODAY = datetime.date.today()
+MONDAY = TODAY - datetime.timedelta(days=TODAY.weekday())
+
+
+def _recipe(test_client, auth_headers, name):
+    return test_client.post("/recipes", json={
+        "name": name, "serves": 1, "instructions": "Chop", "meal_type": "lunch", "is_vegetarian": True,
+        "ingredients": [],
+    }, headers=auth_headers).json()["id"]
+
+
+def _sync(test_client, auth_headers, since=None):
+    resp = test_client.get("/sync", params={"since": since} if since else {}, headers=auth_headers)
+    assert resp.status_code == 200, resp.text
+    return resp.json()
+
+
+def test_sync_returns_only_what_changed_since_the_cursor(engine, test_client: TestClient, auth_headers):
+    salad = _recipe(test_client, auth_headers, "Salad")
+    soup = _recipe(test_client, auth_headers, "Soup")
+    test_client.post("/ingredients", params={"name": "Leek", "shelf_life": 10, "serving_unit": "g"},
+                     headers=auth_headers)
+    test_client.put("/weekly-plan", json={"day": "Monday", "meal_type": "lunch", "recipe_ids": [salad]},
+                    headers=auth_headers)
+    with engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO recipes (name, serves, ingredients, instructions, meal_type, is_vegetarian)
+            VALUES ('Global stew', 4, '[]', 'Stew', 'dinner', true)
+        """))
+
+    first = _sync(test_client, auth_headers)
+    assert first["full"] is True
+    assert sorted(r["name"] for r in first["recipes"]) == ["Global stew", "Salad", "Soup"]
+    assert [i["name"] for i in first["ingredients"]] == ["Leek"]
+    assert first["ingredients"][0]["remaining_shelf_life"] == 10
+    assert [(p["plan_date"], p["recipe_ids"]) for p in first["plan"]] == [(MONDAY.isoformat(), [salad])]
+
+    unchanged = _sync(test_client, auth_headers, first["cursor"])
+    assert unchanged["full"] is False
+    assert (unchanged["recipes"], unchanged["ingredients"], unchanged["plan"]) == ([], [], [])
+    assert unchanged["deleted"] == {"recipes": [], "ingredients": [], "plan": []}
+
+    test_client.put("/weekly-plan", json={"day": "Monday", "meal_type": "lunch", "recipe_ids": [soup]},
+                    headers=auth_headers)
+    test_client.delete(f"/recipes/{salad}", headers=auth_headers)
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM plan_entries"))
+    delta = _sync(test_client, auth_headers, unchanged["cursor"])
+    assert delta["recipes"] == [] and delta["ingredients"] == []
+    assert delta["deleted"] == {
+        "recipes": [salad], "ingredients": [],
+        "plan": [{"plan_date": MONDAY.isoformat(), "meal_type": "lunch"}],
+    }
+    assert _sync(test_client, auth_headers, delta["cursor"])["deleted"]["recipes"] == []
+
+
+def test_every_write_path_bumps_the_row_version(engine, test_client: TestClient, auth_headers):
+    salad = _recipe(test_client, auth_headers, "Salad")
+    cursor = _sync(test_client, auth_headers)["cursor"]
+
+    def versions():
+        with engine.connect() as conn:
+            return conn.execute(text("SELECT row_version, updated_at FROM recipes WHERE id = :id"),
+                                {"id": salad}).one()
+
+    before = versions()
+    # An update that changes nothing keeps the version
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE recipes SET serves = serves"))
+    assert versions() == before
+    assert _sync(test_client, auth_headers, cursor)["recipes"] == []
+
+    # Writes outside the API are picked up as well
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE recipes SET serves = 3"))
+    after = versions()
+    assert after.row_version > before.row_version and after.updated_at >= before.updated_at
+    changed = _sync(test_client, auth_headers, cursor)["recipes"]
+    assert [(r["id"], r["serves"]) for r in changed] == [(salad, 3)]
+
+
+def test_writes_committing_after_a_sync_are_not_missed(engine, test_client: TestClient, auth_headers):
+    cursor = _sync(test_client, auth_headers)["cursor"]
+    user_id = test_client.get("/auth/me", headers=auth_headers).json()["id"]
+
+    # Started before the next sync, committed after it
+    with engine.connect() as slow:
+        slow.begin()
+        slow.execute(text("""
+            INSERT INTO recipes (user_id, name, serves, ingredients, instructions, meal_type, is_vegetarian)
+            VALUES (:u, 'Slow cooked', 2, '[]', 'Wait', 'dinner', false)
+        """), {"u": user_id})
+        during = _sync(test_client, auth_headers, cursor)
+        slow.commit()
+    assert during["recipes"] == []
+
+    after = _sync(test_client, auth_headers, during["cursor"])
+    assert [r["name"] for r in after["recipes"]] == ["Slow cooked"]
+
+
+def test_stale_and_malformed_cursors(test_client: TestClient, auth_headers):
+    _recipe(test_client, auth_headers, "Salad")
+    stale = _sync(test_client, auth_headers, "1.0")
+    # The tombstones may have been purged since: start over
+    assert stale["full"] is True
+    assert [r["name"] for r in stale["recipes"]] == ["Salad"]
+
+    resp = test_client.get("/sync", params={"since": "yesterday"}, headers=auth_headers)
+    assert resp.status_code == 400
+
+
+def test_old_tombstones_are_purged(engine, db_session, test_client: TestClient, auth_headers):
+    test_client.delete(f"/recipes/{_recipe(test_client, auth_headers, 'Salad')}", headers=auth_headers)
+    test_client.delete(f"/recipes/{_recipe(test_client, auth_headers, 'Soup')}", headers=auth_headers)
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE sync_tombstones SET deleted_at = now() - interval '90 days' "
+                          "WHERE entity_key = '{\"id\": 1}'"))
+    sync_router.purge_sync_tombstones(db_session)
+    db_session.commit()
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT entity, entity_key FROM sync_tombstones")).all() == [("recipe", {"id": 2})]
@@ -0,0 +1,67 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+from units import CONVERSIONS, convert_quantities, convert_quantity
+
+
+def test_conversions():
+    assert convert_quantity(2, "cup", "ml") == 480
+    assert convert_quantity(3, "tsp", "tbsp") == 1
+    # Across dimensions with the ingredient's density or piece weight, else not at all
+    assert convert_quantity(2, "tbsp", "g", density=0.92) == pytest.approx(27.6)
+    assert convert_quantity(240, "g", "nos", grams_per_piece=120) == 2
+    assert convert_quantity(1, "nos", "tbsp", density=0.5, grams_per_piece=30) == 4
+    assert convert_quantity(100, "g", "ml") is None
+    assert convert_quantity(100, "g", "handful") is None
+    assert convert_quantities([1, 2, None, 5], ["cup", "tbsp", "g", "g"], "ml", density=2) == [240, 30, None, 2.5]
+
+
+def test_sql_converts_like_python(engine):
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT from_unit, to_unit, factor, density_power, piece_power FROM unit_conversions"))
+        assert {(r[0], r[1]): tuple(r[2:]) for r in rows} == {k: tuple(c) for k, c in CONVERSIONS.items()}
+        for (from_unit, to_unit) in CONVERSIONS:
+            for density, grams_per_piece in ((None, None), (0.8, 50)):
+                converted = conn.execute(text("SELECT convert_quantity(3, :f, :t, :d, :p)"), {
+                    "f": from_unit, "t": to_unit, "d": density, "p": grams_per_piece}).scalar()
+                assert converted == pytest.approx(convert_quantity(3, from_unit, to_unit, density, grams_per_piece))
+
+
+def test_recipe_quantities_are_converted_to_the_ingredients_unit(test_client: TestClient, auth_headers):
+    oil = test_client.post("/ingredients", params={"name": "Olive oil", "shelf_life": 300, "serving_unit": "g"},
+                           headers=auth_headers).json()
+    test_client.put(f"/ingredients/{oil['id']}", params={"energy": 900, "density_g_per_ml": 0.9},
+                    headers=auth_headers)
+    recipe = test_client.post("/recipes", json={
+        "name": "Dressing", "serves": 1, "instructions": "Whisk", "meal_type": "lunch", "is_vegetarian": True,
+        "ingredients": [{"name": "Olive oil", "quantity": 2, "serving_unit": "tbsp"}],
+    }, headers=auth_headers).json()
+    # 2 tbsp = 30 ml = 27 g, at 900 kcal per 100 g
+    assert recipe["energy"] == 243
+
+    # A unit change leaves the recipe as written; its nutrients follow the ingredient
+    test_client.put(f"/ingredients/{oil['id']}", params={"serving_unit": "ml", "serving_size": 100, "energy": 810},
+                    headers=auth_headers)
+    recipe = test_client.get(f"/recipes/{recipe['id']}", headers=auth_headers).json()
+    assert recipe["ingredients"] == [{"id": oil["id"], "name": "Olive oil", "quantity": 2, "serving_unit": "tbsp"}]
+    assert recipe["energy"] == 243
+
+    test_client.put("/weekly-plan", json={"day": "Monday", "meal_type": "lunch", "recipe_ids": [recipe["id"]]},
+                    headers=auth_headers)
+    shopping_list = test_client.get("/utilities/shopping-list", headers=auth_headers).json()
+    assert shopping_list == {"olive oil": {"quantity": 30, "serving_unit": "ml"}}
+
+    # Without a density, spoons do not convert to grams: listed with the quantity in the ingredient's unit
+    salt = test_client.post("/ingredients", params={"name": "Salt", "shelf_life": 300, "serving_unit": "g"},
+                            headers=auth_headers).json()
+    seasoning = test_client.post("/recipes", json={
+        "name": "Seasoning", "serves": 1, "instructions": "Mix", "meal_type": "lunch", "is_vegetarian": True,
+        "ingredients": [{"name": "salt", "quantity": 1, "serving_unit": "tsp"},
+                        {"id": salt["id"], "name": "Salt", "quantity": 5, "serving_unit": "g"}],
+    }, headers=auth_headers).json()
+    test_client.put("/weekly-plan", json={"day": "Monday", "meal_type": "lunch", "recipe_ids": [seasoning["id"]]},
+                    headers=auth_headers)
+    shopping_list = test_client.get("/utilities/shopping-list", headers=auth_headers).json()
+    assert shopping_list == {"salt": {"quantity": 5, "serving_unit": "g",
+                                      "other_units": [{"quantity": 1, "serving_unit": "tsp"}]}}
@@ -148,6 +148,12 @@ def test_get_shopping_list(test_client: TestClient, auth_headers):
     assert "potato" in shopping_list
     assert shopping_list["potato"]["quantity"] == 200
 
+    # Ingredients are matched by id: in stock, or under their new name
+    test_client.put(f"/ingredients/{carrot['id']}", params={"available": True}, headers=auth_headers)
+    test_client.put(f"/ingredients/{potato['id']}", params={"name": "Baby potato"}, headers=auth_headers)
+    shopping_list = test_client.get("/utilities/shopping-list", headers=auth_headers).json()
+    assert list(shopping_list) == ["baby potato"]
+
 def test_plan_and_utilities_unauthorized(test_client: TestClient):
     resp = test_client.get("/weekly-plan")
     assert resp.status_code == 401